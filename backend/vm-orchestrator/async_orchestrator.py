@@ -0,0 +1,783 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial, wraps
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import orchestrator
+from orchestrator import AuthError
+from notifications import format_sse
+from provisioning import QueueFullError
+from http_cache import dumps, etag_matches
+from single_flight import AsyncSingleFlight, IdempotencyConflict, request_fingerprint
+from warm_pool import pool_key
+
+logger = logging.getLogger(__name__)
+
+# Blocking work (boot scheduling, warm pool claims, process teardown) runs here
+# so the event loop only ever waits on sockets
+blocking_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('ASYNC_BLOCKING_WORKERS', 32)),
+    thread_name_prefix='orchestrator-blocking'
+)
+
+mongo = {}
+# Launches in flight on this event loop; the thread-based one in orchestrator covers the Flask server
+launch_flights = AsyncSingleFlight()
+background_tasks = set()
+blocking_in_flight = [0]
+
+
+def blocking_pool_stats():
+    workers = blocking_executor._max_workers
+    return {
+        'workers': workers,
+        'busy': min(blocking_in_flight[0], workers),
+        'queued': max(0, blocking_in_flight[0] - workers)
+    }
+
+
+orchestrator.thread_pools['async_blocking'] = blocking_pool_stats
+
+
+def vms():
+    return mongo['db'].vms
+
+
+def jobs():
+    return mongo['db'].jobs
+
+
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Only the event loop thread touches the counter
+    blocking_in_flight[0] += 1
+    try:
+        return await loop.run_in_executor(blocking_executor, partial(func, *args, **kwargs))
+    finally:
+        blocking_in_flight[0] -= 1
+
+
+def spawn(coro):
+    # Keep a reference so the task is not garbage collected mid-flight
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+class RequestLatencyMiddleware:
+    """Records time to the response headers per route, like the Flask server's hooks"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        recorded = []
+
+        def record(status):
+            # The router stores the matched endpoint in the scope
+            endpoint = scope.get('endpoint')
+            orchestrator.request_latency.observe(time.perf_counter() - started,
+                                                 endpoint.__name__ if endpoint else 'unmatched',
+                                                 scope['method'], str(status))
+            recorded.append(status)
+
+        async def send_recording(event):
+            if event['type'] == 'http.response.start':
+                record(event['status'])
+            await send(event)
+
+        try:
+            await self.app(scope, receive, send_recording)
+        finally:
+            if not recorded:
+                record(500)
+
+
+def message(text, status_code):
+    return JSONResponse({'message': text}, status_code=status_code)
+
+
+def json_response(request, body, etag=None):
+    """orjson-encoded response; a request already holding `etag` gets a 304 instead"""
+    if etag and etag_matches(request.headers.get('If-None-Match'), etag):
+        return not_modified(etag)
+    return Response(dumps(body), media_type='application/json', headers={'ETag': etag} if etag else None)
+
+
+def not_modified(etag):
+    return Response(status_code=304, headers={'ETag': etag})
+
+
+# JWT authentication for Supabase tokens, same rules as the Flask server
+def authenticate(handler):
+    @wraps(handler)
+    async def wrapper(request):
+        auth_header = request.headers.get('Authorization')
+        # Cache hits are a dict lookup; a miss may fetch signing keys, so it runs off the loop
+        current_user = orchestrator.cached_user(auth_header)
+        if current_user is None:
+            try:
+                current_user = await run_blocking(orchestrator.resolve_user, auth_header)
+            except AuthError as e:
+                return message(str(e), 401)
+        return await handler(request, current_user)
+    return wrapper
+
+
+async def root(request):
+    return JSONResponse({
+        'service': 'VM Orchestrator',
+        'status': 'UP',
+        'version': '1.0.0',
+        'mode': 'async'
+    })
+
+
+async def health_check(request):
+    # Cached probes only block when a result is past its staleness bound
+    return JSONResponse(await run_blocking(orchestrator.health_report))
+
+
+@authenticate
+async def launch_vm(request, current_user):
+    try:
+        user_id = current_user['id']
+        try:
+            request_data = await request.json() or {}
+        except ValueError:
+            request_data = {}
+
+        # A retried request with the same Idempotency-Key gets the first response, on any worker
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key:
+            try:
+                stored = await run_blocking(orchestrator.launch_keys.begin, user_id, idempotency_key,
+                                            request_fingerprint(request_data))
+            except IdempotencyConflict as e:
+                return message(str(e), e.status)
+            if stored:
+                return stored_response(stored, replayed=True)
+
+        # Concurrent launches for the same user and config join the one in flight
+        async def lead():
+            return flight_response(await launch(request, current_user, request_data))
+
+        try:
+            response, _ = await launch_flights.do(
+                (user_id, pool_key(orchestrator.build_vm_config(request_data))), lead)
+        except Exception:
+            if idempotency_key:
+                await run_blocking(orchestrator.launch_keys.abandon, user_id, idempotency_key)
+            raise
+        if idempotency_key:
+            await run_blocking(orchestrator.launch_keys.complete, user_id, idempotency_key, response)
+        return stored_response(response)
+
+    except Exception as e:
+        logger.error(f"Error launching VM: {e}")
+        return message('Error launching VM', 500)
+
+
+def flight_response(response):
+    return {
+        'content': response.body.decode(),
+        'status': response.status_code,
+        'content_type': response.media_type,
+        'headers': {name: value for name, value in response.headers.items() if name.lower() == 'retry-after'}
+    }
+
+
+def stored_response(stored, replayed=False):
+    headers = dict(stored.get('headers') or {})
+    if replayed:
+        headers['Idempotent-Replayed'] = 'true'
+    return Response(stored['content'], stored['status'], headers=headers, media_type=stored['content_type'])
+
+
+async def launch(request, current_user, request_data):
+    try:
+        user_id = current_user['id']
+
+        # Check if user already has an active VM
+        existing_vm = await resume_suspended(await find_active_vm(user_id), request.headers.get('Authorization'))
+        if existing_vm:
+            return JSONResponse(*orchestrator.existing_vm_body(existing_vm))
+
+        vm_config = orchestrator.build_vm_config(request_data)
+        placement_header = request.headers.get('X-Placement-Token')
+
+        # A warm pool hit is already booted, so there is no job to wait on
+        warm_vm = None
+        if not placement_header:
+            warm_vm = await run_blocking(orchestrator.warm_pool.acquire, user_id, vm_config)
+        if warm_vm:
+            orchestrator.vm_cache.invalidate(warm_vm['_id'])
+            orchestrator.vm_cache.invalidate_user(user_id)
+            orchestrator.status_hub.publish(warm_vm)
+            return JSONResponse({
+                'message': 'VM is running',
+                'vm_id': str(warm_vm['_id']),
+                'status': 'running',
+                'connection_info': warm_vm['connection_info']
+            })
+
+        try:
+            node, resources = await run_blocking(orchestrator.place_launch, vm_config, placement_header)
+        except orchestrator.PlacementError as e:
+            return JSONResponse({'message': str(e)}, status_code=e.status,
+                                headers={'Retry-After': '5'} if e.status == 503 else None)
+        if node and node['_id'] != orchestrator.NODE_ID:
+            content, status, content_type = await run_blocking(
+                orchestrator.forward_launch, node, request.headers.get('Authorization'), request_data, resources
+            )
+            return Response(content, status, media_type=content_type)
+        node_id = node['_id'] if node else None
+
+        try:
+            result = await vms().insert_one({
+                'user_id': user_id,
+                'config': vm_config,
+                'status': 'starting',
+                'active': True,
+                'node_id': node_id,
+                'resources': resources if node_id else None,
+                'created_at': time.time(),
+                'updated_at': time.time(),
+                'version': 1,
+                'connection_info': None
+            })
+        except DuplicateKeyError:
+            # A concurrent launch for this user got there first
+            await run_blocking(orchestrator.release_placement, node_id, resources)
+            return JSONResponse(*orchestrator.existing_vm_body(await find_active_vm(user_id)))
+        vm_id = str(result.inserted_id)
+        orchestrator.vm_cache.invalidate_user(user_id)
+
+        try:
+            queue_info = await run_blocking(orchestrator.launch_scheduler.submit, vm_id, user_id, vm_config)
+        except QueueFullError as e:
+            logger.warning(f"Rejecting launch for user {user_id}: {e}")
+            await vms().delete_one({'_id': result.inserted_id})
+            orchestrator.vm_cache.invalidate(vm_id, user_id)
+            await run_blocking(orchestrator.release_placement, node_id, resources)
+            retry_after = int(orchestrator.launch_scheduler.snapshot()['boot_estimate_seconds']) or 1
+            return JSONResponse({'message': 'Launch queue is full, please retry shortly'},
+                                status_code=503, headers={'Retry-After': str(retry_after)})
+
+        job_id = await create_job('launch', vm_id, user_id)
+        return JSONResponse({
+            'message': 'VM is starting',
+            'vm_id': vm_id,
+            'job_id': job_id,
+            'status': 'starting',
+            **(queue_info or {})
+        }, status_code=202)
+
+    except Exception as e:
+        logger.error(f"Error launching VM: {e}")
+        return message('Error launching VM', 500)
+
+
+async def find_active_vm(user_id):
+    return await vms().find_one({'user_id': user_id, 'active': True},
+                                {'status': 1, 'connection_info': 1, 'node_id': 1})
+
+
+async def resume_suspended(vm, auth_header):
+    # Resuming reads the saved state from disk, so it runs off the event loop
+    if vm and vm['status'] == 'suspended':
+        vm = await run_blocking(orchestrator.resume_suspended, vm, auth_header)
+    return vm
+
+
+async def cached_vm(vm_id):
+    """VM document from the shared state cache, loaded through Motor on a miss"""
+    vm = orchestrator.vm_cache.peek(vm_id)
+    if vm is None:
+        vm = await vms().find_one({'_id': ObjectId(vm_id)})
+        if vm is not None:
+            orchestrator.vm_cache.store(vm)
+    return vm
+
+
+@authenticate
+async def get_vm_status(request, current_user):
+    vm_id = request.path_params['vm_id']
+    try:
+        # A poll that already holds the current version is answered from memory
+        etag = orchestrator.unchanged_vm(current_user, vm_id, request.headers.get('If-None-Match'))
+        if etag:
+            orchestrator.idle_monitor.touch(vm_id)
+            return not_modified(etag)
+
+        vm = await cached_vm(vm_id)
+
+        if not vm:
+            return message('VM not found', 404)
+
+        if vm['user_id'] != current_user['id'] and current_user['role'] != 'admin':
+            return message('Access denied', 403)
+
+        orchestrator.idle_monitor.touch(vm_id)
+        vm = await resume_suspended(vm, request.headers.get('Authorization'))
+
+        return json_response(request, *orchestrator.vm_status_body(vm_id, vm))
+
+    except Exception as e:
+        logger.error(f"Error getting VM status: {e}")
+        return message('Error retrieving VM status', 500)
+
+
+@authenticate
+async def stop_vm(request, current_user):
+    vm_id = request.path_params['vm_id']
+    try:
+        vm = await cached_vm(vm_id)
+
+        if not vm:
+            return message('VM not found', 404)
+
+        if vm['user_id'] != current_user['id'] and current_user['role'] != 'admin':
+            return message('Access denied', 403)
+
+        if vm['status'] not in ('running', 'suspended'):
+            return message(f"VM is not running (current status: {vm['status']})", 400)
+
+        forwarded = await run_blocking(orchestrator.forward_stop, vm, request.headers.get('Authorization'))
+        if forwarded:
+            content, status, content_type = forwarded
+            return Response(content, status, media_type=content_type)
+
+        job_id = await create_job('stop', vm_id, vm['user_id'])
+        spawn(run_stop(job_id, vm_id))
+        return JSONResponse({'message': 'VM is stopping', 'vm_id': vm_id, 'job_id': job_id}, status_code=202)
+
+    except Exception as e:
+        logger.error(f"Error stopping VM: {e}")
+        return message('Error stopping VM', 500)
+
+
+@authenticate
+async def resume_vm(request, current_user):
+    vm_id = request.path_params['vm_id']
+    try:
+        vm = await cached_vm(vm_id)
+    except InvalidId:
+        vm = None
+    if not vm:
+        return message('VM not found', 404)
+    if vm['user_id'] != current_user['id'] and current_user['role'] != 'admin':
+        return message('Access denied', 403)
+
+    vm = await resume_suspended(vm, request.headers.get('Authorization'))
+    return JSONResponse({'vm_id': vm_id, 'status': vm['status'] if vm else 'stopped'})
+
+
+async def run_stop(job_id, vm_id):
+    try:
+        await run_blocking(orchestrator.terminate_vm, vm_id)
+        await finish_job(job_id, 'succeeded')
+    except Exception as e:
+        logger.error(f"Error stopping VM {vm_id}: {e}")
+        await finish_job(job_id, 'failed', str(e))
+
+
+@authenticate
+async def list_user_vms(request, current_user):
+    try:
+        try:
+            query, projection, limit = orchestrator.vm_page_query(current_user['id'], request.query_params)
+        except (ValueError, InvalidId) as e:
+            return message(str(e), 400)
+
+        # Read before the query, so a write racing it invalidates the memoized ETag
+        user_id = current_user['id']
+        generation = orchestrator.vm_cache.listing_generation(user_id)
+        key = orchestrator.vm_page_key(user_id, request.query_params)
+        etag = orchestrator.vm_page_etags.get(key, generation)
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            return not_modified(etag)
+
+        vms_list = await vms().find(query, {**projection, 'version': 1}).sort('_id', 1).limit(limit + 1) \
+            .to_list(length=None)
+        page, etag = orchestrator.vm_page(vms_list, limit, projection)
+        orchestrator.vm_page_etags.put(key, etag, generation)
+        return json_response(request, page, etag)
+
+    except Exception as e:
+        logger.error(f"Error listing VMs: {e}")
+        return message('Error retrieving VMs', 500)
+
+
+@authenticate
+async def vm_metrics(request, current_user):
+    vm_id = request.path_params['vm_id']
+    try:
+        seconds = orchestrator.parse_duration(request.query_params.get('range', '15m'))
+    except ValueError as e:
+        return message(str(e), 400)
+
+    try:
+        vm = await cached_vm(vm_id)
+    except InvalidId:
+        vm = None
+    if not vm:
+        return message('VM not found', 404)
+    if vm['user_id'] != current_user['id'] and current_user['role'] != 'admin':
+        return message('Access denied', 403)
+
+    path = request.url.path + (f"?{request.url.query}" if request.url.query else '')
+    forwarded = await run_blocking(orchestrator.forward_to_owner, vm, 'GET', path,
+                                   request.headers.get('Authorization'))
+    if forwarded:
+        content, status, content_type = forwarded
+        return Response(content, status, media_type=content_type)
+
+    return JSONResponse(orchestrator.vm_metrics_body(vm_id, seconds))
+
+
+async def vm_stream_info(request):
+    vm_id = request.path_params['vm_id']
+    try:
+        vm = await cached_vm(vm_id)
+    except InvalidId:
+        vm = None
+
+    if not vm or vm['status'] != 'running':
+        return message('VM not running', 404)
+
+    return JSONResponse({
+        'websocket_url': f"{orchestrator.STREAM_PUBLIC_URL}/stream/{vm_id}",
+        'status': 'available',
+        'viewers': len(orchestrator.active_websockets.get(vm_id, ()))
+    })
+
+
+async def vm_events(request):
+    vm_ids = request.query_params.getlist('vm_id')
+    try:
+        user = await run_blocking(orchestrator.subscription_user, request.headers.get('Authorization'), vm_ids)
+    except AuthError as e:
+        return message(str(e), 401)
+    if not user:
+        return message('Access denied', 403)
+
+    hub = orchestrator.status_hub
+    subscription = await run_blocking(
+        hub.subscribe, user, vm_ids,
+        all_owned=not vm_ids or request.query_params.get('all') == '1',
+        last_event_id=request.headers.get('Last-Event-ID') or request.query_params.get('last_event_id')
+    )
+
+    async def stream():
+        try:
+            yield 'retry: 2000\n\n'
+            while True:
+                events = await subscription.wait_async(hub.keepalive)
+                if not events:
+                    yield ': keepalive\n\n'
+                for event in events:
+                    yield format_sse(event)
+        finally:
+            subscription.close()
+
+    return StreamingResponse(stream(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def prometheus_metrics(request):
+    return Response(await run_blocking(orchestrator.metrics.render), media_type=orchestrator.METRICS_CONTENT_TYPE)
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return {}
+
+
+@authenticate
+async def bulk_stop(request, current_user):
+    body, code = await run_blocking(orchestrator.start_bulk_job, 'bulk_stop', current_user,
+                                    await read_json(request), request.headers.get('Authorization'))
+    return JSONResponse(body, status_code=code)
+
+
+@authenticate
+async def bulk_launch(request, current_user):
+    body, code = await run_blocking(orchestrator.start_bulk_job, 'bulk_launch', current_user,
+                                    await read_json(request), request.headers.get('Authorization'))
+    return JSONResponse(body, status_code=code)
+
+
+@authenticate
+async def bulk_job(request, current_user):
+    body, code = await run_blocking(orchestrator.bulk_job_body, request.path_params['job_id'], current_user,
+                                    int(request.query_params.get('offset', 0)))
+    return JSONResponse(body, status_code=code)
+
+
+@authenticate
+async def bulk_job_events(request, current_user):
+    job_id = request.path_params['job_id']
+    body, code = await run_blocking(orchestrator.bulk_job_body, job_id, current_user, with_results=False)
+    if code != 200:
+        return JSONResponse(body, status_code=code)
+    last_event_id = request.headers.get('Last-Event-ID')
+    offset = int(last_event_id) + 1 if last_event_id else int(request.query_params.get('offset', 0))
+    # Each step blocks an executor thread until progress or a keepalive, so
+    # these streams share the same cap as on the threaded server
+    if not orchestrator.open_event_stream():
+        return JSONResponse({'message': 'Too many open event streams, retry shortly'}, status_code=503,
+                            headers={'Retry-After': str(int(orchestrator.status_hub.keepalive))})
+    events = orchestrator.bulk_events(job_id, offset)
+
+    async def stream():
+        try:
+            while not orchestrator.sse_closing.is_set():
+                chunk = await run_blocking(next, events, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            orchestrator.close_event_stream()
+
+    return StreamingResponse(stream(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@authenticate
+async def launch_queue_stats(request, current_user):
+    return JSONResponse(orchestrator.launch_scheduler.snapshot())
+
+
+@authenticate
+async def list_nodes(request, current_user):
+    if current_user['role'] != 'admin':
+        return message('Access denied', 403)
+    nodes = await run_blocking(orchestrator.node_registry.live_nodes)
+    return JSONResponse({
+        'node_id': orchestrator.NODE_ID,
+        'policy': orchestrator.placement_scheduler.policy,
+        'stats': orchestrator.placement_scheduler.stats,
+        'nodes': [{'node_id': node.pop('_id'), **node} for node in nodes]
+    })
+
+
+@authenticate
+async def warm_pool_stats(request, current_user):
+    return JSONResponse(await run_blocking(orchestrator.warm_pool.stats))
+
+
+@authenticate
+async def vm_stream_stats(request, current_user):
+    vm_id = request.path_params['vm_id']
+    if not await run_blocking(orchestrator.authorize_stream, vm_id, request.headers.get('Authorization')):
+        return message('VM not running or access denied', 404)
+    return JSONResponse({'vm_id': vm_id, 'viewers': orchestrator.stream_hub.stats(vm_id)[vm_id]})
+
+
+@authenticate
+async def reconcile_stats(request, current_user):
+    if current_user['role'] != 'admin':
+        return message('Access denied', 403)
+    return JSONResponse(orchestrator.reconciler.snapshot())
+
+
+@authenticate
+async def hypervisor_stats(request, current_user):
+    if current_user['role'] != 'admin':
+        return message('Access denied', 403)
+    return JSONResponse({'driver': orchestrator.VM_DRIVER, **orchestrator.hypervisor.snapshot(),
+                         'network': orchestrator.network.snapshot()})
+
+
+@authenticate
+async def vm_cache_stats(request, current_user):
+    return JSONResponse(orchestrator.vm_cache.snapshot())
+
+
+@authenticate
+async def vm_events_stats(request, current_user):
+    return JSONResponse({**orchestrator.status_hub.snapshot(), 'sse': orchestrator.event_stream_stats()})
+
+
+@authenticate
+async def image_stats(request, current_user):
+    if not orchestrator.image_store:
+        return message('Image store is not enabled', 404)
+    return JSONResponse(orchestrator.image_store.snapshot())
+
+
+@authenticate
+async def idle_stats(request, current_user):
+    return JSONResponse(orchestrator.idle_monitor.snapshot())
+
+
+@authenticate
+async def telemetry_stats(request, current_user):
+    return JSONResponse(orchestrator.telemetry.snapshot())
+
+
+@authenticate
+async def token_cache_stats(request, current_user):
+    return JSONResponse(orchestrator.token_verifier.snapshot())
+
+
+@authenticate
+async def list_snapshots(request, current_user):
+    snapshots = await mongo['db'].snapshots.find(
+        {}, {'config': 1, 'status': 1, 'generation': 1, 'refreshing': 1,
+             'created_at': 1, 'memory_bytes': 1, 'disk_bytes': 1}
+    ).to_list(length=None)
+    return JSONResponse({
+        'snapshots': [{**snapshot, '_id': str(snapshot['_id'])} for snapshot in snapshots],
+        'stats': orchestrator.snapshot_catalog.stats
+    })
+
+
+@authenticate
+async def create_snapshot(request, current_user):
+    if current_user['role'] != 'admin':
+        return message('Access denied', 403)
+    if not orchestrator.SNAPSHOT_RESTORE:
+        return message(f"Snapshots are not supported by the {orchestrator.VM_DRIVER} driver", 409)
+
+    try:
+        request_data = await request.json()
+    except ValueError:
+        request_data = {}
+    config = orchestrator.build_vm_config(request_data or {})
+    job_id = await create_job('snapshot', None, current_user['id'], config=config)
+    spawn(run_snapshot(job_id, config))
+    return JSONResponse({'message': 'Snapshot build started', 'job_id': job_id, 'config': config},
+                        status_code=202)
+
+
+async def run_snapshot(job_id, config):
+    try:
+        await run_blocking(orchestrator.snapshot_catalog.create, config)
+        await finish_job(job_id, 'succeeded')
+    except Exception as e:
+        await finish_job(job_id, 'failed', str(e))
+
+
+# Lifecycle jobs
+
+async def create_job(job_type, vm_id, user_id, **extra):
+    job_id = uuid.uuid4().hex
+    await jobs().insert_one({
+        '_id': job_id,
+        'type': job_type,
+        'vm_id': vm_id,
+        'user_id': user_id,
+        'state': 'pending',
+        'created_at': time.time(),
+        **extra
+    })
+    return job_id
+
+
+async def finish_job(job_id, state, error=None):
+    update = {'state': state, 'finished_at': time.time()}
+    if error:
+        update['error'] = error
+    await jobs().update_one({'_id': job_id}, {'$set': update})
+
+
+@authenticate
+async def get_job(request, current_user):
+    job = await jobs().find_one({'_id': request.path_params['job_id']})
+    if not job:
+        return message('Job not found', 404)
+    if job['user_id'] != current_user['id'] and current_user['role'] != 'admin':
+        return message('Access denied', 403)
+
+    if job['type'] == 'launch' and job['state'] == 'pending':
+        # Launch jobs finish when the provisioning worker moves the VM out of 'starting'
+        vm = await vms().find_one({'_id': ObjectId(job['vm_id'])}, {'status': 1, 'error': 1})
+        if vm and vm['status'] in ('running', 'suspended'):
+            job['state'] = 'succeeded'
+        elif not vm or vm['status'] not in ('starting', 'running'):
+            job['state'] = 'failed'
+            job['error'] = (vm or {}).get('error', 'VM no longer exists')
+
+    job['job_id'] = job.pop('_id')
+    return JSONResponse(job)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # The Motor client must be created inside the server's event loop
+    mongo['client'] = AsyncIOMotorClient(
+        orchestrator.mongo_uri,
+        maxPoolSize=int(os.environ.get('ASYNC_MONGO_POOL_SIZE', 200)),
+        event_listeners=[orchestrator.mongo_metrics]
+    )
+    mongo['db'] = mongo['client'].get_database()
+    orchestrator.start_background_services()
+    logger.info('Async orchestrator started')
+    yield
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    # Boots in flight finish and their status updates are written before the worker exits
+    await run_blocking(orchestrator.drain)
+    mongo['client'].close()
+
+
+routes = [
+    Route('/', root, methods=['GET']),
+    Route('/health', health_check, methods=['GET']),
+    Route('/metrics', prometheus_metrics, methods=['GET']),
+    Route('/launch', launch_vm, methods=['POST']),
+    Route('/launch/queue', launch_queue_stats, methods=['GET']),
+    Route('/vm/{vm_id}', get_vm_status, methods=['GET']),
+    Route('/vm/{vm_id}/stop', stop_vm, methods=['POST']),
+    Route('/vm/{vm_id}/resume', resume_vm, methods=['POST']),
+    Route('/vm/{vm_id}/metrics', vm_metrics, methods=['GET']),
+    Route('/vm/{vm_id}/stream', vm_stream_info, methods=['GET']),
+    Route('/vm/{vm_id}/stream/stats', vm_stream_stats, methods=['GET']),
+    Route('/vms', list_user_vms, methods=['GET']),
+    Route('/vms/events', vm_events, methods=['GET']),
+    Route('/vms/events/stats', vm_events_stats, methods=['GET']),
+    Route('/vms/cache/stats', vm_cache_stats, methods=['GET']),
+    Route('/vms/idle/stats', idle_stats, methods=['GET']),
+    Route('/vms/bulk/stop', bulk_stop, methods=['POST']),
+    Route('/vms/bulk/launch', bulk_launch, methods=['POST']),
+    Route('/vms/bulk/{job_id}', bulk_job, methods=['GET']),
+    Route('/vms/bulk/{job_id}/events', bulk_job_events, methods=['GET']),
+    Route('/pool/stats', warm_pool_stats, methods=['GET']),
+    Route('/nodes', list_nodes, methods=['GET']),
+    Route('/reconcile/stats', reconcile_stats, methods=['GET']),
+    Route('/hypervisor/stats', hypervisor_stats, methods=['GET']),
+    Route('/images/stats', image_stats, methods=['GET']),
+    Route('/telemetry/stats', telemetry_stats, methods=['GET']),
+    Route('/auth/cache/stats', token_cache_stats, methods=['GET']),
+    Route('/snapshots', list_snapshots, methods=['GET']),
+    Route('/snapshots', create_snapshot, methods=['POST']),
+    Route('/jobs/{job_id}', get_job, methods=['GET']),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan, middleware=[Middleware(RequestLatencyMiddleware)])
+
+# Run the ASGI application
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 8084)))
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Rough per-entry overhead of the OrderedDict slot, key and tuple
+ENTRY_OVERHEAD_BYTES = 240
+
+
+class JWKSCache:
+    """Signing keys from a JWKS endpoint, refreshed on a background thread.
+
+    Unknown key ids trigger an immediate refresh, rate limited so a flood of
+    tokens with a bogus kid cannot turn into a flood of JWKS requests.
+    """
+
+    def __init__(self, url, refresh_interval=600.0, min_refresh_interval=30.0, timeout=5.0):
+        self.url = url
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._last_refresh = 0.0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        response = requests.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        keys = {}
+        for jwk in jwt.PyJWKSet.from_dict(response.json()).keys:
+            keys[jwk.key_id] = jwk
+        with self._lock:
+            self._keys = keys
+            self._last_refresh = time.time()
+        logger.info(f"Loaded {len(keys)} signing keys from {self.url}")
+
+    def get(self, kid):
+        with self._lock:
+            jwk = self._keys.get(kid)
+            stale = time.time() - self._last_refresh >= self.min_refresh_interval
+        if jwk is None and stale:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing JWKS: {e}")
+            with self._lock:
+                jwk = self._keys.get(kid)
+        return jwk
+
+    def start(self):
+        if self._thread:
+            return
+
+        def run():
+            while not self._stopping.is_set():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logger.error(f"Error refreshing JWKS: {e}")
+                self._stopping.wait(self.refresh_interval)
+
+        self._thread = threading.Thread(target=run, name='jwks-refresh', daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._stopping.set()
+
+
+class TokenVerifier:
+    """Verifies JWTs and caches the verified claims keyed by token hash.
+
+    Entries live until the token's `exp` (capped at max_ttl) and are evicted
+    least-recently-used once the entry count or estimated memory exceeds its
+    cap, so repeated polls with the same token cost one hash and one dict
+    lookup. HS256 tokens are checked against the shared secret; asymmetric
+    tokens against keys from the JWKS endpoint, when one is configured.
+    """
+
+    def __init__(self, secret, jwks=None, audience=None, max_entries=10000,
+                 max_bytes=16 * 1024 * 1024, max_ttl=300.0):
+        self.secret = secret
+        self.jwks = jwks
+        self.audience = audience
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self._cache = OrderedDict()  # sha256(token) -> (expires_at, claims, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'failures': 0}
+
+    def verify(self, token):
+        """Return verified claims, raising jwt.InvalidTokenError for bad tokens"""
+        key = hashlib.sha256(token.encode()).digest()
+        now = time.time()
+        with self._lock:
+            claims = self._hit(key, now)
+            if claims is not None:
+                return claims
+            self.stats['misses'] += 1
+
+        try:
+            claims = self._decode(token)
+        except jwt.InvalidTokenError:
+            with self._lock:
+                self.stats['failures'] += 1
+            raise
+
+        expires_at = min(claims.get('exp', now + self.max_ttl), now + self.max_ttl)
+        size = ENTRY_OVERHEAD_BYTES + len(key) + len(json.dumps(claims, default=str))
+        with self._lock:
+            if key in self._cache:
+                self._remove(key)
+            self._cache[key] = (expires_at, claims, size)
+            self._bytes += size
+            while self._cache and (len(self._cache) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._cache)))
+                self.stats['evictions'] += 1
+        return claims
+
+    def cached(self, token):
+        """Claims of a token already verified and not expired, else None; never decodes or fetches keys"""
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            return self._hit(key, time.time())
+
+    def _hit(self, key, now):
+        """Cached claims for `key`; called with the lock held"""
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] > now:
+            self._cache.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[1]
+        self._remove(key)
+        self.stats['expired'] += 1
+        return None
+
+    def _remove(self, key):
+        _, _, size = self._cache.pop(key)
+        self._bytes -= size
+
+    def _decode(self, token):
+        header = jwt.get_unverified_header(token)
+        algorithm = header.get('alg')
+        options = {'require': ['sub'], 'verify_aud': self.audience is not None}
+
+        if algorithm == 'HS256':
+            key = self.secret
+        elif self.jwks and algorithm in ('RS256', 'ES256'):
+            jwk = self.jwks.get(header.get('kid'))
+            if jwk is None:
+                raise jwt.InvalidTokenError(f"Unknown signing key {header.get('kid')}")
+            key = jwk.key
+        else:
+            raise jwt.InvalidAlgorithmError(f"Unsupported token algorithm {algorithm}")
+
+        return jwt.decode(token, key, algorithms=[algorithm], audience=self.audience, options=options)
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'hit_rate': round(self.stats['hits'] / lookups, 4) if lookups else None,
+                'entries': len(self._cache),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes
+            }
@@ -0,0 +1,123 @@
+"""Bytes/frame and encode time for the tile-diff pipeline on synthetic screens.
+
+Usage: python benchmarks/frame_pipeline_bench.py [--resolution 1080x1920] [--frames 120] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frame_pipeline import QUALITY_LEVELS, TileDecoder, TileEncoder, parse_resolution  # noqa: E402
+
+
+def base_screen(width, height, rng):
+    # Flat app-like background with text-like noise bands, which is what
+    # tiles and compresses realistically (pure noise would not)
+    screen = np.full((height, width, 4), 240, dtype=np.uint8)
+    for top in range(0, height, 48):
+        band = rng.integers(0, 2, size=(16, width), dtype=np.uint8) * 200
+        screen[top + 16:top + 32, :, :3] = band[:, :, None]
+    screen[..., 3] = 255
+    return screen
+
+
+def static_sequence(width, height, frames, rng):
+    """Home screen with a blinking cursor"""
+    screen = base_screen(width, height, rng)
+    for i in range(frames):
+        frame = screen.copy()
+        if i % 2:
+            frame[100:140, 100:104, :3] = 0
+        yield frame
+
+
+def scrolling_sequence(width, height, frames, rng):
+    """List scrolling by 12 px per frame"""
+    content = base_screen(width, height * 3, rng)
+    for i in range(frames):
+        top = (i * 12) % (content.shape[0] - height)
+        yield np.ascontiguousarray(content[top:top + height])
+
+
+def video_sequence(width, height, frames, rng):
+    """16:9 video playing in the top of an otherwise static screen"""
+    screen = base_screen(width, height, rng)
+    video_height = width * 9 // 16
+    for _ in range(frames):
+        frame = screen.copy()
+        frame[200:200 + video_height, :, :3] = rng.integers(0, 256, size=(video_height, width, 3), dtype=np.uint8)
+        yield frame
+
+
+SEQUENCES = {
+    'static': static_sequence,
+    'scrolling': scrolling_sequence,
+    'video': video_sequence,
+}
+
+
+def run(width, height, frames, levels, tile):
+    results = []
+    raw_bytes = width * height * 4
+    for name, sequence in SEQUENCES.items():
+        for level in levels:
+            rng = np.random.default_rng(42)
+            encoder = TileEncoder(width, height, tile=tile, level=level)
+            decoder = TileDecoder()
+            total_bytes = 0
+            total_dirty = 0
+            encode_seconds = 0.0
+            max_error = 0
+            for frame in sequence(width, height, frames, rng):
+                started = time.perf_counter()
+                packet, dirty = encoder.encode(frame)
+                encode_seconds += time.perf_counter() - started
+                total_bytes += len(packet)
+                total_dirty += dirty
+                decoded = decoder.decode(packet)
+                max_error = max(max_error, int(np.abs(decoded.astype(np.int16) - frame).max()))
+            results.append({
+                'sequence': name,
+                'level': level,
+                'quality': dict(zip(('scale', 'drop_bits', 'zlib_level', 'fps_divisor'), QUALITY_LEVELS[level])),
+                'bytes_per_frame': round(total_bytes / frames),
+                'raw_bytes_per_frame': raw_bytes,
+                'ratio': round(raw_bytes * frames / total_bytes, 1),
+                'dirty_tiles_per_frame': round(total_dirty / frames, 1),
+                'encode_ms_per_frame': round(encode_seconds * 1000 / frames, 3),
+                'max_pixel_error': max_error
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--resolution', default='1080x1920')
+    parser.add_argument('--frames', type=int, default=120)
+    parser.add_argument('--tile', type=int, default=64)
+    parser.add_argument('--levels', default='0,2,4', help='comma-separated QUALITY_LEVELS indices')
+    parser.add_argument('--json', action='store_true', help='print raw JSON results')
+    args = parser.parse_args()
+
+    width, height = parse_resolution(args.resolution)
+    levels = [int(level) for level in args.levels.split(',')]
+    results = run(width, height, args.frames, levels, args.tile)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{args.resolution}, {args.frames} frames, {args.tile}px tiles, raw frame {width * height * 4} bytes")
+    print(f"{'sequence':<10} {'level':>5} {'bytes/frame':>12} {'ratio':>8} {'dirty':>7} {'encode ms':>10} {'max err':>8}")
+    for r in results:
+        print(f"{r['sequence']:<10} {r['level']:>5} {r['bytes_per_frame']:>12} {r['ratio']:>8} "
+              f"{r['dirty_tiles_per_frame']:>7} {r['encode_ms_per_frame']:>10} {r['max_pixel_error']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+"""Launch/poll/stop load test of the orchestrator or the demo app, with latency per route.
+
+Every simulated user runs lifecycle cycles back to back against the service
+loaded in this process: for the orchestrator POST /launch, GET /vm/<id> until
+running, POST /vm/<id>/stop; for the demo app create, start, get and stop,
+polling each job. Boots go to the fake hypervisor driver, which sleeps for the boot time.
+MongoDB is an in-process stand-in (mongomock) unless --mongo names a mongod,
+whose database is dropped before and after the run.
+
+The report has p50/p95/p99 per route, throughput and the process's thread
+and memory high-water marks. --baseline saves it as JSON; --compare checks a
+run against a saved one and exits non-zero on a regression.
+
+Usage: python benchmarks/lifecycle_bench.py [--target orchestrator|demo] [--users 50] [--cycles 3]
+           [--boot-seconds 0.5] [--workers N] [--mongo mongodb://localhost:27017/avmo_bench]
+           [--baseline baseline.json] [--compare baseline.json] [--tolerance 0.2] [--json]
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import ExitStack
+from unittest import mock
+
+import jwt
+import psutil
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEMO_APP = os.path.join(SERVICE_DIR, '..', '..', 'demo-production', 'backend', 'vm-orchestrator', 'app.py')
+SECRET = 'lifecycle-bench-secret-with-at-least-32-characters'
+
+sys.path.insert(0, SERVICE_DIR)
+
+from hypervisor import FakeDriver  # noqa: E402
+
+
+class Recorder:
+    """Latencies per route; a response of 400 or above counts as an error and raises"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def __call__(self, route, call):
+        started = time.perf_counter()
+        try:
+            response = call()
+        except Exception:
+            self._add(route, time.perf_counter() - started, error=True)
+            raise
+        failed = response.status_code >= 400
+        self._add(route, time.perf_counter() - started, error=failed)
+        if failed:
+            raise RuntimeError(f"{route} returned {response.status_code}")
+        return response.get_json()
+
+    def _add(self, route, seconds, error):
+        with self._lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            if error:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+
+class ResourceSampler:
+    """Thread count and RSS of this process, sampled in the background; keeps the peaks"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak_threads = 0
+        self.peak_rss = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='bench-sampler', daemon=True)
+
+    def sample(self):
+        self.peak_threads = max(self.peak_threads, self.process.num_threads())
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+        self.sample()
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an ascending list"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def wait_until(poll, done, poll_interval, timeout, what):
+    deadline = time.time() + timeout
+    while True:
+        result = poll()
+        if done(result):
+            return result
+        if time.time() > deadline:
+            raise TimeoutError(f"{what} did not finish within {timeout}s")
+        time.sleep(poll_interval)
+
+
+def orchestrator_target(hypervisor, workers):
+    """Load orchestrator.py with its boots going to `hypervisor`; returns (app, cycle, stop)"""
+    if workers:
+        os.environ['PROVISION_WORKERS'] = str(workers)
+    os.environ.setdefault('WARM_POOL_MIN', '0')
+    import orchestrator
+
+    driver = orchestrator.hypervisor
+    orchestrator.hypervisor = hypervisor
+    orchestrator.status_writer.start()
+    orchestrator.launch_scheduler.start()
+
+    def cycle(client, user_id, record, poll_interval, timeout):
+        token = jwt.encode({'sub': user_id, 'role': 'user'}, orchestrator.app.config['SECRET_KEY'], algorithm='HS256')
+        headers = {'Authorization': f"Bearer {token}"}
+        vm_id = record('POST /launch', lambda: client.post('/launch', json={}, headers=headers))['vm_id']
+        status = wait_until(
+            lambda: record('GET /vm/<id>', lambda: client.get(f'/vm/{vm_id}', headers=headers))['status'],
+            lambda status: status not in ('starting', 'suspended'), poll_interval, timeout, f"VM {vm_id} boot")
+        if status != 'running':
+            raise RuntimeError(f"VM {vm_id} ended up {status}")
+        record('POST /vm/<id>/stop', lambda: client.post(f'/vm/{vm_id}/stop', headers=headers))
+
+    def stop():
+        orchestrator.launch_scheduler.shutdown()
+        orchestrator.status_writer.shutdown()
+        orchestrator.hypervisor = driver
+
+    return orchestrator.app, cycle, stop
+
+
+def demo_target(hypervisor, workers):
+    """Load the demo app with its transitions taking the boot time; returns (app, cycle, stop)"""
+    if workers:
+        os.environ['LIFECYCLE_WORKERS'] = str(workers)
+    os.environ['SIMULATED_TRANSITION_SECONDS'] = str(hypervisor.boot_seconds)
+    spec = importlib.util.spec_from_file_location('demo_app', DEMO_APP)
+    demo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(demo)
+    demo.init_db()
+
+    def cycle(client, user_id, record, poll_interval, timeout):
+        headers = {'Authorization': f"Bearer {jwt.encode({'id': user_id}, demo.jwt_secret, algorithm='HS256')}"}
+
+        def finish(job_id):
+            job = wait_until(lambda: record('GET /jobs/<id>', lambda: client.get(f'/jobs/{job_id}', headers=headers)),
+                             lambda job: job['state'] != 'pending', poll_interval, timeout, f"Job {job_id}")
+            if job['state'] != 'succeeded':
+                raise RuntimeError(f"Job {job_id} {job['state']}: {job.get('error')}")
+
+        vm = record('POST /vms', lambda: client.post('/vms', json={'name': user_id, 'os': 'Android'}, headers=headers))
+        finish(vm['jobId'])
+        finish(record('POST /vms/<id>/start',
+                      lambda: client.post(f"/vms/{vm['id']}/start", headers=headers))['jobId'])
+        record('GET /vms/<id>', lambda: client.get(f"/vms/{vm['id']}", headers=headers))
+        finish(record('POST /vms/<id>/stop',
+                      lambda: client.post(f"/vms/{vm['id']}/stop", headers=headers))['jobId'])
+
+    return demo.app, cycle, lambda: demo.lifecycle_executor.shutdown(wait=True)
+
+
+TARGETS = {'orchestrator': orchestrator_target, 'demo': demo_target}
+
+
+def run(target='orchestrator', users=50, cycles=3, boot_seconds=0.5, workers=None, mongo=None,
+        poll_interval=0.05, timeout=120.0):
+    """Run the load test and return its report"""
+    os.environ.setdefault('JWT_SECRET', SECRET)
+    os.environ['VM_BOOT_SECONDS'] = str(boot_seconds)
+    hypervisor = FakeDriver(boot_seconds, jitter=0.2)
+    recorder = Recorder()
+    sampler = ResourceSampler()
+    outcomes = {'completed': 0, 'failed': 0}
+    outcome_lock = threading.Lock()
+
+    with ExitStack() as stack:
+        if mongo:
+            import pymongo
+            database = pymongo.MongoClient(mongo).get_database()
+            database.client.drop_database(database.name)
+            stack.callback(database.client.drop_database, database.name)
+        else:
+            import mongomock
+            stack.enter_context(mock.patch('pymongo.MongoClient', mongomock.MongoClient))
+        uri = mongo or 'mongodb://localhost:27017/avmo_bench'
+        os.environ.setdefault('DB_CONNECTION_STRING', uri)
+        os.environ.setdefault('MONGO_URI', uri)
+        # Configured first, so the services' own INFO setup (a log line per launch) does not apply
+        logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        app, cycle, stop = TARGETS[target](hypervisor, workers)
+        stack.callback(stop)
+
+        def user(index):
+            client = app.test_client()
+            for _ in range(cycles):
+                try:
+                    cycle(client, f'bench-user-{index}', recorder, poll_interval, timeout)
+                    outcome = 'completed'
+                except Exception as e:
+                    logging.getLogger(__name__).warning(f"User {index} cycle failed: {e}")
+                    outcome = 'failed'
+                with outcome_lock:
+                    outcomes[outcome] += 1
+
+        threads = [threading.Thread(target=user, args=(i,), name=f'bench-user-{i}') for i in range(users)]
+        sampler.start()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - started
+        sampler.stop()
+
+
+    routes = {}
+    for route, latencies in sorted(recorder.latencies.items()):
+        ordered = sorted(latencies)
+        routes[route] = {
+            'count': len(ordered),
+            'errors': recorder.errors.get(route, 0),
+            **{f'p{q}_ms': round(percentile(ordered, q / 100) * 1000, 3) for q in (50, 95, 99)},
+            'max_ms': round(ordered[-1] * 1000, 3)
+        }
+    requests_made = sum(route['count'] for route in routes.values())
+    return {
+        'target': target,
+        'users': users,
+        'cycles': cycles,
+        'boot_seconds': boot_seconds,
+        'mongo': 'mongod' if mongo else 'in-process',
+        'duration_seconds': round(duration, 3),
+        'cycles_completed': outcomes['completed'],
+        'cycles_failed': outcomes['failed'],
+        'requests': requests_made,
+        'throughput_rps': round(requests_made / duration, 1),
+        'cycles_per_second': round(outcomes['completed'] / duration, 2),
+        'peak_threads': sampler.peak_threads,
+        'peak_rss_mb': round(sampler.peak_rss / 1024 ** 2, 1),
+        # The demo app simulates its transitions itself
+        'peak_concurrent_boots': hypervisor.stats['peak_booting'] if hypervisor.stats['ready'] else None,
+        'routes': routes
+    }
+
+
+def compare(report, baseline, tolerance=0.2):
+    """Regressions of `report` against `baseline`: slower p95/p99 per route, lower throughput, more memory"""
+    regressions = []
+    for key in ('target', 'users', 'cycles', 'boot_seconds', 'mongo'):
+        if report[key] != baseline.get(key):
+            regressions.append(f"{key} differs from the baseline ({report[key]} vs {baseline.get(key)}); "
+                               f"results are not comparable")
+    for route, base in baseline.get('routes', {}).items():
+        current = report['routes'].get(route)
+        if current is None:
+            regressions.append(f"{route}: no requests in this run")
+            continue
+        for key in ('p95_ms', 'p99_ms'):
+            if current[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{route} {key}: {current[key]} > {base[key]} baseline")
+    if report['throughput_rps'] < baseline['throughput_rps'] * (1 - tolerance):
+        regressions.append(f"throughput_rps: {report['throughput_rps']} < {baseline['throughput_rps']} baseline")
+    if report['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + tolerance):
+        regressions.append(f"peak_rss_mb: {report['peak_rss_mb']} > {baseline['peak_rss_mb']} baseline")
+    if report['cycles_failed'] > baseline.get('cycles_failed', 0):
+        regressions.append(f"cycles_failed: {report['cycles_failed']} > {baseline.get('cycles_failed', 0)} baseline")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--target', default='orchestrator', choices=sorted(TARGETS))
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--cycles', type=int, default=3, help='lifecycle cycles per user')
+    parser.add_argument('--boot-seconds', type=float, default=0.5, help='fake hypervisor boot time')
+    parser.add_argument('--workers', type=int, help='provisioning/lifecycle worker threads')
+    parser.add_argument('--mongo', help='MongoDB URI to use instead of the in-process stand-in')
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--baseline', help='write the report to this JSON file')
+    parser.add_argument('--compare', help='compare against this baseline JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    parser.add_argument('--json', action='store_true', help='print the raw JSON report')
+    args = parser.parse_args()
+
+    report = run(args.target, args.users, args.cycles, args.boot_seconds, args.workers, args.mongo,
+                 args.poll_interval)
+    if args.baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{report['target']}: {report['users']} users x {report['cycles']} cycles, "
+              f"boot {report['boot_seconds']}s, {report['mongo']} Mongo")
+        print(f"{report['cycles_completed']} cycles ({report['cycles_failed']} failed) in "
+              f"{report['duration_seconds']}s: {report['throughput_rps']} req/s, "
+              f"{report['cycles_per_second']} cycles/s")
+        print(f"peak threads {report['peak_threads']}, peak RSS {report['peak_rss_mb']} MB"
+              + (f", peak concurrent boots {report['peak_concurrent_boots']}"
+                 if report['peak_concurrent_boots'] is not None else ''))
+        print(f"{'route':<22} {'count':>7} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for route, r in report['routes'].items():
+            print(f"{route:<22} {r['count']:>7} {r['errors']:>7} {r['p50_ms']:>9} {r['p95_ms']:>9} "
+                  f"{r['p99_ms']:>9} {r['max_ms']:>9}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Run several orchestrator processes on one machine as stand-in hosts and show where launches land.
+
+Every process registers as its own node (NODE_ID/NODE_URL) with the capacity
+given on the command line, so placement policies can be exercised without
+real hosts. All nodes share one MongoDB, which must be a real mongod.
+
+Usage: python benchmarks/local_cluster.py --mongo mongodb://localhost:27017/avmo_cluster
+           [--nodes 3] [--cpu 8] [--memory-mb 16384] [--policy spread] [--launches 10]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import jwt
+import requests
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = 'local-cluster-secret-with-at-least-32-characters'
+
+
+def start_cluster(mongo_uri, nodes=3, base_port=18100, cpu=8, memory_mb=16384, policy='spread', extra_env=None):
+    """Start `nodes` orchestrator processes; returns (processes, base URLs) once all answer /health"""
+    processes, urls = [], []
+    for i in range(nodes):
+        port = base_port + 2 * i
+        env = {
+            **os.environ,
+            'JWT_SECRET': SECRET,
+            'DB_CONNECTION_STRING': mongo_uri,
+            'PORT': str(port),
+            'STREAM_PORT': str(port + 1),
+            'NODE_ID': f'node-{i}',
+            'NODE_URL': f'http://127.0.0.1:{port}',
+            'NODE_CPU_CORES': str(cpu),
+            'NODE_MEMORY_MB': str(memory_mb),
+            'NODE_HEARTBEAT_SECONDS': '1',
+            'PLACEMENT_POLICY': policy,
+            'VM_BOOT_SECONDS': '0',
+            'WARM_POOL_MIN': '0',
+            **(extra_env or {})
+        }
+        processes.append(subprocess.Popen([sys.executable, 'orchestrator.py'], cwd=SERVICE_DIR, env=env,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        urls.append(f'http://127.0.0.1:{port}')
+
+    deadline = time.time() + 30
+    for url in urls:
+        while True:
+            try:
+                requests.get(f'{url}/health', timeout=1)
+                break
+            except requests.ConnectionError:
+                if time.time() > deadline:
+                    stop_cluster(processes)
+                    raise RuntimeError(f'Orchestrator at {url} did not start')
+                time.sleep(0.2)
+    return processes, urls
+
+
+def stop_cluster(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait(timeout=10)
+
+
+def token(user_id):
+    return jwt.encode({'sub': user_id, 'email': f'{user_id}@example.com', 'role': 'user'}, SECRET, algorithm='HS256')
+
+
+def launch(url, user_id, config=None):
+    return requests.post(f'{url}/launch', json=config or {},
+                         headers={'Authorization': f'Bearer {token(user_id)}'}, timeout=15)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mongo', required=True, help='MongoDB URI (the database is dropped afterwards)')
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--cpu', type=int, default=8)
+    parser.add_argument('--memory-mb', type=int, default=16384)
+    parser.add_argument('--policy', default='spread', choices=['spread', 'pack'])
+    parser.add_argument('--launches', type=int, default=10)
+    args = parser.parse_args()
+
+    import pymongo
+    db = pymongo.MongoClient(args.mongo).get_database()
+    db.client.drop_database(db.name)
+    processes, urls = start_cluster(args.mongo, args.nodes, cpu=args.cpu, memory_mb=args.memory_mb,
+                                    policy=args.policy)
+    try:
+        statuses = Counter()
+        for i in range(args.launches):
+            # Every request enters through the first node; placement decides where it runs
+            statuses[launch(urls[0], f'user-{i}').status_code] += 1
+        time.sleep(1)
+        placed = Counter(vm.get('node_id') for vm in db.vms.find({}, {'node_id': 1}))
+        nodes = {node['_id']: node['free'] for node in db.nodes.find()}
+        print(json.dumps({'responses': statuses, 'vms_per_node': placed, 'free': nodes}, indent=2, default=str))
+    finally:
+        stop_cluster(processes)
+        db.client.drop_database(db.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Startup cost of the orchestrator: cold import, slowest imports, and worker spawn from a preloaded app.
+
+A cold start imports orchestrator in a fresh interpreter, as `python
+orchestrator.py` or a non-preloading server worker does; the report checks
+that the import opens no Mongo client and starts no thread, which is what
+makes forking from a preloaded master safe. A preloaded spawn forks this
+process after importing the app, as gunicorn's preload_app does, and times
+the child until it has answered GET / (which, unlike /health, needs no
+Mongo). Mongo is never contacted: the connection string points at a
+closed port.
+
+Usage: python benchmarks/startup_bench.py [--runs 5] [--forks 20] [--top 10] [--json]
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENV = {
+    'JWT_SECRET': 'startup-bench-secret-with-at-least-32-characters',
+    'DB_CONNECTION_STRING': 'mongodb://127.0.0.1:1/avmo_startup_bench',
+}
+
+IMPORT_PROBE = """
+import json, sys, threading, time
+started = time.perf_counter()
+import orchestrator
+print(json.dumps({
+    'seconds': time.perf_counter() - started,
+    'modules': len(sys.modules),
+    'threads': threading.active_count(),
+    'mongo_connected': orchestrator.mongo_clients.connected(),
+}))
+"""
+
+
+def cold_imports(runs):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', IMPORT_PROBE], cwd=SERVICE_DIR, env={**os.environ, **ENV},
+                                capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return samples
+
+
+def slowest_imports(top):
+    """Modules orchestrator imports directly, by cumulative import time, from -X importtime"""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import orchestrator'], cwd=SERVICE_DIR,
+                            env={**os.environ, **ENV}, capture_output=True, text=True, check=True).stderr
+    # Lines come after the imports they triggered, indented two spaces per level
+    children = {}
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)', line)
+        if not match:
+            continue
+        depth = len(match.group(2)) // 2
+        if depth == 0:
+            if match.group(3) == 'orchestrator':
+                break
+            children = {}
+        elif depth == 1:
+            children[match.group(3)] = int(match.group(1)) / 1e6
+    return sorted(children.items(), key=lambda item: -item[1])[:top]
+
+
+def preloaded_spawns(forks):
+    """Fork-to-first-response of workers forked from a process that has imported the app"""
+    os.environ.update(ENV)
+    sys.path.insert(0, SERVICE_DIR)
+    import orchestrator
+    samples = []
+    for _ in range(forks):
+        read_end, write_end = os.pipe()
+        started = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            status = 1
+            try:
+                client = orchestrator.app.test_client()
+                response = client.get('/')
+                os.write(write_end, f"{time.perf_counter() - started} {response.status_code}".encode())
+                status = 0
+            finally:
+                os._exit(status)
+        os.close(write_end)
+        with os.fdopen(read_end) as f:
+            seconds, status = f.read().split()
+        os.waitpid(pid, 0)
+        if status != '200':
+            raise RuntimeError(f"GET / returned {status} in a forked worker")
+        samples.append(float(seconds))
+    return samples
+
+
+def summary(samples):
+    ordered = sorted(samples)
+    return {
+        'p50_ms': round(1000 * statistics.median(ordered), 2),
+        'max_ms': round(1000 * ordered[-1], 2),
+        'mean_ms': round(1000 * statistics.mean(ordered), 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5, help='cold imports, each in a new interpreter')
+    parser.add_argument('--forks', type=int, default=20, help='workers forked from the preloaded app')
+    parser.add_argument('--top', type=int, default=10, help='slowest imports to list')
+    parser.add_argument('--json', action='store_true', help='print the raw JSON report')
+    args = parser.parse_args()
+
+    cold = cold_imports(args.runs)
+    report = {
+        'cold_import': summary([sample['seconds'] for sample in cold]),
+        'modules_loaded': cold[-1]['modules'],
+        'threads_after_import': max(sample['threads'] for sample in cold),
+        'mongo_connected_at_import': any(sample['mongo_connected'] for sample in cold),
+        'slowest_imports': [{'module': name, 'ms': round(1000 * seconds, 1)}
+                            for name, seconds in slowest_imports(args.top)],
+    }
+    if hasattr(os, 'fork'):
+        report['preloaded_spawn'] = summary(preloaded_spawns(args.forks))
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"cold import: p50 {report['cold_import']['p50_ms']} ms, max {report['cold_import']['max_ms']} ms "
+              f"({report['modules_loaded']} modules)")
+        print(f"after import: {report['threads_after_import']} thread(s), Mongo "
+              f"{'connected' if report['mongo_connected_at_import'] else 'not connected'}")
+        if 'preloaded_spawn' in report:
+            print(f"preloaded worker to first response: p50 {report['preloaded_spawn']['p50_ms']} ms, "
+                  f"max {report['preloaded_spawn']['max_ms']} ms")
+        print(f"{'slowest imports':<24} {'ms':>8}")
+        for entry in report['slowest_imports']:
+            print(f"{entry['module']:<24} {entry['ms']:>8}")
+    # Forking from a master that holds a connection or threads is unsafe
+    sys.exit(1 if report['mongo_connected_at_import'] or report['threads_after_import'] > 1 else 0)
+
+
+if __name__ == '__main__':
+    main()
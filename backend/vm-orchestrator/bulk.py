@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from bson.objectid import ObjectId
+
+from telemetry import parse_duration
+
+logger = logging.getLogger(__name__)
+
+SELECTOR_KEYS = ('vm_ids', 'user_id', 'status', 'node_id', 'older_than', 'all')
+
+
+def selector_query(selector):
+    """Mongo query for a bulk selector, e.g. {"user_id": "u1"} or {"status": "running", "older_than": "2h"}.
+
+    Criteria combine with AND; `older_than` applies to the VM's last status
+    change. An empty selector is refused unless it says {"all": true}.
+    """
+    if not isinstance(selector, dict):
+        raise ValueError('selector must be an object')
+    unknown = set(selector) - set(SELECTOR_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown selector keys: {', '.join(sorted(unknown))}")
+
+    query = {}
+    if selector.get('vm_ids'):
+        query['_id'] = {'$in': [ObjectId(vm_id) for vm_id in selector['vm_ids']]}
+    if selector.get('user_id'):
+        query['user_id'] = selector['user_id']
+    if selector.get('status'):
+        status = selector['status']
+        query['status'] = {'$in': list(status)} if isinstance(status, list) else status
+    if selector.get('node_id'):
+        query['node_id'] = selector['node_id']
+    if selector.get('older_than'):
+        query['updated_at'] = {'$lt': time.time() - parse_duration(selector['older_than'])}
+    if not query and selector.get('all') is not True:
+        raise ValueError('selector matches every VM; pass {"all": true} to mean that')
+    if selector.get('all') is not True:
+        # Warm pool VMs belong to no user and are managed by the pool
+        query.setdefault('user_id', {'$ne': None})
+    return query
+
+
+class BulkJob:
+    """Progress of one bulk operation.
+
+    Per-VM results are appended in memory, where watchers in this process are
+    woken directly, and written to the job's document in `jobs` in batches
+    ($push/$inc), where watchers on other workers pick them up.
+    """
+
+    def __init__(self, collection, job_id, flush_interval=0.5):
+        self.collection = collection
+        self.job_id = job_id
+        self.flush_interval = flush_interval
+        self.results = []
+        self.counts = {}
+        self.state = 'running'
+        self._flushed = 0
+        self._flushed_at = time.time()
+        self._cond = threading.Condition()
+
+    def record(self, vm_id, outcome, error=None):
+        result = {'vm_id': str(vm_id), 'outcome': outcome}
+        if error:
+            result['error'] = error
+        with self._cond:
+            self.results.append(result)
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+            self._cond.notify_all()
+        if time.time() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self._cond:
+            pending = self.results[self._flushed:]
+            self._flushed = len(self.results)
+            self._flushed_at = time.time()
+        if not pending:
+            return
+        counts = {}
+        for result in pending:
+            counts[f"counts.{result['outcome']}"] = counts.get(f"counts.{result['outcome']}", 0) + 1
+        self.collection.update_one({'_id': self.job_id},
+                                   {'$push': {'results': {'$each': pending}}, '$inc': counts})
+
+    def finish(self, state, error=None):
+        self.flush()
+        update = {'state': state, 'finished_at': time.time()}
+        if error:
+            update['error'] = error
+        self.collection.update_one({'_id': self.job_id}, {'$set': update})
+        with self._cond:
+            self.state = state
+            self._cond.notify_all()
+
+    def wait(self, offset, timeout):
+        """Results from `offset` on (blocking up to `timeout` for new ones) and the job state"""
+        with self._cond:
+            if len(self.results) <= offset and self.state == 'running':
+                self._cond.wait(timeout)
+            return self.results[offset:], self.state
+
+
+class BulkRunner:
+    """Runs bulk jobs: the selected VMs are handed to `process_batch(job, batch, parallel)`
+    in batches, where `parallel(func, items)` runs func over items on the job's
+    bounded thread pool and returns [(item, result, exception)]."""
+
+    def __init__(self, collection, concurrency=8, batch_size=100, max_vms=10000, retention=3600.0):
+        self.collection = collection
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_vms = max_vms
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._jobs = {}  # job_id -> BulkJob run by this process
+
+    def start(self, job_type, user_id, selector, vms, process_batch):
+        job_id = uuid.uuid4().hex
+        self.collection.insert_one({
+            '_id': job_id,
+            'type': job_type,
+            'user_id': user_id,
+            'selector': selector,
+            'state': 'running',
+            'total': len(vms),
+            'counts': {},
+            'results': [],
+            'created_at': time.time()
+        })
+        job = BulkJob(self.collection, job_id)
+        with self._lock:
+            self._prune()
+            self._jobs[job_id] = job
+        threading.Thread(target=self._run, args=(job, vms, process_batch),
+                         name=f"bulk-{job_type}-{job_id[:8]}", daemon=True).start()
+        return job_id
+
+    def _run(self, job, vms, process_batch):
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='bulk-worker') as executor:
+            def parallel(func, items):
+                futures = [(item, executor.submit(func, item)) for item in items]
+                outcomes = []
+                for item, future in futures:
+                    try:
+                        outcomes.append((item, future.result(), None))
+                    except Exception as e:
+                        outcomes.append((item, None, e))
+                return outcomes
+
+            try:
+                for start in range(0, len(vms), self.batch_size):
+                    process_batch(job, vms[start:start + self.batch_size], parallel)
+            except Exception as e:
+                logger.error(f"Bulk job {job.job_id} failed: {e}")
+                job.finish('failed', str(e))
+                return
+        job.finish('succeeded' if not job.counts.get('failed') else 'completed_with_errors')
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        for job_id, job in list(self._jobs.items()):
+            if job.state != 'running' and job._flushed_at < cutoff:
+                del self._jobs[job_id]
+
+    def get(self, job_id, offset=0, with_results=True):
+        job = self.collection.find_one({'_id': job_id}, {'results': 0})
+        if job and with_results:
+            page = self.collection.find_one({'_id': job_id}, {'_id': 1, 'results': {'$slice': [offset, self.max_vms]}})
+            job['results'] = (page or {}).get('results', [])
+        return job
+
+    def wait(self, job_id, offset, timeout):
+        """New results from `offset` on and the job state; None when there is no such job"""
+        job = self._jobs.get(job_id)
+        if job:
+            return job.wait(offset, timeout)
+        # Run by another worker: read what it has flushed so far
+        doc = self.get(job_id, offset)
+        if doc is None:
+            return None
+        results = doc.get('results', [])
+        if not results and doc['state'] == 'running':
+            time.sleep(min(timeout, 0.5))
+        return results, doc['state']
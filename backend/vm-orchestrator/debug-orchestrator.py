@@ -1,7 +1,14 @@
 from flask import Flask, jsonify, request
 import json
+import os
 import time
 import random
+import sys
+
+import psutil
+
+import fleet_sim
+from telemetry import TelemetryCollector
 
 app = Flask(__name__)
 
@@ -19,14 +26,59 @@ mock_vms = {
         'vnc_port': 5900,
         'created_at': '2025-07-19T10:30:00Z',
         'performance': {
-            'cpu_usage': random.randint(20, 80),
-            'memory_usage': random.randint(40, 90),
-            'network_rx': random.randint(100, 1000),
-            'network_tx': random.randint(50, 500)
+            'cpu_usage': 0,
+            'memory_usage': 0,
+            'network_rx': 0,
+            'network_tx': 0
         }
     }
 }
 
+# Templates offered for new VMs; the fleet simulator sizes sessions from them
+VM_TEMPLATES = [
+    {
+        'id': 'android-enterprise',
+        'name': 'Android Enterprise',
+        'description': 'Secure Android environment for business apps',
+        'architecture': 'arm64',
+        'cpu_cores': 4,
+        'memory_mb': 4096,
+        'disk_gb': 32,
+        'features': ['TPM 2.0', 'Secure Boot', 'Disk Encryption']
+    },
+    {
+        'id': 'android-standard',
+        'name': 'Android Standard',
+        'description': 'Standard Android environment',
+        'architecture': 'arm64',
+        'cpu_cores': 2,
+        'memory_mb': 2048,
+        'disk_gb': 16,
+        'features': ['Basic Security', 'App Isolation']
+    }
+]
+
+# Mock VMs have no process of their own; this service stands in for each
+# running one, so their performance figures are real samples of it
+debug_process = psutil.Process()
+
+def telemetry_targets():
+    interface = os.environ.get('DEBUG_VM_INTERFACE')
+    return [(vm_id, debug_process, interface) for vm_id, vm in list(mock_vms.items()) if vm['status'] == 'running']
+
+telemetry = TelemetryCollector(telemetry_targets, interval=float(os.environ.get('TELEMETRY_INTERVAL_SECONDS', 5)))
+
+def performance(vm):
+    sample = telemetry.latest(vm['id'])
+    if not sample:
+        return {'cpu_usage': 0, 'memory_usage': 0, 'network_rx': 0, 'network_tx': 0}
+    return {
+        'cpu_usage': round(sample['cpu_percent'], 1),
+        'memory_usage': round(100 * sample['rss_bytes'] / (vm['memory_mb'] * 1024 * 1024), 1),
+        'network_rx': round(sample['net_rx_bps']),
+        'network_tx': round(sample['net_tx_bps'])
+    }
+
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({
@@ -112,12 +164,7 @@ def vm_status(vm_id):
         # Update performance metrics
         vm = mock_vms[vm_id]
         if vm['status'] == 'running':
-            vm['performance'] = {
-                'cpu_usage': random.randint(20, 80),
-                'memory_usage': random.randint(40, 90),
-                'network_rx': random.randint(100, 1000),
-                'network_tx': random.randint(50, 500)
-            }
+            vm['performance'] = performance(vm)
         
         return jsonify({
             'success': True,
@@ -128,36 +175,37 @@ def vm_status(vm_id):
 
 @app.route('/api/vm/templates', methods=['GET'])
 def vm_templates():
-    templates = [
-        {
-            'id': 'android-enterprise',
-            'name': 'Android Enterprise',
-            'description': 'Secure Android environment for business apps',
-            'architecture': 'arm64',
-            'cpu_cores': 4,
-            'memory_mb': 4096,
-            'disk_gb': 32,
-            'features': ['TPM 2.0', 'Secure Boot', 'Disk Encryption']
-        },
-        {
-            'id': 'android-standard',
-            'name': 'Android Standard',
-            'description': 'Standard Android environment',
-            'architecture': 'arm64',
-            'cpu_cores': 2,
-            'memory_mb': 2048,
-            'disk_gb': 16,
-            'features': ['Basic Security', 'App Isolation']
-        }
-    ]
-    
     return jsonify({
         'success': True,
-        'templates': templates
+        'templates': VM_TEMPLATES
     })
 
+@app.route('/api/sim/run', methods=['POST'])
+def run_simulation():
+    """Replay a trace (or a synthetic day) against the fleet in virtual time"""
+    data = request.get_json() or {}
+    sessions = data.get('trace') or fleet_sim.synthetic_trace(
+        VM_TEMPLATES,
+        hours=float(data.get('hours', 24)),
+        sessions_per_hour=float(data.get('sessions_per_hour', 60)),
+        peak_ratio=float(data.get('peak_ratio', 3)),
+        seed=int(data.get('seed', 0))
+    )
+    options = {key: data[key] for key in ('hosts', 'host_capacity', 'placement', 'pool', 'pool_size',
+                                          'idle_after', 'boot_slots', 'seed') if key in data}
+    try:
+        report = fleet_sim.simulate(VM_TEMPLATES, sessions, **options)
+    except (KeyError, ValueError, TypeError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'report': report})
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['simulate']:
+        # python debug-orchestrator.py simulate [--hosts N] [--pool adaptive] ...
+        print(json.dumps(fleet_sim.main(sys.argv[2:], VM_TEMPLATES), indent=2))
+        sys.exit(0)
     print('🚀 VM Orchestrator Debug Service starting...')
     print('✅ UTM-Enhanced QEMU VM management (debug mode)')
     print('✅ Mock VMs with performance monitoring')
+    telemetry.start()
     app.run(host='0.0.0.0', port=5000, debug=True)
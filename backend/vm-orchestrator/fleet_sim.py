@@ -0,0 +1,443 @@
+"""Discrete-event simulation of a VM fleet, for capacity planning before a policy goes to production.
+
+Sessions (a launch of a template, `active_seconds` in use, then
+`idle_seconds` idle before the stop) are replayed in virtual time against a
+placement policy (placement.POLICIES, or any score function), a warm pool
+policy and, optionally, idle suspension. A simulated day takes seconds.
+Traces are synthetic (`synthetic_trace`), recorded as JSON
+(`load_trace`), or rebuilt from vms documents (`trace_from_vm_documents`).
+
+With `hosts=None` the fleet grows a host whenever nothing fits, and the
+report says how many were needed; with a fixed count, launches that do not
+fit wait for capacity and that shows in launch latency.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import math
+import random
+import time
+from collections import deque
+
+from placement import POLICIES, RESOURCE_KEYS, vm_resources
+
+DAY = 86400.0
+
+# Per-template session and boot profile; templates may override any of these
+DEFAULT_PROFILE = {'weight': 1.0, 'active_seconds': 1800.0, 'idle_seconds': 600.0, 'boot_seconds': 30.0}
+DEFAULT_HOST = {'cpu_cores': 32, 'memory_mb': 128 * 1024}
+
+
+def template_resources(template):
+    return {'cpu_cores': int(template['cpu_cores']), 'memory_mb': int(template['memory_mb'])}
+
+
+def profile(template):
+    return {**DEFAULT_PROFILE, **{key: template[key] for key in DEFAULT_PROFILE if key in template}}
+
+
+def synthetic_trace(templates, hours=24.0, sessions_per_hour=60.0, peak_ratio=3.0, peak_hour=14.0, seed=0):
+    """Poisson arrivals following a daily cycle, `peak_ratio` times busier at `peak_hour` than 12 hours off it.
+
+    Templates are picked by `weight`; active and idle times are exponential
+    around each template's means.
+    """
+    rng = random.Random(seed)
+    mean_rate = sessions_per_hour / 3600
+    amplitude = (peak_ratio - 1) / (peak_ratio + 1)
+    peak_rate = mean_rate * (1 + amplitude)
+    weights = [profile(template)['weight'] for template in templates]
+    sessions = []
+    at = 0.0
+    while True:
+        # Thinning: candidates at the peak rate, kept in proportion to the rate at the time
+        at += rng.expovariate(peak_rate)
+        if at >= hours * 3600:
+            return sessions
+        rate = mean_rate * (1 + amplitude * math.cos(2 * math.pi * (at - peak_hour * 3600) / DAY))
+        if rng.random() * peak_rate > rate:
+            continue
+        template = rng.choices(templates, weights)[0]
+        means = profile(template)
+        sessions.append({
+            'at': round(at, 3),
+            'template': template['id'],
+            'active_seconds': round(rng.expovariate(1 / means['active_seconds']), 3),
+            'idle_seconds': round(rng.expovariate(1 / means['idle_seconds']), 3) if means['idle_seconds'] else 0.0
+        })
+
+
+def load_trace(path):
+    """Sessions from a JSON list or JSON lines file of {at, template, active_seconds, idle_seconds}"""
+    with open(path) as f:
+        text = f.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def trace_from_vm_documents(vms, templates):
+    """Sessions from stopped vms documents; the template is the one reserving the same resources.
+
+    Activity ends at `last_active_at` (the last stream connect or
+    disconnect), so the rest of the VM's life counts as idle.
+    """
+    by_resources = {tuple(template_resources(t)[key] for key in RESOURCE_KEYS): t['id'] for t in templates}
+    vms = [vm for vm in vms if vm.get('created_at') and vm.get('stopped_at')]
+    if not vms:
+        return []
+    origin = min(vm['created_at'] for vm in vms)
+    sessions = []
+    for vm in sorted(vms, key=lambda vm: vm['created_at']):
+        resources = vm_resources(vm.get('config') or {})
+        template = by_resources.get(tuple(resources[key] for key in RESOURCE_KEYS))
+        if template is None:
+            continue
+        started = vm.get('started_at') or vm['created_at']
+        active_until = min(max(vm.get('last_active_at') or vm['stopped_at'], started), vm['stopped_at'])
+        sessions.append({
+            'at': vm['created_at'] - origin,
+            'template': template,
+            'active_seconds': active_until - started,
+            'idle_seconds': vm['stopped_at'] - active_until
+        })
+    return sessions
+
+
+class NoPool:
+    """No pre-booted VMs: every launch is a cold boot"""
+
+    def observe(self, template_id, now):
+        pass
+
+    def target(self, template_id, now, boot_seconds):
+        return 0
+
+
+class FixedPool(NoPool):
+    """`size` warm VMs per template at all times"""
+
+    def __init__(self, size=1):
+        self.size = size
+
+    def target(self, template_id, now, boot_seconds):
+        return self.size
+
+
+class AdaptivePool:
+    """warm_pool.WarmPool's sizing: launches expected within one boot (Little's law), with headroom"""
+
+    def __init__(self, min_size=0, max_size=10, rate_window=300.0, headroom=1.5):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.rate_window = rate_window
+        self.headroom = headroom
+        self._arrivals = {}
+
+    def observe(self, template_id, now):
+        self._arrivals.setdefault(template_id, deque()).append(now)
+
+    def target(self, template_id, now, boot_seconds):
+        arrivals = self._arrivals.get(template_id, deque())
+        while arrivals and arrivals[0] < now - self.rate_window:
+            arrivals.popleft()
+        rate = len(arrivals) / self.rate_window
+        return max(self.min_size, min(self.max_size, math.ceil(rate * boot_seconds * self.headroom)))
+
+
+POOL_POLICIES = {'none': NoPool, 'fixed': FixedPool, 'adaptive': AdaptivePool}
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an ascending list"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+class FleetSimulator:
+    """Replays sessions against hosts, placement, a warm pool policy and idle suspension in virtual time.
+
+    Each host boots at most `boot_slots` VMs at once (its provisioning
+    workers) and queues the rest. A warm pool hit takes `assign_seconds`;
+    warm VMs hold host capacity like any other and are topped up every
+    `pool_interval` with at most `pool_concurrency` boots in flight, never
+    ahead of launches waiting for capacity. With `idle_after`, a VM idle
+    that long is suspended and stops holding host capacity.
+    """
+
+    def __init__(self, templates, hosts=None, host_capacity=None, placement='pack', pool=None, idle_after=None,
+                 boot_slots=4, boot_jitter=0.1, assign_seconds=0.05, pool_interval=5.0, pool_concurrency=1,
+                 max_hosts=10000, seed=0):
+        self.templates = {template['id']: template for template in templates}
+        self.capacity = dict(host_capacity or DEFAULT_HOST)
+        self.score = POLICIES[placement] if isinstance(placement, str) else placement
+        self.pool = pool or NoPool()
+        self.idle_after = idle_after
+        self.boot_slots = boot_slots
+        self.boot_jitter = boot_jitter
+        self.assign_seconds = assign_seconds
+        self.pool_interval = pool_interval
+        self.pool_concurrency = pool_concurrency
+        self.elastic = hosts is None
+        self.max_hosts = max_hosts if self.elastic else hosts
+        self.rng = random.Random(seed)
+
+        self.hosts = []
+        for _ in range(0 if self.elastic else hosts):
+            self._open_host()
+        self._events = []
+        self._sequence = itertools.count()
+        self.now = 0.0
+        self._pending = deque()  # launches waiting for capacity
+        self._warm = {template_id: deque() for template_id in self.templates}
+        self._warming = {template_id: 0 for template_id in self.templates}
+        self._last_arrival = 0.0
+        # Running totals, so each event costs the same however large the fleet
+        self._used = {key: 0 for key in RESOURCE_KEYS}
+        self._warm_memory = 0
+        self._in_use = 0
+        self._integrals = {'cpu': 0.0, 'memory': 0.0, 'warm_memory': 0.0, 'cpu_capacity': 0.0,
+                           'memory_capacity': 0.0}
+        self._latencies = []
+        self.counts = {'sessions': 0, 'warm_hits': 0, 'cold_boots': 0, 'warm_boots': 0, 'capacity_waits': 0,
+                       'suspended': 0, 'unplaceable': 0, 'events': 0}
+        self.peaks = {'hosts_in_use': 0, 'vms': 0, 'pending': 0}
+        self._vms = 0
+
+    # Hosts
+
+    def _open_host(self):
+        host = {'_id': f"host-{len(self.hosts)}", 'capacity': dict(self.capacity), 'free': dict(self.capacity),
+                'vms': 0, 'booting': 0, 'boot_queue': deque()}
+        self.hosts.append(host)
+        return host
+
+    def _place(self, resources, grow=True):
+        fits = [host for host in self.hosts if all(host['free'][key] >= resources[key] for key in RESOURCE_KEYS)]
+        if fits:
+            host = min(fits, key=lambda host: (self.score(host, resources), int(host['_id'].split('-')[1])))
+        elif grow and self.elastic and len(self.hosts) < self.max_hosts:
+            host = self._open_host()
+        else:
+            return None
+        for key in RESOURCE_KEYS:
+            host['free'][key] -= resources[key]
+            self._used[key] += resources[key]
+        return host
+
+    def _release(self, vm):
+        host = vm['host']
+        for key in RESOURCE_KEYS:
+            host['free'][key] += vm['resources'][key]
+            self._used[key] -= vm['resources'][key]
+        host['vms'] -= 1
+        if not host['vms']:
+            self._in_use -= 1
+        vm['host'] = None
+        self._vms -= 1
+        self._place_pending()
+
+    def _place_pending(self):
+        while self._pending:
+            vm = self._pending[0]
+            host = self._place(vm['resources'], grow=False)
+            if host is None:
+                return
+            self._pending.popleft()
+            self._boot(host, vm)
+
+    # Events
+
+    def _schedule(self, at, kind, payload=None):
+        heapq.heappush(self._events, (at, next(self._sequence), kind, payload))
+
+    def _advance(self, at):
+        elapsed = at - self.now
+        if elapsed > 0:
+            for key, integral in (('cpu_cores', 'cpu'), ('memory_mb', 'memory')):
+                self._integrals[integral] += elapsed * self._used[key]
+                self._integrals[integral + '_capacity'] += elapsed * self.capacity[key] * len(self.hosts)
+            self._integrals['warm_memory'] += elapsed * self._warm_memory
+        self.now = at
+
+    def _boot(self, host, vm):
+        vm['host'] = host
+        host['vms'] += 1
+        if host['vms'] == 1:
+            self._in_use += 1
+        self._vms += 1
+        self.peaks['vms'] = max(self.peaks['vms'], self._vms)
+        self.peaks['hosts_in_use'] = max(self.peaks['hosts_in_use'], self._in_use)
+        if host['booting'] < self.boot_slots:
+            self._start_boot(host, vm)
+        else:
+            host['boot_queue'].append(vm)
+
+    def _start_boot(self, host, vm):
+        host['booting'] += 1
+        boot_seconds = profile(self.templates[vm['template']])['boot_seconds']
+        jitter = self.rng.uniform(1 - self.boot_jitter, 1 + self.boot_jitter)
+        self._schedule(self.now + boot_seconds * jitter, 'booted', vm)
+
+    def _new_vm(self, template_id, session=None):
+        return {'template': template_id, 'resources': template_resources(self.templates[template_id]),
+                'session': session, 'requested_at': self.now, 'host': None}
+
+    def _arrive(self, session):
+        self.counts['sessions'] += 1
+        template_id = session['template']
+        self.pool.observe(template_id, self.now)
+        if self._warm[template_id]:
+            vm = self._warm[template_id].popleft()
+            self._warm_memory -= vm['resources']['memory_mb']
+            vm['session'] = session
+            self.counts['warm_hits'] += 1
+            self._latencies.append(self.assign_seconds)
+            self._begin(vm, self.now + self.assign_seconds)
+            return
+        self.counts['cold_boots'] += 1
+        vm = self._new_vm(template_id, session)
+        if any(vm['resources'][key] > self.capacity[key] for key in RESOURCE_KEYS):
+            self.counts['unplaceable'] += 1
+            return
+        host = None if self._pending else self._place(vm['resources'])
+        if host is None:
+            self.counts['capacity_waits'] += 1
+            self._pending.append(vm)
+            self.peaks['pending'] = max(self.peaks['pending'], len(self._pending))
+        else:
+            self._boot(host, vm)
+
+    def _booted(self, vm):
+        host = vm['host']
+        host['booting'] -= 1
+        if host['boot_queue']:
+            self._start_boot(host, host['boot_queue'].popleft())
+        if vm['session'] is None:
+            self._warming[vm['template']] -= 1
+            self._warm[vm['template']].append(vm)
+            self._warm_memory += vm['resources']['memory_mb']
+            return
+        self._latencies.append(self.now - vm['requested_at'])
+        self._begin(vm, self.now)
+
+    def _begin(self, vm, start):
+        session = vm['session']
+        stop_at = start + session['active_seconds'] + session['idle_seconds']
+        if self.idle_after is not None and session['idle_seconds'] > self.idle_after:
+            self._schedule(start + session['active_seconds'] + self.idle_after, 'suspend', vm)
+        self._schedule(stop_at, 'stop', vm)
+
+    def _suspend(self, vm):
+        self.counts['suspended'] += 1
+        self._release(vm)
+
+    def _stop(self, vm):
+        if vm['host'] is not None:
+            self._release(vm)
+
+    def _top_up_pool(self):
+        if self._pending:
+            return
+        in_flight = sum(self._warming.values())
+        for template_id, template in self.templates.items():
+            target = self.pool.target(template_id, self.now, profile(template)['boot_seconds'])
+            while (len(self._warm[template_id]) + self._warming[template_id] < target
+                   and in_flight < self.pool_concurrency):
+                vm = self._new_vm(template_id)
+                host = self._place(vm['resources'])
+                if host is None:
+                    return
+                self._warming[template_id] += 1
+                self.counts['warm_boots'] += 1
+                in_flight += 1
+                self._boot(host, vm)
+
+    def run(self, sessions):
+        """Replay `sessions` to the end; returns the report"""
+        started = time.perf_counter()
+        sessions = sorted(sessions, key=lambda session: session['at'])
+        for session in sessions:
+            if session['template'] not in self.templates:
+                raise ValueError(f"Unknown template {session['template']}")
+            self._schedule(session['at'], 'arrive', session)
+        self._last_arrival = sessions[-1]['at'] if sessions else 0.0
+        self._schedule(0.0, 'pool')
+
+        handlers = {'arrive': self._arrive, 'booted': self._booted, 'suspend': self._suspend, 'stop': self._stop}
+        while self._events:
+            at, _, kind, payload = heapq.heappop(self._events)
+            self._advance(at)
+            self.counts['events'] += 1
+            if kind == 'pool':
+                self._top_up_pool()
+                if self.now < self._last_arrival:
+                    self._schedule(self.now + self.pool_interval, 'pool')
+            else:
+                handlers[kind](payload)
+        return self.report(time.perf_counter() - started)
+
+    def report(self, wall_seconds=0.0):
+        latencies = sorted(round(latency, 3) for latency in self._latencies)
+        launches = self.counts['warm_hits'] + self.counts['cold_boots'] - self.counts['unplaceable']
+        integrals = self._integrals
+        share = lambda used, capacity: round(used / capacity, 4) if capacity else None
+        return {
+            **self.counts,
+            'hosts': None if self.elastic else len(self.hosts),
+            'hosts_needed': self.peaks['hosts_in_use'],
+            'peak_vms': self.peaks['vms'],
+            'peak_pending': self.peaks['pending'],
+            'warm_hit_rate': round(self.counts['warm_hits'] / launches, 4) if launches else None,
+            'launch_latency_seconds': {
+                'p50': percentile(latencies, 0.5),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+                'max': latencies[-1] if latencies else None,
+                'mean': round(sum(latencies) / len(latencies), 3) if latencies else None
+            },
+            'utilization': {
+                'cpu': share(integrals['cpu'], integrals['cpu_capacity']),
+                'memory': share(integrals['memory'], integrals['memory_capacity']),
+                # Share of reserved memory held by warm VMs nobody is using yet
+                'warm_memory': share(integrals['warm_memory'], integrals['memory'])
+            },
+            'simulated_seconds': round(self.now, 3),
+            'wall_seconds': round(wall_seconds, 3)
+        }
+
+
+def simulate(templates, sessions, pool='none', pool_size=1, **options):
+    """FleetSimulator run with the pool policy given by name (see POOL_POLICIES)"""
+    if isinstance(pool, str):
+        if pool not in POOL_POLICIES:
+            raise ValueError(f"Unknown pool policy {pool}; expected one of {', '.join(POOL_POLICIES)}")
+        pool = FixedPool(pool_size) if pool == 'fixed' else POOL_POLICIES[pool]()
+    return FleetSimulator(templates, pool=pool, **options).run(sessions)
+
+
+def main(argv, templates):
+    parser = argparse.ArgumentParser(description='Simulate the VM fleet in virtual time')
+    parser.add_argument('--trace', help='JSON (lines) file of sessions; synthetic when omitted')
+    parser.add_argument('--hours', type=float, default=24.0, help='length of a synthetic trace')
+    parser.add_argument('--sessions-per-hour', type=float, default=60.0)
+    parser.add_argument('--peak-ratio', type=float, default=3.0, help='busiest vs quietest hour')
+    parser.add_argument('--hosts', type=int, help='fixed host count; grown as needed when omitted')
+    parser.add_argument('--host-cpu-cores', type=int, default=DEFAULT_HOST['cpu_cores'])
+    parser.add_argument('--host-memory-mb', type=int, default=DEFAULT_HOST['memory_mb'])
+    parser.add_argument('--placement', default='pack', choices=sorted(POLICIES))
+    parser.add_argument('--pool', default='none', choices=sorted(POOL_POLICIES))
+    parser.add_argument('--pool-size', type=int, default=1, help='warm VMs per template for --pool fixed')
+    parser.add_argument('--idle-after', type=float, help='suspend VMs idle this many seconds')
+    parser.add_argument('--boot-slots', type=int, default=4, help='concurrent boots per host')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    sessions = load_trace(args.trace) if args.trace else synthetic_trace(
+        templates, args.hours, args.sessions_per_hour, args.peak_ratio, seed=args.seed)
+    return simulate(templates, sessions, pool=args.pool, pool_size=args.pool_size, hosts=args.hosts,
+                    host_capacity={'cpu_cores': args.host_cpu_cores, 'memory_mb': args.host_memory_mb},
+                    placement=args.placement, idle_after=args.idle_after, boot_slots=args.boot_slots,
+                    seed=args.seed)
@@ -0,0 +1,309 @@
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+from streaming import Frame
+
+logger = logging.getLogger(__name__)
+
+# Packet layout: header, one uint16 index per dirty tile, zlib-compressed tile pixels
+PACKET_HEADER = struct.Struct('>4sBBBBBHHHH')
+PACKET_MAGIC = b'AVTF'
+PACKET_VERSION = 1
+FLAG_KEYFRAME = 0x01
+
+# Quality ladder, best first: (downscale factor, dropped low bits, zlib level, frame-rate divisor)
+QUALITY_LEVELS = (
+    (1, 0, 1, 1),
+    (1, 2, 1, 1),
+    (2, 2, 1, 1),
+    (2, 3, 1, 2),
+    (4, 4, 1, 2),
+    (4, 4, 1, 4),
+)
+
+
+class TileEncoder:
+    """Sends only the tiles that changed since the previous frame.
+
+    Frames are (height, width, channels) uint8 arrays. The dirty comparison
+    and tile gather are single vectorized operations over reshaped views of
+    the frame, with no Python loop over the screen, and only dirty tiles
+    are copied and compressed.
+    """
+
+    def __init__(self, width, height, channels=4, tile=64, level=0):
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.tile = tile
+        self.level = level
+        self.rows = -(-height // tile)
+        self.cols = -(-width // tile)
+        if self.rows * self.cols > 0xFFFF:
+            raise ValueError('Too many tiles for a uint16 tile index')
+        self._padded = np.zeros((self.rows * tile, self.cols * tile, channels), dtype=np.uint8)
+        self._previous = None
+
+    def _pad(self, frame):
+        padded = self._padded
+        if frame.shape[0] != padded.shape[0] or frame.shape[1] != padded.shape[1]:
+            # Edge tiles are padded with zeros in a buffer reused across frames
+            padded[:self.height, :self.width] = frame
+            return padded
+        return frame
+
+    def _tiles(self, frame):
+        return frame.reshape(self.rows, self.tile, self.cols, self.tile, self.channels).swapaxes(1, 2)
+
+    def _pixels(self, frame):
+        # RGBA pixels compare as one uint32 each, a quarter of the work of bytewise
+        if self.channels == 4 and frame.flags.c_contiguous:
+            return frame.view(np.uint32)[..., 0]
+        return frame
+
+    def dirty_mask(self, frame):
+        frame = self._pad(frame)
+        pixels = self._pixels(frame)
+        if self._previous is None:
+            dirty = np.ones((self.rows, self.cols), dtype=bool)
+        else:
+            changed = (pixels != self._previous).reshape(self.rows, self.tile, self.cols, self.tile, -1)
+            dirty = changed.any(axis=(1, 3, 4))
+        return frame, pixels, dirty
+
+    def encode(self, frame, keyframe=False):
+        """Encode a frame; returns the packet bytes and the number of dirty tiles"""
+        frame, pixels, dirty = self.dirty_mask(frame)
+        if keyframe:
+            dirty = np.ones_like(dirty)
+        packet = self._pack(self._tiles(frame), dirty, keyframe or self._previous is None)
+        self._previous = pixels.copy()
+        return packet, int(dirty.sum())
+
+    def keyframe(self, frame):
+        """Self-contained packet for viewers joining or resyncing; leaves the diff state alone"""
+        tiles = self._tiles(self._pad(frame))
+        return self._pack(tiles, np.ones((self.rows, self.cols), dtype=bool), True)
+
+    def _pack(self, tiles, dirty, keyframe):
+        scale, drop_bits, zlib_level, _ = QUALITY_LEVELS[self.level]
+        indices = np.flatnonzero(dirty).astype('>u2')
+        selected = tiles[dirty]
+        if scale > 1:
+            selected = selected[:, ::scale, ::scale]
+        if drop_bits:
+            selected = selected & np.uint8((0xFF << drop_bits) & 0xFF)
+        payload = zlib.compress(np.ascontiguousarray(selected).tobytes(), zlib_level) if len(indices) else b''
+        header = PACKET_HEADER.pack(
+            PACKET_MAGIC, PACKET_VERSION, FLAG_KEYFRAME if keyframe else 0, scale, self.channels,
+            self.tile, self.width, self.height, len(indices), 0
+        )
+        return header + indices.tobytes() + payload
+
+
+class TileDecoder:
+    """Reference client-side reconstruction of TileEncoder packets"""
+
+    def __init__(self):
+        self.frame = None
+
+    def decode(self, packet):
+        magic, version, flags, scale, channels, tile, width, height, count, _ = \
+            PACKET_HEADER.unpack_from(packet)
+        if magic != PACKET_MAGIC or version != PACKET_VERSION:
+            raise ValueError('Not a tile packet')
+        rows, cols = -(-height // tile), -(-width // tile)
+        if flags & FLAG_KEYFRAME:
+            self.frame = np.zeros((rows * tile, cols * tile, channels), dtype=np.uint8)
+        elif self.frame is None:
+            raise ValueError('Delta packet without a keyframe')
+
+        offset = PACKET_HEADER.size
+        indices = np.frombuffer(packet, dtype='>u2', count=count, offset=offset)
+        if count:
+            side = tile // scale
+            pixels = np.frombuffer(zlib.decompress(packet[offset + 2 * count:]), dtype=np.uint8)
+            pixels = pixels.reshape(count, side, side, channels)
+            if scale > 1:
+                pixels = pixels.repeat(scale, axis=1).repeat(scale, axis=2)
+            view = self.frame.reshape(rows, tile, cols, tile, channels).swapaxes(1, 2)
+            view[indices // cols, indices % cols] = pixels
+        return self.frame[:height, :width]
+
+
+class AdaptiveController:
+    """Moves a viewer along QUALITY_LEVELS from its measured throughput.
+
+    Frames dropped at the viewer mean the link is saturated, so the rate it
+    achieved is taken as its capacity and quality steps down until the
+    expected bytes/sec fit. After enough clean intervals it probes one level
+    up; a probe that causes drops doubles the wait before the next one.
+    """
+
+    def __init__(self, fps, level=0, interval=1.0, probe_after=3, max_probe_after=32):
+        self.fps = fps
+        self.level = level
+        self.interval = interval
+        self.probe_after = probe_after
+        self.min_probe_after = probe_after
+        self.max_probe_after = max_probe_after
+        self._clean_intervals = 0
+        self._probing = False
+        self._last_check = time.monotonic()
+        self._last_dropped = 0
+        self._last_sent = 0
+        self._bytes_per_frame = {}
+
+    def observe_frame(self, level, nbytes):
+        previous = self._bytes_per_frame.get(level)
+        self._bytes_per_frame[level] = nbytes if previous is None else 0.9 * previous + 0.1 * nbytes
+
+    def demand(self, level):
+        """Expected bytes/sec at a level, once we have seen frames encoded at it"""
+        per_frame = self._bytes_per_frame.get(level)
+        if per_frame is None:
+            return None
+        return per_frame * self.fps / QUALITY_LEVELS[level][3]
+
+    def update(self, viewer):
+        now = time.monotonic()
+        if now - self._last_check < self.interval:
+            return self.level
+        dropped = viewer.frames_dropped - self._last_dropped
+        sent = viewer.frames_sent - self._last_sent
+        self._last_check, self._last_dropped, self._last_sent = now, viewer.frames_dropped, viewer.frames_sent
+
+        if sent + dropped and dropped / (sent + dropped) > 0.1:
+            if self._probing:
+                self.probe_after = min(self.max_probe_after, self.probe_after * 2)
+            self._probing = False
+            self._clean_intervals = 0
+            capacity = viewer.bytes_per_sec
+            while self.level < len(QUALITY_LEVELS) - 1:
+                self.level += 1
+                demand = self.demand(self.level)
+                if demand is None or demand <= 0.8 * capacity:
+                    break
+        elif sent:
+            self._clean_intervals += 1
+            if self._probing and self._clean_intervals >= self.probe_after:
+                # The last probe held up; probe again at the normal pace
+                self.probe_after = self.min_probe_after
+                self._probing = False
+            if self.level > 0 and self._clean_intervals >= self.probe_after:
+                self.level -= 1
+                self._probing = True
+                self._clean_intervals = 0
+        return self.level
+
+
+class FramePipeline:
+    """Per-VM encoding stage between a raw framebuffer source and its viewers.
+
+    Viewers on the same quality level share one encoder and one encoded
+    packet per frame. A viewer that still has an unsent packet when the next
+    one is ready (or that just joined or changed level) gets a keyframe
+    instead, because skipping a delta would corrupt its picture.
+    """
+
+    def __init__(self, width, height, channels=4, tile=64, fps=30):
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.tile = tile
+        self.fps = fps
+        self.encoders = {}
+        self.controllers = {}
+        self.frame_count = 0
+        self.stats = {'frames': 0, 'packets': 0, 'keyframes': 0, 'bytes': 0, 'encode_ms': 0.0}
+
+    def _encoder(self, level):
+        encoder = self.encoders.get(level)
+        if encoder is None:
+            encoder = self.encoders[level] = TileEncoder(self.width, self.height, self.channels, self.tile, level)
+        return encoder
+
+    def publish(self, frame, captured_at, viewers):
+        self.frame_count += 1
+        self.stats['frames'] += 1
+        by_level = {}
+        for viewer in viewers:
+            controller = self.controllers.get(viewer.id)
+            if controller is None:
+                controller = self.controllers[viewer.id] = AdaptiveController(self.fps)
+                viewer.needs_keyframe = True
+            level = controller.update(viewer)
+            if level != viewer.quality_level:
+                viewer.quality_level = level
+                viewer.needs_keyframe = True
+            by_level.setdefault(level, []).append(viewer)
+
+        for level, members in by_level.items():
+            if self.frame_count % QUALITY_LEVELS[level][3]:
+                continue
+            started = time.perf_counter()
+            encoder = self._encoder(level)
+            packet, _ = encoder.encode(frame)
+            delta = Frame(self.frame_count, packet, captured_at)
+            keyframe = None
+            for viewer in members:
+                if viewer.needs_keyframe or viewer.pending is not None:
+                    if keyframe is None:
+                        keyframe = Frame(self.frame_count, encoder.keyframe(frame), captured_at)
+                        self.stats['keyframes'] += 1
+                    viewer.needs_keyframe = False
+                    viewer.offer(keyframe)
+                else:
+                    viewer.offer(delta)
+                self.controllers[viewer.id].observe_frame(level, len(packet))
+            self.stats['packets'] += 1
+            self.stats['bytes'] += len(packet)
+            self.stats['encode_ms'] += (time.perf_counter() - started) * 1000
+
+        # Drop state for viewers that have left
+        live = {viewer.id for viewer in viewers}
+        for viewer_id in [v for v in self.controllers if v not in live]:
+            del self.controllers[viewer_id]
+        for level in [lvl for lvl in self.encoders if lvl not in by_level]:
+            del self.encoders[level]
+
+
+class FramebufferSource:
+    """Samples a raw RGBA framebuffer the VM process maps at `path`"""
+
+    def __init__(self, path, width, height, channels=4, fps=30, tile=64):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.interval = 1.0 / fps
+        self.pipeline = FramePipeline(width, height, channels, tile, fps)
+
+    async def frames(self):
+        size = self.width * self.height * self.channels
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as buffer:
+            view = np.frombuffer(buffer, dtype=np.uint8).reshape(self.height, self.width, self.channels)
+            try:
+                while True:
+                    # Copy once so the encoder sees a consistent frame while the VM keeps drawing
+                    yield view.copy(), time.monotonic()
+                    await asyncio.sleep(self.interval)
+            finally:
+                del view
+
+
+def parse_resolution(resolution):
+    width, height = (int(part) for part in str(resolution).lower().split('x'))
+    return width, height
+
+
+def framebuffer_path(vm_id, socket_dir=None):
+    socket_dir = socket_dir or os.environ.get('STREAM_SOCKET_DIR', '/run/avmo/frames')
+    return os.path.join(socket_dir, f"{vm_id}.fb")
@@ -0,0 +1,56 @@
+"""Production server for the orchestrator.
+
+    gunicorn -c gunicorn.conf.py orchestrator:app
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker async_orchestrator:app
+
+The app is imported once in the master (which opens no Mongo connection and
+starts no thread) and workers are forked from it, so a restarted worker
+serves again without re-importing anything. Each worker starts the
+background services after the fork, and on shutdown stops accepting
+requests, then drains: boots in flight finish before it exits.
+
+VMs, their sessions and the stream port belong to the process that started
+them, so a node runs a single worker and serves requests on its threads;
+add nodes to scale out.
+
+Server-sent event streams (/vms/events, /vms/bulk/<job_id>/events) each
+hold a thread while connected, so at most SSE_MAX_SUBSCRIBERS (default 8)
+are open at once; keep it well below GUNICORN_THREADS. Further
+subscribers get a 503 with Retry-After, and open streams end as soon as
+the worker is told to stop, so clients reconnect to another node instead
+of holding up the drain.
+"""
+import os
+import signal
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8084)}"
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+preload_app = True
+keepalive = 5
+timeout = int(os.environ.get('GUNICORN_TIMEOUT_SECONDS', 60))
+# Requests in flight, then the drain, must fit in this before the master kills the worker
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT_SECONDS', 120))
+accesslog = '-'
+errorlog = '-'
+
+
+def post_worker_init(worker):
+    import orchestrator
+    orchestrator.start_background_services()
+
+    # The worker waits for requests in flight before it exits; event streams
+    # never finish by themselves, so they are ended first
+    handle_exit = worker.handle_exit
+
+    def end_streams_and_exit(sig, frame):
+        orchestrator.end_event_streams()
+        handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, end_streams_and_exit)
+
+
+def worker_exit(server, worker):
+    import orchestrator
+    orchestrator.drain()
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessTracker:
+    """Emulator/QEMU processes this orchestrator launched, keyed by VM id.
+
+    Checking them costs one liveness probe per tracked process instead of a
+    walk over every process on the host. psutil.Process remembers each
+    process's start time, so a recycled PID is not mistaken for the VM.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes = {}  # vm_id -> psutil.Process
+        self._interfaces = {} # vm_id -> host network interface (tap) of the VM
+        self.exited = {}      # vm_id -> exit detected at, until untracked
+
+    def track(self, vm_id, pid, interface=None):
+        try:
+            process = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            logger.warning(f"VM {vm_id} process {pid} exited before it could be tracked")
+            return
+        with self._lock:
+            self._processes[vm_id] = process
+            self._interfaces[vm_id] = interface
+            self.exited.pop(vm_id, None)
+
+    def untrack(self, vm_id):
+        with self._lock:
+            self._processes.pop(vm_id, None)
+            self._interfaces.pop(vm_id, None)
+            self.exited.pop(vm_id, None)
+
+    def targets(self):
+        """(vm_id, process, interface) of every tracked VM still running, for telemetry"""
+        with self._lock:
+            return [(vm_id, process, self._interfaces.get(vm_id))
+                    for vm_id, process in self._processes.items() if vm_id not in self.exited]
+
+    def check(self):
+        with self._lock:
+            processes = list(self._processes.items())
+        alive = 0
+        for vm_id, process in processes:
+            try:
+                running = process.is_running() and process.status() != psutil.STATUS_ZOMBIE
+            except psutil.Error:
+                running = False
+            if running:
+                alive += 1
+            else:
+                with self._lock:
+                    self.exited.setdefault(vm_id, time.time())
+        return {
+            'status': 'UP' if alive == len(processes) else 'DEGRADED',
+            'tracked': len(processes),
+            'alive': alive,
+            'exited': sorted(self.exited)
+        }
+
+
+class HealthMonitor:
+    """Runs dependency probes in the background and serves the cached results.
+
+    A probe is a callable that raises when its dependency is down and may
+    return a dict of details (including its own 'status'). Results older
+    than `max_staleness` (a stalled or not yet started monitor) are
+    refreshed inline, one caller per probe, so /health never reports stale
+    data and a burst of probes does not stampede the dependency.
+    """
+
+    def __init__(self, probes, interval=5.0, max_staleness=15.0):
+        self.probes = dict(probes)
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self._results = {}
+        self._locks = {name: threading.Lock() for name in self.probes}
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def run_probe(self, name):
+        started = time.perf_counter()
+        try:
+            result = {'status': 'UP', **(self.probes[name]() or {})}
+        except Exception as e:
+            result = {'status': 'DOWN', 'error': str(e)}
+        result['latency_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        result['checked_at'] = time.time()
+        self._results[name] = result
+        return result
+
+    def result(self, name):
+        result = self._results.get(name)
+        if result is None or time.time() - result['checked_at'] > self.max_staleness:
+            with self._locks[name]:
+                # Another request may have refreshed it while we waited
+                result = self._results.get(name)
+                if result is None or time.time() - result['checked_at'] > self.max_staleness:
+                    result = self.run_probe(name)
+        return result
+
+    def snapshot(self):
+        now = time.time()
+        checks = {}
+        for name in self.probes:
+            result = dict(self.result(name))
+            result['age_seconds'] = round(now - result['checked_at'], 3)
+            checks[name] = result
+        statuses = {check['status'] for check in checks.values()}
+        overall = 'DOWN' if 'DOWN' in statuses else 'DEGRADED' if 'DEGRADED' in statuses else 'UP'
+        return {'status': overall, 'checks': checks}
+
+    def start(self):
+        if self._thread:
+            return
+
+        def run():
+            while not self._stopping.is_set():
+                for name in self.probes:
+                    with self._locks[name]:
+                        self.run_probe(name)
+                self._stopping.wait(self.interval)
+
+        self._thread = threading.Thread(target=run, name='health-monitor', daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._stopping.set()
@@ -0,0 +1,71 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import orjson
+from bson.objectid import ObjectId
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def dumps(value):
+    """JSON bytes; ObjectIds become their hex string"""
+    return orjson.dumps(value, default=_default)
+
+
+def vm_etag(vm_id, version, extra=None):
+    """Strong ETag of a VM representation: its document version, plus anything else the body shows"""
+    tag = f"{vm_id}.{version or 0}"
+    if extra:
+        tag += '.' + hashlib.sha1(dumps(extra)).hexdigest()[:12]
+    return f'"{tag}"'
+
+
+def page_etag(vms, next_cursor, fields):
+    """Strong ETag of a page of VMs from their ids and document versions"""
+    digest = hashlib.sha1(','.join(fields).encode())
+    for vm in vms:
+        digest.update(f"|{vm['_id']}.{vm.get('version') or 0}".encode())
+    digest.update(f"|{next_cursor}".encode())
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match uses the weak comparison, so W/ tags from intermediaries still match"""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+
+class ETagMemo:
+    """Last ETag sent for each page key, valid while its listing generation is unchanged.
+
+    Lets a poll that presents that ETag be answered without a query; the
+    generation must be read before the query the ETag was computed from.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (etag, generation)
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != generation:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, etag, generation):
+        with self._lock:
+            self._entries[key] = (etag, generation)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
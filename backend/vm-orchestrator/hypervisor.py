@@ -0,0 +1,458 @@
+import ipaddress
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+
+from frame_pipeline import parse_resolution
+from snapshots import parse_size
+
+logger = logging.getLogger(__name__)
+
+
+class NetworkAllocator:
+    """Addresses and host ports for the VMs on this node.
+
+    Each VM holds the lowest free slot, and everything else follows from the
+    slot: guest IP `subnet host slot+1` (the first host is the gateway),
+    console port `base_port + 2*slot` and ADB port one above it (the Android
+    emulator's own pairing), tap interface `tap_prefix + slot`. Two VMs can
+    never share an address, and a VM keeps the same one for as long as it
+    holds the lease, suspended or not.
+    """
+
+    def __init__(self, subnet='10.0.0.0/24', base_port=5554, tap_prefix='avmo-tap'):
+        self.hosts = list(ipaddress.ip_network(subnet).hosts())
+        self.base_port = base_port
+        self.tap_prefix = tap_prefix
+        self.capacity = min(len(self.hosts) - 1, (65535 - base_port) // 2)
+        self._lock = threading.Lock()
+        self._slots = {}  # slot -> vm_id
+        self._leases = {}  # vm_id -> lease
+
+    def _lease(self, slot):
+        return {
+            'slot': slot,
+            'ip': str(self.hosts[slot + 1]),
+            'console_port': self.base_port + 2 * slot,
+            'adb_port': self.base_port + 2 * slot + 1,
+            'tap': f"{self.tap_prefix}{slot}"
+        }
+
+    def lease(self, vm_id):
+        """The VM's lease, allocating the lowest free slot for a new one"""
+        with self._lock:
+            if vm_id in self._leases:
+                return self._leases[vm_id]
+            slot = next((slot for slot in range(self.capacity) if slot not in self._slots), None)
+            if slot is None:
+                raise RuntimeError(f"No free addresses ({self.capacity} VMs hold one)")
+            self._slots[slot] = vm_id
+            lease = self._leases[vm_id] = self._lease(slot)
+            return lease
+
+    def claim(self, vm_id, lease):
+        """Take back a lease held before a restart; False when another VM has the slot now"""
+        with self._lock:
+            holder = self._slots.get(lease['slot'])
+            if holder not in (None, vm_id):
+                return False
+            self._slots[lease['slot']] = vm_id
+            self._leases[vm_id] = self._lease(lease['slot'])
+            return True
+
+    def release(self, vm_id):
+        with self._lock:
+            lease = self._leases.pop(vm_id, None)
+            if lease:
+                self._slots.pop(lease['slot'], None)
+
+    def snapshot(self):
+        with self._lock:
+            return {'leased': len(self._leases), 'capacity': self.capacity}
+
+
+def stop_process(process, timeout=10.0):
+    """Terminate, then kill after `timeout`; works on Popen and psutil.Process alike"""
+    try:
+        process.terminate()
+        try:
+            process.wait(timeout)
+        except (subprocess.TimeoutExpired, psutil.TimeoutExpired):
+            process.kill()
+            process.wait(timeout)
+    except (ProcessLookupError, psutil.NoSuchProcess):
+        pass
+
+
+class QMPClient:
+    """Minimal QEMU Machine Protocol client over the VM's unix socket"""
+
+    def __init__(self, path, timeout=5.0):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.reader = self.sock.makefile('r')
+        self._read()  # greeting
+        self.execute('qmp_capabilities')
+
+    def _read(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError('QMP socket closed')
+        return json.loads(line)
+
+    def execute(self, command, arguments=None):
+        message = {'execute': command, **({'arguments': arguments} if arguments else {})}
+        self.sock.sendall(json.dumps(message).encode() + b'\n')
+        while True:
+            reply = self._read()
+            if 'return' in reply:
+                return reply['return']
+            if 'error' in reply:
+                raise RuntimeError(f"QMP {command}: {reply['error'].get('desc')}")
+            # Asynchronous events are interleaved with replies
+
+    def close(self):
+        self.sock.close()
+
+
+def qmp_running(path):
+    """True once the VM's QMP socket reports the guest CPUs running"""
+    try:
+        client = QMPClient(path)
+    except (OSError, ValueError):
+        return False
+    try:
+        return client.execute('query-status').get('status') == 'running'
+    finally:
+        client.close()
+
+
+def adb_boot_completed(adb, serial):
+    """True once Android inside the VM reports sys.boot_completed"""
+    try:
+        if ':' in serial:
+            subprocess.run([adb, 'connect', serial], capture_output=True, timeout=5)
+        result = subprocess.run([adb, '-s', serial, 'shell', 'getprop', 'sys.boot_completed'],
+                                capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0 and result.stdout.strip() == '1'
+
+
+def log_tail(path, size=500):
+    """Last `size` bytes of a VM's log, for error messages"""
+    if not path:
+        return ''
+    try:
+        with open(path, 'rb') as f:
+            f.seek(max(0, os.path.getsize(path) - size))
+            return f.read().decode(errors='replace')
+    except OSError:
+        return ''
+
+
+def hugepages_available(memory_bytes, meminfo='/proc/meminfo'):
+    """Whether enough free hugepages are reserved on the host to back `memory_bytes`"""
+    try:
+        with open(meminfo) as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        free_pages = int(fields['HugePages_Free'].split()[0])
+        page_bytes = int(fields['Hugepagesize'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return False
+    return free_pages * page_bytes >= memory_bytes
+
+
+class QemuDriver:
+    """Runs each VM as a QEMU process, configured from its vm_config.
+
+    - cpu_cores: -smp, with the process pinned to that many host CPUs, the
+      least used ones first (`pin_cpus`);
+    - ram: -m, backed by hugepages when `hugepages` is on and the host has
+      enough free (falls back to normal pages with a warning);
+    - android_version: the disk image `<image_dir>/android-<version>.qcow2`,
+      the VM's snapshot overlay when it was restored from one, or `disk` (an
+      overlay from the image store) when given;
+    - resolution: the virtio-gpu framebuffer size.
+
+    Disk, network, balloon (used to reclaim idle memory) and RNG are virtio
+    devices, and KVM is used when /dev/kvm exists. In `user` networking ADB
+    is forwarded from the lease's host port; `tap` attaches the lease's tap
+    interface (created by the host's network setup) with vhost.
+
+    A VM is ready when QMP reports it running and ADB reports
+    sys.boot_completed; one restored from a snapshot is ready as soon as QMP
+    reports it running.
+    """
+
+    def __init__(self, binary=None, image_dir=None, run_dir=None, adb=None, network='user', host_ip='127.0.0.1',
+                 hugepages=False, pin_cpus=True, poll_interval=0.5):
+        self.binary = binary or shutil.which('qemu-system-x86_64') or 'qemu-system-x86_64'
+        self.image_dir = image_dir or '/var/lib/avmo/images'
+        self.run_dir = run_dir or os.path.join(tempfile.gettempdir(), 'avmo-qmp')
+        self.adb = adb or shutil.which('adb') or 'adb'
+        self.network = network
+        self.host_ip = host_ip
+        self.hugepages = hugepages
+        self.pin_cpus = pin_cpus
+        self.poll_interval = poll_interval
+        self.host_cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+        self.taskset = shutil.which('taskset')
+        self._lock = threading.Lock()
+        self._pinned = {}  # vm_id -> host CPUs
+        self.stats = {'started': 0, 'ready': 0, 'failed': 0, 'stopped': 0, 'hugepage_fallbacks': 0}
+        os.makedirs(self.run_dir, exist_ok=True)
+
+    def qmp_path(self, vm_id):
+        return os.path.join(self.run_dir, f"{vm_id}.qmp")
+
+    def log_path(self, vm_id):
+        return os.path.join(self.run_dir, f"{vm_id}.log")
+
+    def _pick_cpus(self, vm_id, count):
+        with self._lock:
+            load = {cpu: 0 for cpu in self.host_cpus}
+            for cpus in self._pinned.values():
+                for cpu in cpus:
+                    load[cpu] = load.get(cpu, 0) + 1
+            cpus = sorted(self.host_cpus, key=lambda cpu: (load[cpu], cpu))[:count]
+            self._pinned[vm_id] = cpus
+            return cpus
+
+    def memory_args(self, config):
+        memory_bytes = parse_size(config.get('ram', '2048M'))
+        args = ['-m', f"{memory_bytes // 1024 ** 2}M"]
+        if self.hugepages or config.get('hugepages'):
+            if hugepages_available(memory_bytes):
+                args += ['-mem-path', '/dev/hugepages', '-mem-prealloc']
+            else:
+                self.stats['hugepage_fallbacks'] += 1
+                logger.warning(f"Not enough free hugepages for {config.get('ram')}; using normal pages")
+        return args
+
+    def network_args(self, lease):
+        if self.network == 'tap':
+            netdev = f"tap,id=net0,ifname={lease['tap']},script=no,downscript=no,vhost=on"
+        else:
+            netdev = f"user,id=net0,hostfwd=tcp:{self.host_ip}:{lease['adb_port']}-:5555"
+        return ['-netdev', netdev, '-device', 'virtio-net-pci,netdev=net0']
+
+    def command(self, vm_id, config, lease, restored=None, disk=None):
+        width, height = parse_resolution(config.get('resolution', '1080x1920'))
+        disk = (restored or {}).get('overlay') or disk or os.path.join(
+            self.image_dir, f"android-{config.get('android_version', '11.0')}.qcow2")
+        args = [
+            self.binary, '-name', f"avmo-{vm_id}", '-nodefaults', '-display', 'none',
+            '-smp', str(int(config.get('cpu_cores', 2))),
+            *self.memory_args(config),
+            '-object', 'iothread,id=io0',
+            '-drive', f"file={disk},if=none,id=disk0,cache=none,aio=native",
+            '-device', 'virtio-blk-pci,drive=disk0,iothread=io0',
+            *self.network_args(lease),
+            '-device', f"virtio-gpu-pci,xres={width},yres={height}",
+            '-device', 'virtio-balloon-pci',
+            '-device', 'virtio-rng-pci',
+            '-qmp', f"unix:{self.qmp_path(vm_id)},server=on,wait=off",
+        ]
+        if os.path.exists('/dev/kvm'):
+            args += ['-enable-kvm', '-cpu', 'host']
+        if (restored or {}).get('memory_image'):
+            args += ['-incoming', f"exec:cat {restored['memory_image']}"]
+        return args
+
+    def connection(self, lease):
+        if self.network == 'tap':
+            return {'ip': lease['ip'], 'port': 5555}
+        return {'ip': self.host_ip, 'port': lease['adb_port']}
+
+    def adb_serial(self, lease):
+        connection = self.connection(lease)
+        return f"{connection['ip']}:{connection['port']}"
+
+    def start(self, vm_id, config, lease, restored=None, disk=None):
+        """Launch the VM's process; returns the instance (wait_ready tells when it has booted)"""
+        cpus = self._pick_cpus(vm_id, int(config.get('cpu_cores', 2))) if self.pin_cpus and self.host_cpus else None
+        command = self.command(vm_id, config, lease, restored, disk)
+        if cpus and self.taskset:
+            # Pinned before exec, so every vCPU and I/O thread QEMU creates inherits it
+            command = [self.taskset, '-c', ','.join(map(str, cpus)), *command]
+        try:
+            # stderr goes to a file: a pipe nobody reads until exit would fill and stall QEMU
+            with open(self.log_path(vm_id), 'wb') as log:
+                process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=log)
+            if cpus and not self.taskset:
+                # Threads QEMU started before this keep the full mask; without taskset it is the best we can do
+                os.sched_setaffinity(process.pid, cpus)
+        except Exception:
+            self._unpin(vm_id)
+            self.stats['failed'] += 1
+            raise
+        self.stats['started'] += 1
+        logger.info(f"Started VM {vm_id} (pid {process.pid}, cpus {cpus}): {' '.join(command)}")
+        return {
+            'vm_id': vm_id,
+            'process': process,
+            'lease': lease,
+            'connection': self.connection(lease),
+            'interface': lease['tap'] if self.network == 'tap' else None,
+            'qmp': self.qmp_path(vm_id),
+            'log': self.log_path(vm_id),
+            'restored': bool(restored)
+        }
+
+    def booted(self, instance):
+        return adb_boot_completed(self.adb, self.adb_serial(instance['lease']))
+
+    def wait_ready(self, instance, timeout=300.0):
+        """Block until the guest has booted; raises if the process exits or `timeout` passes"""
+        deadline = time.time() + timeout
+        delay = self.poll_interval
+        while True:
+            code = instance['process'].poll()
+            if code is not None:
+                self.stats['failed'] += 1
+                raise RuntimeError(f"VM process exited with code {code}: {log_tail(instance.get('log'))}")
+            if qmp_running(instance['qmp']) and (instance['restored'] or self.booted(instance)):
+                self.stats['ready'] += 1
+                return
+            if time.time() > deadline:
+                self.stats['failed'] += 1
+                raise TimeoutError(f"VM did not boot within {timeout}s")
+            time.sleep(delay)
+            delay = min(delay * 1.5, 5.0)
+
+    def stop(self, instance, timeout=10.0):
+        process = instance.get('process')
+        if process is None:
+            return
+        # Ask the guest to power off first, then fall back to signals
+        qmp = instance.get('qmp')
+        if qmp and os.path.exists(qmp):
+            try:
+                client = QMPClient(qmp, timeout=2.0)
+                client.execute('system_powerdown')
+                client.close()
+                process.wait(timeout)
+            except Exception:
+                pass
+        stop_process(process, timeout)
+        for path in (qmp, instance.get('log')):
+            if path and os.path.exists(path):
+                os.remove(path)
+        self._unpin(instance.get('vm_id'))
+        self.stats['stopped'] += 1
+
+    def _unpin(self, vm_id):
+        with self._lock:
+            self._pinned.pop(vm_id, None)
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, 'pinned_vms': len(self._pinned)}
+
+
+class EmulatorDriver(QemuDriver):
+    """Runs each VM under the Android emulator (which wraps QEMU) from an AVD per Android version.
+
+    The emulator takes the lease's console/ADB port pair, so ADB reaches it
+    as `emulator-<console port>`; QEMU options (QMP, hugepages) are passed
+    through after -qemu.
+    """
+
+    def __init__(self, binary=None, avd_prefix='avmo-android-', **options):
+        super().__init__(binary=binary or shutil.which('emulator') or 'emulator', **options)
+        self.avd_prefix = avd_prefix
+
+    def command(self, vm_id, config, lease, restored=None, disk=None):
+        memory_args = self.memory_args(config)
+        args = [
+            self.binary, '-avd', f"{self.avd_prefix}{config.get('android_version', '11.0')}",
+            '-no-window', '-no-audio', '-no-boot-anim', '-no-snapshot-save',
+            '-ports', f"{lease['console_port']},{lease['adb_port']}",
+            '-cores', str(int(config.get('cpu_cores', 2))),
+            '-memory', memory_args[1][:-1],
+            '-skin', config.get('resolution', '1080x1920'),
+        ]
+        if (restored or {}).get('overlay'):
+            args += ['-data', restored['overlay']]
+        return args + ['-qemu', *memory_args[2:], '-qmp', f"unix:{self.qmp_path(vm_id)},server=on,wait=off"]
+
+    def connection(self, lease):
+        return {'ip': self.host_ip, 'port': lease['adb_port']}
+
+    def adb_serial(self, lease):
+        return f"emulator-{lease['console_port']}"
+
+
+class FakeDriver:
+    """Stand-in for tests and development: a boot takes `boot_seconds` (± jitter), a restore none.
+
+    With `processes` each VM gets a real (idle) child process, so process
+    tracking, telemetry and reconciliation see a PID as they would for QEMU.
+    """
+
+    def __init__(self, boot_seconds=10.0, jitter=0.0, processes=False):
+        self.boot_seconds = boot_seconds
+        self.jitter = jitter
+        self.processes = processes
+        self._lock = threading.Lock()
+        self.booting = 0
+        self.stats = {'started': 0, 'ready': 0, 'failed': 0, 'stopped': 0, 'peak_booting': 0}
+
+    def start(self, vm_id, config, lease, restored=None, disk=None):
+        process = None
+        if self.processes:
+            process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(1e9)'],
+                                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        with self._lock:
+            self.stats['started'] += 1
+        return {
+            'vm_id': vm_id,
+            'process': process,
+            'lease': lease,
+            'connection': {'ip': lease['ip'], 'port': lease['adb_port']},
+            'interface': None,
+            'qmp': None,
+            'restored': bool(restored)
+        }
+
+    def wait_ready(self, instance, timeout=300.0):
+        if instance['restored']:
+            seconds = 0.0
+        else:
+            seconds = random.uniform(1 - self.jitter, 1 + self.jitter) * self.boot_seconds
+        if seconds > timeout:
+            raise TimeoutError(f"VM did not boot within {timeout}s")
+        with self._lock:
+            self.booting += 1
+            self.stats['peak_booting'] = max(self.stats['peak_booting'], self.booting)
+        try:
+            time.sleep(max(0.0, seconds))
+        finally:
+            with self._lock:
+                self.booting -= 1
+                self.stats['ready'] += 1
+
+    def stop(self, instance, timeout=10.0):
+        if instance.get('process') is not None:
+            stop_process(instance['process'], timeout)
+        with self._lock:
+            self.stats['stopped'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, 'booting': self.booting}
+
+
+DRIVERS = {'fake': FakeDriver, 'qemu': QemuDriver, 'emulator': EmulatorDriver}
@@ -0,0 +1,227 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from snapshots import parse_size
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedSuspendBackend:
+    """Stub backend that saves suspended VMs to local disk and simulates the I/O.
+
+    A suspend writes a sparse memory image the size of the guest's RAM plus
+    the VM's session state; resume time is modelled from the image size and
+    a configurable bandwidth. A QEMU backend would use migrate-to-file for
+    suspend, and for reclaim inflate the virtio balloon and mark guest memory
+    mergeable for KSM.
+    """
+
+    def __init__(self, root=None, bandwidth_mbps=2000.0, reclaim_fraction=0.5):
+        self.root = root or os.path.join(tempfile.gettempdir(), 'avmo-suspended')
+        self.bandwidth = bandwidth_mbps * 1024 ** 2
+        self.reclaim_fraction = reclaim_fraction
+        self.reclaimed = {}  # vm_id -> bytes the balloon currently holds
+        os.makedirs(self.root, exist_ok=True)
+
+    def _paths(self, vm_id):
+        return os.path.join(self.root, f"{vm_id}.mem"), os.path.join(self.root, f"{vm_id}.json")
+
+    def suspend(self, vm_id, session):
+        memory_path, state_path = self._paths(vm_id)
+        memory_bytes = parse_size(session['config'].get('ram', '2048M'))
+        with open(memory_path, 'wb') as f:
+            f.truncate(memory_bytes)
+        with open(state_path, 'w') as f:
+            json.dump({
+                'config': session['config'],
+                'connection_info': session['connection_info'],
+                'overlay': session.get('overlay'),
+                'lease': session.get('lease'),
+                'interface': session.get('interface'),
+                'memory_bytes': memory_bytes
+            }, f)
+        time.sleep(memory_bytes / self.bandwidth)
+        return memory_bytes
+
+    def resume(self, vm_id):
+        """The saved session, or None when nothing is saved for the VM; kept until discarded"""
+        _, state_path = self._paths(vm_id)
+        try:
+            with open(state_path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        time.sleep(saved['memory_bytes'] / self.bandwidth)
+        return {'process': None, **saved}
+
+    def saved(self, vm_id):
+        return os.path.exists(self._paths(vm_id)[1])
+
+    def discard(self, vm_id):
+        for path in self._paths(vm_id):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def reclaim(self, vm_id, session):
+        """Take back memory an idle guest is not using; returns the bytes reclaimed"""
+        reclaimed = int(parse_size(session['config'].get('ram', '2048M')) * self.reclaim_fraction)
+        self.reclaimed[vm_id] = reclaimed
+        return reclaimed
+
+    def restore(self, vm_id):
+        """Give reclaimed memory back once the VM is in use again"""
+        return self.reclaimed.pop(vm_id, 0)
+
+
+class IdleMonitor:
+    """Suspends VMs nobody is using and resumes them on their next use.
+
+    A VM is idle while it has no stream viewers, no input and CPU below
+    `cpu_threshold`. After `reclaim_after` idle seconds its spare memory is
+    reclaimed; after `idle_after` it is suspended to disk.
+
+    `running()` returns {vm_id: session} for the VMs this node may suspend.
+    `viewers(vm_id)` and `cpu_percent(vm_id)` (None when unknown) report
+    activity, and `touch(vm_id)` records input. `on_suspended(vm_id)` and
+    `on_resumed(vm_id, session)` record the transition; a falsy return from
+    on_suspended (e.g. the VM was stopped meanwhile) discards the saved state.
+    Suspend and resume of one VM never overlap, and concurrent resumes
+    collapse into one.
+    """
+
+    def __init__(self, backend, running, on_suspended, on_resumed, viewers=None, cpu_percent=None,
+                 idle_after=900.0, reclaim_after=300.0, cpu_threshold=5.0, interval=30.0, observe=None):
+        self.backend = backend
+        self.running = running
+        self.on_suspended = on_suspended
+        self.on_resumed = on_resumed
+        self.viewers = viewers or (lambda vm_id: 0)
+        self.cpu_percent = cpu_percent or (lambda vm_id: None)
+        self.idle_after = idle_after
+        self.reclaim_after = reclaim_after
+        self.cpu_threshold = cpu_threshold
+        self.interval = interval
+        self.observe = observe
+        self._last_active = {}  # vm_id -> last time the VM was in use
+        self._reclaimed = set()
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.stats = {'suspended': 0, 'resumed': 0, 'suspend_failures': 0, 'resume_failures': 0,
+                      'reclaimed_bytes': 0}
+
+    def _lock(self, vm_id):
+        with self._locks_guard:
+            return self._locks.setdefault(vm_id, threading.Lock())
+
+    def touch(self, vm_id):
+        self._last_active[vm_id] = time.time()
+        if vm_id in self._reclaimed:
+            self._restore(vm_id)
+
+    def _restore(self, vm_id):
+        self._reclaimed.discard(vm_id)
+        self.stats['reclaimed_bytes'] -= self.backend.restore(vm_id)
+
+    def sweep(self, now=None):
+        now = time.time() if now is None else now
+        running = self.running()
+        for vm_id in set(self._last_active) - set(running):
+            self._last_active.pop(vm_id, None)
+            if vm_id in self._reclaimed:
+                self._restore(vm_id)
+        for vm_id, session in running.items():
+            cpu = self.cpu_percent(vm_id)
+            if self.viewers(vm_id) or (cpu is not None and cpu > self.cpu_threshold):
+                self.touch(vm_id)
+                continue
+            idle = now - self._last_active.setdefault(vm_id, now)
+            if idle >= self.idle_after:
+                self.suspend(vm_id, session)
+            elif idle >= self.reclaim_after and vm_id not in self._reclaimed:
+                self._reclaimed.add(vm_id)
+                self.stats['reclaimed_bytes'] += self.backend.reclaim(vm_id, session)
+
+    def suspend(self, vm_id, session):
+        started = time.time()
+        with self._lock(vm_id):
+            if vm_id in self._reclaimed:
+                self._restore(vm_id)
+            try:
+                self.backend.suspend(vm_id, session)
+                if not self.on_suspended(vm_id):
+                    self.backend.discard(vm_id)
+                    return False
+            except Exception as e:
+                self.stats['suspend_failures'] += 1
+                logger.error(f"Suspending VM {vm_id} failed: {e}")
+                self.backend.discard(vm_id)
+                return False
+            self._last_active.pop(vm_id, None)
+            self.stats['suspended'] += 1
+        if self.observe:
+            self.observe('suspend', time.time() - started)
+        logger.info(f"Suspended idle VM {vm_id}")
+        return True
+
+    def resume(self, vm_id):
+        """Bring a suspended VM back; False when this node holds no saved state for it"""
+        started = time.time()
+        with self._lock(vm_id):
+            session = self.backend.resume(vm_id)
+            if session is None:
+                return False
+            try:
+                self.on_resumed(vm_id, session)
+            except Exception as e:
+                # The saved state is kept, so the next access retries
+                self.stats['resume_failures'] += 1
+                logger.error(f"Resuming VM {vm_id} failed: {e}")
+                raise
+            self.backend.discard(vm_id)
+            self._last_active[vm_id] = time.time()
+            self.stats['resumed'] += 1
+        if self.observe:
+            self.observe('resume', time.time() - started)
+        logger.info(f"Resumed VM {vm_id}")
+        return True
+
+    def has_saved_state(self, vm_id):
+        return self.backend.saved(vm_id)
+
+    def discard(self, vm_id):
+        """Drop a suspended VM's saved state (it is being stopped)"""
+        with self._lock(vm_id):
+            self.backend.discard(vm_id)
+        with self._locks_guard:
+            self._locks.pop(vm_id, None)
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            'tracked': len(self._last_active),
+            'reclaimed_vms': len(self._reclaimed),
+            'idle_after_seconds': self.idle_after
+        }
+
+    def start(self):
+        if self._thread or not self.idle_after:
+            return
+
+        def run():
+            while not self._stopping.wait(self.interval):
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error(f"Idle sweep failed: {e}")
+
+        self._thread = threading.Thread(target=run, name='idle-monitor', daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._stopping.set()
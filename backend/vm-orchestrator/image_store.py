@@ -0,0 +1,288 @@
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter
+
+from single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+CHUNK_BYTES = 1024 * 1024
+
+
+def image_name(config):
+    """System image a VM config boots from; the same name QemuDriver looks for in its image_dir"""
+    return f"android-{config.get('android_version', '11.0')}"
+
+
+def image_source(location):
+    """Opener for `<location>/<name>.qcow2`, where location is a directory or an http(s) URL"""
+    if location.startswith(('http://', 'https://')):
+        return lambda name: urllib.request.urlopen(f"{location.rstrip('/')}/{name}.qcow2", timeout=60)
+    return lambda name: open(os.path.join(location, f"{name}.qcow2"), 'rb')
+
+
+class ImageStore:
+    """Local system images, deduplicated by content, with a thin overlay disk per VM.
+
+    Images are fetched from `source(name)` (a binary stream) once, hashed
+    while they are copied in, and stored read-only as blobs/<sha256>; names
+    whose content is identical share one blob. Each VM boots from an
+    overlay backed by that blob, created with `qemu-img` when given
+    (otherwise a descriptor file, as for the fake driver), so a launch
+    writes kilobytes instead of copying the image.
+
+    Blobs are evicted least recently used first when the store grows past
+    `quota_bytes`, except while an overlay is backed by them. Names asked
+    for most often, plus `prefetch` ones, are fetched ahead of launches in
+    the background.
+    """
+
+    def __init__(self, root, source, quota_bytes, qemu_img=None, prefetch=(), prefetch_top=2, interval=300.0):
+        self.root = root
+        self.source = source
+        self.quota_bytes = quota_bytes
+        self.qemu_img = qemu_img
+        self.prefetch_names = list(prefetch)
+        self.prefetch_top = prefetch_top
+        self.interval = interval
+        self.stats = {'hits': 0, 'misses': 0, 'prefetches': 0, 'fetch_failures': 0, 'fetched_bytes': 0,
+                      'deduplicated_bytes': 0, 'overlays': 0, 'overlay_bytes_saved': 0, 'evictions': 0,
+                      'evicted_bytes': 0}
+
+        self._lock = threading.Lock()
+        self._fetches = SingleFlight()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._demand = Counter()  # name -> launches that asked for it
+        self._names = {}          # name -> digest
+        self._blobs = {}          # digest -> {'size', 'last_used'}
+        self._overlays = {}       # vm_id -> digest
+        for directory in ('blobs', 'overlays', 'tmp'):
+            os.makedirs(os.path.join(root, directory), exist_ok=True)
+        self._load()
+
+    def _blob_path(self, digest):
+        return os.path.join(self.root, 'blobs', digest)
+
+    def _overlay_path(self, vm_id, suffix):
+        return os.path.join(self.root, 'overlays', f"{vm_id}.{suffix}")
+
+    # Index
+
+    def _load(self):
+        """Rebuild the index from disk: blobs that survived, and the overlays still backed by them"""
+        try:
+            with open(os.path.join(self.root, 'index.json')) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        for digest in os.listdir(os.path.join(self.root, 'blobs')):
+            path = self._blob_path(digest)
+            last_used = index.get('blobs', {}).get(digest, {}).get('last_used', os.path.getmtime(path))
+            self._blobs[digest] = {'size': os.path.getsize(path), 'last_used': last_used}
+        self._names = {name: digest for name, digest in index.get('names', {}).items() if digest in self._blobs}
+        for entry in os.listdir(os.path.join(self.root, 'overlays')):
+            if not entry.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.root, 'overlays', entry)) as f:
+                    digest = json.load(f)['base']
+            except (OSError, ValueError, KeyError):
+                continue
+            if digest in self._blobs:
+                self._overlays[entry[:-len('.json')]] = digest
+        for entry in os.listdir(os.path.join(self.root, 'tmp')):
+            os.remove(os.path.join(self.root, 'tmp', entry))
+
+    def _save(self):
+        """Write the index atomically; called with the lock held"""
+        fd, path = tempfile.mkstemp(dir=os.path.join(self.root, 'tmp'))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'names': self._names, 'blobs': self._blobs}, f)
+        os.replace(path, os.path.join(self.root, 'index.json'))
+
+    def used_bytes(self):
+        with self._lock:
+            return sum(blob['size'] for blob in self._blobs.values())
+
+    # Images
+
+    def ensure(self, name, prefetch=False):
+        """Path of the blob holding `name`, fetching it first on a miss"""
+        with self._lock:
+            if not prefetch:
+                self._demand[name] += 1
+            digest = self._names.get(name)
+            if digest:
+                self._blobs[digest]['last_used'] = time.time()
+                if not prefetch:
+                    self.stats['hits'] += 1
+                return self._blob_path(digest)
+            if not prefetch:
+                self.stats['misses'] += 1
+        # Concurrent launches of a template nobody has fetched yet share one download
+        digest, _ = self._fetches.do(name, lambda: self._fetch(name))
+        if prefetch:
+            with self._lock:
+                self.stats['prefetches'] += 1
+        return self._blob_path(digest)
+
+    def _fetch(self, name):
+        with self._lock:
+            if name in self._names:
+                return self._names[name]
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, 'tmp'))
+        digest = hashlib.sha256()
+        size = 0
+        started = time.time()
+        try:
+            with self.source(name) as stream, os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except Exception as e:
+            os.remove(tmp_path)
+            with self._lock:
+                self.stats['fetch_failures'] += 1
+            logger.error(f"Error fetching image {name}: {e}")
+            raise
+        digest = digest.hexdigest()
+
+        with self._lock:
+            self.stats['fetched_bytes'] += size
+            if digest in self._blobs:
+                # Same content as an image we already hold under another name
+                os.remove(tmp_path)
+                self.stats['deduplicated_bytes'] += size
+            else:
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, self._blob_path(digest))
+                self._blobs[digest] = {'size': size, 'last_used': time.time()}
+            self._blobs[digest]['last_used'] = time.time()
+            self._names[name] = digest
+            self._evict(keep=digest)
+            self._save()
+        logger.info(f"Fetched image {name} ({size} bytes, sha256 {digest[:12]}) in {time.time() - started:.1f}s")
+        return digest
+
+    def _evict(self, keep=None):
+        """Drop least recently used blobs no overlay depends on until under quota; called with the lock held"""
+        used = sum(blob['size'] for blob in self._blobs.values())
+        pinned = set(self._overlays.values()) | {keep}
+        for digest in sorted(self._blobs, key=lambda digest: self._blobs[digest]['last_used']):
+            if used <= self.quota_bytes:
+                return
+            if digest in pinned:
+                continue
+            size = self._blobs.pop(digest)['size']
+            os.remove(self._blob_path(digest))
+            self._names = {name: d for name, d in self._names.items() if d != digest}
+            used -= size
+            self.stats['evictions'] += 1
+            self.stats['evicted_bytes'] += size
+            logger.info(f"Evicted image blob {digest[:12]} ({size} bytes)")
+        if used > self.quota_bytes:
+            logger.warning(f"Image store holds {used} bytes, over its {self.quota_bytes} byte quota, "
+                           f"all of it backing running VMs")
+
+    # Overlays
+
+    def create_overlay(self, vm_id, config):
+        """Thin disk for the VM over its image's blob; returns the path to boot from"""
+        for _ in range(3):
+            base = self.ensure(image_name(config))
+            digest = os.path.basename(base)
+            with self._lock:
+                # Another fetch may have evicted it in between; pinned from here on
+                if digest in self._blobs:
+                    self._overlays[vm_id] = digest
+                    break
+        else:
+            raise RuntimeError(f"Image for VM {vm_id} kept being evicted before its overlay was created")
+        try:
+            if self.qemu_img:
+                path = self._overlay_path(vm_id, 'qcow2')
+                subprocess.run([self.qemu_img, 'create', '-q', '-f', 'qcow2', '-F', 'qcow2', '-b', base, path],
+                               check=True, capture_output=True, timeout=60)
+            else:
+                path = self._overlay_path(vm_id, 'img.json')
+                with open(path, 'w') as f:
+                    json.dump({'backing_file': base}, f)
+            with open(self._overlay_path(vm_id, 'json'), 'w') as f:
+                json.dump({'base': digest, 'image': image_name(config), 'created_at': time.time()}, f)
+        except Exception:
+            self.release(vm_id)
+            raise
+        with self._lock:
+            self.stats['overlays'] += 1
+            self.stats['overlay_bytes_saved'] += max(0, self._blobs[digest]['size'] - os.path.getsize(path))
+        return path
+
+    def release(self, vm_id):
+        """Delete the VM's overlay; its blob becomes evictable once no other overlay uses it"""
+        for suffix in ('qcow2', 'img.json', 'json'):
+            path = self._overlay_path(vm_id, suffix)
+            if os.path.exists(path):
+                os.remove(path)
+        with self._lock:
+            if self._overlays.pop(vm_id, None):
+                self._evict()
+                self._save()
+
+    # Background prefetch
+
+    def popular(self):
+        with self._lock:
+            names = self.prefetch_names + [name for name, _ in self._demand.most_common(self.prefetch_top)]
+        return list(dict.fromkeys(names))
+
+    def prefetch(self):
+        for name in self.popular():
+            try:
+                self.ensure(name, prefetch=True)
+            except Exception as e:
+                logger.error(f"Error prefetching image {name}: {e}")
+
+    def start(self):
+        if self._thread:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._prefetch_loop, name='image-prefetch', daemon=True)
+        self._thread.start()
+
+    def shutdown(self, wait=True):
+        self._stopping.set()
+        if wait and self._thread:
+            self._thread.join()
+        self._thread = None
+
+    def _prefetch_loop(self):
+        while not self._stopping.is_set():
+            self.prefetch()
+            self._stopping.wait(self.interval)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            lookups = stats['hits'] + stats['misses']
+            return {
+                **stats,
+                'hit_rate': round(stats['hits'] / lookups, 3) if lookups else None,
+                'bytes_saved': stats['deduplicated_bytes'] + stats['overlay_bytes_saved'],
+                'images': len(self._names),
+                'blobs': len(self._blobs),
+                'used_bytes': sum(blob['size'] for blob in self._blobs.values()),
+                'quota_bytes': self.quota_bytes,
+                'active_overlays': len(self._overlays)
+            }
@@ -0,0 +1,119 @@
+import logging
+
+from pymongo import IndexModel
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# A user may have one VM in any of these statuses; such VMs carry `active: True`
+ACTIVE_STATUSES = ('starting', 'running', 'suspended')
+
+# Every query on a hot path is served by one of these. Equality fields come
+# first, then the sort/range field, so each query reads only matching keys.
+INDEXES = {
+    'vms': [
+        # Launch pre-check and the unique guard that closes the launch race:
+        # a second concurrent insert for the same user fails instead of booting
+        IndexModel([('user_id', 1)], name='one_active_vm_per_user', unique=True,
+                   partialFilterExpression={'active': True}),
+        # /vms pages by _id, with and without a status filter
+        IndexModel([('user_id', 1), ('_id', 1)], name='user_page'),
+        IndexModel([('user_id', 1), ('status', 1), ('_id', 1)], name='user_status_page'),
+        # Warm pool hand-out: oldest warm VM for a config
+        IndexModel([('status', 1), ('pool_key', 1), ('warmed_at', 1)], name='warm_claim'),
+        # VM cache polling fallback and status event backfill
+        IndexModel([('updated_at', 1)], name='updated_at'),
+        # Reconciliation pages through one node's live VMs, skipping stopped history
+        IndexModel([('node_id', 1), ('status', 1), ('_id', 1)], name='node_status_page'),
+    ],
+    'launch_queue': [
+        IndexModel([('state', 1), ('enqueued_at', 1)], name='state_enqueued'),
+        IndexModel([('state', 1), ('owner', 1)], name='state_owner'),
+        IndexModel([('state', 1), ('heartbeat_at', 1)], name='state_heartbeat'),
+    ],
+    'idempotency_keys': [
+        # Stored launch responses are dropped once past their expiry
+        IndexModel([('expires_at', 1)], name='expiry', expireAfterSeconds=0),
+    ],
+}
+
+# Indexes earlier releases created that the declarations above replace
+RETIRED_INDEXES = {}
+
+
+def backfill_active_flag(db):
+    """VMs created before `active` existed need it before the unique index can guard them"""
+    result = db.vms.update_many(
+        {'active': {'$exists': False}, 'user_id': {'$ne': None}, 'status': {'$in': list(ACTIVE_STATUSES)}},
+        {'$set': {'active': True}}
+    )
+    if result.modified_count:
+        logger.info(f"Marked {result.modified_count} existing VMs active")
+
+
+# Data migrations that must run before the indexes are built
+MIGRATIONS = [backfill_active_flag]
+
+
+def _matches(existing, model):
+    spec = model.document
+    return (
+        list(existing['key']) == list(spec['key'].items())
+        and bool(existing.get('unique')) == bool(spec.get('unique'))
+        and existing.get('partialFilterExpression') == spec.get('partialFilterExpression')
+    )
+
+
+def ensure_indexes(db, indexes=None, retired=None, migrations=None):
+    """Create missing indexes, rebuild ones whose definition changed, drop retired ones.
+
+    Safe to run on every start from every worker: existing matching indexes
+    are left alone. A failed build (e.g. duplicates blocking a unique index)
+    is logged and reported rather than stopping the service.
+    """
+    indexes = INDEXES if indexes is None else indexes
+    retired = RETIRED_INDEXES if retired is None else retired
+    summary = {'created': [], 'rebuilt': [], 'dropped': [], 'failed': []}
+
+    for migration in (MIGRATIONS if migrations is None else migrations):
+        try:
+            migration(db)
+        except PyMongoError as e:
+            logger.error(f"Index migration {migration.__name__} failed: {e}")
+
+    for collection_name in set(indexes) | set(retired):
+        collection = db[collection_name]
+        try:
+            existing = collection.index_information()
+        except PyMongoError as e:
+            logger.error(f"Cannot read indexes of {collection_name}: {e}")
+            summary['failed'].append(collection_name)
+            continue
+
+        for name in retired.get(collection_name, ()):
+            if name in existing:
+                collection.drop_index(name)
+                summary['dropped'].append(f"{collection_name}.{name}")
+
+        for model in indexes.get(collection_name, ()):
+            name = model.document['name']
+            label = f"{collection_name}.{name}"
+            action = 'created'
+            if name in existing:
+                if _matches(existing[name], model):
+                    continue
+                collection.drop_index(name)
+                action = 'rebuilt'
+            options = dict(model.document)
+            keys = list(options.pop('key').items())
+            try:
+                collection.create_index(keys, **options)
+                summary[action].append(label)
+            except PyMongoError as e:
+                logger.error(f"Building index {label} failed: {e}")
+                summary['failed'].append(label)
+
+    changes = {key: value for key, value in summary.items() if value}
+    if changes:
+        logger.info(f"Index migration: {changes}")
+    return summary
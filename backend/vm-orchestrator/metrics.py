@@ -0,0 +1,196 @@
+import bisect
+import logging
+import threading
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds: HTTP handlers and Mongo commands are milliseconds,
+# VM launches take seconds to minutes
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAUNCH_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Sharded:
+    """Values kept per thread, so recording never takes a lock.
+
+    Each thread writes only its own shard (a dict of label values -> list of
+    numbers); a scrape sums them. Shards of threads that have exited are
+    folded into `_retired`, so short-lived request threads do not accumulate.
+    """
+
+    def __init__(self, name, help_text, labelnames, width):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.width = width
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []  # (thread, shard)
+        self._retired = {}
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _values(self, labelvalues):
+        shard = self._shard()
+        values = shard.get(labelvalues)
+        if values is None:
+            values = shard[labelvalues] = [0] * self.width
+        return values
+
+    @staticmethod
+    def _merge(into, shard):
+        # list() copies the items atomically while the owning thread may be writing
+        for key, values in list(shard.items()):
+            total = into.setdefault(key, [0] * len(values))
+            for i, value in enumerate(list(values)):
+                total[i] += value
+
+    def collect(self):
+        """Label values -> summed values across all threads"""
+        with self._lock:
+            live = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    self._merge(self._retired, shard)
+            self._shards = live
+            merged = {key: list(values) for key, values in self._retired.items()}
+            for _, shard in live:
+                self._merge(merged, shard)
+        return merged
+
+
+class Counter(_Sharded):
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames, 1)
+
+    def inc(self, amount=1, *labelvalues):
+        self._values(labelvalues)[0] += amount
+
+    def render(self):
+        for labelvalues, (value,) in sorted(self.collect().items()):
+            yield f"{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}"
+
+
+class Histogram(_Sharded):
+    """Per-bucket counts, then sum and count; rendered cumulatively"""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames, len(self.buckets) + 3)
+
+    def observe(self, value, *labelvalues):
+        values = self._values(labelvalues)
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def render(self):
+        for labelvalues, values in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                le = ('le', _number(bound))
+                yield f"{self.name}_bucket{_labels(self.labelnames, labelvalues, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {_number(float(values[-2]))}"
+            yield f"{self.name}_count{_labels(self.labelnames, labelvalues)} {values[-1]}"
+
+
+class Gauge:
+    """Read at scrape time from `read()`, which returns {label values: value}"""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames, read):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.read = read
+
+    def render(self):
+        for labelvalues, value in sorted(self.read().items()):
+            yield f"{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._add(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge(self, name, help_text, labelnames, read):
+        return self._add(Gauge(name, help_text, labelnames, read))
+
+    def render(self):
+        """Prometheus text exposition of every metric"""
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = list(metric.render())
+            except Exception as e:
+                # One failing gauge (e.g. Mongo down) must not take the whole scrape with it
+                logger.error(f"Collecting metric {metric.name} failed: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Driver command latency by command name (find, insert, update, findAndModify, ...)"""
+
+    def __init__(self, registry):
+        self.latency = registry.histogram('mongo_command_duration_seconds',
+                                          'MongoDB command round trip by command', ('command',))
+        self.failures = registry.counter('mongo_command_failures_total',
+                                         'MongoDB commands that returned an error', ('command',))
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.latency.observe(event.duration_micros / 1e6, event.command_name)
+
+    def failed(self, event):
+        self.latency.observe(event.duration_micros / 1e6, event.command_name)
+        self.failures.inc(1, event.command_name)
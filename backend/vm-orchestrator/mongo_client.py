@@ -0,0 +1,120 @@
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def pool_options(environ=os.environ):
+    """MongoClient pool settings from MONGO_* variables.
+
+    Sized for one server process: request threads, provisioning workers and
+    background loops share the pool. A few connections are kept open so the
+    first requests after a (re)start do not each pay for a handshake, and
+    new connections are opened a few at a time so a burst does not stampede
+    the server.
+    """
+    return {
+        'maxPoolSize': int(environ.get('MONGO_MAX_POOL_SIZE', 64)),
+        'minPoolSize': int(environ.get('MONGO_MIN_POOL_SIZE', 4)),
+        'maxConnecting': int(environ.get('MONGO_MAX_CONNECTING', 4)),
+        'maxIdleTimeMS': int(environ.get('MONGO_MAX_IDLE_MS', 300000)),
+        'connectTimeoutMS': int(environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+        'serverSelectionTimeoutMS': int(environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 10000))
+    }
+
+
+class MongoClientFactory:
+    """One MongoClient per process, created on first use.
+
+    Nothing connects when the app is imported, so a server can preload it
+    and fork workers. A client inherited across a fork (its sockets and
+    monitor threads belong to the parent) is dropped in the child, which
+    opens its own.
+    """
+
+    def __init__(self, uri, client_class, **options):
+        self.uri = uri
+        self.client_class = client_class
+        self.options = options
+        self.stats = {'created': 0, 'dropped_after_fork': 0}
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # The parent's lock may have been held by another thread at fork time
+        self._lock = threading.Lock()
+        if self._client is not None:
+            self._client = None
+            self.stats['dropped_after_fork'] += 1
+
+    def client(self):
+        client = self._client
+        if client is not None and self._pid == os.getpid():
+            return client
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client = self.client_class(self.uri, **self.options)
+                self._pid = os.getpid()
+                self.stats['created'] += 1
+                logger.info(f"Opened MongoDB client in process {self._pid}")
+            return self._client
+
+    def database(self):
+        return self.client().get_database()
+
+    def connected(self):
+        return self._client is not None and self._pid == os.getpid()
+
+    def close(self):
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None and self._pid == os.getpid():
+            client.close()
+
+
+class LazyCollection:
+    """A collection of the factory's database, resolved against the current process's client when used"""
+
+    def __init__(self, factory, name):
+        self._factory = factory
+        self._name = name
+        self._resolved = (None, None)  # (client, collection)
+
+    def _collection(self):
+        client = self._factory.client()
+        resolved_client, collection = self._resolved
+        if resolved_client is not client:
+            collection = client.get_database()[self._name]
+            self._resolved = (client, collection)
+        return collection
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self._collection(), name)
+
+    def __repr__(self):
+        return f"LazyCollection({self._name!r})"
+
+
+class LazyDatabase:
+    """Stands in for the factory's database at import time; `db.vms` and `db['vms']` give lazy collections"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._collections = {}
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections.setdefault(name, LazyCollection(self._factory, name))
+        return collection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
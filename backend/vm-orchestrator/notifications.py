@@ -0,0 +1,238 @@
+import asyncio
+import json
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+import websockets
+
+logger = logging.getLogger(__name__)
+
+# Fields of a VM document sent with each status event
+EVENT_FIELDS = ('status', 'connection_info', 'error')
+
+
+def event_id(updated_at):
+    """Event ids are the transition's updated_at, so any worker can resume from them"""
+    return f"{updated_at:.6f}"
+
+
+def vm_event(vm):
+    event = {
+        'id': event_id(vm.get('updated_at') or 0.0),
+        'vm_id': str(vm['_id']),
+        'updated_at': vm.get('updated_at'),
+    }
+    for field in EVENT_FIELDS:
+        if vm.get(field) is not None:
+            event[field] = vm[field]
+    return event
+
+
+def format_sse(event):
+    return f"id: {event['id']}\nevent: status\ndata: {json.dumps(event, default=str)}\n\n"
+
+
+class Subscription:
+    """One client connection's view of the hub.
+
+    Covers every VM the user owns and/or an explicit set of VM ids, and can
+    be changed while connected. Pending events are coalesced per VM, so a
+    slow client gets each VM's latest state instead of a growing backlog.
+    """
+
+    def __init__(self, hub, user, vm_ids=(), all_owned=True):
+        self.hub = hub
+        self.user_id = user['id']
+        self.all_owned = all_owned
+        self.vm_ids = set(vm_ids)
+        self._pending = OrderedDict()  # vm_id -> event
+        self._delivered = {}           # vm_id -> updated_at of the newest event pushed
+        self._cond = threading.Condition()
+        self._loop = None
+        self._ready = None
+
+    def push(self, event):
+        with self._cond:
+            if (event['updated_at'] or 0) <= self._delivered.get(event['vm_id'], -1):
+                return
+            self._delivered[event['vm_id']] = event['updated_at'] or 0
+            self._pending.pop(event['vm_id'], None)
+            self._pending[event['vm_id']] = event
+            self._cond.notify()
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._ready.set)
+
+    def _drain(self):
+        events = list(self._pending.values())
+        self._pending.clear()
+        return events
+
+    def wait(self, timeout=None):
+        """Block until events arrive (or timeout); returns them, oldest first"""
+        with self._cond:
+            if not self._pending:
+                self._cond.wait(timeout)
+            return self._drain()
+
+    async def wait_async(self, timeout=None):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._ready = asyncio.Event()
+        with self._cond:
+            if self._pending:
+                return self._drain()
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._ready.clear()
+        with self._cond:
+            return self._drain()
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class StatusHub:
+    """Per-process fan-out of VM status transitions to subscribed clients.
+
+    Transitions reach it twice: directly from this worker's write paths,
+    and from the VM state cache's change stream (or polling), which also
+    carries other workers' writes. Only events newer than the last one seen
+    for a VM are fanned out, so the duplicates collapse here.
+
+    `backfill(user_id, vm_ids, all_owned, since)` returns the VM documents
+    updated after `since` and is used to resume a subscription from a
+    Last-Event-ID. `authorize(auth_header, vm_ids)` returns the user allowed
+    to watch those VMs, or None; both may block.
+    """
+
+    def __init__(self, backfill=None, authorize=None, max_tracked=100000, keepalive=15.0):
+        self.backfill = backfill
+        self.authorize = authorize
+        self.max_tracked = max_tracked
+        self.keepalive = keepalive
+        self._lock = threading.Lock()
+        self._latest = OrderedDict()  # vm_id -> (updated_at, status)
+        self._by_user = {}            # user_id -> set of Subscription
+        self._by_vm = {}              # vm_id -> set of Subscription
+        self.stats = {'published': 0, 'duplicates': 0, 'delivered': 0, 'subscriptions': 0}
+
+    def publish(self, vm):
+        if not vm or 'status' not in vm:
+            return
+        vm_id = str(vm['_id'])
+        updated_at = vm.get('updated_at') or 0.0
+        with self._lock:
+            latest = self._latest.get(vm_id)
+            if latest and (latest[0] >= updated_at or latest[1] == vm['status']):
+                self.stats['duplicates'] += 1
+                return
+            self._latest.pop(vm_id, None)
+            self._latest[vm_id] = (updated_at, vm['status'])
+            while len(self._latest) > self.max_tracked:
+                self._latest.popitem(last=False)
+            targets = set(self._by_vm.get(vm_id, ()))
+            targets.update(sub for sub in self._by_user.get(vm.get('user_id'), ()) if sub.all_owned)
+            self.stats['published'] += 1
+            self.stats['delivered'] += len(targets)
+        event = vm_event(vm)
+        for subscription in targets:
+            subscription.push(event)
+
+    def subscribe(self, user, vm_ids=(), all_owned=True, last_event_id=None):
+        subscription = Subscription(self, user, vm_ids, all_owned)
+        with self._lock:
+            self._by_user.setdefault(subscription.user_id, set()).add(subscription)
+            for vm_id in subscription.vm_ids:
+                self._by_vm.setdefault(vm_id, set()).add(subscription)
+            self.stats['subscriptions'] += 1
+        if last_event_id:
+            # Registered first, so nothing written during the backfill is missed;
+            # Subscription.push drops whichever copy arrives second
+            self._resume(subscription, subscription.vm_ids, last_event_id)
+        return subscription
+
+    def update(self, subscription, add=(), remove=()):
+        with self._lock:
+            for vm_id in remove:
+                subscription.vm_ids.discard(vm_id)
+                self._discard(self._by_vm, vm_id, subscription)
+            for vm_id in add:
+                subscription.vm_ids.add(vm_id)
+                self._by_vm.setdefault(vm_id, set()).add(subscription)
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._discard(self._by_user, subscription.user_id, subscription)
+            for vm_id in subscription.vm_ids:
+                self._discard(self._by_vm, vm_id, subscription)
+
+    @staticmethod
+    def _discard(index, key, subscription):
+        members = index.get(key)
+        if members is not None:
+            members.discard(subscription)
+            if not members:
+                del index[key]
+
+    def _resume(self, subscription, vm_ids, last_event_id):
+        if not self.backfill:
+            return
+        try:
+            since = float(last_event_id)
+        except ValueError:
+            return
+        for vm in sorted(self.backfill(subscription.user_id, list(vm_ids), subscription.all_owned, since),
+                         key=lambda vm: vm.get('updated_at') or 0):
+            subscription.push(vm_event(vm))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                **self.stats,
+                'connected': sum(len(subs) for subs in self._by_user.values()),
+                'tracked_vms': len(self._latest)
+            }
+
+    # WebSocket transport, mounted on the stream hub's server at /events
+
+    async def serve_websocket(self, websocket, request, auth_header):
+        """Clients send {"subscribe": [...]} / {"unsubscribe": [...]} to change VMs on the same connection"""
+        query = parse_qs(request.query)
+        vm_ids = query.get('vm_id', [])
+        loop = asyncio.get_running_loop()
+        user = await loop.run_in_executor(None, self.authorize, auth_header, vm_ids)
+        if not user:
+            await websocket.close(1008, 'Access denied')
+            return
+
+        subscription = self.subscribe(
+            user, vm_ids, all_owned=not vm_ids or query.get('all', ['0'])[0] == '1',
+            last_event_id=(query.get('last_event_id') or [None])[0]
+        )
+
+        async def send_events():
+            while True:
+                for event in await subscription.wait_async(self.keepalive):
+                    await websocket.send(json.dumps(event, default=str))
+
+        sender = asyncio.create_task(send_events())
+        try:
+            async for raw in websocket:
+                try:
+                    command = json.loads(raw)
+                except ValueError:
+                    continue
+                add = [str(v) for v in command.get('subscribe', ())]
+                if add and not await loop.run_in_executor(None, self.authorize, auth_header, add):
+                    await websocket.send(json.dumps({'error': 'Access denied', 'vm_ids': add}))
+                    continue
+                self.update(subscription, add=add, remove=[str(v) for v in command.get('unsubscribe', ())])
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            sender.cancel()
+            subscription.close()
@@ -1,16 +1,43 @@
-from flask import Flask, request, jsonify
-import jwt
+from flask import Flask, Response, g, request, jsonify
+import requests
 import os
+import shutil
 import subprocess
 import json
 import threading
 import time
 import logging
-from pymongo import MongoClient
+import uuid
+import atexit
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
 import websockets
 import asyncio
-import psutil
+from auth_cache import JWKSCache, TokenVerifier
+from provisioning import LaunchScheduler, QueueFullError, default_worker_count
+from warm_pool import WarmPool, pool_key
+from snapshots import LocalSnapshotBackend, SnapshotCatalog, parse_size
+from streaming import StreamHub, frame_source_for
+from frame_pipeline import FramebufferSource, framebuffer_path, parse_resolution
+from vm_cache import VMStateCache
+from notifications import StatusHub, format_sse
+from indexes import ACTIVE_STATUSES, ensure_indexes
+from health import HealthMonitor, ProcessTracker
+from telemetry import TelemetryCollector, parse_duration
+from idle import IdleMonitor, SimulatedSuspendBackend
+from bulk import BulkRunner, selector_query
+from status_writes import StatusWriter
+from reconcile import Reconciler, RuntimeDirectory
+from hypervisor import DRIVERS, FakeDriver, NetworkAllocator
+from image_store import ImageStore, image_name, image_source
+from http_cache import ETagMemo, dumps, etag_matches, page_etag, vm_etag
+from single_flight import IdempotencyConflict, IdempotencyStore, SingleFlight, request_fingerprint
+from mongo_client import LazyDatabase, MongoClientFactory, pool_options
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, LAUNCH_BUCKETS, MetricsRegistry, MongoCommandMetrics
+from placement import (NodeRegistry, NodeReporter, PlacementScheduler, default_node_id, default_node_url,
+                       forward_request, placement_token, verify_placement_token, vm_resources)
 
 # Configure logging
 logging.basicConfig(
@@ -32,62 +59,151 @@ app.config['PORT'] = int(os.environ.get('PORT', 8084))
 mongo_uri = os.environ.get('DB_CONNECTION_STRING')
 if not mongo_uri:
     raise ValueError("DB_CONNECTION_STRING environment variable is required. Example: mongodb://localhost:27017/vms")
-client = MongoClient(mongo_uri)
-db = client.get_database()
+
+# Prometheus metrics served on /metrics; recording is per-thread and lock-free
+metrics = MetricsRegistry()
+request_latency = metrics.histogram('http_request_duration_seconds',
+                                    'Time to the response headers by route', ('route', 'method', 'status'))
+launch_phase_seconds = metrics.histogram('vm_launch_phase_seconds',
+                                         'Launch queue wait, boot time and request-to-running time',
+                                         ('phase',), buckets=LAUNCH_BUCKETS)
+idle_transition_seconds = metrics.histogram('vm_idle_transition_seconds',
+                                            'Suspends of idle VMs and resumes on next use',
+                                            ('action',), buckets=LAUNCH_BUCKETS)
+mongo_metrics = MongoCommandMetrics(metrics)
+
+# One client per process, opened on first use: importing this module connects to
+# nothing, so a preloading server can fork workers from it (see gunicorn.conf.py)
+mongo_clients = MongoClientFactory(mongo_uri, MongoClient, event_listeners=[mongo_metrics], **pool_options())
+db = LazyDatabase(mongo_clients)
 vms_collection = db.vms
 
+# VM documents served from memory, kept coherent through the vms change stream
+vm_cache = VMStateCache(
+    vms_collection,
+    poll_interval=float(os.environ.get('VM_CACHE_POLL_SECONDS', 1)),
+    max_staleness=float(os.environ.get('VM_CACHE_MAX_STALENESS_SECONDS', 30))
+)
+
+# Host capacity accounting; every node registers itself and /launch places
+# each VM on the node the policy picks (spread or pack)
+node_registry = NodeRegistry(db.nodes, heartbeat_interval=float(os.environ.get('NODE_HEARTBEAT_SECONDS', 5)))
+NODE_ID = default_node_id(app.config['PORT'])
+node_reporter = NodeReporter(
+    node_registry,
+    NODE_ID,
+    default_node_url(app.config['PORT']),
+    cpu_overcommit=float(os.environ.get('NODE_CPU_OVERCOMMIT', 1)),
+    memory_reserved_mb=int(os.environ.get('NODE_MEMORY_RESERVED_MB', 1024))
+)
+placement_scheduler = PlacementScheduler(node_registry, policy=os.environ.get('PLACEMENT_POLICY', 'spread'))
+PLACEMENT_FORWARD_TIMEOUT = float(os.environ.get('PLACEMENT_FORWARD_TIMEOUT', 10))
+
+# Verified-claims cache: HS256 against JWT_SECRET, RS256/ES256 against the
+# Supabase JWKS endpoint when SUPABASE_JWKS_URL is set
+jwks_url = os.environ.get('SUPABASE_JWKS_URL')
+token_verifier = TokenVerifier(
+    app.config['SECRET_KEY'],
+    jwks=JWKSCache(jwks_url) if jwks_url else None,
+    audience=os.environ.get('JWT_AUDIENCE') or None,
+    max_entries=int(os.environ.get('TOKEN_CACHE_MAX_ENTRIES', 10000)),
+    max_bytes=int(os.environ.get('TOKEN_CACHE_MAX_BYTES', 16 * 1024 * 1024)),
+    max_ttl=float(os.environ.get('TOKEN_CACHE_MAX_TTL', 300))
+)
+
 # Handle Supabase JWT tokens
 def decode_supabase_token(token):
     try:
-        # Supabase tokens are JWT tokens
-        # We can decode them to verify and extract user info
-        return jwt.decode(
-            token, 
-            app.config['SECRET_KEY'], 
-            algorithms=["HS256"],
-            options={"verify_signature": False}  # For demo, we'll skip signature verification
-        )
+        return token_verifier.verify(token)
     except Exception as e:
         logger.error(f"Error decoding token: {e}")
         return None
 
+# Defaults applied to launch requests
+DEFAULT_VM_CONFIG = {
+    'android_version': '11.0',
+    'ram': '2048M',
+    'resolution': '1080x1920',
+    'cpu_cores': 2,
+}
+SIMULATED_BOOT_SECONDS = float(os.environ.get('VM_BOOT_SECONDS', 10))
+STREAM_PORT = int(os.environ.get('STREAM_PORT', 8085))
+STREAM_PUBLIC_URL = os.environ.get('STREAM_PUBLIC_URL', f"ws://localhost:{STREAM_PORT}")
+
 # Store active VM sessions
 active_vms = {}
-active_websockets = {}
+
+class AuthError(Exception):
+    pass
+
+# Resolve the Authorization header to the current user (shared by all server modes)
+def resolve_user(auth_header):
+    token = None
+    if auth_header and auth_header.startswith('Bearer '):
+        token = auth_header.split(' ')[1]
+        
+    if not token:
+        raise AuthError('Authentication token is missing')
+        
+    try:
+        # Use our Supabase token decoder
+        decoded_token = decode_supabase_token(token)
+        
+        if not decoded_token or 'sub' not in decoded_token:
+            raise ValueError("Invalid token structure")
+            
+        return user_from_claims(decoded_token)
+    except Exception as e:
+        logger.error(f"Token validation error: {e}")
+        raise AuthError('Invalid authentication token')
+
+def user_from_claims(claims):
+    # In Supabase, the user ID is in the 'sub' claim
+    return {
+        'id': claims.get('sub'),
+        'email': claims.get('email', ''),
+        'role': claims.get('role', 'user')
+    }
+
+# The user for a token already in the verification cache, else None; a miss may
+# need a JWKS fetch, so callers on an event loop resolve it off the loop
+def cached_user(auth_header):
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None
+    claims = token_verifier.cached(auth_header.split(' ')[1])
+    return user_from_claims(claims) if claims else None
+
+# Per-route latency; the route label is the view name so it stays low-cardinality
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        request_latency.observe(time.perf_counter() - started, request.endpoint or 'unmatched',
+                                request.method, str(response.status_code))
+    return response
 
 # JWT authentication middleware for Supabase tokens
 def authenticate(f):
     def decorator(*args, **kwargs):
-        token = None
-        auth_header = request.headers.get('Authorization')
-        
-        if auth_header and auth_header.startswith('Bearer '):
-            token = auth_header.split(' ')[1]
-            
-        if not token:
-            return jsonify({'message': 'Authentication token is missing'}), 401
-            
         try:
-            # Use our Supabase token decoder
-            decoded_token = decode_supabase_token(token)
-            
-            if not decoded_token or 'sub' not in decoded_token:
-                raise ValueError("Invalid token structure")
-                
-            # In Supabase, the user ID is in the 'sub' claim
-            current_user = {
-                'id': decoded_token.get('sub'),
-                'email': decoded_token.get('email', ''),
-                'role': decoded_token.get('role', 'user')
-            }
-        except Exception as e:
-            logger.error(f"Token validation error: {e}")
-            return jsonify({'message': 'Invalid authentication token'}), 401
+            current_user = resolve_user(request.headers.get('Authorization'))
+        except AuthError as e:
+            return jsonify({'message': str(e)}), 401
             
         return f(current_user, *args, **kwargs)
     decorator.__name__ = f.__name__
     return decorator
 
+def build_vm_config(request_data):
+    return {
+        field: request_data.get(field, default)
+        for field, default in DEFAULT_VM_CONFIG.items()
+    }
+
 # Root endpoint
 @app.route('/', methods=['GET'])
 def root():
@@ -100,31 +216,84 @@ def root():
 # Health check endpoint
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({
-        'status': 'UP',
+    return jsonify(health_report())
+
+def health_report():
+    # Served from the monitor's cached probes; no Mongo round trip or process scan per call
+    snapshot = health_monitor.snapshot()
+    return {
+        'status': snapshot['status'],
         'timestamp': time.time(),
-        'services': {
-            'database': 'UP' if check_db_connection() else 'DOWN',
-            'emulator': 'UP' if check_emulator_status() else 'DOWN'
-        }
-    })
+        'services': {name: check['status'] for name, check in snapshot['checks'].items()},
+        'checks': snapshot['checks']
+    }
 
 def check_db_connection():
-    try:
-        client.admin.command('ping')
-        return True
-    except Exception:
-        return False
+    mongo_clients.client().admin.command('ping')
 
-def check_emulator_status():
-    try:
-        # Check if Android emulator processes are running
-        for proc in psutil.process_iter(['name']):
-            if 'emulator' in proc.info['name'] or 'qemu' in proc.info['name']:
-                return True
-        return False
-    except Exception:
-        return False
+# Emulator processes this orchestrator started; only these are checked
+process_tracker = ProcessTracker()
+# ...and recorded on disk, so they are adopted again after a restart
+vm_runtime = RuntimeDirectory(os.environ.get('VM_RUNTIME_DIR'))
+
+# Guest addresses and host ports, one slot per VM on this node
+network = NetworkAllocator(
+    subnet=os.environ.get('VM_SUBNET', '10.0.0.0/24'),
+    base_port=int(os.environ.get('VM_BASE_PORT', 5554))
+)
+
+# Runs the VM processes: qemu, emulator, or fake (a timed stand-in for development and tests)
+VM_DRIVER = os.environ.get('VM_DRIVER', 'fake')
+VM_READY_TIMEOUT = float(os.environ.get('VM_READY_TIMEOUT_SECONDS', 300))
+if VM_DRIVER == 'fake':
+    hypervisor = FakeDriver(boot_seconds=SIMULATED_BOOT_SECONDS)
+else:
+    hypervisor = DRIVERS[VM_DRIVER](
+        image_dir=os.environ.get('VM_IMAGE_DIR'),
+        run_dir=os.environ.get('VM_RUN_DIR'),
+        network=os.environ.get('VM_NETWORK', 'user'),
+        host_ip=os.environ.get('VM_HOST_IP', '127.0.0.1'),
+        hugepages=os.environ.get('VM_HUGEPAGES', 'false').lower() == 'true',
+        pin_cpus=os.environ.get('VM_PIN_CPUS', 'true').lower() == 'true'
+    )
+
+# Shared, deduplicated system images with a thin overlay disk per VM, used once
+# IMAGE_SOURCE (a directory or http(s) URL of android-<version>.qcow2 files) is
+# set. The emulator boots from its AVDs, so it keeps its own images
+IMAGE_SOURCE = os.environ.get('IMAGE_SOURCE')
+image_store = None
+if IMAGE_SOURCE and VM_DRIVER != 'emulator':
+    image_store = ImageStore(
+        root=os.environ.get('IMAGE_STORE_DIR', '/var/lib/avmo/image-store'),
+        source=image_source(IMAGE_SOURCE),
+        quota_bytes=parse_size(os.environ.get('IMAGE_STORE_QUOTA', '100G')),
+        qemu_img=shutil.which('qemu-img') if VM_DRIVER == 'qemu' else None,
+        prefetch=[image_name({'android_version': version.strip()})
+                  for version in os.environ.get('IMAGE_PREFETCH_VERSIONS', '').split(',') if version.strip()],
+        prefetch_top=int(os.environ.get('IMAGE_PREFETCH_TOP', 2)),
+        interval=float(os.environ.get('IMAGE_PREFETCH_INTERVAL_SECONDS', 300))
+    )
+
+health_monitor = HealthMonitor(
+    {'database': check_db_connection, 'emulator': process_tracker.check},
+    interval=float(os.environ.get('HEALTH_INTERVAL_SECONDS', 5)),
+    max_staleness=float(os.environ.get('HEALTH_MAX_STALENESS_SECONDS', 15))
+)
+
+# CPU, memory, disk and network samples of the tracked processes, kept in memory
+telemetry = TelemetryCollector(
+    process_tracker.targets,
+    interval=float(os.environ.get('TELEMETRY_INTERVAL_SECONDS', 5)),
+    raw_capacity=int(os.environ.get('TELEMETRY_RAW_SAMPLES', 360))
+)
+
+# In-flight launches per user and config, and launch responses by Idempotency-Key
+launch_flights = SingleFlight()
+launch_keys = IdempotencyStore(
+    db.idempotency_keys,
+    ttl=float(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 86400)),
+    wait=float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 10))
+)
 
 # Launch a new VM instance
 @app.route('/launch', methods=['POST'])
@@ -132,98 +301,555 @@ def check_emulator_status():
 def launch_vm(current_user):
     try:
         user_id = current_user['id']
-        request_data = request.get_json()
+        request_data = request.get_json() or {}
+        
+        # A retried request with the same Idempotency-Key gets the first response, on any worker
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key:
+            try:
+                stored = launch_keys.begin(user_id, idempotency_key, request_fingerprint(request_data))
+            except IdempotencyConflict as e:
+                return jsonify({'message': str(e)}), e.status
+            if stored:
+                return stored_response(stored, replayed=True)
+        
+        # Concurrent launches for the same user and config join the one in flight
+        try:
+            response, _ = launch_flights.do((user_id, pool_key(build_vm_config(request_data))),
+                                            lambda: flight_response(launch(current_user, request_data)))
+        except Exception:
+            if idempotency_key:
+                launch_keys.abandon(user_id, idempotency_key)
+            raise
+        if idempotency_key:
+            launch_keys.complete(user_id, idempotency_key, response)
+        return stored_response(response)
+        
+    except Exception as e:
+        logger.error(f"Error launching VM: {e}")
+        return jsonify({'message': 'Error launching VM'}), 500
+
+def flight_response(rv):
+    """A view's return value as plain data, so it can be shared between requests and stored"""
+    response = app.make_response(rv)
+    return {
+        'content': response.get_data(as_text=True),
+        'status': response.status_code,
+        'content_type': response.content_type,
+        'headers': {name: value for name, value in response.headers.items() if name == 'Retry-After'}
+    }
+
+def stored_response(stored, replayed=False):
+    response = Response(stored['content'], stored['status'], content_type=stored['content_type'],
+                        headers=stored.get('headers'))
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def launch(current_user, request_data):
+    try:
+        user_id = current_user['id']
         
         # Check if user already has an active VM
-        existing_vm = vms_collection.find_one({'user_id': user_id, 'status': 'running'})
+        existing_vm = resume_suspended(find_active_vm(user_id), request.headers.get('Authorization'))
         if existing_vm:
-            vm_id = str(existing_vm['_id'])
+            body, code = existing_vm_body(existing_vm)
+            return jsonify(body), code
+        
+        # VM configuration
+        vm_config = build_vm_config(request_data)
+        placement_header = request.headers.get('X-Placement-Token')
+        
+        # Hand out a pre-booted VM when the pool has one for this config
+        # (a launch forwarded by another node already tried the pool there)
+        warm_vm = None if placement_header else warm_pool.acquire(user_id, vm_config)
+        if warm_vm:
+            vm_cache.invalidate(warm_vm['_id'])
+            vm_cache.invalidate_user(user_id)
+            status_hub.publish(warm_vm)
+            logger.info(f"Assigned warm VM {warm_vm['_id']} to user {user_id}")
             return jsonify({
-                'message': 'VM already running',
-                'vm_id': vm_id,
-                'connection_info': existing_vm['connection_info']
+                'message': 'VM is running',
+                'vm_id': str(warm_vm['_id']),
+                'status': 'running',
+                'connection_info': warm_vm['connection_info']
             })
         
-        # VM configuration
-        vm_config = {
-            'android_version': request_data.get('android_version', '11.0'),
-            'ram': request_data.get('ram', '2048M'),
-            'resolution': request_data.get('resolution', '1080x1920'),
-            'cpu_cores': request_data.get('cpu_cores', 2),
-        }
+        # Reserve capacity on a host; launches placed elsewhere are handed to that node
+        try:
+            node, resources = place_launch(vm_config, placement_header)
+        except PlacementError as e:
+            response = jsonify({'message': str(e)})
+            if e.status == 503:
+                response.headers['Retry-After'] = '5'
+            return response, e.status
+        if node and node['_id'] != NODE_ID:
+            content, status, content_type = forward_launch(node, request.headers.get('Authorization'),
+                                                           request_data, resources)
+            return Response(content, status, content_type=content_type)
+        node_id = node['_id'] if node else None
         
         # Create VM document in MongoDB
         vm_doc = {
             'user_id': user_id,
             'config': vm_config,
             'status': 'starting',
+            'active': True,
+            'node_id': node_id,
+            'resources': resources if node_id else None,
             'created_at': time.time(),
+            'updated_at': time.time(),
+            'version': 1,
             'connection_info': None
         }
         
-        result = vms_collection.insert_one(vm_doc)
+        try:
+            result = vms_collection.insert_one(vm_doc)
+        except DuplicateKeyError:
+            # A concurrent launch for this user got there first
+            release_placement(node_id, resources)
+            body, code = existing_vm_body(find_active_vm(user_id))
+            return jsonify(body), code
         vm_id = str(result.inserted_id)
+        vm_cache.invalidate_user(user_id)
         
-        # Start VM in a separate thread
-        threading.Thread(target=start_vm_process, args=(vm_id, vm_config)).start()
+        # Hand the boot to the provisioning pool
+        try:
+            queue_info = launch_scheduler.submit(vm_id, user_id, vm_config)
+        except QueueFullError as e:
+            logger.warning(f"Rejecting launch for user {user_id}: {e}")
+            vms_collection.delete_one({'_id': result.inserted_id})
+            vm_cache.invalidate(vm_id, user_id)
+            release_placement(node_id, resources)
+            response = jsonify({'message': 'Launch queue is full, please retry shortly'})
+            response.headers['Retry-After'] = str(int(launch_scheduler.snapshot()['boot_estimate_seconds']) or 1)
+            return response, 503
         
         return jsonify({
             'message': 'VM is starting',
             'vm_id': vm_id,
-            'status': 'starting'
+            'status': 'starting',
+            **(queue_info or {})
         })
         
     except Exception as e:
         logger.error(f"Error launching VM: {e}")
         return jsonify({'message': 'Error launching VM'}), 500
 
+class PlacementError(Exception):
+    def __init__(self, message, status=503):
+        super().__init__(message)
+        self.status = status
+
+def place_launch(vm_config, placement_header=None):
+    """Node chosen for a new VM (None when no nodes are registered) and the resources reserved there"""
+    if placement_header:
+        claims = verify_placement_token(app.config['SECRET_KEY'], placement_header, NODE_ID)
+        if not claims:
+            raise PlacementError('Invalid placement token', 403)
+        return {'_id': NODE_ID}, claims['resources']
+    
+    resources = vm_resources(vm_config)
+    node = placement_scheduler.place(resources)
+    if node is None and node_registry.any_registered():
+        raise PlacementError('No host has capacity for this VM, please retry shortly')
+    # With no registered nodes (single-node development setups) boot here unaccounted
+    return node, resources
+
+def forward_launch(node, auth_header, request_data, resources):
+    """Hand a placed launch to its node; returns (body, status, content type)"""
+    token = placement_token(app.config['SECRET_KEY'], node['_id'], resources)
+    try:
+        response = forward_request(
+            node, 'POST', '/launch',
+            {'Authorization': auth_header, 'X-Placement-Token': token},
+            request_data, timeout=PLACEMENT_FORWARD_TIMEOUT
+        )
+    except requests.ConnectionError as e:
+        # Never reached the node, so nothing there will use the reservation
+        logger.error(f"Node {node['_id']} unreachable for launch: {e}")
+        release_placement(node['_id'], resources)
+        return json.dumps({'message': 'Chosen host is unreachable, please retry'}), 502, 'application/json'
+    except requests.RequestException as e:
+        # The node may have accepted the launch; reconciliation settles the reservation
+        logger.error(f"Forwarding launch to node {node['_id']} failed: {e}")
+        return json.dumps({'message': 'Chosen host did not respond, please retry'}), 504, 'application/json'
+    return response.content, response.status_code, response.headers.get('Content-Type', 'application/json')
+
+def forward_to_owner(vm, method, path, auth_header):
+    """Requests about a VM's process go to the node running it; None when that is this node (or it is gone)"""
+    if vm.get('node_id') in (None, NODE_ID):
+        return None
+    node = node_registry.get(vm['node_id'])
+    if not node:
+        return None
+    try:
+        response = forward_request(node, method, path, {'Authorization': auth_header}, None,
+                                   timeout=PLACEMENT_FORWARD_TIMEOUT)
+    except requests.RequestException as e:
+        logger.error(f"Node {node['_id']} unreachable for {method} {path}: {e}")
+        return None
+    return response.content, response.status_code, response.headers.get('Content-Type', 'application/json')
+
+def forward_stop(vm, auth_header):
+    # When its node is gone the stop is recorded here, so the reservation is returned
+    return forward_to_owner(vm, 'POST', f"/vm/{vm['_id']}/stop", auth_header)
+
+def release_placement(node_id, resources):
+    if node_id:
+        node_registry.release(node_id, resources)
+
+def release_vm_resources(vm_id):
+    # Marked on the document first so a VM's reservation is only ever returned once
+    vm = vms_collection.find_one_and_update(
+        {'_id': ObjectId(vm_id), 'node_id': {'$ne': None}, 'resources_released': {'$ne': True}},
+        {'$set': {'resources_released': True}}
+    )
+    if vm and vm.get('resources'):
+        node_registry.release(vm['node_id'], vm['resources'])
+
+def reserve_local_capacity(config):
+    """Warm pool hook: account warm VMs against this node"""
+    resources = vm_resources(config)
+    if node_registry.reserve(NODE_ID, resources):
+        return {'node_id': NODE_ID, 'resources': resources}
+    return None if node_registry.any_registered() else {}
+
+def find_active_vm(user_id):
+    return vms_collection.find_one({'user_id': user_id, 'active': True},
+                                   {'status': 1, 'connection_info': 1, 'node_id': 1})
+
+def existing_vm_body(vm):
+    """Launch response for a user who already has an active VM, with its HTTP status"""
+    if vm is None:
+        # The conflicting VM stopped between the failed insert and this lookup
+        return {'message': 'VM launch conflicted, please retry'}, 409
+    vm_id = str(vm['_id'])
+    if vm['status'] == 'running':
+        return {
+            'message': 'VM already running',
+            'vm_id': vm_id,
+            'connection_info': vm['connection_info']
+        }, 200
+    return {
+        'message': 'VM is already starting',
+        'vm_id': vm_id,
+        'status': vm['status'],
+        **(launch_scheduler.position(vm_id) or {})
+    }, 200
+
+def start_instance(vm_id, config, restored=None):
+    """Start the VM under the hypervisor driver and wait until it is ready to serve"""
+    lease = network.lease(vm_id)
+    try:
+        # A VM restored from a snapshot boots from the snapshot's overlay instead
+        disk = image_store.create_overlay(vm_id, config) if image_store and not restored else None
+        instance = hypervisor.start(vm_id, config, lease, restored, disk=disk)
+    except Exception:
+        network.release(vm_id)
+        if image_store:
+            image_store.release(vm_id)
+        raise
+    try:
+        hypervisor.wait_ready(instance, VM_READY_TIMEOUT)
+    except Exception:
+        stop_instance(vm_id, instance)
+        raise
+    return instance
+
+def stop_instance(vm_id, instance):
+    try:
+        hypervisor.stop(instance)
+    except Exception as e:
+        logger.error(f"Error stopping VM {vm_id} process: {e}")
+    network.release(vm_id)
+    if image_store:
+        image_store.release(vm_id)
+
+def cold_boot(vm_id, config):
+    logger.info(f"Starting VM {vm_id} with config: {config}")
+    return start_instance(vm_id, config)
+
+def boot_golden(vm_id, config):
+    # The snapshot backend captures from the config, so the golden VM only has to have booted
+    stop_instance(vm_id, cold_boot(vm_id, config))
+
+# Golden snapshots restored in place of a cold boot when one matches the config.
+# The local backend writes descriptor files, not qcow2 overlays and memory
+# images a hypervisor could boot from, so only fake VMs are restored.
+SNAPSHOT_RESTORE = VM_DRIVER == 'fake'
+snapshot_catalog = SnapshotCatalog(
+    db.snapshots,
+    LocalSnapshotBackend(
+        root=os.environ.get('SNAPSHOT_DIR'),
+        bandwidth_mbps=float(os.environ.get('SNAPSHOT_IO_MBPS', 2000))
+    ),
+    boot_golden
+)
+
+def boot_vm(vm_id, config):
+    restored = None
+    snapshot = snapshot_catalog.lookup(config) if SNAPSHOT_RESTORE else None
+    if snapshot:
+        logger.info(f"Restoring VM {vm_id} from snapshot generation {snapshot['generation']}")
+        restored = snapshot_catalog.restore(vm_id, snapshot)
+    if restored:
+        instance = start_instance(vm_id, config, restored)
+    else:
+        snapshot_catalog.record_cold_boot()
+        instance = cold_boot(vm_id, config)
+    
+    # Generate connection info
+    connection_info = {
+        **instance['connection'],
+        'websocket_url': f"{STREAM_PUBLIC_URL}/stream/{vm_id}",
+        'rtc_url': f"wss://rtc.avmo.local/vm/{vm_id}"
+    }
+    
+    process = instance['process']
+    session = {
+        'config': config,
+        'connection_info': connection_info,
+        'overlay': restored['overlay'] if restored else None,
+        'lease': instance['lease'],
+        'qmp': instance['qmp'],
+        'interface': instance['interface']
+    }
+    if process is not None:
+        process_tracker.track(vm_id, process.pid, instance['interface'])
+        vm_runtime.record(vm_id, process.pid, session)
+    
+    # Add to active VMs
+    active_vms[vm_id] = {'process': process, **session}
+    return connection_info
+
+def vm_documents_written(written):
+    """Status writer hook: the cache and subscribers see every transition"""
+    released = []
+    for vm, fields in written:
+        if 'status' not in fields:
+            continue
+        vm_cache.invalidate(vm['_id'], vm.get('user_id'))
+        status_hub.publish(vm)
+        if vm.get('active') is False:
+            released.append(vm['_id'])
+    if released:
+        release_batch_resources(released)
+
+# VM document updates from all threads, coalesced per VM and written in batches
+status_writer = StatusWriter(
+    vms_collection,
+    window=float(os.environ.get('STATUS_WRITE_WINDOW_MS', 20)) / 1000,
+    max_batch=int(os.environ.get('STATUS_WRITE_MAX_BATCH', 500)),
+    on_written=vm_documents_written
+)
+
+def status_fields(fields):
+    fields['updated_at'] = time.time()
+    if 'status' in fields:
+        fields['active'] = fields['status'] in ACTIVE_STATUSES
+    return fields
+
+def update_vm_status(vm_id, fields, only_from=None):
+    # Every status transition goes through here and waits until Mongo has it, so
+    # terminal states are never only in memory; concurrent transitions share a batch.
+    # With `only_from` it applies only to a VM in that status, else returns None.
+    return status_writer.write(vm_id, status_fields(fields), only_from)
+
+def adopt_placement(vm_id):
+    # A launch re-homed from a dead node boots here, so its reservation moves here too
+    vm = vms_collection.find_one_and_update(
+        {'_id': ObjectId(vm_id), 'node_id': {'$nin': [None, NODE_ID]}},
+        {'$set': {'node_id': NODE_ID, 'updated_at': time.time()}, '$inc': {'version': 1}}
+    )
+    if vm is None:
+        return
+    logger.info(f"VM {vm_id} re-homed from dead node {vm['node_id']}")
+    if vm.get('resources'):
+        node_registry.release(vm['node_id'], vm['resources'])
+        node_registry.reserve(NODE_ID, vm['resources'], force=True)
+    vm_cache.invalidate(vm_id)
+
 def start_vm_process(vm_id, config):
     try:
-        # Simulate starting the Android VM
-        # In a real implementation, this would use QEMU/KVM or Android emulator
-        logger.info(f"Starting VM {vm_id} with config: {config}")
-        time.sleep(10)  # Simulate startup time
-        
-        # Generate connection info
-        connection_info = {
-            'ip': '10.0.0.' + str(int(time.time()) % 255),
-            'port': 5555,
-            'websocket_url': f"ws://localhost:8084/vm/{vm_id}/stream",
-            'rtc_url': f"wss://rtc.avmo.local/vm/{vm_id}"
-        }
+        adopt_placement(vm_id)
+        boot_started = time.time()
+        connection_info = boot_vm(vm_id, config)
+        launch_phase_seconds.observe(time.time() - boot_started, 'booting')
         
         # Update VM status in database
-        vms_collection.update_one(
-            {'_id': ObjectId(vm_id)},
-            {'$set': {
-                'status': 'running',
-                'connection_info': connection_info,
-                'started_at': time.time()
-            }}
-        )
-        
-        # Add to active VMs
-        active_vms[vm_id] = {
-            'process': None,  # Would be the actual process in real implementation
-            'config': config,
-            'connection_info': connection_info
-        }
+        vm = update_vm_status(vm_id, {
+            'status': 'running',
+            'connection_info': connection_info,
+            'started_at': time.time()
+        })
+        if vm and vm.get('created_at'):
+            launch_phase_seconds.observe(vm['started_at'] - (vm.get('relaunched_at') or vm['created_at']), 'ready')
         
         logger.info(f"VM {vm_id} started successfully")
         
     except Exception as e:
         logger.error(f"Error starting VM {vm_id}: {e}")
-        vms_collection.update_one(
-            {'_id': ObjectId(vm_id)},
-            {'$set': {'status': 'error', 'error': str(e)}}
-        )
+        update_vm_status(vm_id, {'status': 'error', 'error': str(e)})
+
+# Provisioning worker pool backed by a persistent launch queue
+launch_scheduler = LaunchScheduler(
+    db.launch_queue,
+    start_vm_process,
+    workers=default_worker_count(),
+    max_queued=int(os.environ.get('LAUNCH_QUEUE_MAX', 1000)),
+    per_user_limit=int(os.environ.get('LAUNCH_PER_USER_LIMIT', 2)),
+    boot_estimate=SIMULATED_BOOT_SECONDS,
+    observe=lambda phase, seconds: launch_phase_seconds.observe(seconds, phase),
+    node_id=NODE_ID,
+    live_nodes=lambda: [node['_id'] for node in node_registry.live_nodes()]
+)
+
+# Pre-booted VMs per config tuple, sized from observed launch rates
+warm_pool = WarmPool(
+    vms_collection,
+    boot_vm,
+    seed_configs=[DEFAULT_VM_CONFIG],
+    min_size=int(os.environ.get('WARM_POOL_MIN', 1)),
+    max_size=int(os.environ.get('WARM_POOL_MAX', 10)),
+    boot_estimate=SIMULATED_BOOT_SECONDS,
+    concurrency=int(os.environ.get('WARM_POOL_BOOT_CONCURRENCY', 1)),
+    place=reserve_local_capacity,
+    release=release_vm_resources
+)
+
+def idle_candidates():
+    """Sessions of user VMs running on this node; warm pool VMs are never suspended"""
+    candidates = {}
+    for vm_id, session in list(active_vms.items()):
+        vm = vm_cache.get(vm_id)
+        if vm and vm.get('user_id') and vm['status'] == 'running':
+            candidates[vm_id] = session
+    return candidates
+
+def record_suspended(vm_id):
+    if not update_vm_status(vm_id, {'status': 'suspended', 'suspended_at': time.time()}, only_from='running'):
+        # Stopped while it was being saved
+        return False
+    # It keeps its network lease, so it comes back on the same address
+    active_vms.pop(vm_id, None)
+    process_tracker.untrack(vm_id)
+    vm_runtime.forget(vm_id)
+    # A suspended VM holds no host memory; it is reserved again on resume
+    release_vm_resources(vm_id)
+    return True
+
+def record_resumed(vm_id, session):
+    vm = vms_collection.find_one({'_id': ObjectId(vm_id)}, {'node_id': 1, 'resources': 1})
+    if vm and vm.get('node_id') and vm.get('resources'):
+        node_registry.reserve(vm['node_id'], vm['resources'], force=True)
+    active_vms[vm_id] = session
+    if session.get('lease'):
+        network.claim(vm_id, session['lease'])
+    if session.get('process') is not None:
+        process_tracker.track(vm_id, session['process'].pid, session.get('interface'))
+        vm_runtime.record(vm_id, session['process'].pid,
+                          {key: value for key, value in session.items() if key != 'process'})
+    update_vm_status(vm_id, {
+        'status': 'running',
+        'connection_info': session['connection_info'],
+        'resumed_at': time.time(),
+        'resources_released': False
+    }, only_from='suspended')
+
+def resume_suspended(vm, auth_header=None):
+    """The VM as it is once resumed if it was suspended, so callers never see the suspension"""
+    if not vm or vm['status'] != 'suspended':
+        return vm
+    vm_id = str(vm['_id'])
+    forwarded = forward_to_owner(vm, 'POST', f"/vm/{vm_id}/resume", auth_header)
+    if forwarded is None and not idle_monitor.resume(vm_id):
+        # Raced with another resume, or the saved state is gone
+        current = vms_collection.find_one({'_id': ObjectId(vm_id)})
+        if current and current['status'] == 'suspended':
+            logger.error(f"No saved state for suspended VM {vm_id}")
+            update_vm_status(vm_id, {'status': 'error', 'error': 'Suspended state was lost'},
+                             only_from='suspended')
+    vm_cache.invalidate(vm_id)
+    return vm_cache.get(vm_id)
+
+def touch_on_stream_activity(event, vm_id, viewer_count):
+    if event in ('connect', 'input'):
+        idle_monitor.touch(vm_id)
+    if event in ('connect', 'disconnect'):
+        # Write-behind: a burst of viewers joining is one update
+        status_writer.submit(vm_id, {'last_active_at': time.time()})
+
+# Idle VMs give back memory, then are suspended to disk until next used. The
+# simulated backend saves no hypervisor state and leaves the process running,
+# so only fake VMs are suspended; under qemu or the emulator it stays off.
+IDLE_SUSPEND_SECONDS = float(os.environ.get('IDLE_SUSPEND_SECONDS', 900)) if VM_DRIVER == 'fake' else 0
+idle_monitor = IdleMonitor(
+    SimulatedSuspendBackend(
+        root=os.environ.get('SUSPEND_DIR'),
+        bandwidth_mbps=float(os.environ.get('SUSPEND_IO_MBPS', 2000))
+    ),
+    idle_candidates,
+    record_suspended,
+    record_resumed,
+    viewers=lambda vm_id: len(active_websockets.get(vm_id, ())),
+    cpu_percent=lambda vm_id: (telemetry.latest(vm_id) or {}).get('cpu_percent'),
+    idle_after=IDLE_SUSPEND_SECONDS,
+    reclaim_after=float(os.environ.get('IDLE_RECLAIM_SECONDS', 300)),
+    cpu_threshold=float(os.environ.get('IDLE_CPU_PERCENT', 5)),
+    interval=float(os.environ.get('IDLE_INTERVAL_SECONDS', 30)),
+    observe=lambda action, seconds: idle_transition_seconds.observe(seconds, action)
+)
+
+def json_response(body, etag=None):
+    """orjson-encoded response; a request already holding `etag` gets a 304 instead"""
+    if etag and etag_matches(request.headers.get('If-None-Match'), etag):
+        return not_modified(etag)
+    response = Response(dumps(body), content_type='application/json')
+    if etag:
+        response.headers['ETag'] = etag
+    return response
+
+def not_modified(etag):
+    return Response(status=304, headers={'ETag': etag})
+
+def vm_status_body(vm_id, vm):
+    """GET /vm/<id> body and its ETag (the queue position of a starting VM changes without a write)"""
+    position = launch_scheduler.position(vm_id) if vm['status'] == 'starting' else None
+    body = {
+        'vm_id': vm_id,
+        'status': vm['status'],
+        'config': vm['config'],
+        'connection_info': vm['connection_info'] if vm['status'] == 'running' else None,
+        **(position or {})
+    }
+    return body, vm_etag(vm_id, vm.get('version'), position)
+
+def unchanged_vm(current_user, vm_id, if_none_match):
+    """ETag of a cached VM the request already holds, or None when the full path must run"""
+    if not if_none_match:
+        return None
+    vm = vm_cache.peek(vm_id)
+    # A suspended VM is resumed by the read, so it is never answered from memory
+    if not vm or vm['status'] == 'suspended':
+        return None
+    if vm['user_id'] != current_user['id'] and current_user['role'] != 'admin':
+        return None
+    etag = vm_status_body(vm_id, vm)[1]
+    return etag if etag_matches(if_none_match, etag) else None
 
 # Get VM status
 @app.route('/vm/<vm_id>', methods=['GET'])
 @authenticate
 def get_vm_status(current_user, vm_id):
     try:
-        vm = vms_collection.find_one({'_id': ObjectId(vm_id)})
+        # A poll that already holds the current version is answered from memory
+        etag = unchanged_vm(current_user, vm_id, request.headers.get('If-None-Match'))
+        if etag:
+            idle_monitor.touch(vm_id)
+            return not_modified(etag)
+        
+        vm = vm_cache.get(vm_id)
         
         if not vm:
             return jsonify({'message': 'VM not found'}), 404
@@ -231,24 +857,47 @@ def get_vm_status(current_user, vm_id):
         # Check if user has access to this VM
         if vm['user_id'] != current_user['id'] and current_user['role'] != 'admin':
             return jsonify({'message': 'Access denied'}), 403
-            
-        return jsonify({
-            'vm_id': vm_id,
-            'status': vm['status'],
-            'config': vm['config'],
-            'connection_info': vm['connection_info'] if vm['status'] == 'running' else None
-        })
+        
+        idle_monitor.touch(vm_id)
+        vm = resume_suspended(vm, request.headers.get('Authorization'))
+        
+        return json_response(*vm_status_body(vm_id, vm))
         
     except Exception as e:
         logger.error(f"Error getting VM status: {e}")
         return jsonify({'message': 'Error retrieving VM status'}), 500
 
+def teardown_vm(vm_id):
+    """Stop the VM's process on this node and drop its local state"""
+    # Waits out a suspend or resume in progress, then drops any saved state
+    idle_monitor.discard(vm_id)
+    
+    # Stop VM process
+    session = active_vms.pop(vm_id, None)
+    if session:
+        stop_instance(vm_id, {**session, 'vm_id': vm_id})
+    network.release(vm_id)
+    process_tracker.untrack(vm_id)
+    vm_runtime.forget(vm_id)
+    snapshot_catalog.release(vm_id)
+    if image_store:
+        image_store.release(vm_id)
+
+def terminate_vm(vm_id):
+    teardown_vm(vm_id)
+    
+    # Update VM status in database
+    update_vm_status(vm_id, {
+        'status': 'stopped',
+        'stopped_at': time.time()
+    })
+
 # Stop VM
 @app.route('/vm/<vm_id>/stop', methods=['POST'])
 @authenticate
 def stop_vm(current_user, vm_id):
     try:
-        vm = vms_collection.find_one({'_id': ObjectId(vm_id)})
+        vm = vm_cache.get(vm_id)
         
         if not vm:
             return jsonify({'message': 'VM not found'}), 404
@@ -257,25 +906,15 @@ def stop_vm(current_user, vm_id):
         if vm['user_id'] != current_user['id'] and current_user['role'] != 'admin':
             return jsonify({'message': 'Access denied'}), 403
             
-        if vm['status'] != 'running':
+        if vm['status'] not in ('running', 'suspended'):
             return jsonify({'message': f"VM is not running (current status: {vm['status']})"}), 400
         
-        # Stop VM process
-        if vm_id in active_vms:
-            # Terminate the process (in real implementation)
-            # if active_vms[vm_id]['process']:
-            #     active_vms[vm_id]['process'].terminate()
-            
-            del active_vms[vm_id]
-            
-        # Update VM status in database
-        vms_collection.update_one(
-            {'_id': ObjectId(vm_id)},
-            {'$set': {
-                'status': 'stopped',
-                'stopped_at': time.time()
-            }}
-        )
+        forwarded = forward_stop(vm, request.headers.get('Authorization'))
+        if forwarded:
+            content, status, content_type = forwarded
+            return Response(content, status, content_type=content_type)
+        
+        terminate_vm(vm_id)
         
         return jsonify({'message': 'VM stopped successfully'})
         
@@ -283,43 +922,777 @@ def stop_vm(current_user, vm_id):
         logger.error(f"Error stopping VM: {e}")
         return jsonify({'message': 'Error stopping VM'}), 500
 
+# Resume a suspended VM now (also happens on its next access or stream connect)
+@app.route('/vm/<vm_id>/resume', methods=['POST'])
+@authenticate
+def resume_vm(current_user, vm_id):
+    try:
+        vm = vm_cache.get(vm_id)
+    except InvalidId:
+        vm = None
+    if not vm:
+        return jsonify({'message': 'VM not found'}), 404
+    if vm['user_id'] != current_user['id'] and current_user['role'] != 'admin':
+        return jsonify({'message': 'Access denied'}), 403
+    
+    vm = resume_suspended(vm, request.headers.get('Authorization'))
+    return jsonify({'vm_id': vm_id, 'status': vm['status'] if vm else 'stopped'})
+
+def reconcile_sessions():
+    # A VM whose tracked process has exited no longer counts as running here
+    return {vm_id: session for vm_id, session in list(active_vms.items()) if vm_id not in process_tracker.exited}
+
+def adopt_vm(vm_id, process, session):
+    active_vms[vm_id] = {'process': process, **session}
+    if session.get('lease') and not network.claim(vm_id, session['lease']):
+        logger.warning(f"Address of adopted VM {vm_id} was handed out again meanwhile")
+    process_tracker.track(vm_id, process.pid, session.get('interface'))
+    logger.info(f"Adopted running VM {vm_id} (pid {process.pid})")
+
+def mark_orphaned(orphans):
+    """Reconciliation hook: VMs nothing on this node backs any more go to error, in one batch"""
+    writes = [(vm_id, status_writer.submit(vm_id, status_fields({'status': 'error', 'error': reason}),
+                                           only_from=status))
+              for vm_id, status, reason in orphans]
+    moved = 0
+    for vm_id, write in writes:
+        if write.result():
+            teardown_vm(vm_id)
+            moved += 1
+    return moved
+
+# Mongo state diffed against the VMs actually on this node, at startup and periodically
+reconciler = Reconciler(
+    vms_collection,
+    db.launch_queue,
+    node_registry,
+    NODE_ID,
+    vm_runtime,
+    reconcile_sessions,
+    adopt_vm,
+    teardown_vm,
+    mark_orphaned,
+    idle_monitor.has_saved_state,
+    page_size=int(os.environ.get('RECONCILE_PAGE_SIZE', 500)),
+    starting_grace=float(os.environ.get('RECONCILE_STARTING_GRACE_SECONDS', 120)),
+    interval=float(os.environ.get('RECONCILE_INTERVAL_SECONDS', 60))
+)
+
+# Last reconciliation pass and running totals (admins only)
+@app.route('/reconcile/stats', methods=['GET'])
+@authenticate
+def reconcile_stats(current_user):
+    if current_user['role'] != 'admin':
+        return jsonify({'message': 'Access denied'}), 403
+    return jsonify(reconciler.snapshot())
+
+# VM process driver and address allocation on this node (admins only)
+@app.route('/hypervisor/stats', methods=['GET'])
+@authenticate
+def hypervisor_stats(current_user):
+    if current_user['role'] != 'admin':
+        return jsonify({'message': 'Access denied'}), 403
+    return jsonify({'driver': VM_DRIVER, **hypervisor.snapshot(), 'network': network.snapshot()})
+
+# Fleet operations for admins: a selector picks the VMs, a background job works
+# through them in batches and streams per-VM progress
+bulk_runner = BulkRunner(
+    db.jobs,
+    concurrency=int(os.environ.get('BULK_CONCURRENCY', 8)),
+    batch_size=int(os.environ.get('BULK_BATCH_SIZE', 100)),
+    max_vms=int(os.environ.get('BULK_MAX_VMS', 10000))
+)
+BULK_FIELDS = {'user_id': 1, 'status': 1, 'config': 1, 'node_id': 1, 'resources': 1}
+STOPPABLE_STATUSES = ('running', 'suspended')
+RELAUNCHABLE_STATUSES = ('stopped', 'error')
+
+def release_batch_resources(object_ids):
+    """release_vm_resources for many VMs: two queries plus one $inc per node"""
+    marker = uuid.uuid4().hex
+    vms_collection.update_many(
+        {'_id': {'$in': object_ids}, 'node_id': {'$ne': None}, 'resources_released': {'$ne': True}},
+        {'$set': {'resources_released': True, 'release_batch': marker}}
+    )
+    per_node = {}
+    for vm in vms_collection.find({'_id': {'$in': object_ids}, 'release_batch': marker}, {'node_id': 1, 'resources': 1}):
+        if vm.get('resources'):
+            totals = per_node.setdefault(vm['node_id'], {key: 0 for key in vm['resources']})
+            for key, value in vm['resources'].items():
+                totals[key] += value
+    for node_id, resources in per_node.items():
+        node_registry.release(node_id, resources)
+
+def apply_batch_status(ops, object_ids, status, now):
+    """Write a batch of transitions in one unordered bulk_write; returns the VMs it moved to `status`
+    and the indexes of operations that failed (e.g. on the one-active-VM guard)"""
+    failed = set()
+    if ops:
+        try:
+            vms_collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            failed = {error['index'] for error in e.details.get('writeErrors', ())}
+    moved = list(vms_collection.find({'_id': {'$in': object_ids}, 'status': status, 'updated_at': now}))
+    for vm in moved:
+        vm_cache.invalidate(vm['_id'], vm.get('user_id'))
+        status_hub.publish(vm)
+    return moved, failed
+
+def bulk_stop_batch(auth_header):
+    def process(job, vms, parallel):
+        local = []
+        remote = []
+        for vm in vms:
+            if vm['status'] not in STOPPABLE_STATUSES:
+                job.record(vm['_id'], 'skipped', f"VM is {vm['status']}")
+            elif vm.get('node_id') in (None, NODE_ID):
+                local.append(vm)
+            else:
+                remote.append(vm)
+        
+        # Other nodes stop their own VMs; a node that is gone is settled here
+        for vm, forwarded, error in parallel(lambda vm: forward_stop(vm, auth_header), remote):
+            if error:
+                job.record(vm['_id'], 'failed', str(error))
+            elif forwarded is None:
+                local.append(vm)
+            elif forwarded[1] == 200:
+                job.record(vm['_id'], 'stopped')
+            else:
+                job.record(vm['_id'], 'failed', f"Node {vm['node_id']} answered {forwarded[1]}")
+        
+        torn_down = []
+        for vm, _, error in parallel(lambda vm: teardown_vm(str(vm['_id'])), local):
+            if error:
+                job.record(vm['_id'], 'failed', str(error))
+            else:
+                torn_down.append(vm['_id'])
+        
+        now = time.time()
+        ops = [UpdateOne({'_id': vm_id, 'status': {'$in': list(STOPPABLE_STATUSES)}},
+                         {'$set': {'status': 'stopped', 'active': False, 'stopped_at': now, 'updated_at': now},
+                          '$inc': {'version': 1}})
+               for vm_id in torn_down]
+        moved, _ = apply_batch_status(ops, torn_down, 'stopped', now)
+        release_batch_resources([vm['_id'] for vm in moved])
+        stopped = {vm['_id'] for vm in moved}
+        for vm_id in torn_down:
+            if vm_id in stopped:
+                job.record(vm_id, 'stopped')
+            else:
+                job.record(vm_id, 'skipped', 'Status changed while stopping')
+    return process
+
+def bulk_launch_batch(job, vms, parallel):
+    candidates = []
+    for vm in vms:
+        if vm['status'] not in RELAUNCHABLE_STATUSES:
+            job.record(vm['_id'], 'skipped', f"VM is {vm['status']}")
+        elif not vm.get('user_id'):
+            job.record(vm['_id'], 'skipped', 'VM has no owner')
+        else:
+            candidates.append(vm)
+    
+    # Relaunches boot on this node, so capacity is reserved here
+    placed = []
+    for vm, placement, error in parallel(lambda vm: reserve_local_capacity(vm['config']), candidates):
+        if error or placement is None:
+            job.record(vm['_id'], 'failed', str(error) if error else 'No capacity on this node')
+        else:
+            placed.append((vm, placement))
+    
+    now = time.time()
+    ops = [UpdateOne(
+        {'_id': vm['_id'], 'status': {'$in': list(RELAUNCHABLE_STATUSES)}},
+        {'$set': {'status': 'starting', 'active': True, 'node_id': placement.get('node_id'),
+                  'resources': placement.get('resources'), 'resources_released': False,
+                  'connection_info': None, 'relaunched_at': now, 'updated_at': now},
+         '$unset': {'error': '', 'stopped_at': ''},
+         '$inc': {'version': 1}}
+    ) for vm, placement in placed]
+    moved, failed = apply_batch_status(ops, [vm['_id'] for vm, _ in placed], 'starting', now)
+    started = {vm['_id'] for vm in moved}
+    
+    for index, (vm, placement) in enumerate(placed):
+        vm_id = str(vm['_id'])
+        if vm['_id'] not in started:
+            release_placement(placement.get('node_id'), placement.get('resources'))
+            job.record(vm_id, 'skipped', 'User already has an active VM' if index in failed
+                       else 'Status changed while launching')
+            continue
+        vm_cache.invalidate_user(vm['user_id'])
+        try:
+            launch_scheduler.submit(vm_id, vm['user_id'], vm['config'])
+            job.record(vm_id, 'queued')
+        except QueueFullError as e:
+            update_vm_status(vm_id, {'status': 'error', 'error': str(e)})
+            job.record(vm_id, 'failed', str(e))
+
+def start_bulk_job(job_type, current_user, request_data, auth_header):
+    """Select the VMs and start the job; returns (body, status)"""
+    if current_user['role'] != 'admin':
+        return {'message': 'Access denied'}, 403
+    selector = (request_data or {}).get('selector', {})
+    try:
+        query = selector_query(selector)
+    except (ValueError, InvalidId, TypeError) as e:
+        return {'message': str(e)}, 400
+    
+    vms = list(vms_collection.find(query, BULK_FIELDS).limit(bulk_runner.max_vms + 1))
+    if len(vms) > bulk_runner.max_vms:
+        return {'message': f"Selector matches more than {bulk_runner.max_vms} VMs; narrow it"}, 400
+    
+    process = bulk_stop_batch(auth_header) if job_type == 'bulk_stop' else bulk_launch_batch
+    job_id = bulk_runner.start(job_type, current_user['id'], selector, vms, process)
+    logger.info(f"{current_user['id']} started {job_type} job {job_id} for {len(vms)} VMs")
+    return {
+        'message': f"{job_type.replace('_', ' ').capitalize()} started",
+        'job_id': job_id,
+        'total': len(vms),
+        'events_url': f"/vms/bulk/{job_id}/events"
+    }, 202
+
+def bulk_job_body(job_id, current_user, offset=0, with_results=True):
+    job = bulk_runner.get(job_id, offset, with_results)
+    if not job or not job['type'].startswith('bulk_'):
+        return {'message': 'Job not found'}, 404
+    if job['user_id'] != current_user['id'] and current_user['role'] != 'admin':
+        return {'message': 'Access denied'}, 403
+    job['job_id'] = job.pop('_id')
+    return job, 200
+
+# Each server-sent event stream holds a request thread for as long as its
+# client stays connected, so streams may take at most SSE_MAX_SUBSCRIBERS of
+# the server's threads (32 under gunicorn.conf.py) and the rest stay free for
+# API calls. Open streams end once the server starts shutting down, so they
+# do not hold up the drain.
+SSE_MAX_SUBSCRIBERS = int(os.environ.get('SSE_MAX_SUBSCRIBERS', 8))
+sse_slots = threading.BoundedSemaphore(SSE_MAX_SUBSCRIBERS)
+sse_closing = threading.Event()
+sse_lock = threading.Lock()
+sse_stats = {'open': 0, 'opened': 0, 'rejected': 0}
+
+def event_stream_stats():
+    with sse_lock:
+        return {**sse_stats, 'max_open': SSE_MAX_SUBSCRIBERS}
+
+def open_event_stream():
+    """Take a stream slot; False when SSE_MAX_SUBSCRIBERS streams are already open"""
+    acquired = not sse_closing.is_set() and sse_slots.acquire(blocking=False)
+    with sse_lock:
+        if acquired:
+            sse_stats['open'] += 1
+            sse_stats['opened'] += 1
+        else:
+            sse_stats['rejected'] += 1
+    return acquired
+
+def close_event_stream():
+    with sse_lock:
+        sse_stats['open'] -= 1
+    sse_slots.release()
+
+def end_event_streams():
+    sse_closing.set()
+
+def event_streams_unavailable():
+    response = jsonify({'message': 'Too many open event streams, retry shortly'})
+    response.headers['Retry-After'] = str(int(status_hub.keepalive))
+    return response, 503
+
+def event_stream_response(chunks, on_close=None):
+    """text/event-stream response over a slot taken with open_event_stream, given back when the client goes"""
+    def stream():
+        for chunk in chunks:
+            yield chunk
+            if sse_closing.is_set():
+                return
+
+    def close():
+        if on_close:
+            on_close()
+        close_event_stream()
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(close)
+    return response
+
+def bulk_events(job_id, offset):
+    """SSE lines of a job's per-VM progress from `offset`, ending with its final state"""
+    yield 'retry: 2000\n\n'
+    while True:
+        progress = bulk_runner.wait(job_id, offset, status_hub.keepalive)
+        if progress is None:
+            return
+        results, state = progress
+        if not results and state == 'running':
+            yield ': keepalive\n\n'
+        for result in results:
+            yield f"id: {offset}\nevent: progress\ndata: {json.dumps(result)}\n\n"
+            offset += 1
+        if state != 'running' and not results:
+            yield f"event: done\ndata: {json.dumps({'job_id': job_id, 'state': state})}\n\n"
+            return
+
+# Stop every VM a selector matches (admins only)
+@app.route('/vms/bulk/stop', methods=['POST'])
+@authenticate
+def bulk_stop(current_user):
+    body, code = start_bulk_job('bulk_stop', current_user, request.get_json(silent=True),
+                                request.headers.get('Authorization'))
+    return jsonify(body), code
+
+# Relaunch every stopped or failed VM a selector matches (admins only)
+@app.route('/vms/bulk/launch', methods=['POST'])
+@authenticate
+def bulk_launch(current_user):
+    body, code = start_bulk_job('bulk_launch', current_user, request.get_json(silent=True),
+                                request.headers.get('Authorization'))
+    return jsonify(body), code
+
+# Bulk job state, counts and per-VM results (?offset= to page through them)
+@app.route('/vms/bulk/<job_id>', methods=['GET'])
+@authenticate
+def bulk_job(current_user, job_id):
+    body, code = bulk_job_body(job_id, current_user, int(request.args.get('offset', 0)))
+    return jsonify(body), code
+
+# Per-VM progress of a bulk job as server-sent events
+@app.route('/vms/bulk/<job_id>/events', methods=['GET'])
+@authenticate
+def bulk_job_events(current_user, job_id):
+    body, code = bulk_job_body(job_id, current_user, with_results=False)
+    if code != 200:
+        return jsonify(body), code
+    # Event ids are result indexes, so a reconnect resumes after the last one seen
+    last_event_id = request.headers.get('Last-Event-ID')
+    offset = int(last_event_id) + 1 if last_event_id else int(request.args.get('offset', 0))
+    if not open_event_stream():
+        return event_streams_unavailable()
+    return event_stream_response(bulk_events(job_id, offset))
+
+VM_LIST_FIELDS = ('status', 'config', 'connection_info', 'created_at', 'started_at', 'stopped_at', 'updated_at')
+VMS_PAGE_DEFAULT = int(os.environ.get('VMS_PAGE_DEFAULT', 50))
+VMS_PAGE_MAX = int(os.environ.get('VMS_PAGE_MAX', 200))
+
+def vm_page_query(user_id, args):
+    """Query, projection and page size for /vms; served by the user_page/user_status_page indexes"""
+    query = {'user_id': user_id}
+    if args.get('status'):
+        query['status'] = args['status']
+    if args.get('cursor'):
+        query['_id'] = {'$gt': ObjectId(args['cursor'])}
+    
+    limit = int(args.get('limit', VMS_PAGE_DEFAULT))
+    if not 0 < limit <= VMS_PAGE_MAX:
+        raise ValueError(f"limit must be between 1 and {VMS_PAGE_MAX}")
+    
+    fields = args.get('fields')
+    fields = fields.split(',') if fields else VM_LIST_FIELDS
+    unknown = set(fields) - set(VM_LIST_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return query, {field: 1 for field in fields}, limit
+
+def vm_page(vms, limit, projection):
+    """The /vms body and its ETag; `vms` were read with `version` added to the projection"""
+    # One extra document was fetched to tell whether another page exists
+    has_more = len(vms) > limit
+    vms = vms[:limit]
+    next_cursor = str(vms[-1]['_id']) if has_more else None
+    etag = page_etag(vms, next_cursor, list(projection))
+    for vm in vms:
+        vm.pop('version', None)
+    return {'vms': vms, 'next_cursor': next_cursor}, etag
+
+# ETags of the /vms pages last served, so an unchanged listing is confirmed without a query
+vm_page_etags = ETagMemo(max_entries=int(os.environ.get('VMS_ETAG_MEMO_ENTRIES', 10000)))
+
+def vm_page_key(user_id, args):
+    return user_id, tuple(sorted(args.items()))
+
 # List user's VMs
 @app.route('/vms', methods=['GET'])
 @authenticate
 def list_user_vms(current_user):
     try:
-        user_id = current_user['id']
-        status_filter = request.args.get('status')
-        
-        query = {'user_id': user_id}
-        if status_filter:
-            query['status'] = status_filter
+        try:
+            query, projection, limit = vm_page_query(current_user['id'], request.args)
+        except (ValueError, InvalidId) as e:
+            return jsonify({'message': str(e)}), 400
             
-        vms = list(vms_collection.find(query))
+        # Read before the query, so a write racing it invalidates the memoized ETag
+        user_id = current_user['id']
+        generation = vm_cache.listing_generation(user_id)
+        key = vm_page_key(user_id, request.args)
+        etag = vm_page_etags.get(key, generation)
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            return not_modified(etag)
         
-        # Convert ObjectId to string for JSON serialization
-        for vm in vms:
-            vm['_id'] = str(vm['_id'])
-            
-        return jsonify({'vms': vms})
+        vms = list(vms_collection.find(query, {**projection, 'version': 1}).sort('_id', 1).limit(limit + 1))
+        page, etag = vm_page(vms, limit, projection)
+        vm_page_etags.put(key, etag, generation)
+        return json_response(page, etag)
         
     except Exception as e:
         logger.error(f"Error listing VMs: {e}")
         return jsonify({'message': 'Error retrieving VMs'}), 500
 
-# WebSocket streaming endpoint (would be implemented with asyncio in production)
+# Only the VM's owner (or an admin) may watch a running VM
+def authorize_stream(vm_id, auth_header):
+    try:
+        user = resolve_user(auth_header)
+        vm = vm_cache.get(vm_id)
+    except (AuthError, InvalidId):
+        return None
+    if not vm or vm['user_id'] != user['id'] and user['role'] != 'admin':
+        return None
+    vm = resume_suspended(vm, auth_header)
+    if not vm or vm['status'] != 'running':
+        return None
+    return user
+
+# Raw framebuffers go through the tile-diff pipeline; anything else is
+# forwarded as the VM encoded it
+def stream_source(vm_id):
+    fb_path = framebuffer_path(vm_id)
+    if os.path.exists(fb_path):
+        config = (active_vms.get(vm_id) or {}).get('config') or DEFAULT_VM_CONFIG
+        width, height = parse_resolution(config['resolution'])
+        return FramebufferSource(fb_path, width, height, fps=int(os.environ.get('STREAM_FPS', 30)))
+    return frame_source_for(vm_id)
+
+# WebSocket frame streaming, served on STREAM_PORT by its own event loop
+stream_hub = StreamHub(stream_source, authorize_stream)
+active_websockets = stream_hub.viewers
+stream_hub.listeners.append(touch_on_stream_activity)
+
+# Subscribers may watch all of their own VMs; naming VMs requires access to each
+def subscription_user(auth_header, vm_ids):
+    """The subscribing user, or None when any of `vm_ids` is missing or not theirs; raises AuthError for a bad token"""
+    user = resolve_user(auth_header)
+    try:
+        for vm_id in vm_ids:
+            vm = vm_cache.get(vm_id)
+            if not vm or (vm['user_id'] != user['id'] and user['role'] != 'admin'):
+                return None
+    except InvalidId:
+        return None
+    return user
+
+def authorize_subscription(auth_header, vm_ids):
+    try:
+        return subscription_user(auth_header, vm_ids)
+    except AuthError:
+        return None
+
+def status_backfill(user_id, vm_ids, all_owned, since):
+    scopes = [{'_id': {'$in': [ObjectId(vm_id) for vm_id in vm_ids]}}] if vm_ids else []
+    if all_owned:
+        scopes.append({'user_id': user_id})
+    return list(vms_collection.find(
+        {'$or': scopes, 'updated_at': {'$gt': since}},
+        {'status': 1, 'connection_info': 1, 'error': 1, 'updated_at': 1, 'user_id': 1}
+    ))
+
+# Status transitions pushed to subscribers over SSE (/vms/events) and WebSocket (/events)
+status_hub = StatusHub(
+    backfill=status_backfill,
+    authorize=authorize_subscription,
+    keepalive=float(os.environ.get('EVENTS_KEEPALIVE_SECONDS', 15))
+)
+vm_cache.listeners.append(status_hub.publish)
+stream_hub.routes['events'] = status_hub.serve_websocket
+
+# VM status event stream; resumes from Last-Event-ID after a reconnect
+@app.route('/vms/events', methods=['GET'])
+def vm_events():
+    vm_ids = request.args.getlist('vm_id')
+    try:
+        user = subscription_user(request.headers.get('Authorization'), vm_ids)
+    except AuthError as e:
+        return jsonify({'message': str(e)}), 401
+    if not user:
+        return jsonify({'message': 'Access denied'}), 403
+    if not open_event_stream():
+        return event_streams_unavailable()
+    
+    subscription = status_hub.subscribe(
+        user, vm_ids,
+        all_owned=not vm_ids or request.args.get('all') == '1',
+        last_event_id=request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    )
+    
+    def stream():
+        yield 'retry: 2000\n\n'
+        while True:
+            events = subscription.wait(status_hub.keepalive)
+            if not events:
+                yield ': keepalive\n\n'
+            for event in events:
+                yield format_sse(event)
+    
+    return event_stream_response(stream(), on_close=subscription.close)
+
+# Resource usage of a VM's process over ?range= (e.g. 15m, 6h, 7d), served from memory
+@app.route('/vm/<vm_id>/metrics', methods=['GET'])
+@authenticate
+def vm_metrics(current_user, vm_id):
+    try:
+        seconds = parse_duration(request.args.get('range', '15m'))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    
+    try:
+        vm = vm_cache.get(vm_id)
+    except InvalidId:
+        vm = None
+    if not vm:
+        return jsonify({'message': 'VM not found'}), 404
+    if vm['user_id'] != current_user['id'] and current_user['role'] != 'admin':
+        return jsonify({'message': 'Access denied'}), 403
+    
+    forwarded = forward_to_owner(vm, 'GET', request.full_path, request.headers.get('Authorization'))
+    if forwarded:
+        content, status, content_type = forwarded
+        return Response(content, status, content_type=content_type)
+    
+    return jsonify(vm_metrics_body(vm_id, seconds))
+
+def vm_metrics_body(vm_id, seconds):
+    window = telemetry.window(vm_id, seconds)
+    if window is None:
+        # Simulated VMs have no process, and history ends when a VM stops
+        window = {'resolution': None, 'step_seconds': None, 'samples': []}
+    return {'vm_id': vm_id, 'range_seconds': seconds, 'sampled': window['resolution'] is not None, **window}
+
+# WebSocket streaming endpoint
 @app.route('/vm/<vm_id>/stream', methods=['GET'])
 def vm_stream_info(vm_id):
-    vm = vms_collection.find_one({'_id': ObjectId(vm_id)})
+    try:
+        vm = vm_cache.get(vm_id)
+    except InvalidId:
+        vm = None
     
     if not vm or vm['status'] != 'running':
         return jsonify({'message': 'VM not running'}), 404
         
     return jsonify({
-        'websocket_url': f"ws://localhost:8084/stream/{vm_id}",
-        'status': 'available'
+        'websocket_url': f"{STREAM_PUBLIC_URL}/stream/{vm_id}",
+        'status': 'available',
+        'viewers': len(active_websockets.get(vm_id, ()))
     })
 
+# Per-connection latency and throughput for a VM's viewers
+@app.route('/vm/<vm_id>/stream/stats', methods=['GET'])
+@authenticate
+def vm_stream_stats(current_user, vm_id):
+    if not authorize_stream(vm_id, request.headers.get('Authorization')):
+        return jsonify({'message': 'VM not running or access denied'}), 404
+    return jsonify({'vm_id': vm_id, 'viewers': stream_hub.stats(vm_id)[vm_id]})
+
+# Launch queue statistics
+@app.route('/launch/queue', methods=['GET'])
+@authenticate
+def launch_queue_stats(current_user):
+    return jsonify(launch_scheduler.snapshot())
+
+# Warm pool hit/miss counters and sizes
+@app.route('/pool/stats', methods=['GET'])
+@authenticate
+def warm_pool_stats(current_user):
+    return jsonify(warm_pool.stats())
+
+# Golden snapshot catalog
+@app.route('/snapshots', methods=['GET'])
+@authenticate
+def list_snapshots(current_user):
+    return jsonify({
+        'snapshots': [{**snapshot, '_id': str(snapshot['_id'])} for snapshot in snapshot_catalog.list()],
+        'stats': snapshot_catalog.stats
+    })
+
+# Create or refresh the golden snapshot for a VM config
+@app.route('/snapshots', methods=['POST'])
+@authenticate
+def create_snapshot(current_user):
+    if current_user['role'] != 'admin':
+        return jsonify({'message': 'Access denied'}), 403
+    if not SNAPSHOT_RESTORE:
+        return jsonify({'message': f"Snapshots are not supported by the {VM_DRIVER} driver"}), 409
+    
+    request_data = request.get_json() or {}
+    config = build_vm_config(request_data)
+    existing = snapshot_catalog.lookup(config)
+    
+    def build():
+        try:
+            snapshot_catalog.create(config)
+        except Exception as e:
+            logger.error(f"Snapshot build failed: {e}")
+    
+    threading.Thread(target=build, name='snapshot-build', daemon=True).start()
+    return jsonify({
+        'message': 'Snapshot refresh started' if existing else 'Snapshot creation started',
+        'config': config
+    }), 202
+
+# VM state cache hit rate, size and coherence mode
+@app.route('/vms/cache/stats', methods=['GET'])
+@authenticate
+def vm_cache_stats(current_user):
+    return jsonify(vm_cache.snapshot())
+
+# Status subscription counters
+@app.route('/vms/events/stats', methods=['GET'])
+@authenticate
+def vm_events_stats(current_user):
+    return jsonify({**status_hub.snapshot(), 'sse': event_stream_stats()})
+
+# Registered nodes, their free capacity and the placement policy (admins only)
+@app.route('/nodes', methods=['GET'])
+@authenticate
+def list_nodes(current_user):
+    if current_user['role'] != 'admin':
+        return jsonify({'message': 'Access denied'}), 403
+    nodes = node_registry.live_nodes()
+    return jsonify({
+        'node_id': NODE_ID,
+        'policy': placement_scheduler.policy,
+        'stats': placement_scheduler.stats,
+        'nodes': [{'node_id': node.pop('_id'), **node} for node in nodes]
+    })
+
+# Image store hit rate, bytes saved and disk use
+@app.route('/images/stats', methods=['GET'])
+@authenticate
+def image_stats(current_user):
+    if not image_store:
+        return jsonify({'message': 'Image store is not enabled'}), 404
+    return jsonify(image_store.snapshot())
+
+# Idle suspend/resume counters
+@app.route('/vms/idle/stats', methods=['GET'])
+@authenticate
+def idle_stats(current_user):
+    return jsonify(idle_monitor.snapshot())
+
+# Telemetry sampler counters and memory held by the rings
+@app.route('/telemetry/stats', methods=['GET'])
+@authenticate
+def telemetry_stats(current_user):
+    return jsonify(telemetry.snapshot())
+
+# Token verification cache hit rate and size
+@app.route('/auth/cache/stats', methods=['GET'])
+@authenticate
+def token_cache_stats(current_user):
+    return jsonify(token_verifier.snapshot())
+
+# Statuses reported on /metrics; counted through the index that leads with status
+VM_STATUSES = ACTIVE_STATUSES + ('stopped', 'error', 'warm', 'warming')
+
+metrics.gauge('vm_reclaimed_memory_bytes', 'Guest memory reclaimed from idle VMs on this node', (),
+              lambda: {(): idle_monitor.stats['reclaimed_bytes']})
+
+if image_store:
+    metrics.gauge('image_store_lookups', 'Image lookups by launches, by whether the image was already local',
+                  ('result',), lambda: {('hit',): image_store.stats['hits'], ('miss',): image_store.stats['misses']})
+    metrics.gauge('image_store_bytes_saved', 'Image bytes not stored or copied, by what saved them', ('reason',),
+                  lambda: {('deduplicated',): image_store.stats['deduplicated_bytes'],
+                           ('overlay',): image_store.stats['overlay_bytes_saved']})
+    metrics.gauge('image_store_used_bytes', 'Disk used by image blobs on this node', (),
+                  lambda: {(): image_store.used_bytes()})
+    metrics.gauge('image_store_evictions', 'Image blobs evicted to stay under the quota', (),
+                  lambda: {(): image_store.stats['evictions']})
+
+def vm_status_counts():
+    return {(status,): vms_collection.count_documents({'status': status}) for status in VM_STATUSES}
+
+metrics.gauge('vms', 'VMs by status across all nodes', ('status',), vm_status_counts)
+
+# Worker pools by name -> callable returning workers/busy/queued; other server modes add theirs
+thread_pools = {'launch': lambda: launch_scheduler.snapshot()}
+
+def thread_pool_gauge(key):
+    return lambda: {(name,): pool()[key] for name, pool in thread_pools.items()}
+
+metrics.gauge('thread_pool_workers', 'Threads in each worker pool', ('pool',), thread_pool_gauge('workers'))
+metrics.gauge('thread_pool_busy', 'Workers currently running a task', ('pool',), thread_pool_gauge('busy'))
+metrics.gauge('thread_pool_queued', 'Tasks waiting for a free worker', ('pool',), thread_pool_gauge('queued'))
+
+# Prometheus scrape endpoint
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+# Set once a process has started its background services (each server worker does, after the fork)
+background_started = threading.Event()
+background_lock = threading.Lock()
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT_SECONDS', 90))
+
+def start_background_services():
+    with background_lock:
+        if background_started.is_set():
+            return
+        background_started.set()
+    sse_closing.clear()
+    ensure_indexes(db)
+    status_writer.start()
+    # Heartbeats still queued are written before the process exits
+    atexit.register(status_writer.shutdown)
+    health_monitor.start()
+    telemetry.start()
+    idle_monitor.start()
+    node_reporter.start()
+    # Before the launch queue resumes, so lost launches are settled first
+    reconciler.start()
+    if token_verifier.jwks:
+        token_verifier.jwks.start()
+    vm_cache.start()
+    launch_scheduler.start()
+    warm_pool.start()
+    if image_store:
+        image_store.start()
+    stream_hub.start(port=STREAM_PORT)
+
+def drain(timeout=None):
+    """Stop taking on work and let what is in flight finish, once the server has stopped accepting requests.
+
+    Boots already running in start_vm_process complete and record their
+    outcome; launches still queued stay in Mongo for the next process, and
+    running VMs are left running for it to adopt.
+    """
+    with background_lock:
+        if not background_started.is_set():
+            return
+        background_started.clear()
+    end_event_streams()
+    started = time.time()
+    deadline = started + (DRAIN_TIMEOUT if timeout is None else timeout)
+    remaining = lambda: max(0.0, deadline - time.time())
+
+    launch_scheduler.shutdown(wait=True, timeout=remaining())
+    warm_pool.shutdown(wait=True, timeout=remaining())
+    busy = launch_scheduler.snapshot()['busy']
+    if busy:
+        logger.warning(f"Drain timed out with {busy} launches still booting")
+    for service in (reconciler, idle_monitor, health_monitor, telemetry, node_reporter, vm_cache):
+        service.shutdown()
+    if image_store:
+        image_store.shutdown(wait=False)
+    if token_verifier.jwks:
+        token_verifier.jwks.shutdown()
+    try:
+        stream_hub.shutdown()
+    except Exception as e:
+        logger.error(f"Error closing stream server: {e}")
+    # Status updates written by the launches that just finished
+    status_writer.shutdown(timeout=remaining())
+    mongo_clients.close()
+    logger.info(f"Drained in {time.time() - started:.1f}s")
+
 # Run the Flask application
 if __name__ == '__main__':
+    start_background_services()
     app.run(host='0.0.0.0', port=app.config['PORT'])
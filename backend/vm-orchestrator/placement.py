@@ -0,0 +1,236 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+import jwt
+import psutil
+import requests
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from snapshots import parse_size
+
+logger = logging.getLogger(__name__)
+
+MIB = 1024 * 1024
+RESOURCE_KEYS = ('cpu_cores', 'memory_mb')
+
+
+def vm_resources(config):
+    """Host resources a VM config reserves"""
+    return {
+        'cpu_cores': int(config.get('cpu_cores', 1)),
+        'memory_mb': -(-parse_size(config.get('ram', '2048M')) // MIB)
+    }
+
+
+def host_capacity(cpu_overcommit=1.0, memory_reserved_mb=1024):
+    """What this host can hand to VMs; NODE_CPU_CORES/NODE_MEMORY_MB override psutil
+    so several processes on one machine can stand in for differently sized hosts"""
+    cpu = os.environ.get('NODE_CPU_CORES')
+    memory = os.environ.get('NODE_MEMORY_MB')
+    return {
+        'cpu_cores': int(cpu) if cpu else int((psutil.cpu_count(logical=True) or 1) * cpu_overcommit),
+        'memory_mb': int(memory) if memory else max(0, psutil.virtual_memory().total // MIB - memory_reserved_mb)
+    }
+
+
+def host_load():
+    load = {'cpu_percent': psutil.cpu_percent(interval=None)}
+    if not os.environ.get('NODE_MEMORY_MB'):
+        # Simulated hosts share one machine's memory, so only real ones report it
+        load['memory_available_mb'] = psutil.virtual_memory().available // MIB
+    return load
+
+
+def remaining_fraction(node, resources):
+    """Mean share of the node's capacity left after placing `resources`"""
+    shares = []
+    for key in RESOURCE_KEYS:
+        capacity = node['capacity'][key] or 1
+        shares.append((node['free'][key] - resources[key]) / capacity)
+    return sum(shares) / len(shares)
+
+
+# Lower score wins. pack is best-fit: fill the fullest node that still fits,
+# keeping whole hosts free for large VMs (and idle hosts drainable). spread is
+# worst-fit: put each VM on the emptiest node to even out load.
+POLICIES = {
+    'pack': remaining_fraction,
+    'spread': lambda node, resources: -remaining_fraction(node, resources),
+}
+
+
+class NodeRegistry:
+    """Orchestrator nodes and their unreserved capacity, in the `nodes` collection.
+
+    Reservations are a conditional $inc on the node's `free` counters, so two
+    nodes placing at once can never both take the last slot on a host.
+    """
+
+    def __init__(self, collection, heartbeat_interval=5.0):
+        self.collection = collection
+        self.heartbeat_interval = heartbeat_interval
+
+    def register(self, node_id, url, capacity, load=None):
+        """Upsert a node, keeping reservations made before a restart or a capacity change"""
+        for _ in range(10):
+            existing = self.collection.find_one({'_id': node_id})
+            now = time.time()
+            if existing is None:
+                try:
+                    self.collection.insert_one({
+                        '_id': node_id, 'url': url, 'capacity': capacity, 'free': dict(capacity),
+                        'load': load or {}, 'started_at': now, 'heartbeat_at': now
+                    })
+                    return
+                except DuplicateKeyError:
+                    # Registered concurrently; merge with that document instead
+                    continue
+            free = {
+                key: capacity[key] - (existing['capacity'][key] - existing['free'][key])
+                for key in RESOURCE_KEYS
+            }
+            result = self.collection.update_one(
+                {'_id': node_id, 'free': existing['free']},
+                {'$set': {'url': url, 'capacity': capacity, 'free': free, 'load': load or {},
+                          'started_at': now, 'heartbeat_at': now}}
+            )
+            if result.matched_count:
+                return
+        raise RuntimeError(f"Could not register node {node_id}: reservations kept changing")
+
+    def get(self, node_id):
+        return self.collection.find_one({'_id': node_id})
+
+    def heartbeat(self, node_id, load):
+        self.collection.update_one({'_id': node_id}, {'$set': {'load': load, 'heartbeat_at': time.time()}})
+
+    def live_nodes(self):
+        stale_before = time.time() - 3 * self.heartbeat_interval
+        return list(self.collection.find({'heartbeat_at': {'$gte': stale_before}}))
+
+    def any_registered(self):
+        return self.collection.count_documents({}, limit=1) > 0
+
+    def reserve(self, node_id, resources, force=False):
+        """Take `resources` from the node's free capacity; `force` may overcommit it
+        (a resumed VM must come back on the node holding its state)"""
+        query = {'_id': node_id}
+        for key in RESOURCE_KEYS if not force else ():
+            query[f'free.{key}'] = {'$gte': resources[key]}
+        return self.collection.find_one_and_update(
+            query,
+            {'$inc': {f'free.{key}': -resources[key] for key in RESOURCE_KEYS}},
+            return_document=ReturnDocument.AFTER
+        )
+
+    def release(self, node_id, resources):
+        self.collection.update_one(
+            {'_id': node_id},
+            {'$inc': {f'free.{key}': resources[key] for key in RESOURCE_KEYS}}
+        )
+
+
+class PlacementScheduler:
+    """Chooses a node for each VM and reserves its resources there"""
+
+    def __init__(self, registry, policy='spread'):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown placement policy {policy}; expected one of {', '.join(POLICIES)}")
+        self.registry = registry
+        self.policy = policy
+        self.stats = {'placed': 0, 'rejected': 0, 'conflicts': 0}
+
+    def candidates(self, resources):
+        score = POLICIES[self.policy]
+        fits = [
+            node for node in self.registry.live_nodes()
+            if all(node['free'][key] >= resources[key] for key in RESOURCE_KEYS)
+            # Reservations are bookkeeping; also skip hosts that are short on real memory
+            and node.get('load', {}).get('memory_available_mb', resources['memory_mb']) >= resources['memory_mb']
+        ]
+        return sorted(fits, key=lambda node: (score(node, resources), node['_id']))
+
+    def place(self, resources):
+        """Reserve `resources` on the best live node; returns the node, or None if nothing fits"""
+        for node in self.candidates(resources):
+            reserved = self.registry.reserve(node['_id'], resources)
+            if reserved:
+                self.stats['placed'] += 1
+                return reserved
+            # Another placement took the space since we read the node
+            self.stats['conflicts'] += 1
+        self.stats['rejected'] += 1
+        return None
+
+
+class NodeReporter:
+    """Registers this orchestrator as a node and keeps its heartbeat and load current"""
+
+    def __init__(self, registry, node_id, url, cpu_overcommit=1.0, memory_reserved_mb=1024):
+        self.registry = registry
+        self.node_id = node_id
+        self.url = url
+        self.cpu_overcommit = cpu_overcommit
+        self.memory_reserved_mb = memory_reserved_mb
+        self._capacity = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def report(self):
+        capacity = host_capacity(self.cpu_overcommit, self.memory_reserved_mb)
+        if capacity != self._capacity:
+            self.registry.register(self.node_id, self.url, capacity, host_load())
+            self._capacity = capacity
+            logger.info(f"Node {self.node_id} registered at {self.url} with {capacity}")
+        else:
+            self.registry.heartbeat(self.node_id, host_load())
+
+    def start(self):
+        if self._thread:
+            return
+        self.report()
+
+        def run():
+            while not self._stopping.wait(self.registry.heartbeat_interval):
+                try:
+                    self.report()
+                except Exception as e:
+                    logger.error(f"Node heartbeat failed: {e}")
+
+        self._thread = threading.Thread(target=run, name='node-reporter', daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._stopping.set()
+
+
+def default_node_id(port):
+    return os.environ.get('NODE_ID') or f"{socket.gethostname()}:{port}"
+
+
+def default_node_url(port):
+    return os.environ.get('NODE_URL') or f"http://{socket.gethostname()}:{port}"
+
+
+# The node that placed a launch hands it to the chosen node with a short-lived
+# signed token, so the reservation is not repeated and clients cannot forge one
+
+def placement_token(secret, node_id, resources, ttl=60):
+    return jwt.encode({'node_id': node_id, 'resources': resources, 'exp': int(time.time() + ttl)},
+                      secret, algorithm='HS256')
+
+
+def verify_placement_token(secret, token, node_id):
+    try:
+        claims = jwt.decode(token, secret, algorithms=['HS256'])
+    except jwt.InvalidTokenError:
+        return None
+    return claims if claims.get('node_id') == node_id else None
+
+
+def forward_request(node, method, path, headers, body, timeout=10.0):
+    return requests.request(method, node['url'].rstrip('/') + path, headers=headers, json=body, timeout=timeout)
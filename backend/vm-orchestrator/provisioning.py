@@ -0,0 +1,287 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# Memory budget assumed for a single booting VM when sizing the pool
+BOOT_MEMORY_BYTES = 2 * 1024 ** 3
+
+
+class QueueFullError(Exception):
+    """Raised when the launch queue has reached its configured depth"""
+
+
+def default_worker_count():
+    """Size the provisioning pool to what the host can boot concurrently"""
+    configured = os.environ.get('PROVISION_WORKERS')
+    if configured:
+        return max(1, int(configured))
+    cpus = psutil.cpu_count(logical=False) or psutil.cpu_count() or 1
+    memory_slots = psutil.virtual_memory().total // BOOT_MEMORY_BYTES
+    return max(1, min(cpus, memory_slots))
+
+
+class LaunchScheduler:
+    """Fixed-size provisioning worker pool fed by a Mongo-backed launch queue.
+
+    Queue documents live in their own collection keyed by vm_id so queued
+    launches survive a restart. Workers dispatch round-robin across users,
+    with a cap on concurrent boots per user, so one tenant cannot starve
+    the others. `observe('queued', seconds)` is called with each launch's
+    time in the queue.
+
+    Launches are placed before they are queued, so each entry records the
+    `node_id` it was submitted on and only that node's scheduler boots it.
+    Entries of nodes that `live_nodes()` no longer lists are re-homed to
+    this node once they have waited past the heartbeat grace period.
+    """
+
+    def __init__(self, collection, handler, workers=None, max_queued=1000,
+                 per_user_limit=2, boot_estimate=10.0, heartbeat_interval=15.0, observe=None,
+                 node_id=None, live_nodes=None):
+        self.collection = collection
+        self.handler = handler
+        self.node_id = node_id
+        self.live_nodes = live_nodes
+        self.observe = observe
+        self.workers = workers or default_worker_count()
+        self.max_queued = max_queued
+        self.per_user_limit = per_user_limit
+        self.heartbeat_interval = heartbeat_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()  # user_id -> deque of jobs, in round-robin order
+        self._queued_ids = {}          # vm_id -> user_id
+        self._in_flight = {}           # user_id -> number of boots in progress
+        self._busy = 0
+        self._boot_estimate = boot_estimate
+        self._threads = []
+        self._stopping = False
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+
+    # Queue operations
+
+    def submit(self, vm_id, user_id, config):
+        """Persist a launch request and hand it to the worker pool"""
+        with self._cond:
+            if len(self._queued_ids) >= self.max_queued:
+                self.stats['rejected'] += 1
+                raise QueueFullError(f"Launch queue is full ({self.max_queued} pending)")
+
+        now = time.time()
+        self.collection.insert_one({
+            '_id': vm_id,
+            'user_id': user_id,
+            'config': config,
+            'node_id': self.node_id,
+            'state': 'queued',
+            'enqueued_at': now,
+        })
+
+        with self._cond:
+            self._enqueue({'vm_id': vm_id, 'user_id': user_id, 'config': config})
+            self.stats['submitted'] += 1
+            position = self._position(vm_id)
+            self._cond.notify()
+        return position
+
+    def position(self, vm_id):
+        """Queue position and ETA for a pending launch, or None once dispatched"""
+        with self._cond:
+            return self._position(vm_id)
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'busy': self._busy,
+                'queued': len(self._queued_ids),
+                'max_queued': self.max_queued,
+                'users_waiting': len(self._pending),
+                'boot_estimate_seconds': round(self._boot_estimate, 2),
+                **self.stats,
+            }
+
+    def _enqueue(self, job):
+        if job['vm_id'] in self._queued_ids:
+            return
+        self._pending.setdefault(job['user_id'], deque()).append(job)
+        self._queued_ids[job['vm_id']] = job['user_id']
+
+    def _position(self, vm_id):
+        user_id = self._queued_ids.get(vm_id)
+        if user_id is None:
+            return None
+
+        # Jobs are taken one per user per round, so anything at a lower
+        # index in another user's queue (or the same index for users ahead
+        # of us in the rotation) is dispatched first.
+        users = list(self._pending)
+        own_index = users.index(user_id)
+        depth = next(i for i, job in enumerate(self._pending[user_id]) if job['vm_id'] == vm_id)
+        ahead = depth
+        for i, other in enumerate(users):
+            if other != user_id:
+                ahead += min(len(self._pending[other]), depth + (1 if i < own_index else 0))
+
+        return {
+            'queue_position': ahead + 1,
+            'eta_seconds': round((ahead // self.workers + 1) * self._boot_estimate, 1),
+        }
+
+    def _next_job(self):
+        for user_id in list(self._pending):
+            if self._in_flight.get(user_id, 0) >= self.per_user_limit:
+                continue
+            jobs = self._pending.pop(user_id)
+            job = jobs.popleft()
+            if jobs:
+                # Re-append so the user goes to the back of the rotation
+                self._pending[user_id] = jobs
+            del self._queued_ids[job['vm_id']]
+            return job
+        return None
+
+    # Worker pool
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            # The process running the workers; under a preloading server not the one that built the scheduler
+            self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self._recover()
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"vm-provisioner-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        heartbeat = threading.Thread(target=self._heartbeat, name='vm-provisioner-heartbeat', daemon=True)
+        heartbeat.start()
+        self._threads.append(heartbeat)
+        logger.info(f"Launch scheduler started with {self.workers} workers ({self.owner})")
+
+    def shutdown(self, wait=True, timeout=None):
+        """Stop dispatching; launches still queued stay in Mongo for the next start"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if wait:
+            deadline = None if timeout is None else time.time() + timeout
+            for thread in self._threads:
+                thread.join(None if deadline is None else max(0, deadline - time.time()))
+        self._threads = []
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = None
+                while job is None:
+                    if self._stopping:
+                        return
+                    job = self._next_job()
+                    if job is None:
+                        self._cond.wait()
+                self._in_flight[job['user_id']] = self._in_flight.get(job['user_id'], 0) + 1
+                self._busy += 1
+
+            try:
+                self._run(job)
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    remaining = self._in_flight[job['user_id']] - 1
+                    if remaining:
+                        self._in_flight[job['user_id']] = remaining
+                    else:
+                        del self._in_flight[job['user_id']]
+                    self._cond.notify_all()
+
+    def _run(self, job):
+        vm_id = job['vm_id']
+        # Claim atomically so another orchestrator process never boots the same VM
+        claimed = self.collection.find_one_and_update(
+            {'_id': vm_id, 'state': 'queued', 'node_id': self.node_id},
+            {'$set': {'state': 'claimed', 'owner': self.owner, 'heartbeat_at': time.time()}}
+        )
+        if not claimed:
+            return
+
+        started = time.time()
+        if self.observe:
+            self.observe('queued', started - claimed['enqueued_at'])
+        outcome = 'completed'
+        try:
+            self.handler(vm_id, job['config'])
+        except Exception as e:
+            outcome = 'failed'
+            logger.error(f"Provisioning worker failed for VM {vm_id}: {e}")
+        finally:
+            elapsed = time.time() - started
+            with self._cond:
+                self.stats[outcome] += 1
+                # Exponentially weighted so ETAs follow the host's current boot speed
+                self._boot_estimate = 0.8 * self._boot_estimate + 0.2 * elapsed
+            self.collection.delete_one({'_id': vm_id, 'owner': self.owner})
+
+    # Persistence and recovery
+
+    def _recover(self, adopt_all=True):
+        """Requeue launches orphaned by dead processes and load this node's pending ones into memory"""
+        stale_before = time.time() - 3 * self.heartbeat_interval
+        query = {'state': 'queued', 'node_id': self.node_id}
+        if not adopt_all:
+            # Recent entries belong to live processes that will dispatch them
+            query['enqueued_at'] = {'$lt': stale_before}
+        try:
+            self.collection.update_many(
+                {'state': 'claimed', 'heartbeat_at': {'$lt': stale_before}},
+                {'$set': {'state': 'queued'}, '$unset': {'owner': '', 'heartbeat_at': ''}}
+            )
+            if self.live_nodes:
+                # Launches placed on a node that has since died would otherwise never boot
+                rehomed = self.collection.update_many(
+                    {'state': 'queued', 'node_id': {'$nin': list(self.live_nodes())},
+                     'enqueued_at': {'$lt': stale_before}},
+                    {'$set': {'node_id': self.node_id}}
+                )
+                if rehomed.modified_count:
+                    logger.info(f"Re-homed {rehomed.modified_count} launches queued on dead nodes")
+            pending = list(self.collection.find(query).sort('enqueued_at', 1))
+        except Exception as e:
+            logger.error(f"Error recovering launch queue: {e}")
+            return
+
+        with self._cond:
+            for doc in pending:
+                self._enqueue({'vm_id': doc['_id'], 'user_id': doc['user_id'], 'config': doc['config']})
+            self._cond.notify_all()
+        if pending:
+            logger.info(f"Recovered {len(pending)} queued launches")
+
+    def _heartbeat(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.heartbeat_interval)
+                if self._stopping:
+                    return
+            try:
+                self.collection.update_many(
+                    {'state': 'claimed', 'owner': self.owner},
+                    {'$set': {'heartbeat_at': time.time()}}
+                )
+            except Exception as e:
+                logger.error(f"Error renewing launch queue claims: {e}")
+            # Pick up launches stranded by processes that died since we started
+            self._recover(adopt_all=False)
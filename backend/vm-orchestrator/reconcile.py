@@ -0,0 +1,262 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import psutil
+from bson.objectid import ObjectId
+
+from placement import RESOURCE_KEYS
+
+logger = logging.getLogger(__name__)
+
+# Statuses that claim something exists on a node: a process, a boot in progress or saved state
+RECONCILED_STATUSES = ('starting', 'running', 'suspended', 'warming', 'warm')
+RECONCILE_FIELDS = {'status': 1, 'updated_at': 1, 'node_id': 1, 'resources': 1, 'resources_released': 1}
+
+
+class RuntimeDirectory:
+    """One small record per VM process on this host, so a restarted orchestrator can find them.
+
+    A record holds the PID, the process start time (so a recycled PID is
+    not mistaken for the VM) and the session needed to serve the VM again.
+    """
+
+    def __init__(self, root=None):
+        self.root = root or os.path.join(tempfile.gettempdir(), 'avmo-runtime')
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, vm_id):
+        return os.path.join(self.root, f"{vm_id}.json")
+
+    def record(self, vm_id, pid, session):
+        record = {'pid': pid, 'create_time': psutil.Process(pid).create_time(), 'session': session}
+        path = self._path(vm_id)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(record, f)
+        os.replace(path + '.tmp', path)
+
+    def forget(self, vm_id):
+        try:
+            os.remove(self._path(vm_id))
+        except FileNotFoundError:
+            pass
+
+    def load(self):
+        """{vm_id: (psutil.Process, session)} for recorded processes still running; dead records are removed"""
+        live = {}
+        for name in os.listdir(self.root):
+            if not name.endswith('.json'):
+                continue
+            vm_id = name[:-len('.json')]
+            try:
+                with open(os.path.join(self.root, name)) as f:
+                    record = json.load(f)
+                process = psutil.Process(record['pid'])
+                if process.create_time() != record['create_time'] or process.status() == psutil.STATUS_ZOMBIE:
+                    raise psutil.NoSuchProcess(record['pid'])
+            except (OSError, ValueError, KeyError, psutil.Error):
+                self.forget(vm_id)
+                continue
+            live[vm_id] = (process, record['session'])
+        return live
+
+
+class Reconciler:
+    """Brings this node's VM documents and the VMs actually on the node back in line.
+
+    VMs in a RECONCILED_STATUSES status on this node (or on no node) are read
+    in _id-ordered pages, so a pass touches only live documents however many
+    stopped ones have accumulated. For each page:
+
+    - running/warm VMs with no session here are re-adopted when their
+      process survived (`runtime.load()`), otherwise marked error;
+    - starting VMs with no launch queue entry, and warming VMs with no
+      session, are marked error once older than `starting_grace`;
+    - suspended VMs whose saved state is gone are marked error.
+
+    A periodic pass only marks a VM error when the previous pass found it
+    unaccounted for too, so a stop or resume in flight is never caught half
+    way; the startup pass, with nothing in flight, acts at once.
+
+    Sessions here whose document no longer places them on this node are torn
+    down, and a drift between the node's reserved capacity and what its VMs
+    hold is corrected once two passes in a row measure the same drift (a
+    single reading may include a launch reserved but not yet inserted).
+
+    `sessions()` returns {vm_id: session} held in memory, `adopt(vm_id,
+    process, session)` takes a surviving VM back, `teardown(vm_id)` drops one,
+    `mark_orphaned([(vm_id, status, reason)])` moves VMs out of `status` to
+    error and returns how many it moved, and `saved_state(vm_id)` says whether
+    a suspended VM can be resumed.
+    """
+
+    def __init__(self, collection, queue_collection, registry, node_id, runtime, sessions, adopt, teardown,
+                 mark_orphaned, saved_state, page_size=500, starting_grace=120.0, interval=60.0):
+        self.collection = collection
+        self.queue_collection = queue_collection
+        self.registry = registry
+        self.node_id = node_id
+        self.runtime = runtime
+        self.sessions = sessions
+        self.adopt = adopt
+        self.teardown = teardown
+        self.mark_orphaned = mark_orphaned
+        self.saved_state = saved_state
+        self.page_size = page_size
+        self.starting_grace = starting_grace
+        self.interval = interval
+        self._drift = None
+        self._suspects = set()  # (vm_id, status) found unaccounted for by the last pass
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.last = None
+        self.stats = {'passes': 0, 'failures': 0, 'adopted': 0, 'orphaned': 0, 'torn_down': 0,
+                      'capacity_corrections': 0}
+
+    def run_once(self, now=None):
+        """One full pass; returns its summary"""
+        with self._lock:
+            started = time.time()
+            now = started if now is None else now
+            summary = {'pages': 0, 'scanned': 0, 'adopted': 0, 'orphaned': 0, 'torn_down': 0,
+                       'capacity_corrected': None}
+            sessions = self.sessions()
+            live = self.runtime.load()
+            seen = set()
+            used = {key: 0 for key in RESOURCE_KEYS}
+            suspects = set()
+
+            last_id = None
+            while True:
+                query = {'node_id': {'$in': [self.node_id, None]}, 'status': {'$in': list(RECONCILED_STATUSES)}}
+                if last_id is not None:
+                    query['_id'] = {'$gt': last_id}
+                page = list(self.collection.find(query, RECONCILE_FIELDS).sort('_id', 1).limit(self.page_size))
+                if not page:
+                    break
+                last_id = page[-1]['_id']
+                summary['pages'] += 1
+                summary['scanned'] += len(page)
+                self._reconcile_page(page, sessions, live, now, seen, used, suspects, summary)
+
+            # Processes recorded here that no document claims any more
+            for vm_id in set(live) - seen - set(sessions):
+                self.runtime.forget(vm_id)
+                self.teardown(vm_id)
+                summary['torn_down'] += 1
+            summary['torn_down'] += self._drop_unclaimed(set(sessions) - seen)
+            summary['capacity_corrected'] = self._correct_capacity(used)
+            summary['duration_seconds'] = round(time.time() - started, 3)
+            self._suspects = suspects
+
+            self.stats['passes'] += 1
+            for key in ('adopted', 'orphaned', 'torn_down'):
+                self.stats[key] += summary[key]
+            if summary['capacity_corrected']:
+                self.stats['capacity_corrections'] += 1
+            self.last = {**summary, 'finished_at': time.time()}
+            if summary['adopted'] or summary['orphaned'] or summary['torn_down'] or summary['capacity_corrected']:
+                logger.info(f"Reconciliation: {summary}")
+            return summary
+
+    def _reconcile_page(self, page, sessions, live, now, seen, used, suspects, summary):
+        starting = [str(vm['_id']) for vm in page if vm['status'] == 'starting']
+        queued = set()
+        if starting:
+            queued = {doc['_id'] for doc in self.queue_collection.find({'_id': {'$in': starting}}, {'_id': 1})}
+
+        orphans = []
+        for vm in page:
+            vm_id = str(vm['_id'])
+            status = vm['status']
+            stale = (vm.get('updated_at') or 0) < now - self.starting_grace
+            seen.add(vm_id)
+            reason = None
+            if status in ('running', 'warm') and vm_id not in sessions:
+                if vm_id in live:
+                    self.adopt(vm_id, *live[vm_id])
+                    summary['adopted'] += 1
+                else:
+                    reason = 'VM process was lost'
+            elif status == 'starting' and vm_id not in queued and vm_id not in sessions and stale:
+                reason = 'Launch was lost before the VM booted'
+            elif status == 'warming' and vm_id not in sessions and stale:
+                reason = 'Warm pool boot was lost'
+            elif status == 'suspended' and not self.saved_state(vm_id):
+                reason = 'Suspended state was lost'
+
+            if reason and (not self.stats['passes'] or (vm_id, status) in self._suspects):
+                orphans.append((vm_id, status, reason))
+                continue
+            if reason:
+                suspects.add((vm_id, status))
+            if vm.get('node_id') == self.node_id and vm.get('resources') and not vm.get('resources_released'):
+                for key in RESOURCE_KEYS:
+                    used[key] += vm['resources'][key]
+        if orphans:
+            # Reservations of orphans are returned as they move to error
+            summary['orphaned'] += self.mark_orphaned(orphans)
+
+    def _drop_unclaimed(self, vm_ids):
+        dropped = 0
+        vm_ids = list(vm_ids)
+        for start in range(0, len(vm_ids), self.page_size):
+            chunk = vm_ids[start:start + self.page_size]
+            docs = {str(doc['_id']): doc for doc in self.collection.find(
+                {'_id': {'$in': [ObjectId(vm_id) for vm_id in chunk]}}, {'status': 1, 'node_id': 1})}
+            for vm_id in chunk:
+                doc = docs.get(vm_id)
+                if (doc is None or doc['status'] not in RECONCILED_STATUSES
+                        or doc.get('node_id') not in (self.node_id, None)):
+                    self.runtime.forget(vm_id)
+                    self.teardown(vm_id)
+                    dropped += 1
+        return dropped
+
+    def _correct_capacity(self, used):
+        node = self.registry.get(self.node_id)
+        if not node:
+            return None
+        drift = {key: (node['capacity'][key] - node['free'][key]) - used[key] for key in RESOURCE_KEYS}
+        if not any(drift.values()):
+            self._drift = None
+            return None
+        if drift != self._drift:
+            self._drift = drift
+            return None
+        # $inc rather than $set, so reservations made meanwhile are kept
+        self.registry.release(self.node_id, drift)
+        self._drift = None
+        logger.warning(f"Corrected reserved capacity of node {self.node_id} by {drift}")
+        return drift
+
+    def snapshot(self):
+        return {**self.stats, 'last': self.last, 'interval_seconds': self.interval}
+
+    def start(self):
+        if self._thread:
+            return
+        # The first pass runs before requests are served
+        try:
+            self.run_once()
+        except Exception as e:
+            self.stats['failures'] += 1
+            logger.error(f"Startup reconciliation failed: {e}")
+
+        def run():
+            while not self._stopping.wait(self.interval):
+                try:
+                    self.run_once()
+                except Exception as e:
+                    self.stats['failures'] += 1
+                    logger.error(f"Reconciliation failed: {e}")
+
+        self._thread = threading.Thread(target=run, name='reconciler', daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._stopping.set()
@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SingleFlight:
+    """Concurrent calls with the same key run once; the others wait for it and share its result.
+
+    Only calls that overlap are merged: once a call returns, the next one
+    with its key runs again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = {'calls': 0, 'shared': 0}
+
+    def do(self, key, fn):
+        """(fn()'s result, whether it came from a call already in flight); its exception is raised to all"""
+        with self._lock:
+            self.stats['calls'] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.stats['shared'] += 1
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, 'in_flight': len(self._calls)}
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines on one event loop"""
+
+    def __init__(self):
+        self._calls = {}
+        self.stats = {'calls': 0, 'shared': 0}
+
+    async def do(self, key, fn):
+        self.stats['calls'] += 1
+        future = self._calls.get(key)
+        if future is not None:
+            self.stats['shared'] += 1
+            # Shielded, so a follower that gives up does not cancel the call for everyone
+            return await asyncio.shield(future), True
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Retrieved, so an unshared failure is not reported as unhandled
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._calls[key]
+            if not future.done():
+                future.cancel()
+
+    def snapshot(self):
+        return {**self.stats, 'in_flight': len(self._calls)}
+
+
+def request_fingerprint(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class IdempotencyConflict(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+class IdempotencyStore:
+    """Responses to requests sent with an Idempotency-Key, kept in Mongo so every worker replays them.
+
+    `begin(scope, key, fingerprint)` claims the key for this request and
+    returns None, or returns the stored response of an earlier request with
+    the key. A key still being processed elsewhere is waited on for up to
+    `wait` seconds (then 409); one reused for a different request is a 422.
+    A claim older than `stale_after` is taken over, since the worker that
+    held it has died. The caller then calls `complete` with its response, or
+    `abandon` when it failed. Server errors are not stored, so a retry gets
+    a fresh attempt; records expire after `ttl`.
+    """
+
+    def __init__(self, collection, ttl=86400.0, wait=10.0, stale_after=60.0, poll_interval=0.05):
+        self.collection = collection
+        self.ttl = ttl
+        self.wait = wait
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.stats = {'claimed': 0, 'replayed': 0, 'conflicts': 0, 'taken_over': 0}
+
+    def begin(self, scope, key, fingerprint):
+        record_id = f"{scope}:{key}"
+        deadline = time.time() + self.wait
+        while True:
+            now = time.time()
+            try:
+                self.collection.insert_one({
+                    '_id': record_id,
+                    'fingerprint': fingerprint,
+                    'state': 'pending',
+                    'claimed_at': now,
+                    # TTL indexes only expire BSON dates
+                    'expires_at': datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+                })
+                self.stats['claimed'] += 1
+                return None
+            except DuplicateKeyError:
+                pass
+            record = self.collection.find_one({'_id': record_id})
+            if record is None:
+                # Abandoned or expired meanwhile
+                continue
+            if record['fingerprint'] != fingerprint:
+                self.stats['conflicts'] += 1
+                raise IdempotencyConflict('Idempotency-Key was already used for a different request', 422)
+            if record['state'] == 'done':
+                self.stats['replayed'] += 1
+                return record['response']
+            if record['claimed_at'] < now - self.stale_after:
+                if self.collection.find_one_and_update(
+                        {'_id': record_id, 'state': 'pending', 'claimed_at': record['claimed_at']},
+                        {'$set': {'claimed_at': now}}):
+                    self.stats['taken_over'] += 1
+                    logger.warning(f"Took over stale idempotency key {record_id}")
+                    return None
+                continue
+            if now > deadline:
+                self.stats['conflicts'] += 1
+                raise IdempotencyConflict('A request with this Idempotency-Key is still in progress', 409)
+            time.sleep(self.poll_interval)
+
+    def complete(self, scope, key, response):
+        """Store `response` ({'content', 'status', 'content_type', 'headers'}) for replays"""
+        if response['status'] >= 500:
+            self.abandon(scope, key)
+            return
+        self.collection.update_one({'_id': f"{scope}:{key}"},
+                                   {'$set': {'state': 'done', 'response': response}})
+
+    def abandon(self, scope, key):
+        self.collection.delete_one({'_id': f"{scope}:{key}", 'state': 'pending'})
+
+    def snapshot(self):
+        return dict(self.stats)
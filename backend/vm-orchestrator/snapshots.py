@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from pymongo.errors import DuplicateKeyError
+
+from warm_pool import pool_key
+
+logger = logging.getLogger(__name__)
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(value):
+    """Convert sizes like '2048M' or '16G' to bytes"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+# Snapshots are matched on the same config tuple as the warm pool
+snapshot_key = pool_key
+
+
+class LocalSnapshotBackend:
+    """Stub backend that lays snapshots out on local disk and simulates I/O cost.
+
+    Memory images are written as sparse files and restore time is modelled
+    from the image size and a configurable bandwidth. Per-VM disks are small
+    copy-on-write descriptors pointing at the shared base, so creating one
+    costs the same whatever the size of the base disk.
+    """
+
+    def __init__(self, root=None, bandwidth_mbps=2000.0, disk_size='8G'):
+        self.root = root or os.path.join(tempfile.gettempdir(), 'avmo-snapshots')
+        self.bandwidth = bandwidth_mbps * 1024 ** 2
+        self.disk_size = parse_size(disk_size)
+        os.makedirs(os.path.join(self.root, 'images'), exist_ok=True)
+        os.makedirs(os.path.join(self.root, 'overlays'), exist_ok=True)
+
+    def capture(self, key, generation, config):
+        """Write the memory image and base disk for a booted golden VM"""
+        name = f"{re.sub(r'[^A-Za-z0-9.]+', '_', key)}-g{generation}"
+        memory_path = os.path.join(self.root, 'images', f"{name}.mem")
+        disk_path = os.path.join(self.root, 'images', f"{name}.img")
+        memory_bytes = parse_size(config.get('ram', '2048M'))
+
+        for path, size in ((memory_path, memory_bytes), (disk_path, self.disk_size)):
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        time.sleep(memory_bytes / self.bandwidth)
+
+        return {
+            'memory_image': memory_path,
+            'base_disk': disk_path,
+            'memory_bytes': memory_bytes,
+            'disk_bytes': self.disk_size
+        }
+
+    def restore(self, vm_id, snapshot):
+        """Create a copy-on-write overlay over the base disk and load memory state"""
+        overlay_path = os.path.join(self.root, 'overlays', f"{vm_id}.json")
+        with open(overlay_path, 'w') as f:
+            json.dump({'backing_file': snapshot['base_disk'], 'created_at': time.time()}, f)
+        time.sleep(snapshot['memory_bytes'] / self.bandwidth)
+        return {'overlay': overlay_path, 'snapshot_generation': snapshot['generation']}
+
+    def release(self, vm_id):
+        overlay_path = os.path.join(self.root, 'overlays', f"{vm_id}.json")
+        if os.path.exists(overlay_path):
+            os.remove(overlay_path)
+
+    def in_use(self, snapshot):
+        overlays = os.path.join(self.root, 'overlays')
+        for name in os.listdir(overlays):
+            try:
+                with open(os.path.join(overlays, name)) as f:
+                    if json.load(f).get('backing_file') == snapshot['base_disk']:
+                        return True
+            except (OSError, ValueError):
+                continue
+        return False
+
+    def delete(self, snapshot):
+        for path in (snapshot.get('memory_image'), snapshot.get('base_disk')):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+
+class SnapshotCatalog:
+    """Golden memory+disk snapshots keyed by VM config, stored in Mongo"""
+
+    def __init__(self, collection, backend, cold_boot):
+        self.collection = collection
+        self.backend = backend
+        self.cold_boot = cold_boot
+        self.stats = {'restores': 0, 'cold_boots': 0, 'restore_failures': 0}
+        self._lock = threading.Lock()
+
+    def lookup(self, config):
+        return self.collection.find_one({'_id': snapshot_key(config), 'status': 'ready'})
+
+    def list(self):
+        return list(self.collection.find({}, {'config': 1, 'status': 1, 'generation': 1, 'refreshing': 1,
+                                              'created_at': 1, 'memory_bytes': 1, 'disk_bytes': 1}))
+
+    def create(self, config):
+        """Cold-boot a golden VM for the config and capture it as the next generation"""
+        key = snapshot_key(config)
+        previous = self.collection.find_one({'_id': key})
+        if previous:
+            # The current generation stays 'ready' and keeps serving restores
+            # until the new one is captured
+            claimed = self.collection.update_one(
+                {'_id': key, 'refreshing': {'$ne': True}},
+                {'$set': {'refreshing': True}}
+            )
+            if not claimed.modified_count:
+                raise RuntimeError(f"Snapshot for {key} is already being created")
+        else:
+            try:
+                self.collection.insert_one({'_id': key, 'config': config, 'status': 'creating',
+                                            'generation': 0, 'refreshing': True, 'retired': []})
+            except DuplicateKeyError:
+                raise RuntimeError(f"Snapshot for {key} is already being created")
+
+        generation = (previous or {}).get('generation', 0) + 1
+        try:
+            golden_id = f"golden-{generation}-{int(time.time())}"
+            self.cold_boot(golden_id, config)
+            images = self.backend.capture(key, generation, config)
+        except Exception as e:
+            logger.error(f"Error creating snapshot for {key}: {e}")
+            update = {'$set': {'error': str(e)}, '$unset': {'refreshing': ''}}
+            if not previous or previous.get('status') != 'ready':
+                update['$set']['status'] = 'error'
+            self.collection.update_one({'_id': key}, update)
+            raise
+
+        update = {
+            '$set': {'status': 'ready', 'config': config, 'generation': generation,
+                     'created_at': time.time(), **images},
+            '$unset': {'refreshing': '', 'error': ''}
+        }
+        if previous and previous.get('memory_image'):
+            # Overlays restored from the old generation still point at its base disk
+            update['$push'] = {'retired': {k: previous[k] for k in
+                                           ('memory_image', 'base_disk', 'generation')}}
+        self.collection.update_one({'_id': key}, update)
+        self.prune(key)
+        logger.info(f"Snapshot generation {generation} ready for {key}")
+        return self.collection.find_one({'_id': key})
+
+    def prune(self, key):
+        """Delete retired generations no running VM is backed by any more"""
+        doc = self.collection.find_one({'_id': key}, {'retired': 1})
+        for retired in (doc or {}).get('retired', []):
+            if not self.backend.in_use(retired):
+                self.backend.delete(retired)
+                self.collection.update_one({'_id': key},
+                                           {'$pull': {'retired': {'generation': retired['generation']}}})
+
+    def restore(self, vm_id, snapshot):
+        """Restore a VM from a snapshot; returns None so callers can fall back to a cold boot"""
+        try:
+            restored = self.backend.restore(vm_id, snapshot)
+        except Exception as e:
+            logger.error(f"Error restoring VM {vm_id} from snapshot {snapshot['_id']}: {e}")
+            with self._lock:
+                self.stats['restore_failures'] += 1
+            return None
+        with self._lock:
+            self.stats['restores'] += 1
+        return restored
+
+    def record_cold_boot(self):
+        with self._lock:
+            self.stats['cold_boots'] += 1
+
+    def release(self, vm_id):
+        try:
+            self.backend.release(vm_id)
+        except Exception as e:
+            logger.error(f"Error releasing overlay for VM {vm_id}: {e}")
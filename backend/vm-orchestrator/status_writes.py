@@ -0,0 +1,203 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, WriteError
+
+logger = logging.getLogger(__name__)
+
+
+class StatusWrite:
+    """A pending update of one VM document; writes merged into it share it"""
+
+    def __init__(self, vm_id, query, fields):
+        self.vm_id = vm_id
+        self.query = query
+        self.fields = fields
+        self.vm = None
+        self.error = None
+        self._done = threading.Event()
+
+    def _finish(self, vm=None, error=None):
+        self.vm = vm
+        self.error = error
+        self._done.set()
+
+    def result(self, timeout=None):
+        """The VM document after the write, or None when the query no longer matched it"""
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"Write for VM {self.vm_id} was not flushed within {timeout}s")
+        if self.error:
+            raise self.error
+        return self.vm
+
+
+class StatusWriter:
+    """Write-behind batching of VM document updates.
+
+    Writes are queued per VM for up to `window` seconds (or until `max_batch`
+    VMs are waiting) and flushed with one unordered bulk_write plus one read
+    back of the written documents. Consecutive writes to a VM with the same
+    query merge into one, so a burst of heartbeats costs a single update.
+    Every update also bumps the document's `version` counter, which ETags
+    are derived from.
+    Callers that need the write durable wait on `result()`, which returns
+    only once Mongo has acknowledged it; the rest return straight away and
+    are flushed by the writer thread, or by `shutdown()`.
+
+    `on_written([(vm, fields), ...])` runs after each batch, before waiters
+    are released, with the documents the batch changed. Until `start()` (and
+    after `shutdown()`) every write is flushed inline.
+    """
+
+    def __init__(self, collection, window=0.05, max_batch=500, on_written=None):
+        self.collection = collection
+        self.window = window
+        self.max_batch = max_batch
+        self.on_written = on_written
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()  # vm_id -> deque of StatusWrite, oldest first
+        self._flush_lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+        self.stats = {'submitted': 0, 'coalesced': 0, 'batches': 0, 'written': 0, 'unmatched': 0,
+                      'failed': 0, 'largest_batch': 0}
+
+    def submit(self, vm_id, fields, only_from=None):
+        """Queue `$set: fields` for a VM (only while it is in status `only_from`, if given)"""
+        vm_id = str(vm_id)
+        query = {'_id': ObjectId(vm_id)}
+        if only_from:
+            query['status'] = only_from
+        with self._cond:
+            self.stats['submitted'] += 1
+            writes = self._pending.setdefault(vm_id, deque())
+            if writes and writes[-1].query == query:
+                write = writes[-1]
+                write.fields.update(fields)
+                self.stats['coalesced'] += 1
+            else:
+                write = StatusWrite(vm_id, query, dict(fields))
+                writes.append(write)
+            background = self._thread is not None and not self._stopping
+            if background:
+                self._cond.notify()
+        if not background:
+            self.flush()
+        return write
+
+    def write(self, vm_id, fields, only_from=None):
+        """submit() and wait until the write is acknowledged"""
+        return self.submit(vm_id, fields, only_from).result()
+
+    def snapshot(self):
+        with self._cond:
+            return {**self.stats, 'pending': sum(len(writes) for writes in self._pending.values()),
+                    'window_seconds': self.window}
+
+    def _take(self):
+        # At most one write per VM per batch: a VM's writes are applied in order
+        with self._cond:
+            batch = []
+            for vm_id in list(self._pending):
+                writes = self._pending[vm_id]
+                batch.append(writes.popleft())
+                if not writes:
+                    del self._pending[vm_id]
+                if len(batch) >= self.max_batch:
+                    break
+            return batch
+
+    def flush(self):
+        """Write everything queued so far"""
+        with self._flush_lock:
+            while True:
+                batch = self._take()
+                if not batch:
+                    return
+                self._write(batch)
+
+    def _write(self, batch):
+        failed = {}
+        try:
+            try:
+                self.collection.bulk_write([UpdateOne(w.query, {'$set': w.fields, '$inc': {'version': 1}})
+                                            for w in batch], ordered=False)
+            except BulkWriteError as e:
+                failed = {error['index']: error.get('errmsg', 'write failed')
+                          for error in e.details.get('writeErrors', ())}
+            ids = list({w.query['_id'] for w in batch})
+            docs = {doc['_id']: doc for doc in self.collection.find({'_id': {'$in': ids}})}
+        except Exception as e:
+            logger.error(f"Status write batch of {len(batch)} failed: {e}")
+            with self._cond:
+                self.stats['failed'] += len(batch)
+            for write in batch:
+                write._finish(error=e)
+            return
+
+        outcomes = []
+        written = []
+        for index, write in enumerate(batch):
+            if index in failed:
+                outcomes.append((write, None, WriteError(failed[index])))
+                continue
+            doc = docs.get(write.query['_id'])
+            # Unordered bulk results do not say which updates matched; a document
+            # carrying every written value did
+            if doc is not None and all(doc.get(key) == value for key, value in write.fields.items()):
+                written.append((doc, write.fields))
+                outcomes.append((write, doc, None))
+            else:
+                outcomes.append((write, None, None))
+
+        with self._cond:
+            self.stats['batches'] += 1
+            self.stats['largest_batch'] = max(self.stats['largest_batch'], len(batch))
+            self.stats['written'] += len(written)
+            self.stats['failed'] += len(failed)
+            self.stats['unmatched'] += len(batch) - len(written) - len(failed)
+        if written and self.on_written:
+            try:
+                self.on_written(written)
+            except Exception as e:
+                logger.error(f"Status write callback failed: {e}")
+        for write, doc, error in outcomes:
+            write._finish(doc, error)
+
+    def start(self):
+        with self._cond:
+            if self._thread:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='status-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                # Give other writes the window to join this batch
+                deadline = time.time() + self.window
+                while not self._stopping and len(self._pending) < self.max_batch:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
+
+    def shutdown(self, timeout=None):
+        """Stop the writer thread and flush whatever is still queued"""
+        with self._cond:
+            self._stopping = True
+            thread, self._thread = self._thread, None
+            self._cond.notify_all()
+        if thread and thread is not threading.current_thread():
+            thread.join(timeout)
+        self.flush()
@@ -0,0 +1,325 @@
+import asyncio
+import logging
+import os
+import struct
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs, urlsplit
+
+import websockets
+
+logger = logging.getLogger(__name__)
+
+# Frames arrive from the VM process as a 4-byte big-endian length prefix
+# followed by the encoded frame
+FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+
+
+class Frame:
+    __slots__ = ('seq', 'data', 'captured_at')
+
+    def __init__(self, seq, data, captured_at):
+        self.seq = seq
+        # One memoryview per frame, shared by every viewer it is sent to
+        self.data = memoryview(data)
+        self.captured_at = captured_at
+
+
+class UnixSocketFrameSource:
+    """Reads length-prefixed encoded frames from the socket a VM process exposes"""
+
+    def __init__(self, path):
+        self.path = path
+
+    async def frames(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        seq = 0
+        try:
+            while True:
+                (length,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                if length > MAX_FRAME_BYTES:
+                    raise ValueError(f"Frame of {length} bytes exceeds limit")
+                data = await reader.readexactly(length)
+                seq += 1
+                yield Frame(seq, data, time.monotonic())
+        except asyncio.IncompleteReadError:
+            return
+        finally:
+            writer.close()
+
+
+class SyntheticFrameSource:
+    """Fixed-rate generated frames for simulated VMs and tests"""
+
+    def __init__(self, fps=30, frame_bytes=64 * 1024):
+        self.interval = 1.0 / fps
+        self.frame_bytes = frame_bytes
+
+    async def frames(self):
+        seq = 0
+        payload = bytearray(self.frame_bytes)
+        while True:
+            seq += 1
+            payload[:8] = seq.to_bytes(8, 'big')
+            yield Frame(seq, bytes(payload), time.monotonic())
+            await asyncio.sleep(self.interval)
+
+
+class Viewer:
+    """One WebSocket client; holds only the newest unsent frame"""
+
+    def __init__(self, websocket, vm_id, user_id=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.websocket = websocket
+        self.vm_id = vm_id
+        self.user_id = user_id
+        self.connected_at = time.time()
+        self.pending = None
+        self.ready = asyncio.Event()
+        # Set by an encoding pipeline, when the source produces raw frames
+        self.quality_level = 0
+        self.needs_keyframe = False
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.bytes_sent = 0
+        self.latency_ms = None
+        self.bytes_per_sec = 0.0
+        self._rate_window_start = time.monotonic()
+        self._rate_window_bytes = 0
+
+    def offer(self, frame):
+        # A slow client skips to the newest frame instead of building a backlog
+        if self.pending is not None:
+            self.frames_dropped += 1
+        self.pending = frame
+        self.ready.set()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            frame, self.pending = self.pending, None
+            if frame is None:
+                continue
+            await self.websocket.send(frame.data)
+            self._record(frame)
+
+    def _record(self, frame):
+        now = time.monotonic()
+        latency = (now - frame.captured_at) * 1000
+        self.latency_ms = latency if self.latency_ms is None else 0.9 * self.latency_ms + 0.1 * latency
+        self.frames_sent += 1
+        self.bytes_sent += frame.data.nbytes
+        self._rate_window_bytes += frame.data.nbytes
+        elapsed = now - self._rate_window_start
+        if elapsed >= 1.0:
+            self.bytes_per_sec = self._rate_window_bytes / elapsed
+            self._rate_window_start = now
+            self._rate_window_bytes = 0
+
+    def stats(self):
+        return {
+            'viewer_id': self.id,
+            'vm_id': self.vm_id,
+            'connected_seconds': round(time.time() - self.connected_at, 1),
+            'frames_sent': self.frames_sent,
+            'frames_dropped': self.frames_dropped,
+            'bytes_sent': self.bytes_sent,
+            'bytes_per_sec': round(self.bytes_per_sec, 1),
+            'latency_ms': round(self.latency_ms, 2) if self.latency_ms is not None else None,
+            'quality_level': self.quality_level
+        }
+
+
+class Broadcaster:
+    """Reads a VM's frames once and fans each one out to every viewer"""
+
+    def __init__(self, vm_id, source):
+        self.vm_id = vm_id
+        self.source = source
+        # Raw framebuffer sources carry a pipeline that encodes per quality level
+        self.pipeline = getattr(source, 'pipeline', None)
+        self.viewers = set()
+        self.frames_read = 0
+        self._task = None
+
+    def add(self, viewer):
+        self.viewers.add(viewer)
+        if self._task is None:
+            self._task = asyncio.create_task(self._pump())
+
+    def remove(self, viewer):
+        self.viewers.discard(viewer)
+        if not self.viewers and self._task:
+            self._task.cancel()
+            self._task = None
+
+    def publish(self, frame):
+        self.frames_read += 1
+        for viewer in self.viewers:
+            viewer.offer(frame)
+
+    async def _pump(self):
+        try:
+            async for frame in self.source.frames():
+                if self.pipeline:
+                    self.frames_read += 1
+                    self.pipeline.publish(*frame, self.viewers)
+                else:
+                    self.publish(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Frame source for VM {self.vm_id} failed: {e}")
+        # Source ended: disconnect viewers so clients can reconnect
+        for viewer in list(self.viewers):
+            await viewer.websocket.close(1011, 'Stream ended')
+
+
+class StreamHub:
+    """WebSocket server for /stream/<vm_id>, run on its own event loop thread.
+
+    `source_factory(vm_id)` returns a frame source for a VM and
+    `authorize(vm_id, auth_header)` returns the user allowed to watch it
+    (or None); the latter may block, so it runs in the default executor.
+    Other paths can share the server through `routes`, which maps a first
+    path segment to a coroutine taking (websocket, request, auth_header).
+    """
+
+    def __init__(self, source_factory, authorize):
+        self.source_factory = source_factory
+        self.authorize = authorize
+        self.broadcasters = {}
+        self.viewers = {}  # vm_id -> set of Viewer, readable from other threads
+        self.listeners = []  # callables(event, vm_id, viewer_count)
+        self.routes = {}
+        self.loop = None
+        self._server = None
+        self._thread = None
+
+    async def handle(self, websocket):
+        request = urlsplit(websocket.path)
+        parts = request.path.strip('/').split('/')
+        auth_header = websocket.request_headers.get('Authorization')
+        token = parse_qs(request.query).get('token')
+        if not auth_header and token:
+            # Browsers cannot set headers on WebSocket requests
+            auth_header = f"Bearer {token[0]}"
+
+        route = self.routes.get(parts[0])
+        if route:
+            await route(websocket, request, auth_header)
+            return
+        if len(parts) != 2 or parts[0] != 'stream':
+            await websocket.close(1008, 'Unknown stream')
+            return
+        vm_id = parts[1]
+
+        user = await asyncio.get_running_loop().run_in_executor(None, self.authorize, vm_id, auth_header)
+        if not user:
+            await websocket.close(1008, 'Access denied')
+            return
+
+        viewer = Viewer(websocket, vm_id, user.get('id'))
+        broadcaster = self.broadcasters.get(vm_id)
+        if broadcaster is None:
+            broadcaster = self.broadcasters[vm_id] = Broadcaster(vm_id, self.source_factory(vm_id))
+        broadcaster.add(viewer)
+        self.viewers.setdefault(vm_id, set()).add(viewer)
+        self._notify('connect', vm_id)
+        logger.info(f"Viewer {viewer.id} connected to VM {vm_id}")
+
+        sender = asyncio.create_task(viewer.run())
+        try:
+            # Incoming messages are client input; keep reading so close frames are seen
+            async for _ in websocket:
+                self._notify('input', vm_id)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            sender.cancel()
+            broadcaster.remove(viewer)
+            self.viewers[vm_id].discard(viewer)
+            if not broadcaster.viewers:
+                self.broadcasters.pop(vm_id, None)
+                self.viewers.pop(vm_id, None)
+            self._notify('disconnect', vm_id)
+            logger.info(f"Viewer {viewer.id} left VM {vm_id}: {viewer.stats()}")
+
+    def _notify(self, event, vm_id):
+        count = len(self.viewers.get(vm_id, ()))
+        for listener in self.listeners:
+            try:
+                listener(event, vm_id, count)
+            except Exception as e:
+                logger.error(f"Stream listener failed: {e}")
+
+    def stats(self, vm_id=None):
+        vm_ids = [vm_id] if vm_id else list(self.viewers)
+        return {
+            vid: [viewer.stats() for viewer in list(self.viewers.get(vid, ()))]
+            for vid in vm_ids
+        }
+
+    # Server thread
+
+    def start(self, host='0.0.0.0', port=8085):
+        if self._thread:
+            return
+        started = threading.Event()
+        failed = []
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            try:
+                # write_limit keeps the per-connection kernel-side backlog small;
+                # anything beyond it is dropped at the Viewer instead
+                self._server = self.loop.run_until_complete(
+                    websockets.serve(self.handle, host, port, write_limit=256 * 1024, compression=None)
+                )
+            except Exception as e:
+                failed.append(e)
+                self.loop.close()
+                return
+            finally:
+                started.set()
+            self.loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='stream-hub', daemon=True)
+        self._thread.start()
+        started.wait()
+        if failed:
+            # e.g. the port is already taken
+            self._thread.join()
+            self._thread = None
+            raise failed[0]
+        logger.info(f"Stream hub listening on {host}:{port}")
+
+    @property
+    def port(self):
+        return self._server.sockets[0].getsockname()[1] if self._server else None
+
+    def shutdown(self):
+        if not self._thread:
+            return
+
+        async def close():
+            self._server.close()
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result(timeout=5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._thread = None
+
+
+def frame_source_for(vm_id, socket_dir=None):
+    """Prefer the VM process's frame socket; simulated VMs get synthetic frames"""
+    socket_dir = socket_dir or os.environ.get('STREAM_SOCKET_DIR', '/run/avmo/frames')
+    path = os.path.join(socket_dir, f"{vm_id}.sock")
+    if os.path.exists(path):
+        return UnixSocketFrameSource(path)
+    return SyntheticFrameSource(fps=int(os.environ.get('STREAM_SYNTHETIC_FPS', 30)))
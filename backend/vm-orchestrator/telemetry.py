@@ -0,0 +1,264 @@
+import logging
+import re
+import threading
+import time
+from array import array
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# Columns of every sample row after its timestamp. Counters (CPU time, disk
+# and network bytes) are stored as rates over the sampling interval, so a
+# rollup is simply the mean of the rows it covers.
+FIELDS = ('cpu_percent', 'rss_bytes', 'disk_read_bps', 'disk_write_bps', 'net_rx_bps', 'net_tx_bps')
+
+# Rollup step in seconds -> rows kept: 6h of minutes, 24h of 5 minutes, 7d of hours
+DEFAULT_ROLLUPS = {60: 360, 300: 288, 3600: 168}
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(value):
+    """'90s', '15m', '6h', '7d' (or plain seconds) -> seconds"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*', str(value))
+    if not match or float(match.group(1)) <= 0:
+        raise ValueError(f"Invalid range {value!r}; expected e.g. 15m, 6h or 7d")
+    return float(match.group(1)) * DURATION_UNITS[match.group(2) or 's']
+
+
+def resolution_label(step):
+    for unit in ('d', 'h', 'm'):
+        if step >= DURATION_UNITS[unit] and step % DURATION_UNITS[unit] == 0:
+            return f"{int(step // DURATION_UNITS[unit])}{unit}"
+    return f"{step:g}s"
+
+
+class Ring:
+    """Fixed-capacity ring of float rows in one preallocated array"""
+
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        self._data = array('d', bytes(8 * capacity * width))
+        self._next = 0
+        self._count = 0
+
+    def append(self, row):
+        start = self._next * self.width
+        self._data[start:start + self.width] = array('d', row)
+        self._next = (self._next + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def rows(self, since=None):
+        """Rows oldest first, optionally only those whose first column is >= since"""
+        first = (self._next - self._count) % self.capacity
+        rows = []
+        for i in range(self._count):
+            start = ((first + i) % self.capacity) * self.width
+            if since is None or self._data[start] >= since:
+                rows.append(self._data[start:start + self.width].tolist())
+        return rows
+
+    def last(self):
+        if not self._count:
+            return None
+        start = ((self._next - 1) % self.capacity) * self.width
+        return self._data[start:start + self.width].tolist()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        return self._data.itemsize * len(self._data)
+
+
+class Rollup:
+    """Means of the rows falling in each `step`-second bucket, kept in a Ring"""
+
+    def __init__(self, step, capacity, width):
+        self.step = step
+        self.ring = Ring(capacity, width)
+        self._bucket = None
+        self._sums = [0.0] * (width - 1)
+        self._count = 0
+
+    def add(self, row):
+        bucket = row[0] - row[0] % self.step
+        if self._bucket is not None and bucket != self._bucket:
+            self.flush()
+        self._bucket = bucket
+        for i, value in enumerate(row[1:]):
+            self._sums[i] += value
+        self._count += 1
+
+    def flush(self):
+        if self._count:
+            self.ring.append([self._bucket] + [total / self._count for total in self._sums])
+        self._sums = [0.0] * len(self._sums)
+        self._count = 0
+
+
+class VMSeries:
+    """Raw samples and rollups for one VM; memory is fixed when it is created"""
+
+    def __init__(self, interval, raw_capacity, rollups):
+        width = 1 + len(FIELDS)
+        self.interval = interval
+        self.raw = Ring(raw_capacity, width)
+        self.rollups = [Rollup(step, capacity, width) for step, capacity in sorted(rollups.items())]
+        self.previous = None  # (timestamp, counters) of the last reading
+
+    def add(self, row):
+        self.raw.append(row)
+        for rollup in self.rollups:
+            rollup.add(row)
+
+    def resolutions(self):
+        """(step, ring) pairs, finest first"""
+        return [(self.interval, self.raw)] + [(rollup.step, rollup.ring) for rollup in self.rollups]
+
+    @property
+    def nbytes(self):
+        return sum(ring.nbytes for _, ring in self.resolutions())
+
+
+def read_process(process, interface=None, nics=None):
+    """Cumulative counters of a VM process; network comes from its host interface (tap) when known"""
+    with process.oneshot():
+        cpu = process.cpu_times()
+        counters = {
+            'cpu_seconds': cpu.user + cpu.system,
+            'rss_bytes': process.memory_info().rss
+        }
+        try:
+            io = process.io_counters()
+            counters['disk_read_bytes'], counters['disk_write_bytes'] = io.read_bytes, io.write_bytes
+        except (AttributeError, psutil.AccessDenied):
+            # Not available on every platform
+            pass
+    nic = (nics or {}).get(interface)
+    if nic is not None:
+        # A tap device's "sent" is what the guest receives
+        counters['net_rx_bytes'], counters['net_tx_bytes'] = nic.bytes_sent, nic.bytes_recv
+    return counters
+
+
+def to_row(now, counters, previous):
+    """Sample row from two readings; counters missing from either are reported as 0"""
+    elapsed = now - previous[0] if previous else 0
+
+    def rate(key):
+        if not elapsed or key not in counters or key not in previous[1]:
+            return 0.0
+        return max(0.0, (counters[key] - previous[1][key]) / elapsed)
+
+    return [
+        now,
+        rate('cpu_seconds') * 100,
+        float(counters.get('rss_bytes', 0)),
+        rate('disk_read_bytes'),
+        rate('disk_write_bytes'),
+        rate('net_rx_bytes'),
+        rate('net_tx_bytes'),
+    ]
+
+
+class TelemetryCollector:
+    """Samples every tracked VM process at a fixed interval into in-memory rings.
+
+    `targets()` returns (vm_id, psutil.Process, interface) for each VM to
+    sample; VMs that drop out of it lose their history. Each VM costs
+    `nbytes` of preallocated arrays however long it runs, and windows are
+    served from memory without touching Mongo.
+    """
+
+    def __init__(self, targets, interval=5.0, raw_capacity=360, rollups=None, reader=read_process):
+        self.targets = targets
+        self.interval = interval
+        self.raw_capacity = raw_capacity
+        self.rollups = DEFAULT_ROLLUPS if rollups is None else rollups
+        self.reader = reader
+        self._lock = threading.Lock()
+        self._series = {}
+        self._stopping = threading.Event()
+        self._thread = None
+        self.stats = {'sweeps': 0, 'samples': 0, 'errors': 0}
+
+    def sample(self, now=None):
+        """Take one reading of every target"""
+        now = time.time() if now is None else now
+        targets = list(self.targets())
+        nics = psutil.net_io_counters(pernic=True) if any(interface for _, _, interface in targets) else {}
+        seen = set()
+        for vm_id, process, interface in targets:
+            seen.add(vm_id)
+            try:
+                counters = self.reader(process, interface, nics)
+            except psutil.Error as e:
+                # Exited or inaccessible; the health monitor reports exits
+                self.stats['errors'] += 1
+                logger.debug(f"Sampling VM {vm_id} failed: {e}")
+                continue
+            with self._lock:
+                series = self._series.get(vm_id)
+                if series is None:
+                    series = self._series[vm_id] = VMSeries(self.interval, self.raw_capacity, self.rollups)
+                if series.previous:
+                    series.add(to_row(now, counters, series.previous))
+                    self.stats['samples'] += 1
+                series.previous = (now, counters)
+        with self._lock:
+            for vm_id in set(self._series) - seen:
+                del self._series[vm_id]
+            self.stats['sweeps'] += 1
+
+    def window(self, vm_id, seconds, now=None):
+        """Samples from the last `seconds` at the finest resolution that covers them, or None"""
+        now = time.time() if now is None else now
+        with self._lock:
+            series = self._series.get(vm_id)
+            if series is None:
+                return None
+            resolutions = series.resolutions()
+            step, ring = next(((step, ring) for step, ring in resolutions if step * ring.capacity >= seconds),
+                              resolutions[-1])
+            rows = ring.rows(since=now - seconds)
+        return {
+            'resolution': resolution_label(step),
+            'step_seconds': step,
+            'samples': [dict(zip(('timestamp',) + FIELDS, row)) for row in rows]
+        }
+
+    def latest(self, vm_id):
+        with self._lock:
+            series = self._series.get(vm_id)
+            row = series.raw.last() if series else None
+        return dict(zip(('timestamp',) + FIELDS, row)) if row else None
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                **self.stats,
+                'interval_seconds': self.interval,
+                'vms': len(self._series),
+                'bytes': sum(series.nbytes for series in self._series.values())
+            }
+
+    def start(self):
+        if self._thread:
+            return
+
+        def run():
+            while not self._stopping.wait(self.interval):
+                try:
+                    self.sample()
+                except Exception as e:
+                    logger.error(f"Telemetry sweep failed: {e}")
+
+        self._thread = threading.Thread(target=run, name='telemetry', daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._stopping.set()
@@ -0,0 +1,1677 @@
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import jwt
+import numpy as np
+import mongomock
+from bson.objectid import ObjectId
+import mongomock_motor
+import pytest
+import websockets
+from starlette.testclient import TestClient
+
+os.environ.setdefault('JWT_SECRET', 'test-secret-key-with-at-least-32-characters')
+os.environ.setdefault('DB_CONNECTION_STRING', 'mongodb://localhost:27017/vms')
+os.environ.setdefault('VM_BOOT_SECONDS', '0')
+
+with mock.patch('pymongo.MongoClient', mongomock.MongoClient):
+    import orchestrator
+import async_orchestrator
+
+from provisioning import LaunchScheduler, QueueFullError
+from auth_cache import JWKSCache, TokenVerifier
+from fleet_sim import AdaptivePool, FleetSimulator, simulate, synthetic_trace, trace_from_vm_documents
+from frame_pipeline import FramePipeline, TileDecoder, TileEncoder
+from notifications import StatusHub
+from health import HealthMonitor, ProcessTracker
+from hypervisor import EmulatorDriver, FakeDriver, NetworkAllocator, QemuDriver
+from image_store import ImageStore, image_source
+from idle import IdleMonitor, SimulatedSuspendBackend
+from mongo_client import LazyDatabase, MongoClientFactory
+from metrics import MetricsRegistry, MongoCommandMetrics
+from indexes import ensure_indexes
+from placement import NodeRegistry, PlacementScheduler, placement_token
+from telemetry import TelemetryCollector, parse_duration
+from streaming import Broadcaster, Frame, StreamHub, SyntheticFrameSource, Viewer
+from snapshots import LocalSnapshotBackend, SnapshotCatalog, parse_size
+from single_flight import IdempotencyConflict, IdempotencyStore, SingleFlight
+from status_writes import StatusWriter
+from reconcile import Reconciler, RuntimeDirectory
+from vm_cache import VMStateCache
+from warm_pool import WarmPool, pool_key
+
+
+def make_token(user_id='user-1', role='user'):
+    return jwt.encode({'sub': user_id, 'email': f'{user_id}@example.com', 'role': role},
+                      os.environ['JWT_SECRET'], algorithm='HS256')
+
+
+@pytest.fixture
+def client(monkeypatch):
+    orchestrator.vms_collection.delete_many({})
+    orchestrator.db.launch_queue.delete_many({})
+    orchestrator.db.nodes.delete_many({})
+    orchestrator.db.idempotency_keys.delete_many({})
+    monkeypatch.setattr(orchestrator, 'launch_scheduler',
+                        LaunchScheduler(orchestrator.db.launch_queue, orchestrator.start_vm_process, workers=1))
+    monkeypatch.setattr(orchestrator, 'warm_pool', WarmPool(orchestrator.vms_collection, orchestrator.boot_vm))
+    monkeypatch.setattr(orchestrator, 'vm_cache', VMStateCache(orchestrator.vms_collection))
+    ensure_indexes(orchestrator.db)
+    orchestrator.app.config['TESTING'] = True
+    return orchestrator.app.test_client()
+
+
+def auth(user_id='user-1', role='user'):
+    return {'Authorization': f'Bearer {make_token(user_id, role)}'}
+
+
+class TestLaunchScheduler:
+    def test_round_robin_across_users(self):
+        queue = mongomock.MongoClient().db.launch_queue
+        order = []
+        scheduler = LaunchScheduler(queue, lambda vm_id, config: order.append(vm_id),
+                                    workers=1, per_user_limit=1)
+        for i in range(3):
+            scheduler.submit(f'a{i}', 'alice', {})
+        scheduler.submit('b0', 'bob', {})
+
+        assert scheduler.position('b0') == {'queue_position': 2, 'eta_seconds': 20.0}
+
+        scheduler.start()
+        deadline = time.time() + 5
+        while len(order) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        scheduler.shutdown()
+
+        assert order == ['a0', 'b0', 'a1', 'a2']
+        assert queue.count_documents({}) == 0
+
+    def test_queued_launches_survive_restart(self):
+        queue = mongomock.MongoClient().db.launch_queue
+        scheduler = LaunchScheduler(queue, lambda vm_id, config: None, workers=1)
+        scheduler.submit('vm-1', 'alice', {'ram': '2048M'})
+
+        booted = []
+        restarted = LaunchScheduler(queue, lambda vm_id, config: booted.append((vm_id, config)), workers=1)
+        restarted.start()
+        deadline = time.time() + 5
+        while not booted and time.time() < deadline:
+            time.sleep(0.01)
+        restarted.shutdown()
+
+        assert booted == [('vm-1', {'ram': '2048M'})]
+
+    def test_nodes_boot_only_their_own_launches(self):
+        queue = mongomock.MongoClient().db.launch_queue
+        live = ['node-a', 'node-b']
+        booted = {'node-a': [], 'node-b': []}
+        schedulers = {
+            node_id: LaunchScheduler(queue, lambda vm_id, config, node_id=node_id: booted[node_id].append(vm_id),
+                                     workers=1, node_id=node_id, live_nodes=lambda: live)
+            for node_id in booted
+        }
+        schedulers['node-a'].submit('vm-a', 'alice', {})
+        schedulers['node-b'].submit('vm-b', 'bob', {})
+        # Both have waited long enough for the heartbeat to consider adopting them
+        queue.update_many({}, {'$set': {'enqueued_at': time.time() - 3600}})
+
+        def settle():
+            deadline = time.time() + 5
+            while queue.count_documents({'node_id': 'node-b'}) and time.time() < deadline:
+                time.sleep(0.01)
+
+        node_b = schedulers['node-b']
+        node_b.start()
+        try:
+            node_b._recover(adopt_all=False)
+            settle()
+            assert booted['node-b'] == ['vm-b']
+            assert queue.find_one({'_id': 'vm-a'})['node_id'] == 'node-a'
+
+            # Once node-a stops heartbeating its launch is re-homed and booted by node-b
+            live.remove('node-a')
+            node_b._recover(adopt_all=False)
+            settle()
+        finally:
+            node_b.shutdown()
+        assert booted == {'node-a': [], 'node-b': ['vm-b', 'vm-a']}
+        assert queue.count_documents({}) == 0
+
+    def test_rejects_when_full(self):
+        queue = mongomock.MongoClient().db.launch_queue
+        scheduler = LaunchScheduler(queue, lambda vm_id, config: None, workers=1, max_queued=1)
+        scheduler.submit('vm-1', 'alice', {})
+        with pytest.raises(QueueFullError):
+            scheduler.submit('vm-2', 'bob', {})
+
+
+class TestWarmPool:
+    def test_replenishes_seeded_config_and_hands_out_atomically(self):
+        vms = mongomock.MongoClient().db.vms
+        config = dict(orchestrator.DEFAULT_VM_CONFIG)
+        pool = WarmPool(vms, lambda vm_id, config: {'ip': '10.0.0.1'},
+                        seed_configs=[config], min_size=2, interval=0.01)
+        pool.start()
+        deadline = time.time() + 5
+        while vms.count_documents({'status': 'warm'}) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        pool.shutdown()
+
+        first = pool.acquire('alice', config)
+        second = pool.acquire('bob', config)
+        assert {first['user_id'], second['user_id']} == {'alice', 'bob'}
+        assert first['_id'] != second['_id']
+        assert pool.acquire('carol', config) is None
+
+        stats = pool.stats()
+        assert (stats['hits'], stats['misses']) == (2, 1)
+
+    def test_target_tracks_arrival_rate(self):
+        vms = mongomock.MongoClient().db.vms
+        pool = WarmPool(vms, lambda vm_id, config: {}, boot_estimate=10.0,
+                        rate_window=60.0, headroom=1.0, max_size=50)
+        config = {'android_version': '12.0', 'ram': '4096M', 'resolution': '1080x1920', 'cpu_cores': 4}
+        for _ in range(30):
+            pool.acquire('alice', config)
+        # 30 launches a minute over a 10 s boot needs 5 VMs on standby
+        assert pool.target_size(pool_key(config)) == 5
+
+
+class TestSnapshots:
+    def make_catalog(self, tmp_path, cold_boots):
+        backend = LocalSnapshotBackend(root=str(tmp_path), bandwidth_mbps=1e9, disk_size='64G')
+        return SnapshotCatalog(mongomock.MongoClient().db.snapshots, backend,
+                               lambda vm_id, config: cold_boots.append(vm_id))
+
+    def test_refresh_retires_generation_once_unused(self, tmp_path):
+        cold_boots = []
+        catalog = self.make_catalog(tmp_path, cold_boots)
+        config = dict(orchestrator.DEFAULT_VM_CONFIG)
+
+        first = catalog.create(config)
+        restored = catalog.restore('vm-1', catalog.lookup(config))
+        second = catalog.create(config)
+
+        assert (first['generation'], second['generation']) == (1, 2)
+        assert restored['snapshot_generation'] == 1
+        assert len(cold_boots) == 2
+        # vm-1 still runs on the first generation's base disk
+        assert os.path.exists(first['base_disk'])
+
+        catalog.release('vm-1')
+        catalog.prune(pool_key(config))
+        assert not os.path.exists(first['base_disk'])
+        assert os.path.exists(second['base_disk'])
+
+    def test_boot_restores_instead_of_cold_boot(self, tmp_path, monkeypatch):
+        cold_boots = []
+        catalog = self.make_catalog(tmp_path, cold_boots)
+        monkeypatch.setattr(orchestrator, 'snapshot_catalog', catalog)
+        monkeypatch.setattr(orchestrator, 'cold_boot', lambda vm_id, config: cold_boots.append(vm_id))
+        config = dict(orchestrator.DEFAULT_VM_CONFIG)
+        catalog.create(config)
+
+        orchestrator.boot_vm('vm-2', config)
+
+        assert len(cold_boots) == 1  # only the golden boot
+        assert orchestrator.active_vms.pop('vm-2')['overlay'].endswith('vm-2.json')
+        assert catalog.stats['restores'] == 1
+
+    def test_real_drivers_cold_boot_past_the_catalog(self, tmp_path, monkeypatch, client):
+        cold_boots = []
+        catalog = self.make_catalog(tmp_path, cold_boots)
+        config = dict(orchestrator.DEFAULT_VM_CONFIG)
+        catalog.create(config)
+        cold_boot = orchestrator.cold_boot
+        monkeypatch.setattr(orchestrator, 'snapshot_catalog', catalog)
+        monkeypatch.setattr(orchestrator, 'SNAPSHOT_RESTORE', False)
+        monkeypatch.setattr(orchestrator, 'cold_boot',
+                            lambda vm_id, config: cold_boots.append(vm_id) or cold_boot(vm_id, config))
+
+        orchestrator.boot_vm('vm-3', config)
+        response = client.post('/snapshots', json={}, headers=auth('admin-1', role='admin'))
+
+        assert cold_boots[-1] == 'vm-3'
+        assert orchestrator.active_vms.pop('vm-3')['overlay'] is None
+        assert catalog.stats['restores'] == 0
+        assert response.status_code == 409
+
+    def test_parse_size(self):
+        assert parse_size('2048M') == 2 * 1024 ** 3
+        assert parse_size('16G') == 16 * 1024 ** 3
+
+
+class RecordingSocket:
+    def __init__(self, block=None):
+        self.sent = []
+        self.block = block
+
+    async def send(self, data):
+        if self.block:
+            await self.block.wait()
+        self.sent.append(data)
+
+
+class TestStreaming:
+    def test_fan_out_shares_buffers_and_drops_stale_frames(self):
+        async def scenario():
+            release = asyncio.Event()
+            fast, slow = RecordingSocket(), RecordingSocket(block=release)
+            broadcaster = Broadcaster('vm-1', SyntheticFrameSource())
+            viewers = [Viewer(fast, 'vm-1'), Viewer(slow, 'vm-1')]
+            broadcaster.viewers.update(viewers)
+            tasks = [asyncio.create_task(v.run()) for v in viewers]
+
+            for seq in range(1, 6):
+                broadcaster.publish(Frame(seq, bytes([seq]) * 1024, time.monotonic()))
+                await asyncio.sleep(0)
+            release.set()
+            await asyncio.sleep(0.01)
+            for task in tasks:
+                task.cancel()
+            return fast, slow, viewers
+
+        fast, slow, viewers = asyncio.run(scenario())
+
+        assert [bytes(m[:1])[0] for m in fast.sent] == [1, 2, 3, 4, 5]
+        # The blocked client gets the frame it was sending plus only the newest one
+        assert [bytes(m[:1])[0] for m in slow.sent] == [1, 5]
+        assert viewers[1].frames_dropped == 3
+        assert fast.sent[4] is slow.sent[1]
+        assert viewers[0].stats()['bytes_sent'] == 5 * 1024
+
+    def test_websocket_viewers_receive_frames(self):
+        hub = StreamHub(lambda vm_id: SyntheticFrameSource(fps=100, frame_bytes=256),
+                        lambda vm_id, header: {'id': 'user-1'} if header == 'Bearer good' else None)
+        hub.start(host='127.0.0.1', port=0)
+
+        async def watch():
+            url = f'ws://127.0.0.1:{hub.port}/stream/vm-1'
+            async with websockets.connect(f'{url}?token=good') as first, \
+                    websockets.connect(url, extra_headers={'Authorization': 'Bearer good'}) as second:
+                frames = [await first.recv(), await second.recv()]
+                viewers = len(hub.stats('vm-1')['vm-1'])
+            async with websockets.connect(f'{url}?token=bad') as denied:
+                with pytest.raises(websockets.ConnectionClosed):
+                    await denied.recv()
+            return frames, viewers
+
+        try:
+            frames, viewers = asyncio.run(watch())
+        finally:
+            hub.shutdown()
+
+        assert [len(frame) for frame in frames] == [256, 256]
+        assert viewers == 2
+
+    def test_start_raises_when_port_is_taken(self):
+        taken = socket.socket()
+        taken.bind(('127.0.0.1', 0))
+        taken.listen()
+        hub = StreamHub(lambda vm_id: None, lambda vm_id, header: None)
+        try:
+            with pytest.raises(OSError):
+                hub.start(host='127.0.0.1', port=taken.getsockname()[1])
+        finally:
+            taken.close()
+
+        # Nothing is left half-started, so a later start can succeed
+        hub.start(host='127.0.0.1', port=0)
+        assert hub.port
+        hub.shutdown()
+
+
+class TestFramePipeline:
+    def test_only_dirty_tiles_are_sent_and_decode_is_exact(self):
+        rng = np.random.default_rng(0)
+        first = rng.integers(0, 256, size=(200, 130, 4), dtype=np.uint8)
+        second = first.copy()
+        second[70:80, 10:20] = 0
+
+        encoder, decoder = TileEncoder(130, 200, tile=64), TileDecoder()
+        key_packet, key_dirty = encoder.encode(first)
+        delta_packet, delta_dirty = encoder.encode(second)
+
+        assert key_dirty == 4 * 3
+        assert delta_dirty == 1
+        assert len(delta_packet) < len(key_packet) / 5
+        np.testing.assert_array_equal(decoder.decode(key_packet), first)
+        np.testing.assert_array_equal(decoder.decode(delta_packet), second)
+        assert encoder.encode(second)[1] == 0
+
+    def test_busy_viewer_gets_keyframe_instead_of_delta(self):
+        class FakeViewer:
+            def __init__(self, viewer_id):
+                self.id = viewer_id
+                self.pending = None
+                self.quality_level = 0
+                self.needs_keyframe = False
+                self.frames_sent = self.frames_dropped = 0
+                self.bytes_per_sec = 0.0
+                self.received = []
+
+            def offer(self, frame):
+                self.pending = frame
+                self.received.append(bytes(frame.data))
+
+        pipeline = FramePipeline(128, 128, tile=64)
+        idle, busy = FakeViewer('idle'), FakeViewer('busy')
+        frame = np.zeros((128, 128, 4), dtype=np.uint8)
+        pipeline.publish(frame, time.monotonic(), [idle, busy])
+        idle.pending = None  # idle drained its frame, busy did not
+        frame[0:10, 0:10] = 255
+        pipeline.publish(frame, time.monotonic(), [idle, busy])
+
+        decoder = TileDecoder()
+        decoder.decode(idle.received[0])
+        np.testing.assert_array_equal(decoder.decode(idle.received[1]), frame)
+        # The busy viewer's replacement frame must stand alone
+        np.testing.assert_array_equal(TileDecoder().decode(busy.received[1]), frame)
+        assert len(busy.received[1]) > len(idle.received[1])
+
+
+class TestTokenVerifier:
+    secret = 'unit-test-secret-with-enough-length!'
+
+    def test_caches_verified_claims_until_expiry(self):
+        verifier = TokenVerifier(self.secret)
+        token = jwt.encode({'sub': 'alice', 'exp': int(time.time()) + 1}, self.secret, algorithm='HS256')
+
+        assert verifier.verify(token)['sub'] == 'alice'
+        assert verifier.verify(token)['sub'] == 'alice'
+        assert verifier.snapshot()['hits'] == 1
+
+        time.sleep(1.1)
+        with pytest.raises(jwt.ExpiredSignatureError):
+            verifier.verify(token)
+        assert verifier.snapshot()['expired'] == 1
+
+    def test_cached_never_decodes(self):
+        verifier = TokenVerifier(self.secret)
+        token = jwt.encode({'sub': 'alice'}, self.secret, algorithm='HS256')
+
+        assert verifier.cached(token) is None
+        verifier.verify(token)
+        assert verifier.cached(token)['sub'] == 'alice'
+        assert (verifier.snapshot()['hits'], verifier.snapshot()['misses']) == (1, 1)
+
+    def test_rejects_forged_signature(self):
+        verifier = TokenVerifier(self.secret)
+        forged = jwt.encode({'sub': 'admin', 'role': 'admin'}, 'some-other-secret-value-entirely!', algorithm='HS256')
+        with pytest.raises(jwt.InvalidSignatureError):
+            verifier.verify(forged)
+        assert verifier.snapshot()['entries'] == 0
+
+    def test_evicts_least_recently_used(self):
+        verifier = TokenVerifier(self.secret, max_entries=2)
+        tokens = [jwt.encode({'sub': f'user-{i}'}, self.secret, algorithm='HS256') for i in range(3)]
+        verifier.verify(tokens[0])
+        verifier.verify(tokens[1])
+        verifier.verify(tokens[0])
+        verifier.verify(tokens[2])
+
+        stats = verifier.snapshot()
+        assert (stats['entries'], stats['evictions']) == (2, 1)
+        verifier.verify(tokens[0])
+        assert verifier.snapshot()['hits'] == 2
+
+    def test_verifies_rs256_against_jwks(self, monkeypatch):
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+        jwk.update({'kid': 'key-1', 'alg': 'RS256', 'use': 'sig'})
+        fetches = []
+
+        class Response:
+            def raise_for_status(self):
+                pass
+
+            def json(self):
+                return {'keys': [jwk]}
+
+        monkeypatch.setattr('auth_cache.requests.get', lambda url, timeout: fetches.append(url) or Response())
+        verifier = TokenVerifier(self.secret, jwks=JWKSCache('https://auth.example/jwks'))
+        token = jwt.encode({'sub': 'alice'}, private_key, algorithm='RS256', headers={'kid': 'key-1'})
+
+        assert verifier.verify(token)['sub'] == 'alice'
+        unknown = jwt.encode({'sub': 'alice'}, private_key, algorithm='RS256', headers={'kid': 'key-2'})
+        with pytest.raises(jwt.InvalidTokenError):
+            verifier.verify(unknown)
+        # The unknown kid arrived within the refresh rate limit, so no second fetch
+        assert fetches == ['https://auth.example/jwks']
+
+
+class TestVMStateCache:
+    def test_status_reads_served_from_memory_and_writes_invalidate(self, client):
+        vm_id = str(orchestrator.vms_collection.insert_one({
+            'user_id': 'user-1', 'config': {}, 'status': 'running', 'created_at': time.time(),
+            'updated_at': time.time(), 'connection_info': {'ip': '10.0.0.2'}
+        }).inserted_id)
+
+        for _ in range(3):
+            assert client.get(f'/vm/{vm_id}', headers=auth()).get_json()['status'] == 'running'
+        assert orchestrator.vm_cache.stats['misses'] == 1
+
+        assert client.post(f'/vm/{vm_id}/stop', headers=auth()).status_code == 200
+        assert client.get(f'/vm/{vm_id}', headers=auth()).get_json()['status'] == 'stopped'
+
+    def test_change_events_update_entries_and_listings(self):
+        collection = mongomock.MongoClient().db.vms
+        cache = VMStateCache(collection)
+        oid = collection.insert_one({'user_id': 'alice', 'status': 'starting', 'updated_at': 1.0}).inserted_id
+        assert [vm['status'] for vm in cache.list_for_user('alice')] == ['starting']
+
+        cache._apply({'operationType': 'update', 'documentKey': {'_id': oid},
+                      'fullDocument': {'_id': oid, 'user_id': 'alice', 'status': 'running', 'updated_at': 2.0}})
+        other = {'_id': mongomock.ObjectId(), 'user_id': 'alice', 'status': 'starting', 'updated_at': 3.0}
+        cache._apply({'operationType': 'insert', 'documentKey': {'_id': other['_id']}, 'fullDocument': other})
+        # An older version read before the event must not overwrite it
+        cache.store({'_id': oid, 'user_id': 'alice', 'status': 'starting', 'updated_at': 1.0})
+
+        assert cache.get(str(oid))['status'] == 'running'
+        assert len(cache.list_for_user('alice')) == 2
+        assert cache.stats['misses'] == 1
+
+        cache._apply({'operationType': 'delete', 'documentKey': {'_id': other['_id']}})
+        assert len(cache.list_for_user('alice')) == 1
+
+    def test_polls_when_change_streams_are_unavailable(self):
+        collection = mongomock.MongoClient().db.vms
+        cache = VMStateCache(collection, poll_interval=0.01)
+        oid = collection.insert_one({'user_id': 'alice', 'status': 'starting', 'updated_at': time.time()}).inserted_id
+        assert cache.get(str(oid))['status'] == 'starting'
+
+        cache.start()
+        try:
+            # Another worker finishes the boot
+            collection.update_one({'_id': oid}, {'$set': {'status': 'running', 'updated_at': time.time()}})
+            deadline = time.time() + 2
+            while cache.peek(str(oid))['status'] != 'running' and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            cache.shutdown()
+
+        assert cache.mode == 'polling'
+        assert cache.peek(str(oid))['status'] == 'running'
+
+    def test_polling_reports_each_version_once(self):
+        collection = mongomock.MongoClient().db.vms
+        cache = VMStateCache(collection, poll_interval=0.01)
+        notified = []
+        cache.listeners.append(notified.append)
+        cache.start()
+        try:
+            collection.insert_one({'user_id': 'u1', 'status': 'running', 'version': 1, 'updated_at': time.time()})
+            # Many polls while the document stays inside the overlap window
+            time.sleep(0.3)
+        finally:
+            cache.shutdown()
+
+        assert len(notified) == 1
+        assert cache.listing_generation('u1') == (0, 1)
+
+
+class TestStatusNotifications:
+    def test_fan_out_dedups_and_multiplexes(self):
+        hub = StatusHub()
+        mine = hub.subscribe({'id': 'alice'})
+        watched = hub.subscribe({'id': 'admin'}, vm_ids=['vm-b'], all_owned=False)
+
+        hub.publish({'_id': 'vm-a', 'user_id': 'alice', 'status': 'starting', 'updated_at': 1.0})
+        hub.publish({'_id': 'vm-b', 'user_id': 'alice', 'status': 'running', 'updated_at': 2.0})
+        # The same write seen again through the change stream
+        hub.publish({'_id': 'vm-b', 'user_id': 'alice', 'status': 'running', 'updated_at': 2.0})
+        hub.publish({'_id': 'vm-a', 'user_id': 'alice', 'status': 'running', 'updated_at': 3.0})
+
+        # Pending events coalesce to each VM's latest state
+        assert [(e['vm_id'], e['status']) for e in mine.wait(0)] == [('vm-b', 'running'), ('vm-a', 'running')]
+        assert [e['id'] for e in watched.wait(0)] == ['2.000000']
+        assert hub.stats['duplicates'] == 1
+
+        hub.update(watched, add=['vm-a'], remove=['vm-b'])
+        hub.publish({'_id': 'vm-a', 'user_id': 'alice', 'status': 'stopped', 'updated_at': 4.0})
+        hub.publish({'_id': 'vm-b', 'user_id': 'alice', 'status': 'stopped', 'updated_at': 5.0})
+        assert [e['vm_id'] for e in watched.wait(0)] == ['vm-a']
+
+        mine.close()
+        watched.close()
+        assert hub.snapshot()['connected'] == 0
+
+    def test_sse_resumes_from_last_event_id(self, client):
+        vm_id = str(orchestrator.vms_collection.insert_one({
+            'user_id': 'user-1', 'config': {}, 'status': 'starting', 'created_at': time.time(),
+            'updated_at': time.time(), 'connection_info': None
+        }).inserted_id)
+        orchestrator.update_vm_status(vm_id, {'status': 'running', 'connection_info': {'ip': '10.0.0.3'}})
+
+        response = client.get('/vms/events', headers={**auth(), 'Last-Event-ID': '0'})
+        chunks = iter(response.response)
+        assert response.mimetype == 'text/event-stream'
+        assert next(chunks).startswith(b'retry:')
+        event = json.loads(next(chunks).decode().split('data: ')[1])
+        response.close()
+
+        assert event['vm_id'] == vm_id
+        assert event['status'] == 'running'
+        assert event['connection_info'] == {'ip': '10.0.0.3'}
+        assert client.get('/vms/events', headers=auth('user-2'), query_string={'vm_id': vm_id}).status_code == 403
+        assert client.get('/vms/events', query_string={'vm_id': vm_id}).status_code == 401
+
+    def test_sse_streams_are_capped_and_end_on_shutdown(self, client, monkeypatch):
+        monkeypatch.setattr(orchestrator, 'SSE_MAX_SUBSCRIBERS', 1)
+        monkeypatch.setattr(orchestrator, 'sse_slots', threading.BoundedSemaphore(1))
+        monkeypatch.setattr(orchestrator, 'sse_closing', threading.Event())
+        monkeypatch.setattr(orchestrator, 'sse_stats', {'open': 0, 'opened': 0, 'rejected': 0})
+
+        first = client.get('/vms/events', headers=auth())
+        chunks = iter(first.response)
+        assert next(chunks).startswith(b'retry:')
+        second = client.get('/vms/events', headers=auth('user-2'))
+        assert (second.status_code, second.headers['Retry-After']) == (503, '15')
+
+        # Shutdown ends the open stream instead of waiting out the client
+        orchestrator.end_event_streams()
+        assert list(chunks) == []
+        first.close()
+
+        assert orchestrator.event_stream_stats() == {'open': 0, 'opened': 1, 'rejected': 1, 'max_open': 1}
+        assert client.get('/vms/events', headers=auth('user-2')).status_code == 503
+        orchestrator.sse_closing.clear()
+        third = client.get('/vms/events', headers=auth('user-2'))
+        third.close()
+        assert third.status_code == 200
+
+    def test_websocket_subscription_receives_transitions(self):
+        hub = StatusHub(authorize=lambda header, vm_ids: {'id': 'alice'} if header == 'Bearer good' else None)
+        streams = StreamHub(lambda vm_id: None, lambda vm_id, header: None)
+        streams.routes['events'] = hub.serve_websocket
+        streams.start(host='127.0.0.1', port=0)
+
+        async def watch():
+            async with websockets.connect(f'ws://127.0.0.1:{streams.port}/events?token=good') as ws:
+                await ws.send(json.dumps({'subscribe': ['vm-x']}))
+                while hub.snapshot()['connected'] == 0 or not hub._by_vm:
+                    await asyncio.sleep(0.01)
+                hub.publish({'_id': 'vm-a', 'user_id': 'alice', 'status': 'running', 'updated_at': 1.0})
+                hub.publish({'_id': 'vm-x', 'user_id': 'bob', 'status': 'stopped', 'updated_at': 2.0})
+                return [json.loads(await ws.recv()) for _ in range(2)]
+
+        try:
+            events = asyncio.run(asyncio.wait_for(watch(), 5))
+        finally:
+            streams.shutdown()
+
+        assert sorted((e['vm_id'], e['status']) for e in events) == [('vm-a', 'running'), ('vm-x', 'stopped')]
+
+
+class TestIndexes:
+    def test_migration_is_idempotent_and_rebuilds_changed_indexes(self):
+        db = mongomock.MongoClient().db
+        db.vms.create_index([('user_id', 1)], name='user_page')
+        db.vms.insert_one({'user_id': 'alice', 'status': 'running'})
+
+        first = ensure_indexes(db)
+        second = ensure_indexes(db)
+
+        assert 'vms.user_page' in first['rebuilt']
+        assert 'vms.one_active_vm_per_user' in first['created']
+        assert second == {'created': [], 'rebuilt': [], 'dropped': [], 'failed': []}
+        assert db.vms.find_one({'user_id': 'alice'})['active'] is True
+
+    def test_one_active_vm_per_user(self, client):
+        orchestrator.vms_collection.insert_one({
+            'user_id': 'user-1', 'config': {}, 'status': 'starting', 'active': True, 'updated_at': time.time()
+        })
+        orchestrator.vms_collection.insert_one({
+            'user_id': None, 'config': dict(orchestrator.DEFAULT_VM_CONFIG),
+            'pool_key': pool_key(orchestrator.DEFAULT_VM_CONFIG), 'status': 'warm', 'warmed_at': time.time()
+        })
+
+        body = client.post('/launch', json={}, headers=auth()).get_json()
+
+        assert body['message'] == 'VM is already starting'
+        assert orchestrator.warm_pool.acquire('user-1', orchestrator.DEFAULT_VM_CONFIG) is None
+        assert orchestrator.vms_collection.count_documents({'status': 'warm'}) == 1
+        assert orchestrator.db.launch_queue.count_documents({}) == 0
+
+    def test_vms_pages_with_cursor_and_projection(self, client):
+        orchestrator.vms_collection.insert_many([
+            {'user_id': 'user-1', 'config': {}, 'status': 'stopped', 'created_at': i, 'connection_info': None}
+            for i in range(5)
+        ] + [{'user_id': 'user-2', 'config': {}, 'status': 'stopped'}])
+
+        first = client.get('/vms?limit=3&fields=status', headers=auth()).get_json()
+        rest = client.get(f"/vms?limit=3&cursor={first['next_cursor']}", headers=auth()).get_json()
+
+        assert [set(vm) for vm in first['vms']] == [{'_id', 'status'}] * 3
+        assert [vm['created_at'] for vm in rest['vms']] == [3, 4]
+        assert rest['next_cursor'] is None
+        assert client.get('/vms?fields=user_id', headers=auth()).status_code == 400
+        assert client.get('/vms?cursor=nope', headers=auth()).status_code == 400
+
+
+def winning_plan_stages(plan):
+    if isinstance(plan, dict):
+        stages = [plan['stage']] if 'stage' in plan else []
+        for value in plan.values():
+            stages += winning_plan_stages(value)
+        return stages
+    if isinstance(plan, list):
+        return [stage for item in plan for stage in winning_plan_stages(item)]
+    return []
+
+
+# Query shapes on hot paths; each must be answered from an index
+HOT_QUERIES = [
+    ('vms', {'user_id': 'u', 'active': True}, None),
+    ('vms', {'user_id': 'u'}, [('_id', 1)]),
+    ('vms', {'user_id': 'u', 'status': 'running', '_id': {'$gt': mongomock.ObjectId()}}, [('_id', 1)]),
+    ('vms', {'status': 'warm', 'pool_key': 'k'}, [('warmed_at', 1)]),
+    ('vms', {'updated_at': {'$gt': 0}}, None),
+    ('launch_queue', {'state': 'queued'}, [('enqueued_at', 1)]),
+    ('launch_queue', {'state': 'claimed', 'owner': 'o'}, None),
+    ('launch_queue', {'state': 'claimed', 'heartbeat_at': {'$lt': 0}}, None),
+]
+
+
+@pytest.mark.skipif(not os.environ.get('MONGO_TEST_URI'), reason='explain plans need a real mongod (MONGO_TEST_URI)')
+@pytest.mark.parametrize('collection,query,sort', HOT_QUERIES)
+def test_hot_queries_use_indexes(collection, query, sort):
+    import pymongo
+    db = pymongo.MongoClient(os.environ['MONGO_TEST_URI']).get_database('avmo_index_test')
+    try:
+        ensure_indexes(db)
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = winning_plan_stages(cursor.explain()['queryPlanner']['winningPlan'])
+        assert stages and 'COLLSCAN' not in stages
+    finally:
+        db.client.drop_database('avmo_index_test')
+        db.client.close()
+
+
+class TestPlacement:
+    def registry(self, **nodes):
+        registry = NodeRegistry(mongomock.MongoClient().db.nodes)
+        for node_id, (cpu, memory_mb) in nodes.items():
+            registry.register(node_id, f'http://{node_id}', {'cpu_cores': cpu, 'memory_mb': memory_mb})
+        return registry
+
+    def test_spread_and_pack_policies(self):
+        vm = {'cpu_cores': 2, 'memory_mb': 2048}
+        spread = PlacementScheduler(self.registry(a=(8, 8192), b=(4, 4096)), 'spread')
+        pack = PlacementScheduler(self.registry(a=(8, 8192), b=(4, 4096)), 'pack')
+
+        assert [spread.place(vm)['_id'] for _ in range(4)] == ['a', 'a', 'b', 'a']
+        assert [pack.place(vm)['_id'] for _ in range(6)] == ['b', 'b', 'a', 'a', 'a', 'a']
+        assert pack.place(vm) is None
+        assert pack.stats == {'placed': 6, 'rejected': 1, 'conflicts': 0}
+
+    def test_reservations_survive_reregistration(self):
+        registry = self.registry(a=(8, 8192))
+        registry.reserve('a', {'cpu_cores': 2, 'memory_mb': 2048})
+        registry.register('a', 'http://a', {'cpu_cores': 4, 'memory_mb': 8192})
+
+        assert registry.get('a')['free'] == {'cpu_cores': 2, 'memory_mb': 6144}
+        assert registry.reserve('a', {'cpu_cores': 4, 'memory_mb': 1024}) is None
+
+    def test_launch_routes_to_chosen_node_and_releases_on_stop(self, client, monkeypatch):
+        local, remote = orchestrator.NODE_ID, 'node-b'
+        orchestrator.node_registry.register(local, 'http://local', {'cpu_cores': 1, 'memory_mb': 1024})
+        orchestrator.node_registry.register(remote, 'http://node-b', {'cpu_cores': 8, 'memory_mb': 8192})
+        forwarded = []
+
+        class Forwarded:
+            status_code, content, headers = 200, b'{"vm_id": "remote"}', {'Content-Type': 'application/json'}
+
+        monkeypatch.setattr(orchestrator, 'forward_request',
+                            lambda node, method, path, headers, body, timeout: forwarded.append(
+                                (node['_id'], path, headers)) or Forwarded())
+
+        assert client.post('/launch', json={}, headers=auth()).get_json() == {'vm_id': 'remote'}
+        assert forwarded[0][:2] == (remote, '/launch')
+        assert orchestrator.node_registry.get(remote)['free'] == {'cpu_cores': 6, 'memory_mb': 6144}
+
+        # The chosen node accepts the signed hand-off without placing again
+        orchestrator.node_registry.register(local, 'http://local', {'cpu_cores': 8, 'memory_mb': 8192})
+        token = placement_token(orchestrator.app.config['SECRET_KEY'], local, {'cpu_cores': 2, 'memory_mb': 2048})
+        orchestrator.node_registry.reserve(local, {'cpu_cores': 2, 'memory_mb': 2048})
+        body = client.post('/launch', json={}, headers={**auth('user-2'), 'X-Placement-Token': token}).get_json()
+        orchestrator.launch_scheduler.start()
+        try:
+            deadline = time.time() + 2
+            while orchestrator.vms_collection.find_one({'status': 'running'}) is None and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            orchestrator.launch_scheduler.shutdown()
+        assert orchestrator.vms_collection.find_one({'user_id': 'user-2'})['node_id'] == local
+        assert orchestrator.node_registry.get(local)['free'] == {'cpu_cores': 6, 'memory_mb': 6144}
+
+        assert client.post(f"/vm/{body['vm_id']}/stop", headers=auth('user-2')).status_code == 200
+        assert orchestrator.node_registry.get(local)['free'] == {'cpu_cores': 8, 'memory_mb': 8192}
+        assert client.post('/launch', json={}, headers={**auth('user-3'), 'X-Placement-Token': 'forged'}).status_code == 403
+
+    def test_fleet_endpoints_require_admin(self, client):
+        for path in ('/nodes', '/reconcile/stats', '/hypervisor/stats'):
+            assert client.get(path, headers=auth()).status_code == 403
+            assert client.get(path, headers=auth('root', 'admin')).status_code == 200
+
+
+@pytest.mark.skipif(not os.environ.get('MONGO_TEST_URI'), reason='several orchestrator processes need a shared mongod')
+def test_local_cluster_packs_launches():
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+    import local_cluster
+    import pymongo
+
+    uri = os.environ['MONGO_TEST_URI'].rstrip('/') + '/avmo_cluster_test'
+    db = pymongo.MongoClient(uri).get_database()
+    db.client.drop_database(db.name)
+    processes, urls = local_cluster.start_cluster(uri, nodes=2, cpu=4, memory_mb=8192, policy='pack')
+    try:
+        codes = [local_cluster.launch(urls[0], f'user-{i}').status_code for i in range(5)]
+        placed = sorted(vm['node_id'] for vm in db.vms.find({}, {'node_id': 1}))
+    finally:
+        local_cluster.stop_cluster(processes)
+        db.client.drop_database(db.name)
+
+    # Two 2-core VMs fill a node before the next one is used; the fifth has nowhere to go
+    assert codes == [200, 200, 200, 200, 503]
+    assert placed.count('node-0') == 2 and placed.count('node-1') == 2
+
+
+def test_lifecycle_bench_reports_latency_and_compares_baselines(client, monkeypatch):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+    import lifecycle_bench
+    monkeypatch.setenv('MONGO_URI', 'mongodb://localhost:27017/demo_bench')
+
+    report = lifecycle_bench.run('orchestrator', users=4, cycles=2, boot_seconds=0.01, poll_interval=0.005)
+    demo = lifecycle_bench.run('demo', users=2, cycles=1, boot_seconds=0.01, poll_interval=0.005)
+
+    assert (report['cycles_completed'], report['cycles_failed']) == (8, 0)
+    assert set(report['routes']) == {'POST /launch', 'GET /vm/<id>', 'POST /vm/<id>/stop'}
+    assert report['routes']['POST /launch']['count'] == 8 and report['peak_concurrent_boots'] >= 1
+    assert report['peak_threads'] > 4 and report['peak_rss_mb'] > 0
+    assert demo['cycles_completed'] == 2 and demo['routes']['POST /vms']['count'] == 2
+    assert lifecycle_bench.compare(report, report) == []
+    slower = {**report, 'throughput_rps': report['throughput_rps'] / 2}
+    assert lifecycle_bench.compare(slower, report) == [
+        f"throughput_rps: {slower['throughput_rps']} < {report['throughput_rps']} baseline"]
+
+class TestHealth:
+    def test_probes_are_cached_within_staleness_bound(self):
+        calls = []
+        monitor = HealthMonitor({'database': lambda: calls.append(1), 'cache': lambda: 1 / 0}, max_staleness=60)
+
+        first = monitor.snapshot()
+        second = monitor.snapshot()
+
+        assert len(calls) == 1
+        assert first['status'] == 'DOWN'
+        assert second['checks']['database']['status'] == 'UP'
+        assert second['checks']['cache']['error'] == 'division by zero'
+        assert second['checks']['database']['latency_ms'] >= 0
+
+        monitor.max_staleness = 0
+        monitor.snapshot()
+        assert len(calls) == 2
+
+    def test_tracks_only_launched_processes(self):
+        tracker = ProcessTracker()
+        process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+        try:
+            tracker.track('vm-1', process.pid)
+            assert tracker.check() == {'status': 'UP', 'tracked': 1, 'alive': 1, 'exited': []}
+            process.kill()
+            process.wait()
+            assert tracker.check() == {'status': 'DEGRADED', 'tracked': 1, 'alive': 0, 'exited': ['vm-1']}
+        finally:
+            process.kill()
+        tracker.untrack('vm-1')
+        assert tracker.check()['tracked'] == 0
+
+    def test_health_endpoint_serves_snapshot(self, client, monkeypatch):
+        pings = []
+        monitor = HealthMonitor({'database': lambda: pings.append(1),
+                                 'emulator': orchestrator.process_tracker.check}, max_staleness=60)
+        monkeypatch.setattr(orchestrator, 'health_monitor', monitor)
+
+        for _ in range(3):
+            body = client.get('/health').get_json()
+
+        assert len(pings) == 1
+        assert body['status'] == 'UP'
+        assert body['services'] == {'database': 'UP', 'emulator': 'UP'}
+        assert set(body['checks']['database']) >= {'latency_ms', 'age_seconds', 'checked_at'}
+
+
+class TestTelemetry:
+    @staticmethod
+    def fake_reader(process, interface, nics):
+        # `process` is a counter standing in for the VM: one CPU second and 1 MB of traffic per reading
+        process['n'] += 1
+        n = process['n']
+        return {'cpu_seconds': n * 0.5, 'rss_bytes': 1000 + n, 'disk_read_bytes': 0, 'disk_write_bytes': 0,
+                'net_rx_bytes': n * 1_000_000, 'net_tx_bytes': 0}
+
+    def test_rings_have_fixed_memory_and_roll_up(self):
+        counter = {'n': 0}
+        collector = TelemetryCollector(lambda: [('vm-1', counter, None)], interval=1.0, raw_capacity=10,
+                                       rollups={60: 5}, reader=self.fake_reader)
+        collector.sample(now=0)
+        collector.sample(now=1)
+        size = collector.snapshot()['bytes']
+        for t in range(2, 200):
+            collector.sample(now=t)
+
+        assert collector.snapshot()['bytes'] == size
+        raw = collector.window('vm-1', 5, now=199)
+        assert raw['resolution'] == '1s'
+        assert [row['timestamp'] for row in raw['samples']] == [194, 195, 196, 197, 198, 199]
+        assert raw['samples'][-1]['cpu_percent'] == 50.0
+        assert raw['samples'][-1]['net_rx_bps'] == 1_000_000
+
+        minutes = collector.window('vm-1', 180, now=199)
+        assert minutes['resolution'] == '1m'
+        assert [row['timestamp'] for row in minutes['samples']] == [60, 120]
+        assert minutes['samples'][0]['rss_bytes'] == 1000 + 90.5
+
+        collector.targets = lambda: []
+        collector.sample(now=200)
+        assert collector.window('vm-1', 5) is None
+
+    def test_samples_real_process(self):
+        tracker = ProcessTracker()
+        process = subprocess.Popen([sys.executable, '-c', 'while True: pass'])
+        try:
+            tracker.track('vm-1', process.pid)
+            collector = TelemetryCollector(tracker.targets)
+            collector.sample()
+            time.sleep(0.3)
+            collector.sample()
+            sample = collector.latest('vm-1')
+        finally:
+            process.kill()
+            process.wait()
+
+        assert sample['cpu_percent'] > 10
+        assert sample['rss_bytes'] > 0
+        with pytest.raises(ValueError):
+            parse_duration('soon')
+
+    def test_metrics_endpoint(self, client, monkeypatch):
+        counter = {'n': 0}
+        vm_id = str(orchestrator.vms_collection.insert_one(
+            {'user_id': 'user-1', 'status': 'running', 'config': {}}).inserted_id)
+        collector = TelemetryCollector(lambda: [(vm_id, counter, None)], reader=self.fake_reader)
+        monkeypatch.setattr(orchestrator, 'telemetry', collector)
+        now = time.time()
+        for t in (now - 10, now - 5, now):
+            collector.sample(now=t)
+
+        body = client.get(f'/vm/{vm_id}/metrics?range=1m', headers=auth()).get_json()
+        assert body['sampled'] is True
+        assert body['range_seconds'] == 60
+        assert len(body['samples']) == 2
+
+        assert client.get(f'/vm/{vm_id}/metrics', headers=auth('user-2')).status_code == 403
+        assert client.get(f'/vm/{vm_id}/metrics?range=x', headers=auth()).status_code == 400
+
+
+class TestMetrics:
+    def test_sharded_histogram_sums_threads(self):
+        registry = MetricsRegistry()
+        latency = registry.histogram('op_seconds', 'Op latency', ('op',), buckets=(0.1, 1.0))
+        calls = registry.counter('calls_total', 'Calls')
+
+        def work():
+            for _ in range(1000):
+                latency.observe(0.05, 'read')
+                latency.observe(0.5, 'read')
+                calls.inc()
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        text = registry.render()
+
+        assert 'op_seconds_bucket{op="read",le="0.1"} 4000' in text
+        assert 'op_seconds_bucket{op="read",le="1.0"} 8000' in text
+        assert 'op_seconds_bucket{op="read",le="+Inf"} 8000' in text
+        assert 'op_seconds_count{op="read"} 8000' in text
+        assert 'calls_total 4000' in text
+        # Exited threads are folded into one retired shard
+        assert latency._shards == [] and registry.render() == text
+
+    def test_mongo_listener_records_commands(self):
+        registry = MetricsRegistry()
+        listener = MongoCommandMetrics(registry)
+
+        listener.succeeded(SimpleNamespace(command_name='find', duration_micros=1500))
+        listener.failed(SimpleNamespace(command_name='insert', duration_micros=400))
+        text = registry.render()
+
+        assert 'mongo_command_duration_seconds_bucket{command="find",le="0.0025"} 1' in text
+        assert 'mongo_command_duration_seconds_count{command="insert"} 1' in text
+        assert 'mongo_command_failures_total{command="insert"} 1' in text
+
+    def test_metrics_endpoint(self, client):
+        vm_id = client.post('/launch', json={}, headers=auth()).get_json()['vm_id']
+        orchestrator.start_vm_process(vm_id, dict(orchestrator.DEFAULT_VM_CONFIG))
+
+        response = client.get('/metrics')
+        text = response.get_data(as_text=True)
+
+        assert response.content_type.startswith('text/plain; version=0.0.4')
+        assert 'http_request_duration_seconds_count{route="launch_vm",method="POST",status="200"}' in text
+        assert 'vms{status="running"} 1' in text
+        assert 'thread_pool_workers{pool="launch"} 1' in text
+        assert 'vm_launch_phase_seconds_count{phase="ready"}' in text
+
+
+class TestIdleSuspend:
+    def make_monitor(self, tmp_path, sessions, viewers=0, **kwargs):
+        events = []
+
+        def resumed(vm_id, session):
+            time.sleep(0.05)
+            events.append(('resumed', vm_id))
+            sessions[vm_id] = session
+
+        def suspended(vm_id):
+            events.append(('suspended', vm_id))
+            sessions.pop(vm_id)
+            return True
+
+        backend = SimulatedSuspendBackend(root=str(tmp_path), bandwidth_mbps=1e9)
+        monitor = IdleMonitor(backend, lambda: dict(sessions), suspended, resumed,
+                              viewers=lambda vm_id: viewers, idle_after=100, reclaim_after=10, **kwargs)
+        return monitor, events
+
+    def test_reclaims_then_suspends_idle_vm(self, tmp_path):
+        session = {'config': {'ram': '2048M'}, 'connection_info': {'ip': '10.0.0.1'}}
+        sessions = {'vm-1': session}
+        monitor, events = self.make_monitor(tmp_path, sessions)
+
+        monitor.sweep(now=time.time())
+        monitor.sweep(now=time.time() + 20)
+        assert monitor.stats['reclaimed_bytes'] == 1024 ** 3
+        monitor.touch('vm-1')
+        assert monitor.stats['reclaimed_bytes'] == 0
+
+        monitor.sweep(now=time.time() + 200)
+        assert events == [('suspended', 'vm-1')]
+        assert sessions == {}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(monitor.resume('vm-1'))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(results) == [False] * 4 + [True]
+        assert sessions['vm-1']['connection_info'] == {'ip': '10.0.0.1'}
+        assert os.listdir(tmp_path) == []
+
+    def test_viewers_keep_vm_awake(self, tmp_path):
+        sessions = {'vm-1': {'config': {}, 'connection_info': {}}}
+        monitor, events = self.make_monitor(tmp_path, sessions, viewers=1)
+
+        monitor.sweep(now=time.time())
+        monitor.sweep(now=time.time() + 1000)
+
+        assert events == [] and monitor.stats['reclaimed_bytes'] == 0
+
+    def test_access_resumes_suspended_vm(self, client, tmp_path, monkeypatch):
+        backend = SimulatedSuspendBackend(root=str(tmp_path), bandwidth_mbps=1e9)
+        monitor = IdleMonitor(backend, orchestrator.idle_candidates, orchestrator.record_suspended,
+                              orchestrator.record_resumed, idle_after=60,
+                              observe=lambda action, seconds: orchestrator.idle_transition_seconds.observe(
+                                  seconds, action))
+        monkeypatch.setattr(orchestrator, 'idle_monitor', monitor)
+        orchestrator.node_registry.register('node-a', 'http://node-a', {'cpu_cores': 4, 'memory_mb': 8192})
+        resources = {'cpu_cores': 2, 'memory_mb': 2048}
+        orchestrator.node_registry.reserve('node-a', resources)
+        vm_id = str(orchestrator.vms_collection.insert_one({
+            'user_id': 'user-1', 'config': dict(orchestrator.DEFAULT_VM_CONFIG), 'status': 'running',
+            'active': True, 'node_id': 'node-a', 'resources': resources, 'connection_info': {'ip': '10.0.0.5'}
+        }).inserted_id)
+        orchestrator.active_vms[vm_id] = {'process': None, 'config': dict(orchestrator.DEFAULT_VM_CONFIG),
+                                          'connection_info': {'ip': '10.0.0.5'}, 'overlay': None}
+
+        monitor.sweep(now=time.time())
+        monitor.sweep(now=time.time() + 61)
+
+        assert orchestrator.vms_collection.find_one()['status'] == 'suspended'
+        assert vm_id not in orchestrator.active_vms
+        assert orchestrator.node_registry.get('node-a')['free']['memory_mb'] == 8192
+        # Still the user's VM: a second launch gets it back instead of booting another
+        body = client.post('/launch', json={}, headers=auth()).get_json()
+        assert (body['vm_id'], body['message']) == (vm_id, 'VM already running')
+        assert body['connection_info'] == {'ip': '10.0.0.5'}
+        assert orchestrator.node_registry.get('node-a')['free']['memory_mb'] == 6144
+        assert client.get(f'/vm/{vm_id}', headers=auth()).get_json()['status'] == 'running'
+        assert monitor.stats['suspended'] == monitor.stats['resumed'] == 1
+        assert 'vm_idle_transition_seconds_count{action="resume"}' in client.get('/metrics').get_data(as_text=True)
+        orchestrator.terminate_vm(vm_id)
+
+
+class TestBulkOperations:
+    def insert_vms(self, status, count, **fields):
+        return [str(orchestrator.vms_collection.insert_one({
+            'user_id': f'user-{status}-{i}', 'config': dict(orchestrator.DEFAULT_VM_CONFIG), 'status': status,
+            'active': status in ('running', 'suspended'), 'updated_at': time.time(), **fields
+        }).inserted_id) for i in range(count)]
+
+    def events(self, client, job_id):
+        text = client.get(f'/vms/bulk/{job_id}/events', headers=auth('root', 'admin')).get_data(as_text=True)
+        progress = [json.loads(line[6:]) for block in text.split('\n\n') if 'event: progress' in block
+                    for line in block.splitlines() if line.startswith('data: ')]
+        return progress, text
+
+    def test_bulk_stop_streams_progress_and_releases_capacity(self, client):
+        orchestrator.node_registry.register(orchestrator.NODE_ID, 'http://local', {'cpu_cores': 16, 'memory_mb': 32768})
+        resources = {'cpu_cores': 2, 'memory_mb': 2048}
+        for _ in range(4):
+            orchestrator.node_registry.reserve(orchestrator.NODE_ID, resources)
+        running = self.insert_vms('running', 4, node_id=orchestrator.NODE_ID, resources=resources)
+        self.insert_vms('stopped', 2)
+
+        assert client.post('/vms/bulk/stop', json={'selector': {'status': 'running'}},
+                           headers=auth()).status_code == 403
+        assert client.post('/vms/bulk/stop', json={'selector': {}}, headers=auth('root', 'admin')).status_code == 400
+        response = client.post('/vms/bulk/stop', json={'selector': {'status': ['running', 'stopped']}},
+                               headers=auth('root', 'admin'))
+        assert response.status_code == 202
+        progress, text = self.events(client, response.get_json()['job_id'])
+
+        assert sorted(p['vm_id'] for p in progress if p['outcome'] == 'stopped') == sorted(running)
+        assert [p['outcome'] for p in progress].count('skipped') == 2
+        assert 'event: done' in text and '"state": "succeeded"' in text
+        assert orchestrator.vms_collection.count_documents({'status': 'stopped', 'active': False}) == 6
+        assert orchestrator.node_registry.get(orchestrator.NODE_ID)['free']['memory_mb'] == 32768
+        job = client.get(f"/vms/bulk/{response.get_json()['job_id']}", headers=auth('root', 'admin')).get_json()
+        assert job['counts'] == {'stopped': 4, 'skipped': 2} and len(job['results']) == 6
+
+    def test_bulk_launch_relaunches_and_respects_active_guard(self, client):
+        stopped = self.insert_vms('stopped', 3)
+        orchestrator.vms_collection.insert_one({'user_id': 'user-stopped-0', 'config': {}, 'status': 'running',
+                                                'active': True})
+
+        response = client.post('/vms/bulk/launch', json={'selector': {'vm_ids': stopped}},
+                               headers=auth('root', 'admin'))
+        progress, _ = self.events(client, response.get_json()['job_id'])
+
+        outcomes = {p['vm_id']: (p['outcome'], p.get('error')) for p in progress}
+        assert outcomes[stopped[0]] == ('skipped', 'User already has an active VM')
+        assert outcomes[stopped[1]] == outcomes[stopped[2]] == ('queued', None)
+        assert orchestrator.launch_scheduler.snapshot()['queued'] == 2
+        assert orchestrator.vms_collection.find_one({'_id': ObjectId(stopped[1])})['status'] == 'starting'
+
+
+class TestStatusWriter:
+    def test_coalesces_per_vm_into_one_bulk_write(self):
+        vms = mongomock.MongoClient().db.vms
+        ids = [vms.insert_one({'status': 'starting'}).inserted_id for _ in range(2)]
+        batches = []
+        writer = StatusWriter(vms, window=60, on_written=batches.append)
+        writer.start()
+
+        for i in range(5):
+            writer.submit(ids[0], {'last_active_at': i})
+        writer.submit(ids[1], {'status': 'running'})
+        stale = writer.submit(ids[1], {'status': 'suspended'}, only_from='starting')
+        writer.shutdown()
+
+        assert vms.find_one({'_id': ids[0]})['last_active_at'] == 4
+        assert vms.find_one({'_id': ids[1]})['status'] == 'running'
+        # The conditional write went in a later batch, after the VM had left 'starting'
+        assert stale.result(0) is None
+        assert writer.snapshot()['coalesced'] == 4 and writer.snapshot()['batches'] == 2
+        assert [len(batch) for batch in batches] == [2]
+
+    def test_durable_writes_share_a_batch(self):
+        vms = mongomock.MongoClient().db.vms
+        ids = [vms.insert_one({'status': 'starting'}).inserted_id for _ in range(20)]
+        writer = StatusWriter(vms, window=0.05)
+        writer.start()
+        results = {}
+
+        def finish(vm_id):
+            results[vm_id] = writer.write(vm_id, {'status': 'running'})
+
+        threads = [threading.Thread(target=finish, args=(vm_id,)) for vm_id in ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        writer.shutdown()
+
+        assert all(results[vm_id]['status'] == 'running' for vm_id in ids)
+        assert writer.snapshot()['batches'] < len(ids)
+
+    def test_transitions_update_cache_and_release_capacity(self, client):
+        orchestrator.node_registry.register(orchestrator.NODE_ID, 'http://local', {'cpu_cores': 4, 'memory_mb': 4096})
+        resources = {'cpu_cores': 2, 'memory_mb': 2048}
+        orchestrator.node_registry.reserve(orchestrator.NODE_ID, resources)
+        vm_id = str(orchestrator.vms_collection.insert_one({
+            'user_id': 'user-1', 'status': 'running', 'active': True,
+            'node_id': orchestrator.NODE_ID, 'resources': resources
+        }).inserted_id)
+        assert orchestrator.vm_cache.get(vm_id)['status'] == 'running'
+
+        vm = orchestrator.update_vm_status(vm_id, {'status': 'stopped'})
+
+        assert vm['status'] == 'stopped' and vm['active'] is False
+        assert orchestrator.vm_cache.get(vm_id)['status'] == 'stopped'
+        assert orchestrator.node_registry.get(orchestrator.NODE_ID)['free']['memory_mb'] == 4096
+        assert orchestrator.update_vm_status(vm_id, {'status': 'suspended'}, only_from='running') is None
+
+class TestReconciler:
+    @pytest.fixture
+    def reconciler(self, client, monkeypatch, tmp_path):
+        runtime = RuntimeDirectory(str(tmp_path))
+        monkeypatch.setattr(orchestrator, 'vm_runtime', runtime)
+        monkeypatch.setattr(orchestrator, 'active_vms', {})
+        monkeypatch.setattr(orchestrator, 'process_tracker', ProcessTracker())
+        orchestrator.node_registry.register(orchestrator.NODE_ID, 'http://local', {'cpu_cores': 8, 'memory_mb': 8192})
+        return Reconciler(orchestrator.vms_collection, orchestrator.db.launch_queue, orchestrator.node_registry,
+                          orchestrator.NODE_ID, runtime, orchestrator.reconcile_sessions, orchestrator.adopt_vm,
+                          orchestrator.teardown_vm, orchestrator.mark_orphaned,
+                          orchestrator.idle_monitor.has_saved_state, page_size=100)
+
+    def insert_vm(self, status, user_id, **fields):
+        return str(orchestrator.vms_collection.insert_one({
+            'user_id': user_id, 'config': {}, 'status': status, 'active': status in ('starting', 'running'),
+            'updated_at': time.time() - 600, **fields
+        }).inserted_id)
+
+    def test_startup_pass_adopts_survivors_and_errors_orphans(self, reconciler):
+        resources = {'cpu_cores': 2, 'memory_mb': 2048}
+        for _ in range(3):
+            # Two VMs' reservations plus one leaked by a crash
+            orchestrator.node_registry.reserve(orchestrator.NODE_ID, resources)
+        local = {'node_id': orchestrator.NODE_ID, 'resources': resources}
+        survivor = self.insert_vm('running', 'u1', **local)
+        lost = self.insert_vm('running', 'u2', **local)
+        stuck = self.insert_vm('starting', 'u3')
+        queued = self.insert_vm('starting', 'u4')
+        orchestrator.db.launch_queue.insert_one({'_id': queued, 'user_id': 'u4', 'config': {}, 'state': 'queued'})
+        suspended = self.insert_vm('suspended', 'u5')
+        orchestrator.vms_collection.insert_many([{'user_id': f'old-{i}', 'status': 'stopped'} for i in range(500)])
+        reconciler.runtime.record(survivor, os.getpid(), {'config': {}, 'connection_info': {'port': 5555}})
+
+        summary = reconciler.run_once()
+
+        status = lambda vm_id: orchestrator.vms_collection.find_one({'_id': ObjectId(vm_id)})['status']
+        assert summary['scanned'] == 5 and summary['adopted'] == 1 and summary['orphaned'] == 3
+        assert orchestrator.active_vms[survivor]['connection_info'] == {'port': 5555}
+        assert [status(vm_id) for vm_id in (survivor, lost, stuck, queued, suspended)] == \
+            ['running', 'error', 'error', 'starting', 'error']
+        # The leak is only corrected once a second pass measures the same drift
+        assert summary['capacity_corrected'] is None
+        assert reconciler.run_once()['capacity_corrected'] == resources
+        assert orchestrator.node_registry.get(orchestrator.NODE_ID)['free'] == {'cpu_cores': 6, 'memory_mb': 6144}
+
+    def test_periodic_pass_waits_for_a_second_sighting(self, reconciler):
+        reconciler.run_once()
+        vm_id = self.insert_vm('running', 'u1')
+        gone = str(ObjectId())
+        orchestrator.active_vms[gone] = {'config': {}}
+
+        assert reconciler.run_once()['orphaned'] == 0
+        assert gone not in orchestrator.active_vms
+        assert reconciler.run_once()['orphaned'] == 1
+        assert orchestrator.vms_collection.find_one({'_id': ObjectId(vm_id)})['status'] == 'error'
+
+class TestHypervisor:
+    def test_allocator_hands_out_lowest_free_slot(self):
+        network = NetworkAllocator(subnet='10.1.0.0/29', base_port=6000)
+        first, second, third = (network.lease(f'vm-{i}') for i in range(3))
+        assert network.lease('vm-0') == first
+        assert (first['ip'], first['console_port'], first['adb_port']) == ('10.1.0.2', 6000, 6001)
+        assert len({lease['ip'] for lease in (first, second, third)}) == 3
+
+        network.release('vm-1')
+        assert network.lease('vm-3') == {**second, 'tap': 'avmo-tap1'}
+        # A lease held before a restart is claimed back unless it was handed out again
+        assert not network.claim('vm-1', second)
+        assert network.claim('vm-0', first)
+        with pytest.raises(RuntimeError):
+            for i in range(4, 10):
+                network.lease(f'vm-{i}')
+
+    def test_qemu_command_follows_vm_config(self, tmp_path):
+        config = {'android_version': '12.0', 'ram': '4096M', 'resolution': '720x1280', 'cpu_cores': 4}
+        lease = NetworkAllocator().lease('vm-1')
+        driver = QemuDriver(binary='qemu', image_dir='/images', run_dir=str(tmp_path), hugepages=True)
+        command = driver.command('vm-1', config, lease)
+
+        assert command[command.index('-smp') + 1] == '4'
+        assert command[command.index('-m') + 1] == '4096M'
+        assert 'file=/images/android-12.0.qcow2,if=none,id=disk0,cache=none,aio=native' in command
+        assert 'user,id=net0,hostfwd=tcp:127.0.0.1:5555-:5555' in command
+        assert 'virtio-gpu-pci,xres=720,yres=1280' in command
+        assert f"unix:{tmp_path}/vm-1.qmp,server=on,wait=off" in command
+        assert ('-mem-path' in command) == (driver.stats['hugepage_fallbacks'] == 0)
+
+        restored = driver.command('vm-1', config, lease, {'overlay': '/overlays/vm-1.qcow2'})
+        assert 'file=/overlays/vm-1.qcow2,if=none,id=disk0,cache=none,aio=native' in restored
+        emulator = EmulatorDriver(binary='emulator', run_dir=str(tmp_path)).command('vm-1', config, lease)
+        assert emulator[emulator.index('-ports') + 1] == '5554,5555'
+        assert emulator[emulator.index('-memory') + 1] == '4096'
+
+    def test_qemu_stderr_goes_to_a_log_and_process_is_pinned(self, tmp_path):
+        # Far more stderr than a pipe holds, then the mask the process was started with
+        binary = tmp_path / 'qemu'
+        binary.write_text("#!/bin/sh\nhead -c 200000 /dev/zero | tr '\\0' x >&2\n"
+                          "grep Cpus_allowed_list /proc/$$/status >&2\nexit 3\n")
+        binary.chmod(0o755)
+        driver = QemuDriver(binary=str(binary), image_dir=str(tmp_path), run_dir=str(tmp_path), poll_interval=0.01)
+        instance = driver.start('vm-1', {'cpu_cores': 1}, NetworkAllocator().lease('vm-1'))
+
+        with pytest.raises(RuntimeError) as error:
+            driver.wait_ready(instance, timeout=10)
+        assert 'exited with code 3' in str(error.value)
+        assert f"Cpus_allowed_list:\t{driver.host_cpus[0]}" in str(error.value)
+        assert os.path.getsize(driver.log_path('vm-1')) > 200000
+
+        driver.stop(instance)
+        assert not os.path.exists(driver.log_path('vm-1'))
+
+    def test_booted_vm_process_is_tracked_and_stopped(self, client, monkeypatch, tmp_path):
+        driver = FakeDriver(boot_seconds=0, processes=True)
+        monkeypatch.setattr(orchestrator, 'hypervisor', driver)
+        monkeypatch.setattr(orchestrator, 'network', NetworkAllocator())
+        monkeypatch.setattr(orchestrator, 'process_tracker', ProcessTracker())
+        monkeypatch.setattr(orchestrator, 'vm_runtime', RuntimeDirectory(str(tmp_path)))
+        monkeypatch.setattr(orchestrator, 'active_vms', {})
+
+        connection_info = orchestrator.boot_vm('vm-1', dict(orchestrator.DEFAULT_VM_CONFIG))
+        second = orchestrator.boot_vm('vm-2', dict(orchestrator.DEFAULT_VM_CONFIG))
+        process = orchestrator.active_vms['vm-1']['process']
+
+        assert connection_info['ip'] != second['ip'] and connection_info['port'] != second['port']
+        assert [(vm_id, tracked.pid) for vm_id, tracked, _ in orchestrator.process_tracker.targets()
+                if vm_id == 'vm-1'] == [('vm-1', process.pid)]
+        assert 'vm-1' in orchestrator.vm_runtime.load()
+
+        orchestrator.teardown_vm('vm-1')
+        orchestrator.teardown_vm('vm-2')
+        assert process.poll() is not None
+        assert orchestrator.network.snapshot()['leased'] == 0
+        assert driver.snapshot()['stopped'] == 2
+
+
+
+class TestImageStore:
+    def make_store(self, tmp_path, quota, images):
+        source = tmp_path / 'source'
+        source.mkdir(exist_ok=True)
+        for name, content in images.items():
+            (source / f'{name}.qcow2').write_bytes(content)
+        return ImageStore(str(tmp_path / 'store'), image_source(str(source)), quota_bytes=quota)
+
+    def test_overlays_share_one_blob_per_content(self, tmp_path):
+        store = self.make_store(tmp_path, 1000, {'android-11.0': b'a' * 300, 'android-12.0': b'a' * 300})
+
+        first = store.create_overlay('vm-1', {'android_version': '11.0'})
+        store.create_overlay('vm-2', {'android_version': '11.0'})
+        store.create_overlay('vm-3', {'android_version': '12.0'})
+
+        with open(first) as f:
+            assert os.path.basename(json.load(f)['backing_file']) == hashlib.sha256(b'a' * 300).hexdigest()
+        stats = store.snapshot()
+        assert (stats['hits'], stats['misses'], stats['blobs'], stats['images']) == (1, 2, 1, 2)
+        assert stats['used_bytes'] == 300 and stats['deduplicated_bytes'] == 300
+        assert stats['overlay_bytes_saved'] > 0 and stats['bytes_saved'] > 300
+        # The index survives a restart, and so do the overlays pinning their blob
+        reopened = ImageStore(str(tmp_path / 'store'), store.source, quota_bytes=1000)
+        assert reopened.snapshot()['active_overlays'] == 3
+        assert reopened.ensure('android-12.0') == store.ensure('android-11.0')
+
+    def test_evicts_least_recently_used_unpinned_blob(self, tmp_path):
+        store = self.make_store(tmp_path, 500, {'android-11.0': b'a' * 200, 'android-12.0': b'b' * 200,
+                                                'android-13.0': b'c' * 200})
+        store.create_overlay('vm-1', {'android_version': '11.0'})
+        store.ensure('android-12.0')
+        store.ensure('android-13.0')  # over quota: 12.0 goes, 11.0 backs vm-1
+
+        assert store.snapshot()['evictions'] == 1 and store.used_bytes() == 400
+        assert store.ensure('android-11.0') and store.snapshot()['misses'] == 3
+
+        store.release('vm-1')
+        store.ensure('android-12.0')  # 11.0 is unpinned now but was used more recently than 13.0
+        assert store.snapshot()['evictions'] == 2
+        assert store.ensure('android-11.0') and store.snapshot()['misses'] == 4
+
+    def test_prefetches_popular_images(self, tmp_path):
+        store = self.make_store(tmp_path, 1000, {'android-11.0': b'a' * 10, 'android-13.0': b'b' * 10})
+        store.prefetch_names = ['android-13.0']
+
+        store.prefetch()
+
+        assert store.snapshot()['prefetches'] == 1
+        store.create_overlay('vm-1', {'android_version': '13.0'})
+        assert store.snapshot()['hits'] == 1 and store.snapshot()['misses'] == 0
+
+
+class TestLaunchCoalescing:
+    def test_concurrent_launches_boot_one_vm(self, client, monkeypatch, tmp_path):
+        driver = FakeDriver(boot_seconds=0.05)
+        monkeypatch.setattr(orchestrator, 'hypervisor', driver)
+        monkeypatch.setattr(orchestrator, 'network', NetworkAllocator())
+        monkeypatch.setattr(orchestrator, 'vm_runtime', RuntimeDirectory(str(tmp_path)))
+        monkeypatch.setattr(orchestrator, 'active_vms', {})
+        monkeypatch.setattr(orchestrator, 'launch_flights', SingleFlight())
+        orchestrator.launch_scheduler.start()
+        barrier = threading.Barrier(100)
+        responses = []
+
+        def launch():
+            test_client = orchestrator.app.test_client()
+            barrier.wait()
+            responses.append(test_client.post('/launch', json={}, headers=auth()))
+
+        threads = [threading.Thread(target=launch) for _ in range(100)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        try:
+            vm_ids = {response.get_json()['vm_id'] for response in responses}
+            assert [response.status_code for response in responses] == [200] * 100
+            assert len(vm_ids) == 1
+            deadline = time.time() + 5
+            while orchestrator.vms_collection.find_one({'_id': ObjectId(vm_ids.pop())})['status'] != 'running':
+                assert time.time() < deadline
+                time.sleep(0.01)
+        finally:
+            orchestrator.launch_scheduler.shutdown()
+        assert orchestrator.vms_collection.count_documents({}) == 1
+        assert driver.stats['started'] == 1
+
+    def test_idempotency_key_replays_first_response(self, client):
+        headers = {**auth(), 'Idempotency-Key': 'retry-1'}
+        first = client.post('/launch', json={'ram': '4096M'}, headers=headers)
+        retried = client.post('/launch', json={'ram': '4096M'}, headers=headers)
+
+        assert retried.get_json() == first.get_json()
+        assert retried.headers['Idempotent-Replayed'] == 'true'
+        assert orchestrator.db.launch_queue.count_documents({}) == 1
+        assert client.post('/launch', json={'ram': '8192M'}, headers=headers).status_code == 422
+
+        # A key another worker is still processing is waited on, then refused
+        other_worker = IdempotencyStore(orchestrator.db.idempotency_keys)
+        assert other_worker.begin('user-1', 'retry-2', 'fingerprint') is None
+        store = IdempotencyStore(orchestrator.db.idempotency_keys, wait=0)
+        with pytest.raises(IdempotencyConflict) as conflict:
+            store.begin('user-1', 'retry-2', 'fingerprint')
+        assert conflict.value.status == 409
+
+
+class TestConditionalGet:
+    def insert_vm(self, status='running'):
+        return str(orchestrator.vms_collection.insert_one({
+            'user_id': 'user-1', 'config': dict(orchestrator.DEFAULT_VM_CONFIG), 'status': status,
+            'active': True, 'created_at': time.time(), 'updated_at': time.time(), 'version': 1,
+            'connection_info': {'ip': '10.0.0.2', 'port': 5555, 'oid': ObjectId()}
+        }).inserted_id)
+
+    def test_vm_poll_is_answered_from_memory_until_it_changes(self, client, monkeypatch):
+        vm_id = self.insert_vm()
+        first = client.get(f'/vm/{vm_id}', headers=auth())
+        etag = first.headers['ETag']
+        assert first.status_code == 200 and isinstance(first.get_json()['connection_info']['oid'], str)
+
+        collection = orchestrator.vm_cache.collection
+        monkeypatch.setattr(orchestrator.vm_cache, 'collection', None)  # any query would fail
+        unchanged = client.get(f'/vm/{vm_id}', headers={**auth(), 'If-None-Match': f'W/{etag}'})
+        assert unchanged.status_code == 304 and unchanged.headers['ETag'] == etag
+        # Another user's poll with a matching tag is still refused
+        assert client.get(f'/vm/{vm_id}', headers={**auth('user-2'), 'If-None-Match': etag}).status_code == 403
+
+        monkeypatch.setattr(orchestrator.vm_cache, 'collection', collection)
+        orchestrator.update_vm_status(vm_id, {'status': 'running', 'connection_info': {'ip': '10.0.0.3'}})
+        changed = client.get(f'/vm/{vm_id}', headers={**auth(), 'If-None-Match': etag})
+        assert changed.status_code == 200 and changed.headers['ETag'] != etag
+        assert changed.get_json()['connection_info'] == {'ip': '10.0.0.3'}
+
+    def test_vms_page_revalidates_without_a_query(self, client, monkeypatch):
+        vm_id = self.insert_vm()
+        first = client.get('/vms?limit=10', headers=auth())
+        etag = first.headers['ETag']
+        assert [vm['_id'] for vm in first.get_json()['vms']] == [vm_id]
+        assert 'version' not in first.get_json()['vms'][0]
+
+        collection = orchestrator.vms_collection
+        monkeypatch.setattr(orchestrator, 'vms_collection', None)
+        assert client.get('/vms?limit=10', headers={**auth(), 'If-None-Match': etag}).status_code == 304
+        monkeypatch.setattr(orchestrator, 'vms_collection', collection)
+
+        orchestrator.update_vm_status(vm_id, {'status': 'stopped'})
+        changed = client.get('/vms?limit=10', headers={**auth(), 'If-None-Match': etag})
+        assert changed.status_code == 200 and changed.headers['ETag'] != etag
+        assert changed.get_json()['vms'][0]['status'] == 'stopped'
+        # Same page computed by a query again yields the same strong ETag
+        orchestrator.vm_cache.invalidate_user('user-1')
+        again = client.get('/vms?limit=10', headers={**auth(), 'If-None-Match': changed.headers['ETag']})
+        assert again.status_code == 304
+
+
+
+class TestFleetSimulator:
+    TEMPLATES = [
+        {'id': 'large', 'cpu_cores': 4, 'memory_mb': 4096},
+        {'id': 'small', 'cpu_cores': 2, 'memory_mb': 2048, 'weight': 3}
+    ]
+    HOST = {'cpu_cores': 16, 'memory_mb': 16384}
+
+    def test_day_runs_in_virtual_time(self):
+        sessions = synthetic_trace(self.TEMPLATES, hours=24, sessions_per_hour=120, seed=1)
+        started = time.perf_counter()
+
+        report = simulate(self.TEMPLATES, sessions, host_capacity=self.HOST)
+
+        assert time.perf_counter() - started < 5
+        assert report['sessions'] == len(sessions) and report['simulated_seconds'] > 23 * 3600
+        assert report['hosts_needed'] >= 1 and 0 < report['utilization']['cpu'] <= 1
+        # Every launch boots cold: roughly one boot time each
+        latency = report['launch_latency_seconds']
+        assert 27 <= latency['p50'] <= latency['p95'] <= latency['p99'] <= 33
+
+    def test_warm_pool_and_too_few_hosts_show_in_latency(self):
+        sessions = synthetic_trace(self.TEMPLATES, hours=4, sessions_per_hour=120, seed=2)
+
+        cold = simulate(self.TEMPLATES, sessions, host_capacity=self.HOST)
+        warm = FleetSimulator(self.TEMPLATES, host_capacity=self.HOST, pool=AdaptivePool()).run(sessions)
+        short = simulate(self.TEMPLATES, sessions, host_capacity=self.HOST, hosts=1)
+
+        assert warm['warm_hit_rate'] > 0.5
+        assert warm['launch_latency_seconds']['p50'] < cold['launch_latency_seconds']['p50']
+        assert warm['utilization']['warm_memory'] > 0
+        assert short['capacity_waits'] > 0 and short['hosts_needed'] == 1
+        assert short['launch_latency_seconds']['p95'] > 10 * cold['launch_latency_seconds']['p95']
+
+    def test_suspending_idle_vms_needs_fewer_hosts(self):
+        sessions = [{'at': i * 10.0, 'template': 'small', 'active_seconds': 60, 'idle_seconds': 3600}
+                    for i in range(40)]
+
+        kept = simulate(self.TEMPLATES, sessions, host_capacity=self.HOST)
+        suspended = simulate(self.TEMPLATES, sessions, host_capacity=self.HOST, idle_after=60)
+
+        assert kept['hosts_needed'] == 5  # 40 VMs of 2 cores, 8 per host
+        assert suspended['hosts_needed'] < kept['hosts_needed'] and suspended['suspended'] == 40
+
+    def test_trace_from_vm_documents(self):
+        vms = [{'created_at': 1000.0, 'started_at': 1030.0, 'last_active_at': 1630.0, 'stopped_at': 2230.0,
+                'config': {'cpu_cores': 4, 'ram': '4096M'}},
+               {'created_at': 1500.0, 'config': {'cpu_cores': 2, 'ram': '2048M'}}]
+
+        assert trace_from_vm_documents(vms, self.TEMPLATES) == [
+            {'at': 0.0, 'template': 'large', 'active_seconds': 600.0, 'idle_seconds': 600.0}
+        ]
+
+
+def test_launch_uses_warm_vm(client):
+    orchestrator.vms_collection.insert_one({
+        'user_id': None, 'config': dict(orchestrator.DEFAULT_VM_CONFIG),
+        'pool_key': pool_key(orchestrator.DEFAULT_VM_CONFIG), 'status': 'warm',
+        'warmed_at': time.time(), 'connection_info': {'ip': '10.0.0.9'}
+    })
+
+    body = client.post('/launch', json={}, headers=auth()).get_json()
+
+    assert body['status'] == 'running'
+    assert body['connection_info'] == {'ip': '10.0.0.9'}
+    assert orchestrator.db.launch_queue.count_documents({}) == 0
+
+
+def test_launch_reports_queue_position(client):
+    response = client.post('/launch', json={}, headers=auth())
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['status'] == 'starting'
+    assert body['queue_position'] == 1
+    assert orchestrator.db.launch_queue.count_documents({'_id': body['vm_id']}) == 1
+
+
+class TestProductionServer:
+    def test_client_is_opened_on_first_use_and_again_after_fork(self):
+        factory = MongoClientFactory('mongodb://localhost:27017/avmo', mongomock.MongoClient)
+        db = LazyDatabase(factory)
+        vms = db.vms
+        assert not factory.connected()
+
+        vms.insert_one({'status': 'running'})
+        parent = factory.client()
+        assert factory.connected() and db['vms'] is vms and vms.name == 'vms'
+
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # The parent's client is not reused: a fresh one (here, an empty mongomock) is opened
+            try:
+                os.write(write_end, json.dumps([factory.connected(), vms.count_documents({}),
+                                                factory.client() is parent]).encode())
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        with os.fdopen(read_end) as f:
+            assert json.loads(f.read()) == [False, 0, False]
+        os.waitpid(pid, 0)
+        assert factory.client() is parent and vms.count_documents({}) == 1
+
+    def test_drain_lets_boot_in_flight_finish(self, client, monkeypatch):
+        monkeypatch.setattr(orchestrator, 'hypervisor', FakeDriver(boot_seconds=0.3))
+        monkeypatch.setattr(orchestrator, 'network', NetworkAllocator())
+        monkeypatch.setattr(orchestrator, 'active_vms', {})
+        for name in ('reconciler', 'idle_monitor', 'health_monitor', 'telemetry', 'node_reporter', 'stream_hub'):
+            monkeypatch.setattr(orchestrator, name, SimpleNamespace(shutdown=lambda: None))
+        monkeypatch.setattr(orchestrator.mongo_clients, 'close', lambda: None)
+        monkeypatch.setattr(orchestrator, 'sse_closing', threading.Event())
+        vm_id = str(orchestrator.vms_collection.insert_one({
+            'user_id': 'user-1', 'config': {}, 'status': 'starting', 'created_at': time.time()
+        }).inserted_id)
+        orchestrator.launch_scheduler.start()
+        orchestrator.launch_scheduler.submit(vm_id, 'user-1', dict(orchestrator.DEFAULT_VM_CONFIG))
+        deadline = time.time() + 5
+        while orchestrator.launch_scheduler.snapshot()['busy'] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        orchestrator.background_started.set()
+
+        orchestrator.drain(timeout=5)
+
+        assert orchestrator.vms_collection.find_one({'_id': ObjectId(vm_id)})['status'] == 'running'
+        assert orchestrator.launch_scheduler.snapshot()['busy'] == 0
+
+
+class TestAsyncServer:
+    @pytest.fixture
+    def async_client(self, client, monkeypatch):
+        monkeypatch.setattr(async_orchestrator, 'AsyncIOMotorClient',
+                            lambda uri, **kwargs: mongomock_motor.AsyncMongoMockClient(
+                                mock_mongo_client=orchestrator.mongo_clients.client()))
+        monkeypatch.setattr(orchestrator, 'start_background_services', lambda: None)
+        monkeypatch.setattr(orchestrator, 'drain', lambda timeout=None: None)
+        with TestClient(async_orchestrator.app) as test_client:
+            yield test_client
+
+    def test_launch_returns_job(self, async_client):
+        response = async_client.post('/launch', json={}, headers=auth())
+
+        assert response.status_code == 202
+        body = response.json()
+        assert body['queue_position'] == 1
+        job = async_client.get(f"/jobs/{body['job_id']}", headers=auth()).json()
+        assert (job['type'], job['state'], job['vm_id']) == ('launch', 'pending', body['vm_id'])
+
+        orchestrator.start_vm_process(body['vm_id'], dict(orchestrator.DEFAULT_VM_CONFIG))
+        job = async_client.get(f"/jobs/{body['job_id']}", headers=auth()).json()
+        assert job['state'] == 'succeeded'
+        assert async_client.get(f"/jobs/{body['job_id']}", headers=auth('user-2')).status_code == 403
+
+    def test_stop_runs_in_background(self, async_client):
+        vm_id = str(orchestrator.vms_collection.insert_one({
+            'user_id': 'user-1', 'config': {}, 'status': 'running', 'connection_info': {}
+        }).inserted_id)
+
+        response = async_client.post(f'/vm/{vm_id}/stop', headers=auth())
+
+        assert response.status_code == 202
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            job = async_client.get(f"/jobs/{response.json()['job_id']}", headers=auth()).json()
+            if job['state'] != 'pending':
+                break
+            time.sleep(0.01)
+        assert job['state'] == 'succeeded'
+        assert async_client.get(f'/vm/{vm_id}', headers=auth()).json()['status'] == 'stopped'
+
+    def test_metrics_record_async_routes(self, async_client):
+        async_client.get('/health')
+
+        text = async_client.get('/metrics').text
+
+        assert 'http_request_duration_seconds_count{route="health_check",method="GET",status="200"}' in text
+        assert 'thread_pool_workers{pool="async_blocking"}' in text
+
+    def test_serves_every_flask_route(self, async_client):
+        flask_routes = {(rule.rule.replace('<', '{').replace('>', '}'), method)
+                        for rule in orchestrator.app.url_map.iter_rules() if rule.endpoint != 'static'
+                        for method in rule.methods - {'HEAD', 'OPTIONS'}}
+        async_routes = {(route.path, method) for route in async_orchestrator.routes
+                        for method in route.methods - {'HEAD'}}
+
+        assert flask_routes - async_routes == set()
+        assert async_client.get('/nodes', headers=auth()).status_code == 403
+        assert async_client.get('/vms/events', params={'vm_id': str(ObjectId())}, headers=auth()).status_code == 403
+        assert async_client.get('/vms/events').status_code == 401
+        assert async_client.get('/vms/idle/stats', headers=auth()).json() == orchestrator.idle_monitor.snapshot()
+
+    def test_token_cache_misses_resolve_off_the_loop(self, async_client, monkeypatch):
+        threads = []
+        resolve_user = orchestrator.resolve_user
+        monkeypatch.setattr(orchestrator, 'resolve_user',
+                            lambda header: threads.append(threading.current_thread().name) or resolve_user(header))
+        headers = auth('user-loop')
+
+        assert async_client.get('/vms/idle/stats', headers=headers).status_code == 200
+        assert async_client.get('/vms/idle/stats', headers=headers).status_code == 200
+        assert async_client.get('/vms/idle/stats').status_code == 401
+
+        assert len(threads) == 2  # the second request was a cache hit
+        assert all(name.startswith('orchestrator-blocking') for name in threads)
@@ -0,0 +1,264 @@
+import logging
+import threading
+import time
+
+from bson.objectid import ObjectId
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+class VMStateCache:
+    """Read-through cache of VM documents indexed by _id and by user_id.
+
+    Every orchestrator worker keeps its own copy and follows the vms
+    collection's change stream, so a write made by any worker reaches all of
+    them. Standalone mongod has no change streams; there the cache polls for
+    documents with a newer `updated_at` instead, and entries also expire
+    after `max_staleness` because deletes are invisible to polling. Local
+    write paths call invalidate() so their own reads never lag.
+
+    `listeners` are called with every changed document the cache observes,
+    from whichever worker wrote it. `listing_generation(user_id)` changes
+    whenever a change to one of the user's VMs is observed, so a response
+    derived from the user's listing can be reused until it does.
+    """
+
+    def __init__(self, collection, poll_interval=1.0, max_staleness=30.0, max_entries=100000):
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.max_staleness = max_staleness
+        self.max_entries = max_entries
+        self.mode = None  # 'change_stream' or 'polling' once started
+
+        self._lock = threading.RLock()
+        self._docs = {}          # vm_id -> (doc, cached_at)
+        self._users = {}         # user_id -> set of vm_ids, only for fully loaded users
+        self._generations = {}   # user_id -> count of changes observed to the user's VMs
+        self._generation = 0     # changes whose user is unknown
+        self._stopping = threading.Event()
+        self._thread = None
+        self.listeners = []
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'events': 0}
+
+    # Reads
+
+    def get(self, vm_id):
+        """VM document by id, from memory when possible; None if it does not exist"""
+        doc = self.peek(vm_id)
+        if doc is not None:
+            return doc
+        with self._lock:
+            self.stats['misses'] += 1
+        doc = self.collection.find_one({'_id': ObjectId(vm_id)})
+        if doc is not None:
+            self.store(doc)
+        return dict(doc) if doc else None
+
+    def peek(self, vm_id):
+        """Cached copy of a VM document without touching Mongo"""
+        with self._lock:
+            entry = self._docs.get(vm_id)
+            if entry is None or not self._fresh(entry):
+                return None
+            self.stats['hits'] += 1
+            return dict(entry[0])
+
+    def list_for_user(self, user_id, status=None):
+        with self._lock:
+            vm_ids = self._users.get(user_id)
+            if vm_ids is not None and all(v in self._docs and self._fresh(self._docs[v]) for v in vm_ids):
+                self.stats['hits'] += 1
+                docs = [dict(self._docs[v][0]) for v in vm_ids]
+            else:
+                docs = None
+        if docs is None:
+            with self._lock:
+                self.stats['misses'] += 1
+            docs = list(self.collection.find({'user_id': user_id}))
+            self.store_user(user_id, docs)
+            docs = [dict(doc) for doc in docs]
+        if status:
+            docs = [doc for doc in docs if doc.get('status') == status]
+        return sorted(docs, key=lambda doc: doc.get('created_at') or 0)
+
+    def listing_generation(self, user_id):
+        with self._lock:
+            return self._generation, self._generations.get(user_id, 0)
+
+    def _changed(self, user_id):
+        with self._lock:
+            if user_id is None:
+                self._generation += 1
+            else:
+                self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def _fresh(self, entry):
+        return self.mode == 'change_stream' or time.time() - entry[1] < self.max_staleness
+
+    # Writes
+
+    def store(self, doc):
+        vm_id = str(doc['_id'])
+        with self._lock:
+            current = self._docs.get(vm_id)
+            if current and _age(current[0]) > _age(doc):
+                # A change event already delivered a newer version
+                return
+            if current and current[0].get('user_id') != doc.get('user_id'):
+                self._users.pop(current[0].get('user_id'), None)
+            self._docs[vm_id] = (doc, time.time())
+            user_ids = self._users.get(doc.get('user_id'))
+            if user_ids is not None:
+                user_ids.add(vm_id)
+            self._evict()
+
+    def store_user(self, user_id, docs):
+        with self._lock:
+            for doc in docs:
+                self.store(doc)
+            self._users[user_id] = {str(doc['_id']) for doc in docs}
+
+    def invalidate(self, vm_id, user_id=None):
+        with self._lock:
+            entry = self._docs.pop(str(vm_id), None)
+            if entry:
+                # The user's listing may now be missing a status change or a new VM
+                user_id = entry[0].get('user_id')
+                self._users.pop(user_id, None)
+            self._changed(user_id)
+            self.stats['invalidations'] += 1
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._changed(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._docs.clear()
+            self._users.clear()
+            self._changed(None)
+
+    def _evict(self):
+        while len(self._docs) > self.max_entries:
+            vm_id = next(iter(self._docs))
+            self.invalidate(vm_id)
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'mode': self.mode,
+                'entries': len(self._docs),
+                'users': len(self._users),
+                'hit_rate': round(self.stats['hits'] / lookups, 4) if lookups else None
+            }
+
+    # Coherence
+
+    def start(self):
+        if self._thread:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._follow, name='vm-cache-watcher', daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self._thread = None
+
+    def _follow(self):
+        resume_token = None
+        opened = False
+        while not self._stopping.is_set():
+            try:
+                with self.collection.watch(full_document='updateLookup', resume_after=resume_token,
+                                           max_await_time_ms=1000) as stream:
+                    # Anything cached before the stream opened may have missed events
+                    self.clear()
+                    self.mode = 'change_stream'
+                    if not opened:
+                        opened = True
+                        logger.info('VM cache following the vms change stream')
+                    while not self._stopping.is_set():
+                        change = stream.try_next()
+                        if change is None:
+                            continue
+                        resume_token = stream.resume_token
+                        self._apply(change)
+            except Exception as e:
+                if not opened:
+                    # Standalone mongod (and test doubles) cannot open change streams
+                    logger.info(f"Change streams unavailable ({e}); VM cache falling back to polling")
+                    self._poll()
+                    return
+                logger.error(f"VM cache change stream interrupted: {e}")
+                # Until the stream is back, entries expire after max_staleness
+                self.mode = None
+                resume_token = None
+                self.clear()
+                self._stopping.wait(self.poll_interval)
+
+    def _apply(self, change):
+        with self._lock:
+            self.stats['events'] += 1
+        operation = change['operationType']
+        if operation in ('insert', 'update', 'replace'):
+            doc = change.get('fullDocument')
+            if doc is None:
+                self.invalidate(change['documentKey']['_id'])
+            else:
+                # Also adds a brand new VM to its owner's listing, if that is loaded
+                self.store(doc)
+                self._changed(doc.get('user_id'))
+                self._notify(doc)
+        elif operation == 'delete':
+            self.invalidate(change['documentKey']['_id'])
+        else:
+            # drop, rename, invalidate
+            self.clear()
+
+    def _notify(self, doc):
+        for listener in self.listeners:
+            try:
+                listener(doc)
+            except Exception as e:
+                logger.error(f"VM cache listener failed: {e}")
+
+    def _poll(self):
+        self.mode = 'polling'
+        since = time.time()
+        seen = {}  # _id -> _age of each document in the last window
+        while not self._stopping.wait(self.poll_interval):
+            try:
+                # Overlap the window so writers with slightly skewed clocks are not missed
+                changed = list(self.collection.find({'updated_at': {'$gt': since - 2.0}}))
+            except PyMongoError as e:
+                logger.error(f"VM cache poll failed: {e}")
+                continue
+            # The overlap returns documents again until they age out of it; only a newer version is a change.
+            # Anything outside the window can only come back with a newer version, so it is not remembered.
+            previous, seen = seen, {doc['_id']: max(_age(doc), seen.get(doc['_id'], (0, 0))) for doc in changed}
+            for doc in changed:
+                if doc['_id'] in previous and _age(doc) <= previous[doc['_id']]:
+                    continue
+                with self._lock:
+                    self.stats['events'] += 1
+                    cached = self._docs.get(str(doc['_id']))
+                if cached is None:
+                    # Unknown to us, but a listing that should include it must reload
+                    self.invalidate_user(doc.get('user_id'))
+                else:
+                    self.store(doc)
+                    self.invalidate_user(doc.get('user_id'))
+                self._notify(doc)
+                since = max(since, doc.get('updated_at') or since)
+
+
+def _age(doc):
+    # Documents carry a version counter bumped by every write; older ones only updated_at
+    return doc.get('version') or 0, doc.get('updated_at') or 0
@@ -0,0 +1,227 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# Fields of vm_config that must match for a pre-booted VM to be handed out
+POOL_KEY_FIELDS = ('android_version', 'ram', 'resolution', 'cpu_cores')
+
+
+def pool_key(config):
+    return '|'.join(str(config.get(field)) for field in POOL_KEY_FIELDS)
+
+
+class WarmPool:
+    """Keeps pre-booted VMs per config tuple so /launch can skip the cold boot.
+
+    Warm VMs are ordinary documents in the vms collection with status 'warm'
+    and no owner; handing one out is a single find_one_and_update, so it is
+    atomic across orchestrator workers. Pool sizes follow observed arrival
+    rates: enough VMs to cover the launches expected while one replacement
+    boots.
+
+    `place(config)`, when given, reserves host capacity for a VM about to be
+    warmed and returns fields recording where (stored on its document), or
+    None when the host is full; `release(vm_id)` returns it if warming fails.
+    """
+
+    def __init__(self, collection, boot, seed_configs=(), min_size=0, max_size=10,
+                 boot_estimate=10.0, rate_window=300.0, headroom=1.5,
+                 concurrency=1, interval=5.0, place=None, release=None):
+        self.collection = collection
+        self.boot = boot
+        self.place = place
+        self.release = release
+        self.min_size = min_size
+        self.max_size = max_size
+        self.rate_window = rate_window
+        self.headroom = headroom
+        self.concurrency = concurrency
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._select_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._boot_estimate = boot_estimate
+        self._configs = {}   # pool key -> vm_config used for warm boots
+        self._seeded = set()
+        self._arrivals = {}  # pool key -> deque of launch timestamps
+        self._counters = {}  # pool key -> {'hits': n, 'misses': n}
+        self._booting = 0
+        self._threads = []
+
+        for config in seed_configs:
+            key = pool_key(config)
+            self._configs[key] = dict(config)
+            self._seeded.add(key)
+
+    def acquire(self, user_id, config):
+        """Assign a warm VM to the user, or return None on a pool miss"""
+        key = pool_key(config)
+        now = time.time()
+        try:
+            vm = self.collection.find_one_and_update(
+                {'status': 'warm', 'pool_key': key},
+                {'$set': {
+                    'user_id': user_id,
+                    'status': 'running',
+                    'active': True,
+                    'assigned_at': now,
+                    'started_at': now,
+                    'updated_at': now
+                }, '$inc': {'version': 1}},
+                sort=[('warmed_at', 1)],
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The user already has an active VM; the warm one stays in the pool
+            return None
+
+        with self._lock:
+            self._configs.setdefault(key, dict(config))
+            self._arrivals.setdefault(key, deque()).append(now)
+            counters = self._counters.setdefault(key, {'hits': 0, 'misses': 0})
+            counters['hits' if vm else 'misses'] += 1
+        # Replace what we just handed out (or start warming a new config)
+        self._wake.set()
+        return vm
+
+    def target_size(self, key, now=None):
+        """Little's law: launches expected per boot time, with headroom"""
+        now = now or time.time()
+        with self._lock:
+            arrivals = self._arrivals.get(key, ())
+            while arrivals and arrivals[0] < now - self.rate_window:
+                arrivals.popleft()
+            rate = len(arrivals) / self.rate_window
+            boot_estimate = self._boot_estimate
+            floor = self.min_size if key in self._seeded else 0
+        return max(floor, min(self.max_size, math.ceil(rate * boot_estimate * self.headroom)))
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            keys = list(self._configs)
+            counters = {key: dict(self._counters.get(key, {'hits': 0, 'misses': 0})) for key in keys}
+            booting = self._booting
+        pools = {}
+        for key in keys:
+            pools[key] = {
+                **counters[key],
+                'warm': self.collection.count_documents({'status': 'warm', 'pool_key': key}),
+                'target': self.target_size(key, now)
+            }
+        hits = sum(p['hits'] for p in pools.values())
+        misses = sum(p['misses'] for p in pools.values())
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+            'booting': booting,
+            'boot_estimate_seconds': round(self._boot_estimate, 2),
+            'pools': pools
+        }
+
+    # Background replenishment
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopping.clear()
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._replenish_loop, name=f"warm-pool-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def shutdown(self, wait=True, timeout=None):
+        """Stop replenishing; boots in progress finish (within `timeout`) and join the pool"""
+        self._stopping.set()
+        self._wake.set()
+        if wait:
+            deadline = None if timeout is None else time.time() + timeout
+            for thread in self._threads:
+                thread.join(None if deadline is None else max(0, deadline - time.time()))
+        self._threads = []
+
+    def _replenish_loop(self):
+        while not self._stopping.is_set():
+            # Choosing a config and reserving its document happen together so
+            # concurrent replenishers never both fill the same slot
+            with self._select_lock:
+                key = self._next_deficit()
+                reserved = self._reserve(key) if key else None
+            if reserved is None:
+                self._wake.wait(self.interval)
+                self._wake.clear()
+                continue
+            self._warm_one(key, *reserved)
+
+    def _next_deficit(self):
+        """Pick the config furthest below its target size"""
+        worst, worst_gap = None, 0
+        stale_before = time.time() - 5 * self._boot_estimate
+        for key in list(self._configs):
+            available = self.collection.count_documents({
+                'pool_key': key,
+                '$or': [
+                    {'status': 'warm'},
+                    {'status': 'warming', 'created_at': {'$gte': stale_before}}
+                ]
+            })
+            gap = self.target_size(key) - available
+            if gap > worst_gap:
+                worst, worst_gap = key, gap
+        return worst
+
+    def _reserve(self, key):
+        with self._lock:
+            config = self._configs[key]
+        placement = self.place(config) if self.place else {}
+        if placement is None:
+            return None
+        with self._lock:
+            self._booting += 1
+        result = self.collection.insert_one({
+            'user_id': None,
+            'config': config,
+            'pool_key': key,
+            'status': 'warming',
+            'created_at': time.time(),
+            'updated_at': time.time(),
+            'version': 1,
+            'connection_info': None,
+            **placement
+        })
+        return result.inserted_id, config
+
+    def _warm_one(self, key, oid, config):
+        vm_id = str(oid)
+        started = time.time()
+        try:
+            connection_info = self.boot(vm_id, config)
+            self.collection.update_one(
+                {'_id': oid, 'status': 'warming'},
+                {'$set': {'status': 'warm', 'connection_info': connection_info,
+                          'warmed_at': time.time(), 'updated_at': time.time()},
+                 '$inc': {'version': 1}}
+            )
+            logger.info(f"Warm VM {vm_id} ready for pool {key}")
+        except Exception as e:
+            logger.error(f"Error warming VM {vm_id} for pool {key}: {e}")
+            self.collection.update_one(
+                {'_id': oid},
+                {'$set': {'status': 'error', 'error': str(e), 'updated_at': time.time()}, '$inc': {'version': 1}}
+            )
+            if self.release:
+                self.release(vm_id)
+        finally:
+            with self._lock:
+                self._booting -= 1
+                self._boot_estimate = 0.8 * self._boot_estimate + 0.2 * (time.time() - started)
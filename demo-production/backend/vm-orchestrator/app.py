@@ -1,11 +1,15 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import os
 import json
 import time
+import hashlib
+import threading
 import jwt
-from pymongo import MongoClient
+import orjson
+from pymongo import MongoClient, IndexModel, ReturnDocument
 from bson.objectid import ObjectId
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 # Initialize Flask app
@@ -19,6 +23,22 @@ db = mongo_client.get_database()
 # JWT secret
 jwt_secret = os.environ.get('JWT_SECRET', 'demo-jwt-secret-key-for-testing-only')
 
+# Owner of the seeded demo VMs, which every user can see
+DEMO_OWNER = 'demo_user'
+
+# Simulated lifecycle transitions run here instead of inside request handlers
+lifecycle_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('LIFECYCLE_WORKERS', 8)))
+# How long a simulated start or stop takes (creation takes twice as long)
+TRANSITION_SECONDS = float(os.environ.get('SIMULATED_TRANSITION_SECONDS', 1))
+
+# Every VM write goes through this process, so it knows each VM's current
+# version and whether any listing changed, and answers conditional GETs
+# without a query. BOOT_ID keeps listing ETags from a previous run invalid.
+BOOT_ID = uuid.uuid4().hex[:8]
+versions_lock = threading.Lock()
+vm_versions = {}        # vm id -> version of its document
+listing_generation = [0]
+
 # Helper functions
 def authenticate():
     """Authenticate a request using JWT"""
@@ -34,12 +54,88 @@ def authenticate():
         print(f"Auth error: {e}")
         return None
 
+def json_response(body, status=200, etag=None):
+    """orjson-encoded response; a request already holding `etag` gets a 304 instead"""
+    if etag and etag_matches(request.headers.get('If-None-Match'), etag):
+        return Response(status=304, headers={'ETag': etag})
+    response = Response(orjson.dumps(body), status, content_type='application/json')
+    if etag:
+        response.headers['ETag'] = etag
+    return response
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+def vm_etag(vm_id, version):
+    return f'"{vm_id}.{version or 0}"'
+
+def listing_etag(user_id):
+    with versions_lock:
+        generation = listing_generation[0]
+    digest = hashlib.sha1(f"{user_id}|{BOOT_ID}|{generation}".encode()).hexdigest()[:32]
+    return f'"{digest}"'
+
+def record_version(vm_id, version, changed=False):
+    with versions_lock:
+        vm_versions[vm_id] = version or 0
+        if changed:
+            listing_generation[0] += 1
+
+def update_vm(query, fields):
+    """Apply a lifecycle write, bumping the VM's version; None when nothing matched"""
+    vm = db.vms.find_one_and_update(
+        query,
+        {'$set': fields, '$inc': {'version': 1}},
+        projection={'_id': False, 'id': True, 'version': True},
+        return_document=ReturnDocument.AFTER
+    )
+    if vm:
+        record_version(vm.get('id'), vm['version'], changed=True)
+    return vm
+
+def submit_job(job_type, vm_id, transition):
+    """Record a lifecycle job and run its transition in the background"""
+    job_id = str(uuid.uuid4())
+    db.jobs.insert_one({
+        'id': job_id,
+        'type': job_type,
+        'vmId': vm_id,
+        'state': 'pending',
+        'created': datetime.utcnow().isoformat()
+    })
+
+    def run():
+        try:
+            transition()
+            db.jobs.update_one({'id': job_id}, {'$set': {
+                'state': 'succeeded', 'finished': datetime.utcnow().isoformat()
+            }})
+        except Exception as e:
+            print(f"Job {job_id} failed: {e}")
+            db.jobs.update_one({'id': job_id}, {'$set': {
+                'state': 'failed', 'error': str(e), 'finished': datetime.utcnow().isoformat()
+            }})
+
+    lifecycle_executor.submit(run)
+    return job_id
+
 # Create indexes and demo data
 def init_db():
     """Initialize database with indexes and demo data"""
-    # Create indexes
-    db.vms.create_index("userId")
-    db.vms.create_index("status")
+    # Create indexes; the compound ones replace the old single-field userId/status indexes
+    for name in ('userId_1', 'status_1'):
+        if name in db.vms.index_information():
+            db.vms.drop_index(name)
+    db.vms.create_indexes([
+        IndexModel([('userId', 1), ('created', -1)], name='user_created'),
+        IndexModel([('userId', 1), ('status', 1)], name='user_status'),
+        IndexModel([('id', 1)], name='vm_id', unique=True, sparse=True)
+    ])
+    db.jobs.create_index("id", unique=True)
     
     # Add demo VM if none exists
     if db.vms.count_documents({}) == 0:
@@ -53,13 +149,14 @@ def init_db():
                 "created": datetime.utcnow().isoformat(),
                 "lastActive": datetime.utcnow().isoformat(),
                 "ipAddress": "10.0.0.5",
-                "userId": "demo_user",
+                "userId": DEMO_OWNER,
                 "specs": {
                     "cpu": 2,
                     "memory": "4GB",
                     "storage": "16GB"
                 },
-                "apps": ["com.shaydz.securebrowser", "com.shaydz.securemail"]
+                "apps": ["com.shaydz.securebrowser", "com.shaydz.securemail"],
+                "version": 1
             },
             {
                 "name": "Android 12 VM",
@@ -70,13 +167,14 @@ def init_db():
                 "created": (datetime.utcnow() - timedelta(days=30)).isoformat(),
                 "lastActive": (datetime.utcnow() - timedelta(days=5)).isoformat(),
                 "ipAddress": "10.0.0.6",
-                "userId": "demo_user",
+                "userId": DEMO_OWNER,
                 "specs": {
                     "cpu": 1,
                     "memory": "2GB",
                     "storage": "8GB"
                 },
-                "apps": ["com.shaydz.securebrowser"]
+                "apps": ["com.shaydz.securebrowser"],
+                "version": 1
             }
         ]
         db.vms.insert_many(demo_vms)
@@ -93,9 +191,17 @@ def get_vms():
     if not user:
         return jsonify({'message': 'Unauthorized'}), 401
     
-    # For demo purposes, always return all VMs
-    vms = list(db.vms.find({}, {'_id': False}))
-    return jsonify(vms)
+    # Computed before the query, so a write racing it changes the next ETag
+    etag = listing_etag(user.get('id'))
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return Response(status=304, headers={'ETag': etag})
+    
+    # The seeded demo VMs are shared; everything else belongs to its creator.
+    # Newest first, served by the user_created index
+    vms = list(db.vms.find(
+        {'userId': {'$in': [user.get('id'), DEMO_OWNER]}}, {'_id': False}
+    ).sort('created', -1))
+    return json_response(vms, etag=etag)
 
 @app.route('/vms/<vm_id>', methods=['GET'])
 def get_vm(vm_id):
@@ -103,11 +209,17 @@ def get_vm(vm_id):
     if not user:
         return jsonify({'message': 'Unauthorized'}), 401
     
+    with versions_lock:
+        known = vm_versions.get(vm_id)
+    if known is not None and etag_matches(request.headers.get('If-None-Match'), vm_etag(vm_id, known)):
+        return Response(status=304, headers={'ETag': vm_etag(vm_id, known)})
+    
     vm = db.vms.find_one({'id': vm_id}, {'_id': False})
     if not vm:
         return jsonify({'message': 'VM not found'}), 404
     
-    return jsonify(vm)
+    record_version(vm_id, vm.get('version'))
+    return json_response(vm, etag=vm_etag(vm_id, vm.get('version')))
 
 @app.route('/vms/<vm_id>/start', methods=['POST'])
 def start_vm(vm_id):
@@ -115,30 +227,23 @@ def start_vm(vm_id):
     if not user:
         return jsonify({'message': 'Unauthorized'}), 401
     
-    # Simulate starting a VM with delay
-    time.sleep(1)
-    
-    result = db.vms.update_one(
-        {'id': vm_id},
-        {'$set': {'status': 'STARTING'}}
-    )
-    
-    if result.matched_count == 0:
+    if not update_vm({'id': vm_id}, {'status': 'STARTING'}):
         return jsonify({'message': 'VM not found'}), 404
     
-    # Simulate VM startup process
-    time.sleep(1)
-    
-    db.vms.update_one(
-        {'id': vm_id},
-        {'$set': {
-            'status': 'RUNNING', 
-            'lastActive': datetime.utcnow().isoformat(),
-            'ipAddress': f'10.0.0.{int(time.time()) % 255}'
-        }}
-    )
+    def finish_start():
+        # Simulate VM startup process
+        time.sleep(TRANSITION_SECONDS)
+        update_vm(
+            {'id': vm_id, 'status': 'STARTING'},
+            {
+                'status': 'RUNNING', 
+                'lastActive': datetime.utcnow().isoformat(),
+                'ipAddress': f'10.0.0.{int(time.time()) % 255}'
+            }
+        )
     
-    return jsonify({'message': 'VM started successfully'})
+    job_id = submit_job('start', vm_id, finish_start)
+    return jsonify({'message': 'VM is starting', 'jobId': job_id}), 202
 
 @app.route('/vms/<vm_id>/stop', methods=['POST'])
 def stop_vm(vm_id):
@@ -146,29 +251,34 @@ def stop_vm(vm_id):
     if not user:
         return jsonify({'message': 'Unauthorized'}), 401
     
-    # Simulate stopping a VM with delay
-    time.sleep(1)
-    
-    result = db.vms.update_one(
-        {'id': vm_id},
-        {'$set': {'status': 'STOPPING'}}
-    )
-    
-    if result.matched_count == 0:
+    if not update_vm({'id': vm_id}, {'status': 'STOPPING'}):
         return jsonify({'message': 'VM not found'}), 404
     
-    # Simulate VM shutdown process
-    time.sleep(1)
+    def finish_stop():
+        # Simulate VM shutdown process
+        time.sleep(TRANSITION_SECONDS)
+        update_vm(
+            {'id': vm_id, 'status': 'STOPPING'},
+            {
+                'status': 'STOPPED', 
+                'lastActive': datetime.utcnow().isoformat()
+            }
+        )
     
-    db.vms.update_one(
-        {'id': vm_id},
-        {'$set': {
-            'status': 'STOPPED', 
-            'lastActive': datetime.utcnow().isoformat()
-        }}
-    )
+    job_id = submit_job('stop', vm_id, finish_stop)
+    return jsonify({'message': 'VM is stopping', 'jobId': job_id}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    user = authenticate()
+    if not user:
+        return jsonify({'message': 'Unauthorized'}), 401
     
-    return jsonify({'message': 'VM stopped successfully'})
+    job = db.jobs.find_one({'id': job_id}, {'_id': False})
+    if not job:
+        return jsonify({'message': 'Job not found'}), 404
+    
+    return jsonify(job)
 
 @app.route('/vms/<vm_id>/connect', methods=['GET'])
 def connect_vm(vm_id):
@@ -223,26 +333,28 @@ def create_vm():
             'memory': data.get('memory', '2GB'),
             'storage': data.get('storage', '8GB')
         },
-        'apps': []
+        'apps': [],
+        'version': 1
     }
     
     db.vms.insert_one(vm)
+    record_version(vm_id, 1, changed=True)
     
-    # Simulate VM creation process
-    time.sleep(2)
-    
-    # Update status
-    db.vms.update_one(
-        {'id': vm_id},
-        {'$set': {
-            'status': 'STOPPED',
-            'ipAddress': f'10.0.0.{int(time.time()) % 255}'
-        }}
-    )
+    def finish_create():
+        # Simulate VM creation process
+        time.sleep(2 * TRANSITION_SECONDS)
+        update_vm(
+            {'id': vm_id},
+            {
+                'status': 'STOPPED',
+                'ipAddress': f'10.0.0.{int(time.time()) % 255}'
+            }
+        )
     
-    # Return the created VM
-    vm = db.vms.find_one({'id': vm_id}, {'_id': False})
-    return jsonify(vm), 201
+    # Return the VM as created so far; the job reports when provisioning ends
+    vm.pop('_id', None)
+    vm['jobId'] = submit_job('create', vm_id, finish_create)
+    return jsonify(vm), 202
 
 # Initialize database and start server
 if __name__ == '__main__':